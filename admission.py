@@ -0,0 +1,260 @@
+"""Admission control for requests that create Checkout Sessions.
+
+Two limits protect the account's Stripe rate limit, so a spike or a bot
+can't use it up and leave real customers' checkouts failing:
+
+- each client (by address) has a token bucket of ``rate`` checkouts per
+  second with bursts of ``burst``; past it the request gets 429
+- at most ``max_in_flight`` admitted requests run at once on the node;
+  past that the request gets 503
+
+Either way the request is refused at once with a ``Retry-After`` instead
+of queueing until it times out. ``rate`` or ``max_in_flight`` of 0
+turns that limit off.
+
+The limits hold for every worker on the host. Their state lives in a
+memory-mapped file that all workers map and update under an ``fcntl``
+lock. The file holds a header, one slot per worker process
+(``pid, in flight``) and a fixed table of client buckets (``key hash,
+tokens, updated``), with clients hashed into it. Two clients that share a
+slot replace each other's bucket, so a bucket can restart full; this is
+generous, never stricter. A worker that died with requests in flight is
+detected by its PID and its count reclaimed when the limit is reached.
+Without ``path`` the table is an unlinked temporary file, which is shared
+only with workers forked after it was created (``serve.py`` with
+preloading).
+"""
+import contextlib
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import weakref
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not POSIX
+    fcntl = None
+
+ADMISSION_REJECTIONS = metrics.counter(
+    "admission_rejections",
+    "Checkout requests refused by admission control, by reason (rate_limited or overloaded).",
+    ["reason"],
+)
+
+# Every live instance, so forked children find their own worker slot
+_instances = weakref.WeakSet()
+
+
+class Rejected(Exception):
+    """A request refused by admission control; ``status`` and ``retry_after`` shape the response."""
+
+    status = 503
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimited(Rejected):
+    status = 429
+
+
+class Overloaded(Rejected):
+    status = 503
+
+
+def forwarded_client(value, trusted_hops=1):
+    """The client address in a comma-separated forwarding header such as ``X-Forwarded-For``.
+
+    Each proxy appends the address it received the request from, so only
+    entries added by our own ``trusted_hops`` proxies can be believed; the
+    leftmost is whatever the client sent. With one proxy that is the
+    rightmost entry.
+    """
+    entries = [entry.strip() for entry in value.split(",") if entry.strip()]
+    if not entries:
+        return None
+    return entries[-min(trusted_hops, len(entries))]
+
+
+class Admission:
+    """Per-client token buckets and a node-wide limit on admitted requests in flight.
+
+    Wrap the work in ``with admission.admit(client):``; it raises
+    ``RateLimited`` or ``Overloaded`` instead of entering.
+    """
+
+    MAGIC = b"admit-v2"  # v1 stored monotonic times
+    _HEADER = struct.Struct("8sqq")   # magic, worker slots, client slots
+    _WORKER = struct.Struct("qq")     # pid, requests in flight
+    _CLIENT = struct.Struct("Qdd")    # key hash, tokens, updated (time.time)
+
+    def __init__(self, path=None, rate=1.0, burst=10, max_in_flight=20, worker_slots=256,
+                 client_slots=4096):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.worker_slots = worker_slots
+        self.client_slots = client_slots
+        self._workers_offset = self._HEADER.size
+        self._clients_offset = self._workers_offset + worker_slots * self._WORKER.size
+        self._size = self._clients_offset + client_slots * self._CLIENT.size
+        self._workers = struct.Struct(f"{2 * worker_slots}q")
+
+        self._lock = threading.Lock()
+        self._slot = None
+        self._stats = {"admitted": 0, "rate_limited": 0, "overloaded": 0}
+        if path:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._file = open(path, "a+b")
+        else:
+            self._file = tempfile.TemporaryFile()
+        with self._locked():
+            if os.fstat(self._file.fileno()).st_size < self._size:
+                self._file.truncate(self._size)
+            self._map = mmap.mmap(self._file.fileno(), self._size)
+            if self._HEADER.unpack_from(self._map, 0) != (self.MAGIC, worker_slots, client_slots):
+                # A new file, or one laid out for other slot counts
+                self._map[:] = bytes(self._size)
+                self._HEADER.pack_into(self._map, 0, self.MAGIC, worker_slots, client_slots)
+        _instances.add(self)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def client_key(client):
+        # Stable across processes, unlike hash(); 0 marks an empty slot
+        digest = hashlib.blake2b(client.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    @contextlib.contextmanager
+    def admit(self, client):
+        """Run the block as one admitted request for ``client``, or raise ``Rejected``."""
+        self.acquire(client)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, client):
+        """Take a token from ``client``'s bucket and a place among the requests in flight."""
+        key = self.client_key(client)
+        # Wall time: the file can outlive a reboot, which restarts the monotonic clock
+        now = time.time()
+        with self._locked():
+            if self.rate > 0:
+                position, tokens = self._bucket(key, now)
+                if tokens < 1:
+                    self._stats["rate_limited"] += 1
+                    ADMISSION_REJECTIONS.inc(reason="rate_limited")
+                    raise RateLimited("Too many checkout requests", (1 - tokens) / self.rate)
+            slot = self._worker_slot()
+            if self.max_in_flight > 0 and self._in_flight() >= self.max_in_flight:
+                if not self._reclaim() or self._in_flight() >= self.max_in_flight:
+                    self._stats["overloaded"] += 1
+                    ADMISSION_REJECTIONS.inc(reason="overloaded")
+                    raise Overloaded("Too many checkouts in progress", 1.0)
+            if self.rate > 0:
+                self._CLIENT.pack_into(self._map, position, key, tokens - 1, now)
+            offset = self._workers_offset + slot * self._WORKER.size
+            pid, in_flight = self._WORKER.unpack_from(self._map, offset)
+            self._WORKER.pack_into(self._map, offset, pid, in_flight + 1)
+            self._stats["admitted"] += 1
+
+    def release(self):
+        """Give back the place taken by ``acquire``."""
+        with self._locked():
+            offset = self._workers_offset + self._worker_slot() * self._WORKER.size
+            pid, in_flight = self._WORKER.unpack_from(self._map, offset)
+            self._WORKER.pack_into(self._map, offset, pid, max(0, in_flight - 1))
+
+    def _bucket(self, key, now):
+        """``(position, tokens)`` of a client's bucket, refilled up to ``now``. Holds the lock."""
+        position = self._clients_offset + key % self.client_slots * self._CLIENT.size
+        stored, tokens, updated = self._CLIENT.unpack_from(self._map, position)
+        if stored != key:
+            return position, float(self.burst)
+        return position, min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+
+    def _in_flight(self):
+        values = self._workers.unpack_from(self._map, self._workers_offset)
+        return sum(values[1::2])
+
+    def _worker_slot(self):
+        """This process's worker slot, claimed on first use. Holds the lock."""
+        pid = os.getpid()
+        if self._slot is not None and self._slot[0] == pid:
+            return self._slot[1]
+        values = self._workers.unpack_from(self._map, self._workers_offset)
+        pids = values[::2]
+        # A slot left by an earlier process with this PID starts over
+        free = pids.index(pid) if pid in pids else (pids.index(0) if 0 in pids else None)
+        if free is None and self._reclaim():
+            return self._worker_slot()
+        if free is None:
+            raise Overloaded("No worker slot free in the admission table", 1.0)
+        self._WORKER.pack_into(self._map, self._workers_offset + free * self._WORKER.size, pid, 0)
+        self._slot = (pid, free)
+        return free
+
+    def _reclaim(self):
+        """Free the slots of worker processes that no longer exist. Holds the lock."""
+        reclaimed = False
+        for slot in range(self.worker_slots):
+            offset = self._workers_offset + slot * self._WORKER.size
+            pid, _ = self._WORKER.unpack_from(self._map, offset)
+            if pid in (0, os.getpid()):
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                self._WORKER.pack_into(self._map, offset, 0, 0)
+                reclaimed = True
+            except PermissionError:
+                pass
+        return reclaimed
+
+    def metrics(self):
+        with self._locked():
+            values = self._workers.unpack_from(self._map, self._workers_offset)
+            stats = dict(self._stats)
+        stats.update(in_flight=sum(values[1::2]), workers=sum(1 for pid in values[::2] if pid),
+                     rate=self.rate, burst=self.burst, max_in_flight=self.max_in_flight)
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._map.close()
+            self._file.close()
+
+    def _reset_after_fork(self):
+        # The parent's lock may have been held mid-fork; the mapping is shared and stays
+        self._lock = threading.Lock()
+        self._slot = None
+        self._stats = {"admitted": 0, "rate_limited": 0, "overloaded": 0}
+
+
+def _reset_after_fork():
+    for admission in list(_instances):
+        admission._reset_after_fork()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,295 +1,791 @@
-import stripe
-from flask import Flask, render_template, request, jsonify, redirect
-from twilio.rest import Client
+import admission
+import atexit
+from flask import Flask, Response, abort, g, render_template, request, jsonify, redirect
+import functools
+import json
+import logging
 import os
+import time
+import uuid
 from dotenv import load_dotenv
+import metrics
+import outbound
+import profiling
+import resilience
+import sdk
+import services
+import webhook_ingest
+from catalog import Catalog
+from customer_cache import CustomerCache
+from event_store import EventStore
+from lanes import LaneFull, Lanes
+from ledger import CUSTOMER, PAYMENT_INTENT, SMS, Ledger, LedgerWriter
+from notifier import SmsNotifier
+from page_cache import PageCache, PageShell, Representation, StaticAssets
+from session_pool import SessionPool
+from settings import get_settings
+from singleflight import SingleFlight
+from sms_dispatcher import SmsDispatcher
+from structured_logging import flush_logging, parse_levels, request_id, request_id_var, setup_logging
+from webhook_queue import WebhookQueue
 
-# Load environment variables first
+# Load environment variables first, then read and validate them once
 load_dotenv()
+settings = get_settings()
 
-# Initialize Flask app
-app = Flask(__name__,
-            static_url_path='',
-            static_folder='static')
+# Structured JSON logs written by a background thread. Per-module levels
+# (LOG_LEVELS="app=DEBUG") turn on the verbose diagnostics where needed.
+setup_logging(settings.log_level, parse_levels(settings.log_levels))
+logger = logging.getLogger("app")
 
-# Stripe Configuration
-stripe.api_key = os.getenv("STRIPE_API_KEY")
-STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY")
-STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# With METRICS_DIR set, each worker process writes its samples to a file there
+# and /metrics sums them, so any worker can answer for the whole server
+metrics.set_directory(settings.metrics_dir)
+REQUEST_LATENCY = services.REQUEST_LATENCY
+TEMPLATE_LATENCY = services.TEMPLATE_LATENCY
+WEBHOOK_EVENTS = services.WEBHOOK_EVENTS
+SMS_MESSAGES = services.SMS_MESSAGES
 
-# Twilio Configuration
-TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
-TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
-USER_PHONE = os.getenv("USER_PHONE")
+# Initialize Flask app. Files in static/ are served by static_asset() below.
+app = Flask(__name__, static_folder=None)
+
+# Rendered pages, kept with their gzip (and brotli) bodies so hits skip Jinja
+# and compression. Templates are read at startup; restart to pick up edits.
+page_cache = PageCache(max_entries=settings.page_cache_size)
+static_assets = StaticAssets(os.path.join(app.root_path, "static"))
+# {{ asset_url("style.css") }} in a template gives the fingerprinted URL
+app.jinja_env.globals["asset_url"] = static_assets.url
+
+# Stripe Configuration. The SDK is imported on first use (see sdk.py), and
+# these settings are applied to it then. Every Stripe call in the worker
+# shares one bounded keep-alive connection pool (stripe_transport.py).
+def configure_stripe(module):
+    from stripe_transport import StripeTransport
+
+    module.api_key = settings.stripe_api_key
+    if settings.stripe_api_base:
+        # Used to point the SDK at a local stand-in for load tests
+        module.api_base = settings.stripe_api_base
+    module.default_http_client = StripeTransport.from_settings(settings)
+
+sdk.on_load("stripe", configure_stripe)
+stripe_gateway = services.StripeGateway()
+
+# One Twilio client per process, reusing keep-alive connections between messages
+notifier = SmsNotifier(settings.twilio_account_sid, settings.twilio_auth_token, settings.twilio_phone_number,
+                       pool_size=settings.twilio_pool_size,
+                       timeout=settings.twilio_timeout,
+                       base_url=settings.twilio_api_base)
+
+# Outbound calls: transient failures are retried with jittered backoff, and a
+# dependency that keeps failing is cut off by its circuit breaker for a while.
+# Every request gets a deadline that bounds its retries and waits.
+outbound.configure(
+    max_attempts=settings.outbound_max_attempts,
+    base_delay=settings.outbound_backoff_base,
+    max_delay=settings.outbound_backoff_max,
+    failure_threshold=settings.breaker_failure_threshold,
+    reset_timeout=settings.breaker_reset_timeout,
+)
+
+# Every request records a tree of timed steps (spans); the slowest and the
+# recent slow ones are kept for /debug/profiles. PROFILE_SAMPLE_RATE runs
+# that fraction of requests under cProfile, keeping captures of slow ones.
+profiler = profiling.Profiler(slowest=settings.profile_keep, recent=settings.profile_keep,
+                              threshold=settings.profile_threshold,
+                              sample_rate=settings.profile_sample_rate)
 
 # Your domain configuration
 YOUR_DOMAIN = 'http://localhost:5000'
 
-def send_sms(amount=50.00):
-    """Function to send SMS using Twilio"""
+# Products for sale, loaded from settings.catalog_path (JSON or SQLite) and reloaded
+# when it changes. Each product's Stripe Price is created or found once in the
+# background, and checkouts then reference the cached Price ID.
+catalog = Catalog(settings.catalog_path,
+                  price_cache_path=settings.catalog_price_cache_path,
+                  check_interval=settings.catalog_check_interval)
+
+def checkout_session_creator(sku, payment_method_types=None):
+    def create():
+        # Looked up per session, so reloads and newly synced Prices apply at once
+        product = catalog.get(sku)
+        if product is None:
+            raise LookupError(f"Unknown product: {sku}")
+        return stripe_gateway.create_checkout_session(services.checkout_session_params(
+            YOUR_DOMAIN, settings.user_phone, payment_method_types,
+            product=product, price_id=catalog.price_id(product),
+        ))
+    return create
+
+# Checkout Sessions created ahead of time, so the buy buttons skip the
+# Session.create round trip. Each button's sessions are pooled separately
+# because /pay restricts the payment methods. Only the default product is pooled.
+checkout_pools = {}
+if settings.checkout_pool_size > 0:
+    pool_options = dict(size=settings.checkout_pool_size, min_ttl=settings.checkout_pool_min_ttl,
+                        workers=settings.checkout_pool_workers)
+    checkout_pools = {
+        "checkout": SessionPool(checkout_session_creator(settings.catalog_default_sku), name="checkout",
+                                **pool_options),
+        "pay": SessionPool(checkout_session_creator(settings.catalog_default_sku, ["card"]), name="pay",
+                           **pool_options),
+    }
+    for pool in checkout_pools.values():
+        # Sessions made before a catalog change may sell the old price
+        catalog.add_listener(pool.clear)
+
+# Per-client rate limits and a cap on checkout creations in flight, shared by
+# every worker on the host, so a spike can't use up the Stripe rate limit
+checkout_admission = admission.Admission(settings.admission_path,
+                                         rate=settings.admission_rate,
+                                         burst=settings.admission_burst,
+                                         max_in_flight=settings.admission_max_in_flight)
+
+def client_address():
+    """Who a request is rate limited as: the address our proxy put in ADMISSION_CLIENT_HEADER, else the peer"""
+    if settings.admission_client_header:
+        forwarded = request.headers.get(settings.admission_client_header)
+        client = forwarded and admission.forwarded_client(forwarded, settings.admission_trusted_hops)
+        if client:
+            return client
+    return request.remote_addr or "unknown"
+
+def checkout_lookup_admission():
+    """Stripe lookups of a session's status count against the client's checkout admission too"""
+    return functools.partial(checkout_admission.admit, client_address())
+
+def new_checkout_session(pool_name, sku, payment_method_types=None):
+    """A ready session from the pool when pooling is on, otherwise a new one"""
+    pool = checkout_pools.get(pool_name)
+    if pool is not None and sku == settings.catalog_default_sku:
+        return pool.take()
+    return checkout_session_creator(sku, payment_method_types)()
+
+def unknown_product(sku):
+    return jsonify({"error": f"Unknown product: {sku}"}), 404
+
+# Processed-event store so redelivered events are not handled twice
+event_store = EventStore(settings.event_store_path,
+                         ttl=settings.event_store_ttl,
+                         max_memory=settings.event_store_cache_size)
+
+# Stripe customer IDs by email, so returning customers skip the Customer.list lookup
+customer_cache = CustomerCache(max_memory=settings.customer_cache_size,
+                               path=settings.customer_cache_path,
+                               ttl=settings.customer_cache_ttl)
+# Concurrent webhooks for one email share a single lookup or create, so they
+# don't each create a customer; CUSTOMER_LOCK_PATH extends this to all workers
+customer_flights = SingleFlight(path=settings.customer_lock_path)
+
+# What the webhook did for each checkout, for reconcile.py to check against Stripe.
+# The webhook only queues its writes; the success page reads them back
+payment_ledger = Ledger(settings.ledger_path)
+ledger_writer = LedgerWriter(payment_ledger, batch_size=settings.ledger_batch_size)
+checkout_lookup = services.CheckoutLookup(ledger_writer, ttl=settings.checkout_lookup_ttl)
+atexit.register(ledger_writer.stop)
+
+def deliver_sms(to, body, sender=None):
+    """Send one SMS through the pooled Twilio client (runs on a dispatcher worker)"""
     try:
-        # Verify Twilio credentials and phone numbers
-        if not all([TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER, USER_PHONE]):
-            missing_vars = []
-            if not TWILIO_ACCOUNT_SID: missing_vars.append("TWILIO_ACCOUNT_SID")
-            if not TWILIO_AUTH_TOKEN: missing_vars.append("TWILIO_AUTH_TOKEN")
-            if not TWILIO_PHONE_NUMBER: missing_vars.append("TWILIO_PHONE_NUMBER")
-            if not USER_PHONE: missing_vars.append("USER_PHONE")
-            raise ValueError(f"Missing required Twilio configuration: {', '.join(missing_vars)}")
-            
-        print("\n=== Twilio Configuration ===")
-        print(f"Account SID: {TWILIO_ACCOUNT_SID[:6]}...{TWILIO_ACCOUNT_SID[-4:]}")
-        print(f"Auth Token: {TWILIO_AUTH_TOKEN[:6]}...{TWILIO_AUTH_TOKEN[-4:]}")
-        print(f"From Number: {TWILIO_PHONE_NUMBER}")
-        print(f"To Number: {USER_PHONE}")
-        
-        # Create Twilio client with the correct credentials
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-            
-        print("\n=== Attempting to send SMS ===")
-        message = client.messages.create(
-            from_=TWILIO_PHONE_NUMBER,
-            body=f"Payment of ${amount:.2f} Successful! Thank you for your purchase.",
-            to=USER_PHONE
-        )
-        
-        print(f"\n=== SMS Sent Successfully ===")
-        print(f"Message SID: {message.sid}")
-        print(f"Status: {message.status}")
-        print(f"Direction: {message.direction}")
-        print(f"Date Created: {message.date_created}")
+        logger.debug("Attempting to send SMS", extra={"to": to, "from_number": sender})
+        message = notifier.send(to, body, from_=sender)
+
+        logger.info("SMS sent", extra={
+            "message_sid": message.sid,
+            "sms_status": message.status,
+            "direction": message.direction,
+            "date_created": message.date_created,
+        })
         
         # Check for any error codes
         if hasattr(message, 'error_code') and message.error_code:
-            print(f"\nWarning: Message has error code: {message.error_code}")
-            print(f"Error message: {message.error_message}")
+            logger.warning("SMS has error code", extra={
+                "message_sid": message.sid,
+                "error_code": message.error_code,
+                "error_message": message.error_message,
+            })
+            SMS_MESSAGES.inc(outcome="failed")
             return False
-            
+
+        SMS_MESSAGES.inc(outcome="sent")
         return True
         
     except Exception as e:
-        print(f"\n=== Error Sending SMS ===")
-        print(f"Error Type: {type(e).__name__}")
-        print(f"Error Message: {str(e)}")
+        # Twilio errors carry their own code and message
+        logger.error("Error sending SMS", extra={
+            "error_type": type(e).__name__,
+            "error": str(e),
+            "twilio_code": getattr(e, 'code', None),
+            "twilio_message": getattr(e, 'msg', None),
+        })
+        SMS_MESSAGES.inc(outcome="failed")
+        return False
+
+# Rate-limited SMS queue in front of Twilio's per-number throughput limits
+sms_dispatcher = SmsDispatcher(deliver_sms,
+                               default_sender=settings.twilio_phone_number,
+                               rate=settings.twilio_sms_rate,
+                               burst=settings.twilio_sms_burst,
+                               max_queue=settings.twilio_sms_queue_size,
+                               workers=settings.twilio_sms_workers)
+
+def notify_payment(amount=50.00, session_id=None):
+    """Queue a payment SMS and return its handle without waiting for delivery.
+
+    Notifications for the same checkout session are coalesced, so a
+    redelivered event does not text the customer twice.
+    """
+    # Verify Twilio credentials and phone numbers
+    missing_vars = services.missing_twilio_config(settings.twilio_account_sid, settings.twilio_auth_token,
+                                                  settings.twilio_phone_number, settings.user_phone)
+    if missing_vars:
+        raise ValueError(f"Missing required Twilio configuration: {', '.join(missing_vars)}")
         
-        # Check for specific Twilio errors
-        if hasattr(e, 'code'):
-            print(f"Twilio Error Code: {e.code}")
-        if hasattr(e, 'msg'):
-            print(f"Twilio Error Message: {e.msg}")
-            
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Twilio configuration", extra={
+            "account_sid": f"{settings.twilio_account_sid[:6]}...{settings.twilio_account_sid[-4:]}",
+            "auth_token": f"{settings.twilio_auth_token[:6]}...{settings.twilio_auth_token[-4:]}",
+            "from_number": settings.twilio_phone_number,
+            "to": settings.user_phone,
+        })
+
+    handle = sms_dispatcher.submit(
+        settings.user_phone,
+        services.payment_sms_body(amount),
+        key=session_id
+    )
+    # Only a full queue finishes a handle unsuccessfully before it is delivered
+    if handle.done() and not handle.ok:
+        SMS_MESSAGES.inc(outcome="dropped")
+    return handle
+
+def send_sms(amount=50.00, session_id=None):
+    """Function to send SMS using Twilio, waiting for the dispatcher to deliver it"""
+    try:
+        handle = notify_payment(amount, session_id)
+        # Never wait past the request's deadline
+        left = resilience.remaining()
+        wait_timeout = settings.twilio_sms_wait_timeout
+        wait = wait_timeout if left is None else max(0.0, min(wait_timeout, left))
+        if not handle.wait(wait):
+            if not handle.done():
+                logger.warning("SMS still queued after %ss", wait_timeout,
+                               extra={"session_id": session_id})
+            elif handle.error:
+                logger.warning("SMS not sent", extra={"session_id": session_id, "error": handle.error})
+            return False
+        return True
+        
+    except Exception as e:
+        logger.error("Error sending SMS", extra={"error_type": type(e).__name__, "error": str(e)})
         return False
 
+def unavailable(e):
+    """503 for a dependency that is failing fast or a request out of time, 429 for a rate-limited client"""
+    logger.warning("Dependency unavailable", extra={"error_type": type(e).__name__, "error": str(e)})
+    retry_after = getattr(e, "retry_after", 1)
+    response = jsonify({"error": str(e)})
+    response.status_code = getattr(e, "status", 503)
+    response.headers["Retry-After"] = str(max(1, int(retry_after + 0.5)))
+    return response
+
+def render(template, **context):
+    """render_template, timed per template"""
+    with TEMPLATE_LATENCY.time(template=template):
+        return render_template(template, **context)
+
+def cached_response(representation, cache_control="no-cache"):
+    """Serve a Representation in the best encoding the client accepts, or 304"""
+    status, headers, body = representation.respond(request.headers.get("Accept-Encoding"),
+                                                   request.headers.get("If-None-Match"),
+                                                   cache_control)
+    return Response(body, status=status, headers=headers)
+
+def cached_page(template, **context):
+    """A page whose context never changes, rendered and compressed once"""
+    return cached_response(page_cache.get(
+        (template, tuple(sorted(context.items()))),
+        lambda: Representation(render(template, **context), "text/html; charset=utf-8"),
+    ))
+
+@app.before_request
+def bind_request_id():
+    g.request_started = time.perf_counter()
+    resilience.deadline_var.set(time.monotonic() + settings.request_deadline)
+    # Reuse the load balancer's request ID when there is one
+    request_id_var.set(request.headers.get("X-Request-ID") or uuid.uuid4().hex)
+
+@app.teardown_request
+def unbind_request_id(exc):
+    # The server may reuse this thread for work outside a request, which must not inherit either
+    resilience.deadline_var.set(None)
+    request_id_var.set(None)
+
+def begin_trace():
+    # One proxy lookup instead of one per attribute; this runs on every request
+    req = request._get_current_object()
+    route = req.url_rule.rule if req.url_rule else "unmatched"
+    profiler.begin(f"{req.method} {route}", request_id_var.get())
+
+def record_trace_status(response):
+    trace = profiling.current_trace()
+    if trace is not None:
+        trace.status = response.status_code
+    return response
+
+def end_trace(exc):
+    trace = profiling.current_trace()
+    if trace is not None:
+        profiler.end(trace, trace.status if exc is None else type(exc).__name__)
+
+if settings.profiling:
+    app.before_request(begin_trace)
+    app.after_request(record_trace_status)
+    app.teardown_request(end_trace)
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers["X-Request-ID"] = request_id_var.get()
+    return response
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get("request_started")
+    if started is not None:
+        # The URL rule, not the path, so query strings and IDs don't explode the label set
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.observe(time.perf_counter() - started,
+                                method=request.method, route=route, status=response.status_code)
+    return response
+
 @app.route("/")
 def home():
-    return render_template("index.html", key=STRIPE_PUBLIC_KEY)
+    return cached_page("index.html", key=settings.stripe_public_key)
 
 @app.route('/create-checkout-session', methods=['POST'])
 def create_checkout_session():
     try:
-        checkout_session = stripe.checkout.Session.create(
-            line_items=[{
-                "price_data": {
-                    "currency": "usd",
-                    "product_data": {"name": "Test Product"},
-                    "unit_amount": 5000,  # $50.00
-                },
-                "quantity": 1,
-            }],
-            mode="payment",
-            success_url=YOUR_DOMAIN + "/success?payment_status=completed&amount=50.00&transaction_id={CHECKOUT_SESSION_ID}",
-            cancel_url=YOUR_DOMAIN + "/cancel",
-            metadata={"phone": USER_PHONE}  # Store phone number in metadata
-        )
+        sku = request.values.get("sku") or settings.catalog_default_sku
+        if catalog.get(sku) is None:
+            return unknown_product(sku)
+        with checkout_admission.admit(client_address()):
+            checkout_session = new_checkout_session("checkout", sku)
         return redirect(checkout_session.url, code=303)
+    except (resilience.CircuitOpenError, resilience.DeadlineExceeded, admission.Rejected) as e:
+        return unavailable(e)
     except Exception as e:
-        print(f"Error creating checkout session: {str(e)}")
+        logger.error("Error creating checkout session", extra={"error": str(e)})
         return str(e), 400
 
 @app.route("/pay", methods=["POST"])
 def pay():
     try:
-        # Create Stripe checkout session
-        session = stripe.checkout.Session.create(
-            payment_method_types=["card"],
-            line_items=[{
-                "price_data": {
-                    "currency": "usd",
-                    "product_data": {"name": "Test Product"},
-                    "unit_amount": 5000,  # $50.00
-                },
-                "quantity": 1,
-            }],
-            mode="payment",
-            success_url=YOUR_DOMAIN + "/success?payment_status=completed&amount=50.00&transaction_id={CHECKOUT_SESSION_ID}",
-            cancel_url=YOUR_DOMAIN + "/cancel",
-            metadata={"phone": USER_PHONE}  # Store phone number in metadata
-        )
+        # Create Stripe checkout session, or take a pre-created one
+        sku = request.values.get("sku") or settings.catalog_default_sku
+        if catalog.get(sku) is None:
+            return unknown_product(sku)
+        with checkout_admission.admit(client_address()):
+            session = new_checkout_session("pay", sku, payment_method_types=["card"])
         
         # Return the session ID to the frontend
         return jsonify({
             "id": session.id,
             "success_url": session.success_url
         })
+    except (resilience.CircuitOpenError, resilience.DeadlineExceeded, admission.Rejected) as e:
+        return unavailable(e)
     except Exception as e:
-        print(f"Error creating checkout session: {str(e)}")
+        logger.error("Error creating checkout session", extra={"error": str(e)})
         return str(e), 400
 
-@app.route("/webhook", methods=["POST"])
-def stripe_webhook():
-    # Get the webhook payload and signature header
-    payload = request.data
-    sig_header = request.headers.get('Stripe-Signature')
+def upsert_customer(email, name):
+    """Create or update the Stripe customer for an email and return its ID"""
+    return services.upsert_customer(stripe_gateway, customer_cache, email, name, customer_flights)
 
-    print("\n=== Webhook Request Received ===")
-    print(f"Signature Header: {sig_header[:20]}...")
-    print(f"Payload Length: {len(payload)} bytes")
+def tag_payment_intent(session, customer_id, customer_email, customer_name):
+    """Attach the customer details to the session's PaymentIntent in one API call"""
+    if not session.get('payment_intent'):
+        return None
+    return stripe_gateway.modify_payment_intent(
+        session['payment_intent'],
+        services.payment_intent_metadata(session, customer_id, customer_email, customer_name)
+    )
 
-    try:
-        # Verify webhook signature
-        event = stripe.Webhook.construct_event(
-            payload,
-            sig_header,
-            STRIPE_WEBHOOK_SECRET
-        )
-        print(f"\n=== Webhook Verified Successfully ===")
-        print(f"Event Type: {event['type']}")
-        print(f"Event ID: {event['id']}")
-        print(f"Created: {event['created']}")
-    except ValueError as e:
-        print(f"\n=== Webhook Error: Invalid Payload ===")
-        print(f"Error: {str(e)}")
-        return jsonify({"error": "Invalid payload"}), 400
-    except stripe.error.SignatureVerificationError as e:
-        print(f"\n=== Webhook Error: Invalid Signature ===")
-        print(f"Error: {str(e)}")
-        print(f"Webhook Secret Used: {STRIPE_WEBHOOK_SECRET[:6]}...")
-        return jsonify({"error": "Invalid signature"}), 400
+def handle_event(event):
+    """Run the side effects for a verified Stripe event.
 
+    Returns a ``(body, status)`` tuple so it can be used both by the
+    webhook route and by the background queue workers.
+    """
     # Handle different event types
     try:
         if event["type"] == "checkout.session.completed":
             session = event["data"]["object"]
             amount = session["amount_total"] / 100
-            
-            print(f"\n=== Checkout Session Completed ===")
-            print(f"Session ID: {session['id']}")
-            print(f"Amount: ${amount:.2f}")
-            print(f"Customer Email: {session.get('customer_details', {}).get('email')}")
-            print(f"Customer Name: {session.get('customer_details', {}).get('name')}")
-            print(f"Payment Status: {session.get('payment_status')}")
+
+            # Without Twilio the event can't complete, so fail before doing
+            # any Stripe work; it is not stored and will be delivered again
+            if not outbound.breaker("twilio").available():
+                logger.warning("Twilio circuit open, deferring event", extra={"session_id": session['id']})
+                return {"error": "SMS provider unavailable"}, 503
             
             # Create or update customer in Stripe
-            customer_email = session.get('customer_details', {}).get('email')
-            customer_name = session.get('customer_details', {}).get('name')
+            customer_email, customer_name = services.customer_details(session)
+
+            logger.info("Checkout session completed", extra={
+                "session_id": session['id'],
+                "amount": amount,
+                "customer_email": customer_email,
+                "customer_name": customer_name,
+                "payment_status": session.get('payment_status'),
+            })
+            ledger_writer.record_payment(event['id'], session)
             
+            outcomes = {}
             if customer_email:
                 try:
-                    # Search for existing customer
-                    customers = stripe.Customer.list(email=customer_email)
-                    if customers.data:
-                        customer = customers.data[0]
-                        # Update customer if needed
-                        if customer_name and customer.name != customer_name:
-                            customer = stripe.Customer.modify(
-                                customer.id,
-                                name=customer_name
-                            )
-                    else:
-                        # Create new customer
-                        customer = stripe.Customer.create(
-                            email=customer_email,
-                            name=customer_name
-                        )
-                    
-                    print(f"Customer ID: {customer.id}")
+                    with profiling.span("customer.upsert"):
+                        customer_id = upsert_customer(customer_email, customer_name)
+                    outcomes[CUSTOMER] = True
+                    logger.debug("Customer upserted", extra={"customer_id": customer_id})
                     
-                    # Store payment details
-                    payment_intent = stripe.PaymentIntent.retrieve(session.payment_intent)
-                    payment_intent = stripe.PaymentIntent.modify(
-                        payment_intent.id,
-                        metadata={
-                            'customer_id': customer.id,
-                            'customer_email': customer_email,
-                            'customer_name': customer_name,
-                            'phone': session.get('metadata', {}).get('phone')
-                        }
-                    )
+                    # Store payment details with a single write; the session
+                    # already carries the PaymentIntent ID, so no retrieve is needed
+                    if tag_payment_intent(session, customer_id, customer_email, customer_name) is not None:
+                        outcomes[PAYMENT_INTENT] = True
                     
-                    print(f"Payment Intent updated with customer details")
+                    logger.debug("Payment Intent updated with customer details")
                     
                 except Exception as e:
-                    print(f"Error handling customer: {str(e)}")
+                    outcomes.setdefault(CUSTOMER, False)
+                    if session.get('payment_intent'):
+                        outcomes.setdefault(PAYMENT_INTENT, False)
+                    logger.error("Error handling customer", extra={"error": str(e)})
             
             # Send SMS notification
-            if send_sms(amount):
-                return jsonify({
-                    "message": "Payment processed and SMS sent",
-                    "amount": amount,
-                    "phone": USER_PHONE,
-                    "session_id": session['id'],
-                    "customer_email": customer_email,
-                    "customer_name": customer_name
-                }), 200
+            with profiling.span("sms.send"):
+                outcomes[SMS] = send_sms(amount, session_id=session['id'])
+            ledger_writer.record_actions(event['id'], session, outcomes)
+            if outcomes[SMS]:
+                return services.completed_body(session, amount, settings.user_phone,
+                                               customer_email, customer_name), 200
             else:
-                return jsonify({"error": "Failed to send SMS"}), 500
+                return {"error": "Failed to send SMS"}, 500
+
+        elif event["type"] in ("customer.updated", "customer.deleted"):
+            body, status = services.invalidate_customer(customer_cache, event)
+            logger.info("Customer cache invalidated", extra={"customer_id": body["customer_id"]})
+            return body, status
 
         else:
-            print(f"\n=== Unhandled Event Type: {event['type']} ===")
-            return jsonify({"message": f"Unhandled event type: {event['type']}"}), 400
+            logger.info("Unhandled event type", extra={"event_type": event['type']})
+            return {"message": f"Unhandled event type: {event['type']}"}, 400
 
     except Exception as e:
-        print(f"\n=== Error Processing Event ===")
-        print(f"Error Type: {type(e).__name__}")
-        print(f"Error Message: {str(e)}")
-        return jsonify({"error": f"Error processing event: {str(e)}"}), 500
+        logger.exception("Error processing event", extra={"event_id": event.get('id')})
+        return {"error": f"Error processing event: {str(e)}"}, 500
+
+    return {"status": "success"}, 200
+
+
+def handle_event_once(event):
+    """Handle an event unless its outcome is already in the event store"""
+    with profiling.span("event_store.get"):
+        stored = event_store.get(event['id'])
+    if stored is not None:
+        WEBHOOK_EVENTS.inc(event_type=event['type'], outcome="duplicate")
+        return stored
+
+    body, status = handle_event(event)
+    WEBHOOK_EVENTS.inc(event_type=event['type'], outcome=status)
+    # Failures are left unrecorded so Stripe's redelivery gets another attempt
+    if status < 500:
+        event_store.put(event['id'], event['type'], body, status)
+    return body, status
+
+# Events for one customer run in order on one lane; other customers' events run alongside
+webhook_lanes = Lanes(settings.webhook_lanes, depth=settings.webhook_lane_depth, name="webhook-lane")
+
+def handle_in_order(event):
+    """handle_event_once on the event's lane, after any earlier events for the same customer"""
+    return webhook_lanes.run(services.ordering_key(event, customer_cache), handle_event_once, event)
+
+def process_event(data):
+    """Handle an already verified event (from the queue or replay.py), given as a dict"""
+    event = webhook_ingest.event_from_dict(data)
+    # There is no HTTP request, so the event ID ties its log records together
+    with request_id(event['id']), resilience.deadline(settings.request_deadline):
+        if not settings.profiling:
+            return handle_in_order(event)
+        with profiler.trace(f"event {event['type']}", event['id']) as trace:
+            body, status = handle_in_order(event)
+            trace.status = status
+        return body, status
+
+def process_queued_event(payload):
+    """Queue worker entry point: rebuild the Stripe event and handle it"""
+    return process_event(json.loads(payload))
+
+# Asynchronous webhook processing: acknowledge Stripe immediately and
+# let background workers do the customer upsert, PaymentIntent tagging and SMS
+webhook_queue = None
+if settings.webhook_async:
+    webhook_queue = WebhookQueue(settings.webhook_queue_path,
+                                 handler=process_queued_event,
+                                 workers=settings.webhook_workers,
+                                 max_attempts=settings.webhook_max_attempts)
+
+def start_background_work():
+    """Start the threads that work outside requests: price sync, session pools and the webhook queue.
+
+    Importing the app never starts them, so tests and tools that import it make
+    no Stripe calls. Whatever serves the app starts them: ``init_worker`` in each
+    pre-fork worker, or ``__main__`` for the development server.
+    """
+    if settings.catalog_sync_prices:
+        catalog.start(stripe_gateway)
+    for pool in checkout_pools.values():
+        pool.start()
+    if webhook_queue is not None:
+        webhook_queue.start()
+
+def warm_up():
+    """Import the Stripe and Twilio SDKs now rather than in the first request that needs them.
+
+    serve.py runs this in the parent before forking, so workers share the
+    imported modules; returns the seconds each import took.
+    """
+    return sdk.preload()
+
+def init_worker():
+    """Per-worker setup for a pre-fork server (serve.py), run in each worker after fork"""
+    # Stripe and Twilio clients drop the parent's connections in the child on their own.
+    # Without preloading, the worker imported the app itself; warm it before it takes requests
+    warm_up()
+    start_background_work()
+
+def missing_environment():
+    """Names of required settings that are not set"""
+    return settings.missing()
+
+@app.route("/webhook", methods=["POST"])
+def stripe_webhook():
+    # Refuse an oversized body before reading it
+    if (request.content_length or 0) > settings.webhook_max_bytes:
+        logger.warning("Webhook error: payload too large", extra={"payload_bytes": request.content_length})
+        return jsonify({"error": "Payload too large"}), 413
+
+    # Get the webhook payload and signature header
+    payload = request.get_data()
+    sig_header = request.headers.get('Stripe-Signature')
+
+    logger.debug("Webhook request received", extra={
+        "signature_header": (sig_header or "")[:20],
+        "payload_bytes": len(payload),
+    })
+
+    try:
+        # Verify webhook signature
+        with profiling.span("webhook.verify"):
+            event = webhook_ingest.construct_event(
+                payload,
+                sig_header,
+                settings.stripe_webhook_secret,
+                tolerance=settings.webhook_tolerance,
+                max_bytes=settings.webhook_max_bytes
+            )
+        logger.info("Webhook verified", extra={
+            "event_type": event['type'],
+            "event_id": event['id'],
+            "event_created": event['created'],
+        })
+    except webhook_ingest.PayloadTooLarge as e:
+        logger.warning("Webhook error: payload too large", extra={"error": str(e)})
+        return jsonify({"error": "Payload too large"}), 413
+    except webhook_ingest.InvalidSignature as e:
+        logger.warning("Webhook error: invalid signature", extra={"error": str(e)})
+        return jsonify({"error": "Invalid signature"}), 400
+    except webhook_ingest.InvalidPayload as e:
+        logger.warning("Webhook error: invalid payload", extra={"error": str(e)})
+        return jsonify({"error": "Invalid payload"}), 400
+
+    # Duplicate deliveries get the stored response without any outbound calls
+    stored = event_store.get(event['id'])
+    if stored is not None:
+        logger.info("Duplicate event, returning stored response", extra={"event_id": event['id']})
+        WEBHOOK_EVENTS.inc(event_type=event['type'], outcome="duplicate")
+        body, status = stored
+        return jsonify(body), status
+
+    if webhook_queue is not None:
+        # Acknowledge right away and let the queue workers do the work
+        queued = webhook_queue.enqueue(event['id'], event['type'], payload.decode('utf-8'))
+        logger.info("Event queued" if queued else "Event already queued", extra={"event_id": event['id']})
+        WEBHOOK_EVENTS.inc(event_type=event['type'], outcome="queued" if queued else "duplicate")
+        return jsonify({"message": "Event queued", "event_id": event['id']}), 200
+
+    try:
+        body, status = handle_in_order(event)
+    except (LaneFull, resilience.DeadlineExceeded) as e:
+        return unavailable(e)
+    return jsonify(body), status
+
+@app.route("/webhook/lanes")
+def webhook_lane_metrics():
+    return jsonify(webhook_lanes.metrics())
+
+@app.route("/webhook/queue")
+def webhook_queue_metrics():
+    if webhook_queue is None:
+        return jsonify({"error": "Asynchronous webhook processing is disabled"}), 404
+    return jsonify(webhook_queue.metrics())
+
+@app.route("/checkout/pool")
+def checkout_pool_metrics():
+    if not checkout_pools:
+        return jsonify({"error": "Checkout session pooling is disabled"}), 404
+    return jsonify({name: pool.metrics() for name, pool in checkout_pools.items()})
+
+@app.route("/catalog")
+def catalog_products():
+    return jsonify({
+        "products": [dict(product.to_dict(), price_id=catalog.price_id(product))
+                     for product in catalog.products()],
+        "metrics": catalog.metrics(),
+    })
+
+@app.route("/catalog/reload", methods=["POST"])
+def reload_catalog():
+    """Reload the catalog file now instead of at the next check"""
+    if settings.catalog_path is None:
+        return jsonify({"error": "No CATALOG_PATH configured"}), 404
+    if not catalog.reload():
+        return jsonify({"error": "Catalog reload failed", "metrics": catalog.metrics()}), 500
+    if settings.catalog_sync_prices:
+        try:
+            catalog.sync(stripe_gateway)
+        except Exception as e:
+            logger.error("Catalog price sync failed", extra={"error": str(e)})
+    return jsonify(catalog.metrics())
+
+@app.route("/pages/cache")
+def page_cache_metrics():
+    return jsonify({"pages": page_cache.metrics(), "static": static_assets.metrics()})
 
-    return jsonify({"status": "success"}), 200
+@app.route("/customers/cache")
+def customer_cache_metrics():
+    return jsonify(dict(customer_cache.metrics(), upserts=customer_flights.metrics()))
+
+@app.route("/admission")
+def admission_metrics():
+    return jsonify(checkout_admission.metrics())
+
+@app.route("/sms/metrics")
+def sms_metrics():
+    return jsonify(sms_dispatcher.metrics())
+
+@app.route("/stripe/transport")
+def stripe_transport_metrics():
+    """Connections the Stripe client opened and reused; empty until Stripe is first called"""
+    transport = getattr(sdk.loaded("stripe"), "default_http_client", None)
+    return jsonify(transport.metrics() if hasattr(transport, "metrics") else {})
+
+@app.route("/outbound/breakers")
+def breaker_metrics():
+    return jsonify(outbound.breaker_metrics())
+
+@app.route("/debug/profiles")
+def profiles():
+    """The slowest and the recent slow requests with their span trees (?spans=0 leaves them out)"""
+    if not settings.profiling:
+        return jsonify({"error": "Profiling is disabled"}), 404
+    return jsonify(profiler.report(spans=request.args.get("spans") != "0"))
+
+@app.route("/debug/profiles/dump", methods=["POST"])
+def dump_profiles():
+    """Write the profiles and cProfile captures to PROFILE_DIR for offline analysis"""
+    if not settings.profiling:
+        return jsonify({"error": "Profiling is disabled"}), 404
+    return jsonify({"path": profiler.dump(settings.profile_dir)})
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
 
 @app.route("/success")
 def success():
-    # Get payment information from session or query parameters
-    payment_status = request.args.get('payment_status', 'completed')
-    amount = request.args.get('amount', '50.00')
     transaction_id = request.args.get('transaction_id', '')
     
     # If this is a direct access to success page without payment, redirect to home
     if not transaction_id or transaction_id == '{CHECKOUT_SESSION_ID}':
         return redirect('/')
     
-    return render_template("success.html", 
-                         payment_status=payment_status,
-                         amount=amount,
-                         transaction_id=transaction_id)
+    # Show what the ledger (or Stripe) says about the session, not the query string
+    record = None
+    if services.is_checkout_session_id(transaction_id):
+        try:
+            record, _ = services.checkout_status(checkout_lookup, stripe_gateway, transaction_id,
+                                                 admit=checkout_lookup_admission())
+        except Exception as e:
+            logger.warning("Checkout status lookup failed", extra={"session_id": transaction_id, "error": str(e)})
+    
+    # The page around the payment details is rendered once; only the details vary
+    shell = page_cache.get("success.html", lambda: PageShell(
+        lambda slot: render("success.html", payment_details=slot)
+    ))
+    details = render("payment_details.html", **services.success_details(transaction_id, record))
+    return cached_response(Representation(shell.fill(details), "text/html; charset=utf-8", precompress=False))
+
+@app.route("/checkout/status")
+def checkout_status():
+    """Payment details of a Checkout Session as JSON, from the ledger or else Stripe"""
+    session_id = request.args.get('session_id')
+    if not session_id:
+        return jsonify({"error": "session_id is required"}), 400
+    if not services.is_checkout_session_id(session_id):
+        return jsonify({"error": "Invalid session_id"}), 400
+    try:
+        record, source = services.checkout_status(checkout_lookup, stripe_gateway, session_id,
+                                                  admit=checkout_lookup_admission())
+    except admission.Rejected as e:
+        return unavailable(e)
+    except Exception as e:
+        logger.warning("Checkout status lookup failed", extra={"session_id": session_id, "error": str(e)})
+        return jsonify({"error": "Payment status is unavailable"}), 503
+    if record is None:
+        return jsonify({"error": "No such checkout session"}), 404
+    return jsonify({"session": record, "source": source})
+
+@app.route("/ledger/metrics")
+def ledger_metrics():
+    return jsonify({"writer": ledger_writer.metrics(), "lookups": checkout_lookup.metrics()})
 
 @app.route("/cancel")
 def cancel():
-    return render_template("cancel.html")
+    return cached_page("cancel.html")
+
+@app.route("/<path:filename>")
+def static_asset(filename):
+    """Files from static/ at the site root; fingerprinted URLs are cached for a year"""
+    found = static_assets.lookup(filename)
+    if found is None:
+        abort(404)
+    return cached_response(*found)
 
 if __name__ == "__main__":
     # Verify environment variables are set
-    required_env_vars = {
-        "STRIPE_API_KEY": stripe.api_key,
-        "STRIPE_PUBLIC_KEY": STRIPE_PUBLIC_KEY,
-        "STRIPE_WEBHOOK_SECRET": STRIPE_WEBHOOK_SECRET,
-        "TWILIO_ACCOUNT_SID": TWILIO_ACCOUNT_SID,
-        "TWILIO_AUTH_TOKEN": TWILIO_AUTH_TOKEN,
-        "TWILIO_PHONE_NUMBER": TWILIO_PHONE_NUMBER,
-        "USER_PHONE": USER_PHONE
-    }
-    
-    missing_vars = [var for var, value in required_env_vars.items() if not value]
+    missing_vars = missing_environment()
     if missing_vars:
-        print("\n=== Missing Required Environment Variables ===")
-        for var in missing_vars:
-            print(f"- {var}")
+        logger.error("Missing required environment variables", extra={"missing": missing_vars})
+        flush_logging()
         exit(1)
     
-    print("\n=== Starting Flask Server ===")
-    print("Configuration:")
-    print(f"- Twilio Account: {TWILIO_ACCOUNT_SID[:6]}...{TWILIO_ACCOUNT_SID[-4:]}")
-    print(f"- Twilio Phone: {TWILIO_PHONE_NUMBER}")
-    print(f"- User Phone: {USER_PHONE}")
-    print(f"- Stripe Webhook Secret: {STRIPE_WEBHOOK_SECRET[:6]}...")
+    logger.info("Starting Flask server", extra={
+        "twilio_account": f"{settings.twilio_account_sid[:6]}...{settings.twilio_account_sid[-4:]}",
+        "twilio_phone": settings.twilio_phone_number,
+        "user_phone": settings.user_phone,
+    })
+    # With the reloader on, only the child process that serves requests starts the threads
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_work()
     app.run(debug=True, port=5000)
\ No newline at end of file
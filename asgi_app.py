@@ -0,0 +1,713 @@
+"""ASGI edition of app.py with async Stripe and Twilio calls.
+
+Serves the same pages and webhook as app.py, but every route is a
+coroutine, so waiting on Stripe or Twilio ties up no worker thread. Within a
+completed checkout the customer upsert (and PaymentIntent tagging) runs
+concurrently with the SMS send. Checkout, customer and notification logic
+comes from services.py; the event store and customer cache are the same
+SQLite-backed objects the WSGI edition uses, so both editions can share
+their files. Run it with any ASGI server:
+
+    uvicorn asgi_app:app --port 5000
+
+The durable webhook queue (WEBHOOK_ASYNC) is only available in app.py.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+import uuid
+from urllib.parse import parse_qsl
+
+from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import admission
+import metrics
+import outbound
+import profiling
+import resilience
+import sdk
+import services
+import webhook_ingest
+from async_clients import AsyncStripeClient, AsyncTwilioClient
+from catalog import Catalog
+from customer_cache import CustomerCache
+from event_store import EventStore
+from lanes import AsyncLanes, LaneFull
+from ledger import CUSTOMER, PAYMENT_INTENT, SMS, Ledger, LedgerWriter
+from page_cache import PageCache, PageShell, Representation, StaticAssets
+from session_pool import AsyncSessionPool
+from settings import get_settings
+from singleflight import SingleFlight
+from structured_logging import parse_levels, request_id_var, setup_logging
+
+load_dotenv()
+settings = get_settings()
+
+setup_logging(settings.log_level, parse_levels(settings.log_levels))
+logger = logging.getLogger("asgi_app")
+
+metrics.set_directory(settings.metrics_dir)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+templates = Environment(loader=FileSystemLoader(os.path.join(BASE_DIR, "templates")),
+                        autoescape=select_autoescape())
+# Rendered pages and static files, precompressed, as in app.py
+page_cache = PageCache(max_entries=settings.page_cache_size)
+static_assets = StaticAssets(STATIC_DIR)
+templates.globals["asset_url"] = static_assets.url
+
+STRIPE_API_BASE = settings.stripe_api_base or "https://api.stripe.com"
+TWILIO_API_BASE = settings.twilio_api_base or "https://api.twilio.com"
+
+YOUR_DOMAIN = 'http://localhost:5000'
+
+# Retries, circuit breakers and per-request deadlines, as in app.py
+outbound.configure(
+    max_attempts=settings.outbound_max_attempts,
+    base_delay=settings.outbound_backoff_base,
+    max_delay=settings.outbound_backoff_max,
+    failure_threshold=settings.breaker_failure_threshold,
+    reset_timeout=settings.breaker_reset_timeout,
+)
+
+# Span trees of the slowest requests, as in app.py. cProfile sampling is left
+# out: on an event loop a capture would mix in every other request's work.
+profiler = profiling.Profiler(slowest=settings.profile_keep, recent=settings.profile_keep,
+                              threshold=settings.profile_threshold)
+
+stripe_client = AsyncStripeClient(settings.stripe_api_key, STRIPE_API_BASE, timeout=settings.stripe_timeout)
+twilio_client = AsyncTwilioClient(settings.twilio_account_sid, settings.twilio_auth_token,
+                                  settings.twilio_phone_number,
+                                  base_url=TWILIO_API_BASE,
+                                  timeout=settings.twilio_timeout,
+                                  pool_size=settings.twilio_pool_size,
+                                  rate=settings.twilio_sms_rate,
+                                  burst=settings.twilio_sms_burst)
+
+# The product catalog, as in app.py. Its Price sync and file watching are
+# rare, so they run on the catalog's own thread through the Stripe SDK
+# rather than on the event loop. The SDK itself is imported at startup.
+def configure_stripe(module):
+    from stripe_transport import StripeTransport
+
+    module.api_key = settings.stripe_api_key
+    module.api_base = STRIPE_API_BASE
+    module.default_http_client = StripeTransport.from_settings(settings)
+
+sdk.on_load("stripe", configure_stripe)
+catalog = Catalog(settings.catalog_path,
+                  price_cache_path=settings.catalog_price_cache_path,
+                  check_interval=settings.catalog_check_interval)
+
+
+def checkout_session_creator(sku, payment_method_types=None):
+    async def create():
+        # Looked up per session, so reloads and newly synced Prices apply at once
+        product = catalog.get(sku)
+        if product is None:
+            raise LookupError(f"Unknown product: {sku}")
+        return await stripe_client.create_checkout_session(services.checkout_session_params(
+            YOUR_DOMAIN, settings.user_phone, payment_method_types,
+            product=product, price_id=catalog.price_id(product),
+        ))
+    return create
+
+
+# Pre-created Checkout Sessions for the buy buttons, refilled by tasks on the loop
+checkout_pools = {}
+if settings.checkout_pool_size > 0:
+    pool_options = dict(size=settings.checkout_pool_size, min_ttl=settings.checkout_pool_min_ttl,
+                        workers=settings.checkout_pool_workers)
+    checkout_pools = {
+        "checkout": AsyncSessionPool(checkout_session_creator(settings.catalog_default_sku), name="checkout",
+                                     **pool_options),
+        "pay": AsyncSessionPool(checkout_session_creator(settings.catalog_default_sku, ["card"]), name="pay",
+                                **pool_options),
+    }
+
+
+async def new_checkout_session(pool_name, sku, payment_method_types=None):
+    """A ready session from the pool when pooling is on, otherwise a new one."""
+    pool = checkout_pools.get(pool_name)
+    if pool is not None and sku == settings.catalog_default_sku:
+        return await pool.take()
+    return await checkout_session_creator(sku, payment_method_types)()
+
+
+# Per-client rate limits and a cap on checkout creations in flight, shared by
+# every worker on the host; checks take microseconds, so they run on the loop
+checkout_admission = admission.Admission(settings.admission_path,
+                                         rate=settings.admission_rate,
+                                         burst=settings.admission_burst,
+                                         max_in_flight=settings.admission_max_in_flight)
+
+
+def unknown_product(sku):
+    return json_response({"error": f"Unknown product: {sku}"}, 404)
+
+
+# Local SQLite lookups take microseconds, so they run inline on the event loop
+event_store = EventStore(settings.event_store_path,
+                         ttl=settings.event_store_ttl,
+                         max_memory=settings.event_store_cache_size)
+customer_cache = CustomerCache(max_memory=settings.customer_cache_size,
+                               path=settings.customer_cache_path,
+                               ttl=settings.customer_cache_ttl)
+customer_flights = SingleFlight(path=settings.customer_lock_path)
+payment_ledger = Ledger(settings.ledger_path)
+# Ledger writes are batched on a thread; the event loop only queues them
+ledger_writer = LedgerWriter(payment_ledger, batch_size=settings.ledger_batch_size)
+checkout_lookup = services.CheckoutLookup(ledger_writer, ttl=settings.checkout_lookup_ttl)
+
+
+class Request:
+    """The parts of an ASGI HTTP request the routes need."""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        self.remote_addr = (scope.get("client") or ("unknown", 0))[0]
+        self.body = body
+
+    @property
+    def values(self):
+        """Query and urlencoded form parameters; the query wins, as in Flask."""
+        values = {}
+        if self.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            values.update(parse_qsl(self.body.decode("utf-8")))
+        values.update(self.args)
+        return values
+
+
+class Response:
+    def __init__(self, body=b"", status=200, content_type="text/plain; charset=utf-8", headers=None):
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.status = status
+        self.headers = {"content-type": content_type, **(headers or {})}
+
+
+def json_response(body, status=200):
+    return Response(json.dumps(body), status, "application/json")
+
+
+def redirect(location, status=302):
+    return Response(b"", status, headers={"location": location})
+
+
+def unavailable(e):
+    """503 for a dependency that is failing fast or a request out of time, 429 for a rate-limited client."""
+    logger.warning("Dependency unavailable", extra={"error_type": type(e).__name__, "error": str(e)})
+    retry_after = max(1, int(getattr(e, "retry_after", 1) + 0.5))
+    return Response(json.dumps({"error": str(e)}), getattr(e, "status", 503), "application/json",
+                    headers={"retry-after": str(retry_after)})
+
+
+def render(template, **context):
+    with services.TEMPLATE_LATENCY.time(template=template):
+        return templates.get_template(template).render(**context)
+
+
+def cached_response(request, representation, cache_control="no-cache"):
+    """Serve a Representation in the best encoding the client accepts, or 304."""
+    status, headers, body = representation.respond(request.headers.get("accept-encoding"),
+                                                   request.headers.get("if-none-match"),
+                                                   cache_control)
+    response = Response(body, status)
+    response.headers = {name.lower(): value for name, value in headers.items()}
+    return response
+
+
+def cached_page(request, template, **context):
+    """A page whose context never changes, rendered and compressed once."""
+    return cached_response(request, page_cache.get(
+        (template, tuple(sorted(context.items()))),
+        lambda: Representation(render(template, **context), "text/html; charset=utf-8"),
+    ))
+
+
+async def home(request):
+    return cached_page(request, "index.html", key=settings.stripe_public_key)
+
+
+def client_address(request):
+    """Who a request is rate limited as: the address our proxy put in ADMISSION_CLIENT_HEADER, else the peer."""
+    if settings.admission_client_header:
+        forwarded = request.headers.get(settings.admission_client_header.lower())
+        client = forwarded and admission.forwarded_client(forwarded, settings.admission_trusted_hops)
+        if client:
+            return client
+    return request.remote_addr
+
+
+def checkout_lookup_admission(request):
+    """Stripe lookups of a session's status count against the client's checkout admission too."""
+    return functools.partial(checkout_admission.admit, client_address(request))
+
+
+async def create_checkout_session(request):
+    try:
+        sku = request.values.get("sku") or settings.catalog_default_sku
+        if catalog.get(sku) is None:
+            return unknown_product(sku)
+        with checkout_admission.admit(client_address(request)):
+            checkout_session = await new_checkout_session("checkout", sku)
+        return redirect(checkout_session["url"], 303)
+    except (resilience.CircuitOpenError, resilience.DeadlineExceeded, admission.Rejected) as e:
+        return unavailable(e)
+    except Exception as e:
+        logger.error("Error creating checkout session", extra={"error": str(e)})
+        return Response(str(e), 400)
+
+
+async def pay(request):
+    try:
+        sku = request.values.get("sku") or settings.catalog_default_sku
+        if catalog.get(sku) is None:
+            return unknown_product(sku)
+        with checkout_admission.admit(client_address(request)):
+            session = await new_checkout_session("pay", sku, payment_method_types=["card"])
+        return json_response({"id": session["id"], "success_url": session["success_url"]})
+    except (resilience.CircuitOpenError, resilience.DeadlineExceeded, admission.Rejected) as e:
+        return unavailable(e)
+    except Exception as e:
+        logger.error("Error creating checkout session", extra={"error": str(e)})
+        return Response(str(e), 400)
+
+
+async def send_sms(amount=50.00, session_id=None):
+    """Send the payment SMS, returning True once Twilio has accepted it."""
+    missing_vars = services.missing_twilio_config(settings.twilio_account_sid, settings.twilio_auth_token,
+                                                  settings.twilio_phone_number, settings.user_phone)
+    if missing_vars:
+        logger.error("Error sending SMS", extra={
+            "error": f"Missing required Twilio configuration: {', '.join(missing_vars)}"})
+        return False
+
+    left = resilience.remaining()
+    wait_timeout = settings.twilio_sms_wait_timeout
+    try:
+        message = await asyncio.wait_for(
+            twilio_client.send(settings.user_phone, services.payment_sms_body(amount), key=session_id),
+            wait_timeout if left is None else max(0.0, min(wait_timeout, left)),
+        )
+    except Exception as e:
+        logger.error("Error sending SMS", extra={
+            "error_type": type(e).__name__,
+            "error": str(e),
+            "twilio_code": getattr(e, 'code', None),
+            "twilio_message": getattr(e, 'msg', None),
+        })
+        services.SMS_MESSAGES.inc(outcome="failed")
+        return False
+
+    logger.info("SMS sent", extra={
+        "message_sid": message.get("sid"),
+        "sms_status": message.get("status"),
+        "direction": message.get("direction"),
+        "date_created": message.get("date_created"),
+    })
+    if message.get("error_code"):
+        logger.warning("SMS has error code", extra={
+            "message_sid": message.get("sid"),
+            "error_code": message.get("error_code"),
+            "error_message": message.get("error_message"),
+        })
+        services.SMS_MESSAGES.inc(outcome="failed")
+        return False
+    services.SMS_MESSAGES.inc(outcome="sent")
+    return True
+
+
+async def record_customer(session, customer_email, customer_name, outcomes):
+    """Upsert the customer and tag the PaymentIntent, noting each in ``outcomes``; failures are logged, not raised."""
+    try:
+        with profiling.span("customer.upsert"):
+            customer_id = await services.upsert_customer_async(stripe_client, customer_cache,
+                                                               customer_email, customer_name,
+                                                               customer_flights)
+        outcomes[CUSTOMER] = True
+        logger.debug("Customer upserted", extra={"customer_id": customer_id})
+        if session.get('payment_intent'):
+            await stripe_client.modify_payment_intent(
+                session['payment_intent'],
+                services.payment_intent_metadata(session, customer_id, customer_email, customer_name)
+            )
+            outcomes[PAYMENT_INTENT] = True
+            logger.debug("Payment Intent updated with customer details")
+    except Exception as e:
+        outcomes.setdefault(CUSTOMER, False)
+        if session.get('payment_intent'):
+            outcomes.setdefault(PAYMENT_INTENT, False)
+        logger.error("Error handling customer", extra={"error": str(e)})
+
+
+async def handle_event(event):
+    """Async ``app.handle_event``: returns a ``(body, status)`` tuple."""
+    try:
+        if event["type"] == "checkout.session.completed":
+            session = event["data"]["object"]
+            amount = session["amount_total"] / 100
+
+            # Without Twilio the event can't complete, so fail before doing
+            # any Stripe work; it is not stored and will be delivered again
+            if not outbound.breaker("twilio").available():
+                logger.warning("Twilio circuit open, deferring event", extra={"session_id": session['id']})
+                return {"error": "SMS provider unavailable"}, 503
+
+            customer_email, customer_name = services.customer_details(session)
+
+            logger.info("Checkout session completed", extra={
+                "session_id": session['id'],
+                "amount": amount,
+                "customer_email": customer_email,
+                "customer_name": customer_name,
+                "payment_status": session.get('payment_status'),
+            })
+
+            ledger_writer.record_payment(event['id'], session)
+
+            # The SMS does not depend on the customer record, so both run at once
+            outcomes = {}
+            steps = [send_sms(amount, session_id=session['id'])]
+            if customer_email:
+                steps.append(record_customer(session, customer_email, customer_name, outcomes))
+            outcomes[SMS] = sent = (await asyncio.gather(*steps))[0]
+            ledger_writer.record_actions(event['id'], session, outcomes)
+
+            if sent:
+                return services.completed_body(session, amount, settings.user_phone,
+                                               customer_email, customer_name), 200
+            return {"error": "Failed to send SMS"}, 500
+
+        elif event["type"] in ("customer.updated", "customer.deleted"):
+            body, status = services.invalidate_customer(customer_cache, event)
+            logger.info("Customer cache invalidated", extra={"customer_id": body["customer_id"]})
+            return body, status
+
+        else:
+            logger.info("Unhandled event type", extra={"event_type": event['type']})
+            return {"message": f"Unhandled event type: {event['type']}"}, 400
+
+    except Exception as e:
+        logger.exception("Error processing event", extra={"event_id": event.get('id')})
+        return {"error": f"Error processing event: {str(e)}"}, 500
+
+
+# Events for one customer run in order; other customers' events run alongside
+webhook_lanes = AsyncLanes(settings.webhook_lanes, depth=settings.webhook_lane_depth)
+
+
+async def handle_event_once(event):
+    """Handle an event unless its outcome is already in the event store."""
+    # Checked again here: a redelivery may have waited on the lane behind the original
+    stored = event_store.get(event['id'])
+    if stored is not None:
+        services.WEBHOOK_EVENTS.inc(event_type=event['type'], outcome="duplicate")
+        return stored
+
+    body, status = await handle_event(event)
+    services.WEBHOOK_EVENTS.inc(event_type=event['type'], outcome=status)
+    # Failures are left unrecorded so Stripe's redelivery gets another attempt
+    if status < 500:
+        event_store.put(event['id'], event['type'], body, status)
+    return body, status
+
+
+async def stripe_webhook(request):
+    payload = request.body
+    sig_header = request.headers.get('stripe-signature')
+
+    try:
+        with profiling.span("webhook.verify"):
+            event = webhook_ingest.construct_event(payload, sig_header, settings.stripe_webhook_secret,
+                                                   tolerance=settings.webhook_tolerance,
+                                                   max_bytes=settings.webhook_max_bytes)
+        logger.info("Webhook verified", extra={
+            "event_type": event['type'],
+            "event_id": event['id'],
+            "event_created": event['created'],
+        })
+    except webhook_ingest.PayloadTooLarge as e:
+        logger.warning("Webhook error: payload too large", extra={"error": str(e)})
+        return json_response({"error": "Payload too large"}, 413)
+    except webhook_ingest.InvalidSignature as e:
+        logger.warning("Webhook error: invalid signature", extra={"error": str(e)})
+        return json_response({"error": "Invalid signature"}, 400)
+    except webhook_ingest.InvalidPayload as e:
+        logger.warning("Webhook error: invalid payload", extra={"error": str(e)})
+        return json_response({"error": "Invalid payload"}, 400)
+
+    stored = event_store.get(event['id'])
+    if stored is not None:
+        logger.info("Duplicate event, returning stored response", extra={"event_id": event['id']})
+        services.WEBHOOK_EVENTS.inc(event_type=event['type'], outcome="duplicate")
+        return json_response(*stored)
+
+    try:
+        body, status = await webhook_lanes.run(services.ordering_key(event, customer_cache), handle_event_once, event)
+    except (LaneFull, resilience.DeadlineExceeded) as e:
+        return unavailable(e)
+    return json_response(body, status)
+
+
+async def profiles(request):
+    """The slowest and the recent slow requests with their span trees (?spans=0 leaves them out)."""
+    if not settings.profiling:
+        return json_response({"error": "Profiling is disabled"}, 404)
+    return json_response(profiler.report(spans=request.args.get("spans") != "0"))
+
+
+async def dump_profiles(request):
+    """Write the profiles to PROFILE_DIR for offline analysis."""
+    if not settings.profiling:
+        return json_response({"error": "Profiling is disabled"}, 404)
+    return json_response({"path": profiler.dump(settings.profile_dir)})
+
+
+async def checkout_pool_metrics(request):
+    if not checkout_pools:
+        return json_response({"error": "Checkout session pooling is disabled"}, 404)
+    return json_response({name: pool.metrics() for name, pool in checkout_pools.items()})
+
+
+async def catalog_products(request):
+    return json_response({
+        "products": [dict(product.to_dict(), price_id=catalog.price_id(product))
+                     for product in catalog.products()],
+        "metrics": catalog.metrics(),
+    })
+
+
+async def reload_catalog(request):
+    """Reload the catalog file now; the sync runs off the loop."""
+    if settings.catalog_path is None:
+        return json_response({"error": "No CATALOG_PATH configured"}, 404)
+    if not await asyncio.to_thread(catalog.reload):
+        return json_response({"error": "Catalog reload failed", "metrics": catalog.metrics()}, 500)
+    if settings.catalog_sync_prices:
+        try:
+            await asyncio.to_thread(catalog.sync, services.StripeGateway())
+        except Exception as e:
+            logger.error("Catalog price sync failed", extra={"error": str(e)})
+    return json_response(catalog.metrics())
+
+
+async def customer_cache_metrics(request):
+    return json_response(dict(customer_cache.metrics(), upserts=customer_flights.metrics()))
+
+
+async def breaker_metrics(request):
+    return json_response(outbound.breaker_metrics())
+
+
+async def metrics_endpoint(request):
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+async def success(request):
+    transaction_id = request.args.get('transaction_id', '')
+
+    # If this is a direct access to success page without payment, redirect to home
+    if not transaction_id or transaction_id == '{CHECKOUT_SESSION_ID}':
+        return redirect('/')
+
+    # Show what the ledger (or Stripe) says about the session, not the query string
+    record = None
+    if services.is_checkout_session_id(transaction_id):
+        try:
+            record, _ = await services.checkout_status_async(checkout_lookup, stripe_client, transaction_id,
+                                                             admit=checkout_lookup_admission(request))
+        except Exception as e:
+            logger.warning("Checkout status lookup failed", extra={"session_id": transaction_id, "error": str(e)})
+
+    # The page around the payment details is rendered once; only the details vary
+    shell = page_cache.get("success.html", lambda: PageShell(
+        lambda slot: render("success.html", payment_details=slot)
+    ))
+    details = render("payment_details.html", **services.success_details(transaction_id, record))
+    return cached_response(request, Representation(shell.fill(details), "text/html; charset=utf-8",
+                                                   precompress=False))
+
+
+async def checkout_status(request):
+    """Payment details of a Checkout Session as JSON, from the ledger or else Stripe."""
+    session_id = request.args.get('session_id')
+    if not session_id:
+        return json_response({"error": "session_id is required"}, 400)
+    if not services.is_checkout_session_id(session_id):
+        return json_response({"error": "Invalid session_id"}, 400)
+    try:
+        record, source = await services.checkout_status_async(checkout_lookup, stripe_client, session_id,
+                                                              admit=checkout_lookup_admission(request))
+    except admission.Rejected as e:
+        return unavailable(e)
+    except Exception as e:
+        logger.warning("Checkout status lookup failed", extra={"session_id": session_id, "error": str(e)})
+        return json_response({"error": "Payment status is unavailable"}, 503)
+    if record is None:
+        return json_response({"error": "No such checkout session"}, 404)
+    return json_response({"session": record, "source": source})
+
+
+async def ledger_metrics(request):
+    return json_response({"writer": ledger_writer.metrics(), "lookups": checkout_lookup.metrics()})
+
+
+async def cancel(request):
+    return cached_page(request, "cancel.html")
+
+
+async def webhook_lane_metrics(request):
+    return json_response(webhook_lanes.metrics())
+
+
+async def admission_metrics(request):
+    return json_response(checkout_admission.metrics())
+
+
+async def page_cache_metrics(request):
+    return json_response({"pages": page_cache.metrics(), "static": static_assets.metrics()})
+
+
+ROUTES = {
+    "/": {"GET": home},
+    "/create-checkout-session": {"POST": create_checkout_session},
+    "/pay": {"POST": pay},
+    "/webhook": {"POST": stripe_webhook},
+    "/checkout/pool": {"GET": checkout_pool_metrics},
+    "/catalog": {"GET": catalog_products},
+    "/catalog/reload": {"POST": reload_catalog},
+    "/customers/cache": {"GET": customer_cache_metrics},
+    "/pages/cache": {"GET": page_cache_metrics},
+    "/admission": {"GET": admission_metrics},
+    "/webhook/lanes": {"GET": webhook_lane_metrics},
+    "/outbound/breakers": {"GET": breaker_metrics},
+    "/metrics": {"GET": metrics_endpoint},
+    "/debug/profiles": {"GET": profiles},
+    "/debug/profiles/dump": {"POST": dump_profiles},
+    "/success": {"GET": success},
+    "/checkout/status": {"GET": checkout_status},
+    "/ledger/metrics": {"GET": ledger_metrics},
+    "/cancel": {"GET": cancel},
+}
+
+
+def static_file(request):
+    """Serve files from static/ at the site root, like the Flask app."""
+    if request.method != "GET":
+        return None
+    found = static_assets.lookup(request.path)
+    if found is None:
+        return None
+    return cached_response(request, *found)
+
+
+async def dispatch(request):
+    """Return ``(route, response)`` for a request."""
+    methods = ROUTES.get(request.path)
+    if methods is None:
+        response = static_file(request)
+        if response is not None:
+            return "/<path:filename>", response
+        return "unmatched", Response("Not Found", 404)
+    handler = methods.get(request.method)
+    if handler is None:
+        return request.path, Response("Method Not Allowed", 405, headers={"allow": ", ".join(methods)})
+    return request.path, await handler(request)
+
+
+async def read_body(receive, limit=None):
+    """The request body; raises PayloadTooLarge as soon as more than ``limit`` bytes have arrived."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if limit is not None and size > limit:
+            raise webhook_ingest.PayloadTooLarge(f"Body over {limit} bytes")
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def body_limit(request):
+    """Most bytes of body the route accepts, or None; webhooks are capped before they are buffered."""
+    return settings.webhook_max_bytes if request.path == "/webhook" else None
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            loop = asyncio.get_running_loop()
+            # Import the Stripe SDK before taking requests, off the loop
+            await loop.run_in_executor(None, sdk.preload, ("stripe",))
+            for pool in checkout_pools.values():
+                pool.start()
+                # Reloads happen on the catalog thread; the pool lives on the loop
+                catalog.add_listener(lambda pool=pool: loop.call_soon_threadsafe(pool.clear))
+            if settings.catalog_sync_prices:
+                catalog.start(services.StripeGateway())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            for pool in checkout_pools.values():
+                await pool.stop()
+            catalog.stop()
+            await stripe_client.close()
+            await twilio_client.close()
+            ledger_writer.stop()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    started = time.perf_counter()
+    request = Request(scope, b"")
+    # Reuse the load balancer's request ID when there is one
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    resilience.deadline_var.set(time.monotonic() + settings.request_deadline)
+
+    trace = profiler.begin(f"{request.method} {request.path}", request_id) if settings.profiling else None
+    limit = body_limit(request)
+    length = request.headers.get("content-length", "")
+    try:
+        if limit is not None and length.isdigit() and int(length) > limit:
+            raise webhook_ingest.PayloadTooLarge(f"Content-Length {length} over {limit} bytes")
+        request.body = await read_body(receive, limit)
+    except webhook_ingest.PayloadTooLarge as e:
+        logger.warning("Webhook error: payload too large", extra={"error": str(e)})
+        route, response = request.path, json_response({"error": "Payload too large"}, 413)
+    else:
+        route, response = await dispatch(request)
+    if trace is not None:
+        profiler.end(trace, response.status, name=f"{request.method} {route}")
+    response.headers["x-request-id"] = request_id
+
+    await send({
+        "type": "http.response.start",
+        "status": response.status,
+        "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in response.headers.items()],
+    })
+    await send({"type": "http.response.body", "body": response.body})
+    services.REQUEST_LATENCY.observe(time.perf_counter() - started,
+                                     method=request.method, route=route, status=response.status)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, port=5000)
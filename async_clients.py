@@ -0,0 +1,204 @@
+import asyncio
+import base64
+import time
+import uuid
+
+import aiohttp
+from twilio.base.exceptions import TwilioRestException
+
+import outbound
+from sdk import stripe
+from sms_dispatcher import TokenBucket
+
+
+def encode_params(params, prefix=None):
+    """Flatten nested params into Stripe's form encoding (``metadata[phone]=...``)."""
+    pairs = []
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if value is None:
+            continue
+        if isinstance(value, (dict, list, tuple)):
+            pairs.extend(encode_params(value, name))
+        elif isinstance(value, bool):
+            pairs.append((name, "true" if value else "false"))
+        else:
+            pairs.append((name, str(value)))
+    return pairs
+
+
+class _HttpClient:
+    """Owns an aiohttp session with a keep-alive pool, created inside the running loop."""
+
+    def __init__(self, timeout, pool_size):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+        self._loop = None
+
+    @property
+    def session(self):
+        loop = asyncio.get_running_loop()
+        # A session is bound to the loop it was created on
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncStripeClient(_HttpClient):
+    """The Stripe calls the app makes, over the REST API with aiohttp.
+
+    Has the same methods as ``services.StripeGateway`` but as coroutines,
+    returning the decoded JSON. API errors raise the matching
+    ``stripe.error`` exception. Creates send an idempotency key, so retries
+    never create twice.
+    """
+
+    def __init__(self, api_key, api_base="https://api.stripe.com", timeout=30.0, pool_size=100):
+        super().__init__(timeout, pool_size)
+        self.api_key = api_key
+        self.api_base = api_base.rstrip("/")
+
+    async def _request(self, operation, method, path, params=None, idempotent_create=False):
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        if idempotent_create:
+            # One key for every attempt, so Stripe replays the first result
+            headers["Idempotency-Key"] = str(uuid.uuid4())
+        return await outbound.call_async("stripe", operation, self._send, method, path, params or {}, headers)
+
+    async def _send(self, method, path, params, headers):
+        encoded = encode_params(params)
+        async with self.session.request(
+            method,
+            self.api_base + path,
+            params=encoded if method == "GET" else None,
+            data=encoded if method != "GET" else None,
+            headers=headers,
+        ) as response:
+            body = await response.json(content_type=None)
+        if response.status >= 400:
+            error = body.get("error", {}) if isinstance(body, dict) else {}
+            message = error.get("message", f"HTTP {response.status}")
+            if response.status == 429:
+                raise stripe.error.RateLimitError(message, http_status=429, json_body=body,
+                                                  code=error.get("code"))
+            if response.status < 500:
+                raise stripe.error.InvalidRequestError(message, error.get("param"), code=error.get("code"),
+                                                       http_status=response.status, json_body=body)
+            raise stripe.error.APIError(message, http_status=response.status, json_body=body,
+                                        code=error.get("code"))
+        return body
+
+    async def create_checkout_session(self, params):
+        return await self._request("checkout.Session.create", "POST", "/v1/checkout/sessions", params,
+                                   idempotent_create=True)
+
+    async def retrieve_checkout_session(self, session_id):
+        return await self._request("checkout.Session.retrieve", "GET", f"/v1/checkout/sessions/{session_id}")
+
+    async def list_customers(self, email):
+        result = await self._request("Customer.list", "GET", "/v1/customers", {"email": email})
+        return result["data"]
+
+    async def create_customer(self, email, name):
+        return await self._request("Customer.create", "POST", "/v1/customers",
+                                   {"email": email, "name": name}, idempotent_create=True)
+
+    async def modify_customer(self, customer_id, **params):
+        return await self._request("Customer.modify", "POST", f"/v1/customers/{customer_id}", params)
+
+    async def modify_payment_intent(self, payment_intent_id, metadata):
+        return await self._request("PaymentIntent.modify", "POST",
+                                   f"/v1/payment_intents/{payment_intent_id}", {"metadata": metadata})
+
+
+class AsyncTwilioClient(_HttpClient):
+    """Sends SMS through Twilio's Messages API with aiohttp.
+
+    Like ``SmsDispatcher``, each sender number is held to ``rate`` messages
+    per second with bursts of ``burst``, and sends that share a ``key`` are
+    coalesced: while one is in flight, or succeeded within
+    ``coalesce_window`` seconds, the same key returns its result instead of
+    texting again. API errors raise ``TwilioRestException``.
+    """
+
+    def __init__(self, account_sid, auth_token, from_number, base_url="https://api.twilio.com",
+                 timeout=10.0, pool_size=10, rate=1.0, burst=5, coalesce_window=300.0):
+        super().__init__(timeout, pool_size)
+        self.account_sid = account_sid
+        self.auth_token = auth_token
+        self.from_number = from_number
+        self.base_url = base_url.rstrip("/")
+        self.rate = rate
+        self.burst = burst
+        self.coalesce_window = coalesce_window
+
+        credentials = base64.b64encode(f"{account_sid}:{auth_token}".encode("utf-8")).decode("ascii")
+        self._headers = {"Authorization": f"Basic {credentials}"}
+        self._buckets = {}
+        self._sends = {}
+        self._pruned_at = time.monotonic()
+
+    async def send(self, to, body, from_=None, key=None):
+        """Send an SMS and return Twilio's message JSON. Defaults to the configured number."""
+        if key is None:
+            return await self._send(to, body, from_ or self.from_number)
+
+        self._prune()
+        entry = self._sends.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(self._send(to, body, from_ or self.from_number))
+            entry = self._sends[key] = [task, None]
+            task.add_done_callback(lambda t, entry=entry: self._finished(key, entry, t))
+        return await asyncio.shield(entry[0])
+
+    def _finished(self, key, entry, task):
+        if task.cancelled() or task.exception() is not None:
+            # Failed sends are not coalesced, so a retry gets a fresh attempt
+            if self._sends.get(key) is entry:
+                del self._sends[key]
+        else:
+            entry[1] = time.monotonic()
+
+    def _prune(self):
+        # Sweep at most once a second so the coalescing index stays cheap to maintain
+        now = time.monotonic()
+        if now - self._pruned_at < 1.0:
+            return
+        self._pruned_at = now
+        cutoff = now - self.coalesce_window
+        for key, (_, completed_at) in list(self._sends.items()):
+            if completed_at is not None and completed_at < cutoff:
+                del self._sends[key]
+
+    async def _send(self, to, body, sender):
+        bucket = self._buckets.get(sender)
+        if bucket is None:
+            bucket = self._buckets[sender] = TokenBucket(self.rate, self.burst)
+        delay = bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        return await outbound.call_async("twilio", "messages.create", self._create_message, to, body, sender)
+
+    async def _create_message(self, to, body, sender):
+        uri = f"{self.base_url}/2010-04-01/Accounts/{self.account_sid}/Messages.json"
+        async with self.session.post(
+            uri,
+            data={"To": to, "From": sender, "Body": body},
+            headers=self._headers,
+        ) as response:
+            message = await response.json(content_type=None)
+        if response.status >= 400:
+            raise TwilioRestException(response.status, uri, message.get("message", "Unable to create record"),
+                                      message.get("code"), method="POST")
+        return message
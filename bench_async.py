@@ -0,0 +1,124 @@
+"""Concurrent webhook throughput of one process: WSGI edition versus ASGI edition.
+
+Serves app.py (werkzeug, a thread per request) and asgi_app.py (uvicorn, one
+event loop) in turn against the Stripe and Twilio stand-ins, then posts
+signed checkout.session.completed events with many in flight at once.
+Reports events per second and latency for each edition, plus the server
+process's peak thread count and memory where /proc is available.
+
+    python bench_async.py --events 1000 --concurrency 100 --stub-latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+
+import aiohttp
+
+from bench_load import WEBHOOK_SECRET, configure_environment, percentile, serve_app
+from bench_stubs import StubProcess, checkout_completed_event, sign_webhook, stripe_routes, twilio_routes
+
+
+def process_usage(pid):
+    """``(threads, rss_kb)`` for a process, or None without /proc."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    return int(fields["Threads"]), int(fields["VmRSS"].split()[0])
+
+
+def watch_process(pid, peak, stop):
+    while not stop.is_set():
+        usage = process_usage(pid)
+        if usage:
+            peak["threads"] = max(peak.get("threads", 0), usage[0])
+            peak["rss_kb"] = max(peak.get("rss_kb", 0), usage[1])
+        stop.wait(0.05)
+
+
+async def post_events(base_url, events, concurrency, offset):
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def one(i):
+            payload = checkout_completed_event(offset + i, email=f"customer{i % 100}@example.com")
+            headers = {"Content-Type": "application/json",
+                       "Stripe-Signature": sign_webhook(payload, WEBHOOK_SECRET)}
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.post(f"{base_url}/webhook", data=payload, headers=headers) as response:
+                        await response.read()
+                        status = str(response.status)
+                except aiohttp.ClientError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(events)))
+        wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "events_per_second": round(events / wall, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "statuses": statuses,
+    }
+
+
+def run_edition(edition, stripe_stub, twilio_stub, args):
+    scratch = tempfile.mkdtemp(prefix=f"bench-async-{edition}-")
+    environment = configure_environment(stripe_stub, twilio_stub, scratch)
+    # Let both editions have as many SMS sends in flight as there are clients
+    environment["TWILIO_POOL_SIZE"] = str(args.concurrency)
+    environment["TWILIO_SMS_WORKERS"] = str(args.concurrency)
+    process, base_url = serve_app(environment, os.path.join(scratch, "app.log"), edition)
+    try:
+        # Warm up connections, imports and the customer cache
+        asyncio.run(post_events(base_url, min(args.events, 100), args.concurrency, 0))
+        peak, stop = {}, threading.Event()
+        watcher = threading.Thread(target=watch_process, args=(process.pid, peak, stop), daemon=True)
+        watcher.start()
+        result = asyncio.run(post_events(base_url, args.events, args.concurrency, time.time_ns() // 1000))
+        stop.set()
+        watcher.join()
+        result.update(peak)
+        return result
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--stub-latency", type=float, default=0.05,
+                        help="Seconds added to every Stripe and Twilio response")
+    parser.add_argument("--editions", default="wsgi,asgi")
+    args = parser.parse_args()
+
+    stripe_stub = StubProcess(stripe_routes, latency=args.stub_latency).start()
+    twilio_stub = StubProcess(twilio_routes, latency=args.stub_latency).start()
+    try:
+        print(f"{'edition':<8}{'events/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'threads':>9}{'rss MB':>8}  statuses")
+        for edition in args.editions.split(","):
+            r = run_edition(edition, stripe_stub, twilio_stub, args)
+            print(f"{edition:<8}{r['events_per_second']:>10.1f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+                  f"{r.get('threads', 0):>9}{r.get('rss_kb', 0) / 1024:>8.1f}  {r['statuses']}")
+    finally:
+        stripe_stub.stop()
+        twilio_stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Load test for the app's endpoints against local Stripe and Twilio stand-ins.
+
+Starts the stubs, points the app at them, serves the app on a threaded local
+server (each in its own process) and drives each endpoint with a pool of
+keep-alive clients. Reports p50/p95/p99 latency and requests per second per
+endpoint, and can save the results as JSON and compare them with an earlier
+run:
+
+    python bench_load.py --requests 500 --concurrency 16 --output baseline.json
+    python bench_load.py --requests 500 --concurrency 16 --compare baseline.json
+
+Use ``--stub-latency`` / ``--stub-error-rate`` to simulate a slow or failing
+Stripe and Twilio. ``--url`` drives an already running server instead; start
+it with STRIPE_API_BASE and TWILIO_API_BASE pointing at ``--stubs-only``.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_stubs import StubProcess, checkout_completed_event, sign_webhook, stripe_routes, twilio_routes
+
+WEBHOOK_SECRET = "whsec_bench"
+ENDPOINTS = ["home", "pay", "create-checkout-session", "webhook", "success"]
+
+
+def configure_environment(stripe_stub, twilio_stub, scratch):
+    """Environment for an app instance that talks only to the stubs."""
+    return {
+        "STRIPE_API_KEY": "sk_test_bench",
+        "STRIPE_PUBLIC_KEY": "pk_test_bench",
+        "STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "STRIPE_API_BASE": stripe_stub.url,
+        "TWILIO_ACCOUNT_SID": "AC" + "0" * 32,
+        "TWILIO_AUTH_TOKEN": "bench-token",
+        "TWILIO_PHONE_NUMBER": "+15550001",
+        "TWILIO_API_BASE": twilio_stub.url,
+        "USER_PHONE": "+15550002",
+        "TWILIO_SMS_RATE": "100000",
+        "TWILIO_SMS_BURST": "100000",
+        # Every request comes from one address; measure the app, not its rate limits
+        "ADMISSION_RATE": "0",
+        "ADMISSION_MAX_IN_FLIGHT": "0",
+        "EVENT_STORE_PATH": os.path.join(scratch, "events.db"),
+        "LEDGER_PATH": os.path.join(scratch, "ledger.db"),
+        "WEBHOOK_QUEUE_PATH": os.path.join(scratch, "queue.db"),
+        "LOG_LEVEL": "WARNING",
+        "LOG_LEVELS": "werkzeug=WARNING",
+    }
+
+
+def _serve_app_in_child(environment, log_path, ready, edition):
+    os.environ.update(environment)
+    sys.stdout = open(log_path, "a", buffering=1)
+
+    if edition == "asgi":
+        import socket
+
+        import uvicorn
+
+        from asgi_app import app
+
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        ready.put(f"http://127.0.0.1:{sock.getsockname()[1]}")
+        uvicorn.Server(uvicorn.Config(app, log_level="warning", backlog=4096)).run(sockets=[sock])
+        return
+
+    from werkzeug.serving import make_server
+
+    import app as flask_app
+
+    flask_app.start_background_work()
+    server = make_server("127.0.0.1", 0, flask_app.app, threaded=True)
+    ready.put(f"http://127.0.0.1:{server.server_port}")
+    server.serve_forever()
+
+
+def serve_app(environment, log_path, edition="wsgi"):
+    """Serve the app with the bench environment in a child process.
+
+    The WSGI edition (app.py) runs on werkzeug's threaded server and the
+    ASGI edition (asgi_app.py) on uvicorn. Keeping the app, the stubs and
+    the load generator in separate processes stops them competing for one
+    GIL and skewing the numbers. The app's logs go to ``log_path`` so they
+    don't interleave with the report.
+    """
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    process = context.Process(target=_serve_app_in_child, args=(environment, log_path, ready, edition),
+                              daemon=True)
+    process.start()
+    return process, ready.get(timeout=60)
+
+
+def request_factory(endpoint, base_url):
+    """Return a function that sends one request to ``endpoint`` on a given session."""
+    counter = itertools.count()
+    run_id = int(time.time() * 1000)
+
+    if endpoint == "home":
+        return lambda session: session.get(f"{base_url}/")
+    if endpoint == "pay":
+        return lambda session: session.post(f"{base_url}/pay")
+    if endpoint == "create-checkout-session":
+        return lambda session: session.post(f"{base_url}/create-checkout-session",
+                                            allow_redirects=False)
+    if endpoint == "success":
+        return lambda session: session.get(
+            f"{base_url}/success",
+            params={"payment_status": "completed", "amount": "50.00",
+                    "transaction_id": f"cs_test_{next(counter)}"})
+    if endpoint == "webhook":
+        def send(session):
+            i = run_id * 1000000 + next(counter)
+            payload = checkout_completed_event(i, email=f"customer{i % 100}@example.com")
+            return session.post(f"{base_url}/webhook", data=payload, headers={
+                "Content-Type": "application/json",
+                "Stripe-Signature": sign_webhook(payload, WEBHOOK_SECRET),
+            })
+        return send
+    raise ValueError(f"Unknown endpoint: {endpoint}")
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_endpoint(endpoint, base_url, total, concurrency):
+    send = request_factory(endpoint, base_url)
+    local = threading.local()
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def one(_):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+            session.trust_env = False
+        start = time.perf_counter()
+        try:
+            status = send(session).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "rps": round(total / wall, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        "statuses": statuses,
+    }
+
+
+def print_report(results, baseline=None):
+    print(f"{'endpoint':<26}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  statuses")
+    for endpoint, r in results["endpoints"].items():
+        line = (f"{endpoint:<26}{r['rps']:>9.1f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+                f"{r['p99_ms']:>10.2f}  {r['statuses']}")
+        previous = (baseline or {}).get("endpoints", {}).get(endpoint)
+        if previous:
+            line += (f"  [rps {(r['rps'] / previous['rps'] - 1) * 100:+.0f}%,"
+                     f" p95 {(r['p95_ms'] / previous['p95_ms'] - 1) * 100:+.0f}%]")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS),
+                        help=f"Comma-separated subset of {','.join(ENDPOINTS)}")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="Seconds added to every stub response")
+    parser.add_argument("--stub-jitter", type=float, default=0.0, help="Extra random latency, up to this many seconds")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0, help="Fraction of stub responses that fail")
+    parser.add_argument("--checkout-pool", type=int, default=0,
+                        help="Run the app with CHECKOUT_POOL_SIZE pre-created Checkout Sessions per button")
+    parser.add_argument("--url", help="Drive an already running server instead of an in-process one")
+    parser.add_argument("--stubs-only", action="store_true",
+                        help="Only run the stubs on --stripe-port/--twilio-port until interrupted")
+    parser.add_argument("--stripe-port", type=int, default=0)
+    parser.add_argument("--twilio-port", type=int, default=0)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Compare against results from an earlier --output")
+    args = parser.parse_args()
+
+    stub_options = dict(latency=args.stub_latency, jitter=args.stub_jitter,
+                        error_rate=args.stub_error_rate)
+    stripe_stub = StubProcess(stripe_routes, port=args.stripe_port, **stub_options).start()
+    twilio_stub = StubProcess(twilio_routes, port=args.twilio_port, **stub_options).start()
+    scratch = tempfile.mkdtemp(prefix="bench-load-")
+    environment = configure_environment(stripe_stub, twilio_stub, scratch)
+    environment["CHECKOUT_POOL_SIZE"] = str(args.checkout_pool)
+
+    if args.stubs_only:
+        for key in ("STRIPE_API_BASE", "TWILIO_API_BASE", "STRIPE_WEBHOOK_SECRET"):
+            print(f"{key}={environment[key]}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            return
+
+    app_log = os.path.join(scratch, "app.log")
+    base_url = args.url.rstrip("/") if args.url else serve_app(environment, app_log)[1]
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "target": base_url if args.url else "in-process",
+        "stub_latency": args.stub_latency,
+        "stub_error_rate": args.stub_error_rate,
+        "checkout_pool": args.checkout_pool,
+        "endpoints": {},
+    }
+    for endpoint in [e.strip() for e in args.endpoints.split(",") if e.strip()]:
+        results["endpoints"][endpoint] = run_endpoint(endpoint, base_url, args.requests, args.concurrency)
+    results["stub_requests"] = {"stripe": stripe_stub.stats()["requests"],
+                                "twilio": twilio_stub.stats()["requests"]}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if not args.url:
+        print(f"app log: {app_log}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Per-request cost of the webhook's diagnostics: print() versus the logging pipeline.
+
+Each "request" emits what one completed checkout used to print (about 25
+lines) or what it now logs (a handful of records, with the verbose ones at
+DEBUG). Output goes to a line-buffered file, like stdout under a process
+manager.
+
+    python bench_logging.py --requests 20000
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from structured_logging import flush_logging, request_id, setup_logging
+
+SESSION = {"id": "cs_test_123", "amount_total": 5000, "payment_status": "paid",
+           "customer_details": {"email": "test@example.com", "name": "Test User"}}
+
+
+def print_request():
+    print("\n=== Webhook Request Received ===")
+    print(f"Signature Header: {'t=1700000000,v1=abcdef0123456789'[:20]}...")
+    print(f"Payload Length: {2048} bytes")
+    print(f"\n=== Webhook Verified Successfully ===")
+    print(f"Event Type: checkout.session.completed")
+    print(f"Event ID: evt_123")
+    print(f"Created: 1700000000")
+    print(f"\n=== Checkout Session Completed ===")
+    print(f"Session ID: {SESSION['id']}")
+    print(f"Amount: ${SESSION['amount_total'] / 100:.2f}")
+    print(f"Customer Email: {SESSION.get('customer_details', {}).get('email')}")
+    print(f"Customer Name: {SESSION.get('customer_details', {}).get('name')}")
+    print(f"Payment Status: {SESSION.get('payment_status')}")
+    print(f"Customer ID: cus_123")
+    print(f"Payment Intent updated with customer details")
+    print("\n=== Twilio Configuration ===")
+    print(f"Account SID: AC1234...abcd")
+    print(f"Auth Token: 123456...abcd")
+    print(f"From Number: +15550001")
+    print(f"To Number: +15550002")
+    print("\n=== Attempting to send SMS ===")
+    print(f"\n=== SMS Sent Successfully ===")
+    print(f"Message SID: SM123")
+    print(f"Status: queued")
+    print(f"Direction: outbound-api")
+    print(f"Date Created: 2024-01-01 00:00:00+00:00")
+
+
+logger = logging.getLogger("app")
+
+
+def logging_request():
+    logger.debug("Webhook request received", extra={"signature_header": "t=1700000000,v1=ab",
+                                                     "payload_bytes": 2048})
+    logger.info("Webhook verified", extra={"event_type": "checkout.session.completed",
+                                           "event_id": "evt_123", "event_created": 1700000000})
+    logger.info("Checkout session completed", extra={
+        "session_id": SESSION["id"],
+        "amount": SESSION["amount_total"] / 100,
+        "customer_email": SESSION["customer_details"]["email"],
+        "customer_name": SESSION["customer_details"]["name"],
+        "payment_status": SESSION["payment_status"],
+    })
+    logger.debug("Customer upserted", extra={"customer_id": "cus_123"})
+    logger.debug("Payment Intent updated with customer details")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Twilio configuration", extra={"account_sid": "AC1234...abcd",
+                                                    "from_number": "+15550001", "to": "+15550002"})
+    logger.debug("Attempting to send SMS", extra={"to": "+15550002", "from_number": "+15550001"})
+    logger.info("SMS sent", extra={"message_sid": "SM123", "sms_status": "queued",
+                                   "direction": "outbound-api"})
+
+
+def measure(label, emit, requests):
+    start = time.perf_counter()
+    with request_id("bench"):
+        for _ in range(requests):
+            emit()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<16} {elapsed / requests * 1e6:8.2f} us/request", file=sys.__stdout__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "print.log"), "w", buffering=1) as out:
+        sys.stdout = out
+        try:
+            measure("print", print_request, args.requests)
+        finally:
+            sys.stdout = sys.__stdout__
+
+    with open(os.path.join(directory, "json.log"), "w", buffering=1) as out:
+        for level in ("DEBUG", "INFO", "WARNING"):
+            setup_logging(level, stream=out)
+            measure(f"logging {level}", logging_request, args.requests)
+            flush_logging()
+
+
+if __name__ == "__main__":
+    main()
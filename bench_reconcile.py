@@ -0,0 +1,92 @@
+"""Reconciliation time for a full history scan versus an incremental run.
+
+Starts the Stripe stub with ``--history`` completed checkouts spread over
+``--days``, fills a ledger from them with a few gaps planted, then runs
+reconcile.py's scan three ways: the whole history one page at a time, the
+whole history in parallel time slices, and an incremental run from a
+watermark an hour old (plus the default one-day overlap).
+
+    python bench_reconcile.py --history 20000 --days 30 --latency 0.1
+"""
+import argparse
+import os
+import tempfile
+import time
+from functools import partial
+
+os.environ.setdefault("STRIPE_API_KEY", "sk_test_bench")
+
+import stripe
+
+import reconcile
+import services
+from bench_stubs import StubProcess, stripe_routes
+from ledger import CUSTOMER, PAYMENT_INTENT, SMS, Ledger
+
+LIST_CALLS = ("GET /v1/checkout/sessions", "GET /v1/payment_intents")
+
+
+def fill_ledger(ledger, sessions):
+    """Record every session as handled, except for planted gaps; returns ``{session_id: (issue, created)}``."""
+    gaps = {}
+    for i, session in enumerate(sessions):
+        if i % 500 == 0:
+            gaps[session["id"]] = ("missing_webhook", session["created"])
+            continue
+        sms = i % 700 != 1
+        ledger.record_checkout(f"evt_{i}", session, {CUSTOMER: True, PAYMENT_INTENT: True, SMS: sms})
+        if i % 900 == 2:
+            ledger.record_checkout(f"evt_{i}_again", session, {CUSTOMER: True, PAYMENT_INTENT: True, SMS: True})
+            gaps[session["id"]] = ("duplicate_sms", session["created"])
+        elif not sms:
+            gaps[session["id"]] = ("missing_sms", session["created"])
+    return gaps
+
+
+def list_pages(stub):
+    calls = stub.stats()["calls"]
+    return sum(calls.get(call, 0) for call in LIST_CALLS)
+
+
+def run(label, stub, ledger, since, until, slices, gaps):
+    pages = list_pages(stub)
+    problems, stats = reconcile.reconcile(services.StripeGateway(), ledger, since, until,
+                                          slices=slices, workers=slices * 2)
+    expected = {(session_id, issue) for session_id, (issue, created) in gaps.items() if since <= created < until}
+    found = {(p["session_id"], p["issue"]) for p in problems}
+    print(f"{label:<22} {stats['elapsed_s']:7.2f} s  {list_pages(stub) - pages:5d} pages"
+          f"  {stats['stripe_sessions']:6d} sessions  {len(problems):4d} problems"
+          f"  {'all gaps found' if found == expected else 'MISMATCH'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--history", type=int, default=20000, help="Completed checkouts on the account")
+    parser.add_argument("--days", type=int, default=30, help="Days the history is spread over")
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds the stub takes per page")
+    parser.add_argument("--slices", type=int, default=8, help="Time slices listed in parallel")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            StubProcess(partial(stripe_routes, history=args.history, history_days=args.days),
+                        latency=args.latency) as stub:
+        stripe.api_key = os.environ["STRIPE_API_KEY"]
+        stripe.api_base = stub.url
+        ledger = Ledger(os.path.join(tmpdir, "ledger.db"))
+        until = int(time.time()) + 1
+        since = until - args.days * 86400 - 1
+
+        started = time.perf_counter()
+        sessions = list(reconcile.iter_listing(stripe.checkout.Session.list, since, until))
+        gaps = fill_ledger(ledger, sessions)
+        print(f"{len(sessions)} checkouts over {args.days} days, {len(gaps)} gaps planted,"
+              f" {args.latency * 1000:.0f} ms per page ({time.perf_counter() - started:.1f} s setup)")
+
+        run("full, sequential", stub, ledger, since, until, 1, gaps)
+        run(f"full, {args.slices} slices", stub, ledger, since, until, args.slices, gaps)
+        watermark = until - 3600
+        run(f"incremental, {args.slices} slices", stub, ledger, watermark - reconcile.DEFAULT_OVERLAP, until,
+            args.slices, gaps)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Per-SMS latency with a pooled notifier versus a fresh Twilio client per message.
+
+Runs against a local HTTPS stand-in for the Twilio API, so the numbers show
+the connection and TLS handshake cost that pooling removes.
+
+    python bench_sms.py --messages 200
+"""
+import argparse
+import statistics
+import time
+
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+from bench_stubs import StubServer, twilio_routes
+from notifier import SmsNotifier
+
+ACCOUNT_SID = "AC" + "0" * 32
+AUTH_TOKEN = "bench-token"
+
+
+def trust_stub(session, stub):
+    """Verify against the stub's certificate instead of any CA bundle from the environment."""
+    session.trust_env = False
+    session.verify = stub.certfile or True
+
+
+def fresh_send(stub):
+    """What send_sms used to do: a brand new client for every message."""
+    http_client = TwilioHttpClient()
+    trust_stub(http_client.session, stub)
+    client = Client(ACCOUNT_SID, AUTH_TOKEN, http_client=http_client)
+    client.api.base_url = stub.url
+    client.messages.create(from_="+15550001", body="Payment of $50.00 Successful!", to="+15550002")
+    http_client.session.close()
+
+
+def measure(label, send, messages):
+    latencies = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        send()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<8} mean {statistics.mean(latencies):7.3f} ms"
+          f"  p50 {statistics.median(latencies):7.3f} ms  p95 {p95:7.3f} ms")
+    return statistics.mean(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--no-tls", action="store_true", help="Use plain HTTP for the stub")
+    args = parser.parse_args()
+
+    with StubServer(twilio_routes(), tls=not args.no_tls) as stub:
+        notifier = SmsNotifier(ACCOUNT_SID, AUTH_TOKEN, "+15550001", base_url=stub.url)
+        trust_stub(notifier.client.http_client.session, stub)
+
+        connections = stub.connections
+        pooled = measure("pooled", lambda: notifier.send("+15550002", "Payment of $50.00 Successful!"),
+                         args.messages)
+        pooled_connections = stub.connections - connections
+
+        connections = stub.connections
+        fresh = measure("fresh", lambda: fresh_send(stub), args.messages)
+        fresh_connections = stub.connections - connections
+
+    print(f"connections opened: pooled {pooled_connections}, fresh {fresh_connections}")
+    print(f"pooled client saves {fresh - pooled:.3f} ms per SMS ({fresh / pooled:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
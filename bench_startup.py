@@ -0,0 +1,114 @@
+"""Cold-start cost of the Flask app: import time, SDK warm-up and the first Stripe SDK call.
+
+Every run is a fresh interpreter that imports the app and then verifies one
+signed webhook with the Stripe SDK, standing in for the worker's first
+Stripe call (the webhook route itself verifies without the SDK; see
+webhook_ingest.py).
+
+    eager   imports stripe, twilio.rest and aiohttp first, as app.py used to
+    lazy    imports the app as it ships; the SDK loads inside the first webhook
+    warm    imports the app, then runs app.warm_up() as serve.py does
+
+    python bench_startup.py --runs 5 --top 10
+
+``--top`` lists the slowest modules of a lazy import (python -X importtime).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+if {eager!r}:
+    import aiohttp, stripe, twilio.rest
+import app, sdk
+imported = time.perf_counter()
+if {warm!r}:
+    app.warm_up()
+warmed = time.perf_counter()
+
+from bench_stubs import checkout_completed_event, sign_webhook
+payload = checkout_completed_event(1)
+sdk.stripe.Webhook.construct_event(payload, sign_webhook(payload, "whsec_bench"), "whsec_bench")
+verified = time.perf_counter()
+print(json.dumps({{
+    "import": imported - start,
+    "warm_up": warmed - imported,
+    "first_webhook": verified - warmed,
+    "ready": verified - start,
+}}))
+"""
+
+MODES = {"eager": dict(eager=True, warm=False),
+         "lazy": dict(eager=False, warm=False),
+         "warm": dict(eager=False, warm=True)}
+
+
+def child_env():
+    scratch = tempfile.mkdtemp()
+    return dict(os.environ,
+                LOG_LEVEL="CRITICAL",
+                STRIPE_API_KEY="sk_test_bench",
+                EVENT_STORE_PATH=os.path.join(scratch, "events.db"),
+                LEDGER_PATH=os.path.join(scratch, "ledger.db"))
+
+
+def run(mode, env):
+    code = CHILD.format(**MODES[mode])
+    result = subprocess.run([sys.executable, "-c", code], env=env, cwd=HERE,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, top):
+    """``(cumulative_seconds, module)`` for ``app`` and the slowest modules it imports directly."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], env=env, cwd=HERE,
+                            capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # A module is listed after everything it imported, one indent deeper
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        row = (int(cumulative) / 1e6, name.strip())
+        if depth == 1:
+            rows.append(row)
+        elif depth == 0:
+            if row[1] == "app":
+                return [row] + sorted(rows, reverse=True)[:top]
+            rows = []
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per mode")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    args = parser.parse_args()
+
+    env = child_env()
+    print(f"{'mode':<6} {'import':>9} {'warm-up':>9} {'1st hook':>9} {'ready':>9}   (median ms of {args.runs})")
+    for mode in MODES:
+        runs = [run(mode, env) for _ in range(args.runs)]
+        median = {key: statistics.median(r[key] for r in runs) * 1000 for key in runs[0]}
+        print(f"{mode:<6} {median['import']:9.1f} {median['warm_up']:9.1f} "
+              f"{median['first_webhook']:9.1f} {median['ready']:9.1f}")
+
+    if args.top:
+        print(f"\nslowest imports of a lazy 'import app':")
+        for seconds, name in slowest_imports(env, args.top):
+            print(f"  {seconds * 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
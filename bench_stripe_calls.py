@@ -0,0 +1,94 @@
+"""Outbound Stripe calls per checkout.session.completed event, before and after.
+
+"before" replays the original webhook flow (Customer.list, create/modify,
+PaymentIntent.retrieve, PaymentIntent.modify on every event); "after" runs
+the app's current handler. Both talk to a local Stripe stand-in, and SMS
+sending is stubbed out so only Stripe traffic is counted.
+
+    python bench_stripe_calls.py --events 200 --customers 20
+"""
+import argparse
+import os
+import tempfile
+import time
+
+os.environ.setdefault("STRIPE_API_KEY", "sk_test_bench")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("EVENT_STORE_PATH", os.path.join(tempfile.mkdtemp(), "events.db"))
+os.environ.setdefault("LEDGER_PATH", os.path.join(tempfile.mkdtemp(), "ledger.db"))
+
+import stripe
+
+import app as webhook_app
+from bench_stubs import StubServer, stripe_routes
+
+
+def make_event(i, customers):
+    return stripe.Event.construct_from({
+        "id": f"evt_{i}",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": f"cs_{i}",
+            "object": "checkout.session",
+            "amount_total": 5000,
+            "payment_intent": f"pi_{i}",
+            "payment_status": "paid",
+            "metadata": {"phone": "+15550002"},
+            "customer_details": {"email": f"customer{i % customers}@example.com",
+                                 "name": f"Customer {i % customers}"},
+        }},
+    }, stripe.api_key)
+
+
+def original_flow(event):
+    """The webhook's customer handling as it was before caching and the single write."""
+    session = event["data"]["object"]
+    email = session["customer_details"]["email"]
+    name = session["customer_details"]["name"]
+    customers = stripe.Customer.list(email=email)
+    if customers.data:
+        customer = customers.data[0]
+        if name and customer.name != name:
+            customer = stripe.Customer.modify(customer.id, name=name)
+    else:
+        customer = stripe.Customer.create(email=email, name=name)
+    payment_intent = stripe.PaymentIntent.retrieve(session.payment_intent)
+    stripe.PaymentIntent.modify(payment_intent.id, metadata={
+        "customer_id": customer.id,
+        "customer_email": email,
+        "customer_name": name,
+        "phone": session["metadata"]["phone"],
+    })
+
+
+def run(label, handle, events):
+    with StubServer(stripe_routes()) as stub:
+        stripe.api_base = stub.url
+        start = time.perf_counter()
+        for event in events:
+            handle(event)
+        elapsed = time.perf_counter() - start
+    print(f"{label:<7} {stub.requests / len(events):5.2f} calls/event"
+          f"  {elapsed / len(events) * 1000:7.3f} ms/event")
+    for call, count in sorted(stub.calls.items()):
+        print(f"        {count:6d}  {call}")
+    return stub.requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--customers", type=int, default=20, help="Distinct customer emails")
+    args = parser.parse_args()
+
+    events = [make_event(i, args.customers) for i in range(args.events)]
+    webhook_app.send_sms = lambda amount, session_id=None: True
+
+    before = run("before", original_flow, events)
+    after = run("after", webhook_app.handle_event, events)
+    print(f"outbound Stripe calls reduced by {before - after} ({(1 - after / before) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
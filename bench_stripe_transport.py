@@ -0,0 +1,73 @@
+"""Stripe call latency per webhook with the SDK's default client and with StripeTransport.
+
+Each webhook runs on a new thread, as a thread-per-request server runs it,
+and makes the Stripe calls of a first-time customer: Customer.list,
+Customer.create and PaymentIntent.modify. The Stripe stand-in serves TLS
+with a self-signed certificate and ``--latency`` seconds per response, so
+the difference between the clients is connection setup: the default client
+opens a new TLS connection for every thread, while the transport reuses a
+shared pool.
+
+    python bench_stripe_transport.py --webhooks 200 --concurrency 4 --latency 0.002
+"""
+import argparse
+import statistics
+import threading
+import time
+
+import stripe
+
+from bench_stubs import StubServer, stripe_routes
+from services import StripeGateway
+from stripe_transport import StripeTransport
+
+
+def webhook(gateway, i, timings):
+    start = time.perf_counter()
+    email = f"bench{i}@example.com"
+    customers = gateway.list_customers(email)
+    customer = customers[0] if customers else gateway.create_customer(email, f"Customer {i}")
+    gateway.modify_payment_intent(f"pi_{i:024d}", {"customer_id": customer.id})
+    timings.append(time.perf_counter() - start)
+
+
+def run(label, client, args):
+    with StubServer(stripe_routes(), tls=True, latency=args.latency) as stub:
+        stripe.api_base = stub.url
+        stripe.ca_bundle_path = stub.certfile
+        stripe.default_http_client = client
+        gateway = StripeGateway()
+        timings = []
+        start = time.perf_counter()
+        for first in range(0, args.webhooks, args.concurrency):
+            threads = [threading.Thread(target=webhook, args=(gateway, i, timings))
+                       for i in range(first, min(first + args.concurrency, args.webhooks))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - start
+    per_webhook = statistics.median(timings) * 1000
+    print(f"{label:<9} {per_webhook:8.2f} ms/webhook (median)  {elapsed / args.webhooks * 1000:8.2f} ms wall"
+          f"  {stub.connections:5d} connections for {stub.requests} calls")
+    return per_webhook
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--webhooks", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4, help="Webhooks in flight at once")
+    parser.add_argument("--latency", type=float, default=0.002, help="Stub response delay in seconds")
+    parser.add_argument("--pool-size", type=int, default=10)
+    args = parser.parse_args()
+
+    stripe.api_key = "sk_test_bench"
+    default = run("default", stripe.http_client.RequestsClient(), args)
+    transport = StripeTransport(pool_size=args.pool_size)
+    pooled = run("pooled", transport, args)
+    transport.close()
+    print(f"saved {default - pooled:.2f} ms per webhook ({(1 - pooled / default) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
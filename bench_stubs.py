@@ -0,0 +1,418 @@
+"""Local stand-ins for the external APIs used by the benchmarks.
+
+Each stub is a threaded HTTP/1.1 server with keep-alive, so benchmarks can
+tell pooled clients (one connection, many requests) from fresh ones (one
+connection per request). Pass ``tls=True`` to serve HTTPS with a throwaway
+self-signed certificate; clients should verify against ``server.certfile``.
+``latency`` and ``error_rate`` inject slow responses and failures.
+"""
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from bisect import bisect_right
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+def self_signed_cert():
+    """Create a certificate for 127.0.0.1 with the openssl CLI. Returns (certfile, keyfile)."""
+    directory = tempfile.mkdtemp(prefix="bench-tls-")
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+         "-keyout", keyfile, "-out", certfile],
+        check=True, capture_output=True,
+    )
+    return certfile, keyfile
+
+
+class StubServer:
+    """Serve canned JSON responses for ``(method, path regex)`` routes.
+
+    Route handlers receive the regex match and the form-decoded query string
+    and request body, and return ``(status, body_dict)``.
+    """
+
+    def __init__(self, routes, tls=False, latency=0.0, jitter=0.0,
+                 error_rate=0.0, error_status=500, port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.errors = 0
+        self.routes = [(method, re.compile(pattern), handler) for method, pattern, handler in routes]
+        self.requests = 0
+        self.connections = 0
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.certfile = None
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; without this,
+            # Nagle plus delayed ACKs adds ~40 ms to every keep-alive request
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def _dispatch(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length).decode("utf-8") if length else ""
+                path, _, query = self.path.partition("?")
+                form = {key: values[-1] for key, values in parse_qs(query).items()}
+                form.update((key, values[-1]) for key, values in parse_qs(raw).items())
+                with stub._lock:
+                    stub.requests += 1
+
+                delay = 0.0 if path == "/_stub/stats" else stub.latency + (random.uniform(0, stub.jitter) if stub.jitter else 0.0)
+                if delay:
+                    time.sleep(delay)
+
+                if path == "/_stub/stats":
+                    self._respond(200, stub.stats())
+                    return
+
+                status, body = 404, {"error": {"message": f"No stub for {method} {path}"}}
+                if stub.error_rate and random.random() < stub.error_rate:
+                    with stub._lock:
+                        stub.errors += 1
+                    self._respond(stub.error_status, {"error": {
+                        "type": "api_error", "message": "Injected failure"}})
+                    return
+                for route_method, pattern, handler in stub.routes:
+                    match = pattern.fullmatch(path)
+                    if route_method == method and match:
+                        with stub._lock:
+                            stub.calls[f"{method} {pattern.pattern}"] += 1
+                        status, body = handler(match, form)
+                        break
+
+                self._respond(status, body)
+
+            def _respond(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def do_DELETE(self):
+                self._dispatch("DELETE")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        if tls:
+            self.certfile, keyfile = self_signed_cert()
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, keyfile)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.scheme = "https" if tls else "http"
+        self._thread = None
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "connections": self.connections,
+                    "errors": self.errors, "calls": dict(self.calls)}
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"{self.scheme}://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _serve_in_child(routes_factory, options, ready):
+    server = StubServer(routes_factory(), **options).start()
+    ready.put(server.url)
+    threading.Event().wait()
+
+
+class StubProcess:
+    """Run a stub in a child process so it does not compete with the code under test for the GIL.
+
+    ``routes_factory`` must be a module-level function such as ``stripe_routes``.
+    Counters are read back over HTTP with ``stats()``.
+    """
+
+    def __init__(self, routes_factory, **options):
+        import multiprocessing
+
+        context = multiprocessing.get_context("spawn")
+        self._ready = context.Queue()
+        self._process = context.Process(target=_serve_in_child,
+                                        args=(routes_factory, options, self._ready), daemon=True)
+        self.url = None
+
+    def start(self):
+        self._process.start()
+        self.url = self._ready.get(timeout=30)
+        return self
+
+    def stats(self):
+        from urllib.request import urlopen
+
+        with urlopen(f"{self.url}/_stub/stats") as response:
+            return json.load(response)
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def twilio_routes():
+    """Routes answering Twilio's Messages.create endpoint."""
+    counter = iter(range(1, 10 ** 9))
+
+    def create_message(match, form):
+        return 201, {
+            "sid": f"SM{next(counter):032d}",
+            "account_sid": match.group(1),
+            "from": form.get("From"),
+            "to": form.get("To"),
+            "body": form.get("Body"),
+            "status": "queued",
+            "direction": "outbound-api",
+            "date_created": time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()),
+            "error_code": None,
+            "error_message": None,
+        }
+
+    return [("POST", r"/2010-04-01/Accounts/([^/]+)/Messages\.json", create_message)]
+
+
+class Listing:
+    """Objects served the way Stripe's list endpoints page them.
+
+    Newest first, filtered on ``created[gte]``/``created[lt]`` and paged
+    with ``limit`` and ``starting_after``. The order is rebuilt only after
+    an object was added, so paging a large history stays cheap.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._objects = {}
+        self._order = None
+        self._lock = threading.Lock()
+
+    def add(self, obj):
+        with self._lock:
+            self._objects[obj["id"]] = obj
+            self._order = None
+
+    def get(self, object_id):
+        with self._lock:
+            return self._objects.get(object_id)
+
+    def page(self, form):
+        with self._lock:
+            if self._order is None:
+                order = sorted(self._objects.values(), key=lambda o: (-o["created"], o["id"]))
+                self._order = (order, [-o["created"] for o in order],
+                               {o["id"]: i for i, o in enumerate(order)})
+            order, keys, position = self._order
+        # keys ascend, so created < lt starts after the last key <= -lt
+        start = bisect_right(keys, -int(form["created[lt]"])) if "created[lt]" in form else 0
+        end = bisect_right(keys, -int(form["created[gte]"])) if "created[gte]" in form else len(order)
+        if form.get("starting_after") in position:
+            start = max(start, position[form["starting_after"]] + 1)
+        limit = int(form.get("limit", 10))
+        return 200, {"object": "list", "url": self.url, "has_more": start + limit < end,
+                     "data": order[start:min(start + limit, end)]}
+
+
+def stripe_routes(history=0, history_days=30):
+    """Routes for the Stripe endpoints the app calls, backed by in-memory objects.
+
+    ``history`` completed checkouts, spread over the last ``history_days``,
+    are listed by the Checkout Session and PaymentIntent list endpoints.
+    """
+    counter = iter(range(1, 10 ** 9))
+    customers = {}
+    prices = {}
+    lock = threading.Lock()
+    sessions = Listing("/v1/checkout/sessions")
+    payment_intents = Listing("/v1/payment_intents")
+    now = int(time.time())
+    for i in range(history):
+        session = checkout_session(i, created=now - history_days * 86400 * (history - i) // history)
+        sessions.add(session)
+        payment_intents.add(payment_intent_object(session))
+
+    def metadata(form):
+        return {key[len("metadata["):-1]: value for key, value in form.items()
+                if key.startswith("metadata[")}
+
+    def create_session(match, form):
+        session_id = f"cs_test_{next(counter):024d}"
+        session = {
+            "id": session_id,
+            "object": "checkout.session",
+            "created": int(time.time()),
+            "status": "open",
+            "payment_status": "unpaid",
+            "url": f"https://checkout.stripe.com/c/pay/{session_id}",
+            "success_url": form.get("success_url"),
+            "cancel_url": form.get("cancel_url"),
+            "mode": form.get("mode"),
+            "payment_intent": None,
+            "metadata": metadata(form),
+            "expires_at": int(time.time()) + 24 * 3600,
+        }
+        sessions.add(session)
+        return 200, session
+
+    def retrieve_session(match, form):
+        session = sessions.get(match.group(1))
+        if session is None:
+            return 404, {"error": {"type": "invalid_request_error", "code": "resource_missing",
+                                   "message": f"No such checkout.session: '{match.group(1)}'"}}
+        return 200, session
+
+    def list_customers(match, form):
+        with lock:
+            data = [c for c in customers.values() if c["email"] == form.get("email")]
+        return 200, {"object": "list", "url": "/v1/customers", "has_more": False, "data": data}
+
+    def create_customer(match, form):
+        customer = {"id": f"cus_{next(counter):014d}", "object": "customer",
+                    "email": form.get("email"), "name": form.get("name"), "metadata": {}}
+        with lock:
+            customers[customer["id"]] = customer
+        return 200, customer
+
+    def modify_customer(match, form):
+        with lock:
+            customer = customers.get(match.group(1))
+            if customer is None:
+                return 404, {"error": {"type": "invalid_request_error", "code": "resource_missing",
+                                       "message": f"No such customer: '{match.group(1)}'"}}
+            customer.update((key, value) for key, value in form.items() if key in ("email", "name"))
+            return 200, dict(customer)
+
+    def list_prices(match, form):
+        keys = {value for key, value in form.items() if key.startswith("lookup_keys[")}
+        with lock:
+            data = [p for p in prices.values() if p["lookup_key"] in keys]
+        return 200, {"object": "list", "url": "/v1/prices", "has_more": False, "data": data}
+
+    def create_price(match, form):
+        price = {"id": f"price_{next(counter):014d}", "object": "price", "active": True,
+                 "currency": form.get("currency"), "unit_amount": int(form.get("unit_amount", 0)),
+                 "lookup_key": form.get("lookup_key"), "metadata": metadata(form)}
+        with lock:
+            prices[price["id"]] = price
+        return 200, price
+
+    def payment_intent(match, form):
+        stored = payment_intents.get(match.group(1))
+        if stored is not None:
+            return 200, dict(stored, metadata=dict(stored["metadata"], **metadata(form)))
+        return 200, {"id": match.group(1), "object": "payment_intent", "amount": 5000,
+                     "currency": "usd", "status": "succeeded", "metadata": metadata(form)}
+
+    return [
+        ("GET", r"/v1/checkout/sessions", lambda match, form: sessions.page(form)),
+        ("POST", r"/v1/checkout/sessions", create_session),
+        ("GET", r"/v1/checkout/sessions/([^/]+)", retrieve_session),
+        ("GET", r"/v1/customers", list_customers),
+        ("POST", r"/v1/customers", create_customer),
+        ("POST", r"/v1/customers/([^/]+)", modify_customer),
+        ("GET", r"/v1/prices", list_prices),
+        ("POST", r"/v1/prices", create_price),
+        ("GET", r"/v1/payment_intents", lambda match, form: payment_intents.page(form)),
+        ("GET", r"/v1/payment_intents/([^/]+)", payment_intent),
+        ("POST", r"/v1/payment_intents/([^/]+)", payment_intent),
+    ]
+
+
+def sign_webhook(payload, secret, timestamp=None):
+    """Build a ``Stripe-Signature`` header for a payload, the way Stripe signs webhooks."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signed = f"{timestamp}.".encode("utf-8") + payload
+    signature = hmac.new(secret.encode("utf-8"), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def checkout_session(i, email=None, amount=5000, created=None):
+    """A completed Checkout Session shaped like Stripe's."""
+    return {
+        "id": f"cs_test_{i:024d}",
+        "object": "checkout.session",
+        "created": int(time.time()) if created is None else created,
+        "amount_total": amount,
+        "currency": "usd",
+        "mode": "payment",
+        "payment_intent": f"pi_{i:024d}",
+        "payment_status": "paid",
+        "status": "complete",
+        "metadata": {"phone": "+15550002"},
+        "customer_details": {"email": email or f"customer{i}@example.com",
+                             "name": f"Customer {i}", "phone": None},
+    }
+
+
+def payment_intent_object(session):
+    """The succeeded PaymentIntent behind a completed Checkout Session, tagged as the webhook tags it."""
+    return {"id": session["payment_intent"], "object": "payment_intent", "created": session["created"],
+            "amount": session["amount_total"], "currency": session["currency"], "status": "succeeded",
+            "metadata": {"customer_id": "cus_" + session["id"][-14:], "checkout_session": session["id"]}}
+
+
+def checkout_completed_event(i, email=None, amount=5000):
+    """A ``checkout.session.completed`` event payload shaped like Stripe's."""
+    return json.dumps({
+        "id": f"evt_{i:024d}",
+        "object": "event",
+        "api_version": "2023-10-16",
+        "created": int(time.time()),
+        "type": "checkout.session.completed",
+        "data": {"object": checkout_session(i, email, amount)},
+        "livemode": False,
+        "pending_webhooks": 1,
+    }).encode("utf-8")
@@ -0,0 +1,129 @@
+"""Webhook verification and decoding: stripe.Webhook.construct_event versus webhook_ingest.
+
+Both paths verify the signature and read the fields the handlers use from
+each event. Events are a mix of ``checkout.session.completed`` and event
+types the app does not handle (``--unhandled`` is their share), with the
+type as the last key, as Stripe sends it. Throughput is measured without
+tracing; memory is the peak traced allocation while handling one event.
+
+    python bench_webhook_ingest.py --events 5000 --unhandled 0.5
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+import stripe
+
+import webhook_ingest
+from bench_stubs import checkout_session, sign_webhook
+
+SECRET = "whsec_bench"
+
+
+def charge(i):
+    """A ``charge.succeeded`` object of about the size Stripe sends."""
+    return {
+        "id": f"ch_{i:024d}", "object": "charge", "amount": 5000, "amount_captured": 5000,
+        "currency": "usd", "paid": True, "status": "succeeded", "created": int(time.time()),
+        "payment_intent": f"pi_{i:024d}", "payment_method": f"pm_{i:024d}",
+        "billing_details": {"address": {"city": None, "country": "US", "line1": None, "line2": None,
+                                        "postal_code": "94103", "state": None},
+                            "email": f"customer{i}@example.com", "name": f"Customer {i}", "phone": None},
+        "outcome": {"network_status": "approved_by_network", "reason": None, "risk_level": "normal",
+                    "risk_score": 32, "seller_message": "Payment complete.", "type": "authorized"},
+        "payment_method_details": {"card": {"brand": "visa", "checks": {"address_line1_check": None,
+                                                                        "address_postal_code_check": "pass",
+                                                                        "cvc_check": "pass"},
+                                            "country": "US", "exp_month": 12, "exp_year": 2030,
+                                            "fingerprint": "Xt5EWLLDS7FJjR1c", "funding": "credit",
+                                            "last4": "4242", "network": "visa"},
+                                   "type": "card"},
+        "refunds": {"object": "list", "data": [], "has_more": False, "total_count": 0,
+                    "url": f"/v1/charges/ch_{i:024d}/refunds"},
+        "metadata": {"phone": "+15550002"},
+    }
+
+
+def make_events(count, unhandled):
+    rng = random.Random(0)
+    events = []
+    for i in range(count):
+        if rng.random() < unhandled:
+            event_type, obj = "charge.succeeded", charge(i)
+        else:
+            event_type, obj = "checkout.session.completed", checkout_session(i)
+        payload = json.dumps({
+            "id": f"evt_{i:024d}", "object": "event", "api_version": "2023-10-16",
+            "created": int(time.time()), "data": {"object": obj}, "livemode": False,
+            "pending_webhooks": 1, "request": {"id": None, "idempotency_key": None},
+            "type": event_type,
+        }).encode("utf-8")
+        events.append((payload, sign_webhook(payload, SECRET)))
+    return events
+
+
+def read_fields(event):
+    """What the webhook route and handler read from an event."""
+    fields = [event["id"], event["type"], event["created"]]
+    if event["type"] == "checkout.session.completed":
+        session = event["data"]["object"]
+        details = session.get("customer_details") or {}
+        fields += [session["id"], session["amount_total"], session.get("payment_intent"),
+                   session.get("payment_status"), details.get("email"), details.get("name"),
+                   (session.get("metadata") or {}).get("phone")]
+    return fields
+
+
+def sdk_path(payload, header):
+    return read_fields(stripe.Webhook.construct_event(payload, header, SECRET))
+
+
+def ingest_path(payload, header):
+    return read_fields(webhook_ingest.construct_event(payload, header, SECRET))
+
+
+PATHS = {"sdk": sdk_path, "ingest": ingest_path}
+
+
+def throughput(path, events):
+    start = time.perf_counter()
+    for payload, header in events:
+        path(payload, header)
+    return len(events) / (time.perf_counter() - start)
+
+
+def allocated(path, events):
+    """Mean peak bytes traced while handling one event."""
+    tracemalloc.start()
+    total = 0
+    for payload, header in events:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        path(payload, header)
+        total += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return total / len(events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--unhandled", type=float, default=0.5, help="Share of events of unhandled types")
+    args = parser.parse_args()
+
+    events = make_events(args.events, args.unhandled)
+    mean_bytes = sum(len(payload) for payload, _ in events) / len(events)
+    print(f"{args.events} events, {mean_bytes:.0f} bytes on average, {args.unhandled:.0%} unhandled")
+    results = {}
+    for name, path in PATHS.items():
+        path(*events[0])
+        results[name] = (throughput(path, events), allocated(path, events[:1000]))
+        print(f"{name:<7} {results[name][0]:10.0f} events/s  {results[name][1]:10.0f} bytes/event")
+    (sdk_rate, sdk_bytes), (rate, allocated_bytes) = results["sdk"], results["ingest"]
+    print(f"ingest: {rate / sdk_rate:.1f}x the events per second, {allocated_bytes / sdk_bytes:.0%} of the memory")
+
+
+if __name__ == "__main__":
+    main()
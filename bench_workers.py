@@ -0,0 +1,173 @@
+"""Scaling benchmark for serve.py: throughput and memory per worker from 1 to N workers.
+
+For each worker count it starts serve.py against the local Stripe and
+Twilio stubs, drives the chosen endpoints from several client processes
+and reads each worker's memory from /proc:
+
+    python bench_workers.py --max-workers 4 --requests 2000
+    python bench_workers.py --max-workers 4 --no-preload   # every worker imports the app itself
+
+RSS counts pages shared with the parent in full; PSS splits them between
+the processes sharing them, and USS is what a worker alone holds. Memory
+figures need Linux. Throughput can only grow while there are idle cores,
+including for the stubs and the load generator.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from bench_load import configure_environment, run_endpoint
+from bench_stubs import StubProcess, stripe_routes, twilio_routes
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def worker_pids(parent):
+    pids = set()
+    for task in os.listdir(f"/proc/{parent}/task"):
+        with open(f"/proc/{parent}/task/{task}/children") as f:
+            pids.update(int(pid) for pid in f.read().split())
+    return sorted(pids)
+
+
+def memory_kb(pid):
+    """RSS, PSS and USS of one process in KiB, from /proc/<pid>/smaps_rollup."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {"rss": fields.get("Rss", 0), "pss": fields.get("Pss", 0),
+            "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)}
+
+
+def start_server(environment, workers, threads, preload, log):
+    port = free_port()
+    command = [sys.executable, "serve.py", "--bind", f"127.0.0.1:{port}",
+               "--workers", str(workers), "--threads", str(threads)]
+    if not preload:
+        command.append("--no-preload")
+    process = subprocess.Popen(command, env={**os.environ, **environment}, stdout=log, stderr=log,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"serve.py exited with {process.returncode}; see {log.name}")
+        try:
+            requests.get(url + "/", timeout=1)
+            if len(worker_pids(process.pid)) == workers:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"serve.py did not come up; see {log.name}")
+
+
+def _client(args):
+    endpoint, url, total, concurrency = args
+    return run_endpoint(endpoint, url, total, concurrency)
+
+
+def drive(endpoint, url, total, concurrency, clients):
+    """Split the load over ``clients`` processes, so the load generator is not one GIL."""
+    share = [(endpoint, url, total // clients, max(1, concurrency // clients)) for _ in range(clients)]
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(clients) as pool:
+        parts = pool.map(_client, share)
+    wall = time.perf_counter() - start
+    statuses = {}
+    for part in parts:
+        for status, count in part["statuses"].items():
+            statuses[status] = statuses.get(status, 0) + count
+    return {
+        "rps": round(sum(part["requests"] for part in parts) / wall, 1),
+        "p95_ms": max(part["p95_ms"] for part in parts),
+        "statuses": statuses,
+    }
+
+
+def measure(environment, workers, args, log):
+    process, url = start_server(environment, workers, args.threads, args.preload, log)
+    try:
+        result = {"workers": workers, "endpoints": {}}
+        for endpoint in args.endpoints.split(","):
+            result["endpoints"][endpoint] = drive(endpoint, url, args.requests, args.concurrency, args.clients)
+        # After the load, so each worker's memory includes what serving touched
+        per_worker = [memory_kb(pid) for pid in worker_pids(process.pid)]
+        result["parent"] = memory_kb(process.pid)
+        result["worker_memory_kb"] = {key: round(sum(m[key] for m in per_worker) / len(per_worker))
+                                      for key in ("rss", "pss", "uss")}
+        result["total_pss_kb"] = result["parent"]["pss"] + sum(m["pss"] for m in per_worker)
+        return result
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(30)
+
+
+def print_report(results):
+    endpoints = list(results[0]["endpoints"])
+    header = f"{'workers':>7}" + "".join(f"{e + ' rps':>14}{'x':>6}" for e in endpoints)
+    print(header + f"{'RSS MiB':>10}{'PSS MiB':>10}{'USS MiB':>10}{'total MiB':>11}")
+    for r in results:
+        line = f"{r['workers']:>7}"
+        for e in endpoints:
+            rps = r["endpoints"][e]["rps"]
+            line += f"{rps:>14.1f}{rps / results[0]['endpoints'][e]['rps']:>6.2f}"
+        memory = r["worker_memory_kb"]
+        line += (f"{memory['rss'] / 1024:>10.1f}{memory['pss'] / 1024:>10.1f}{memory['uss'] / 1024:>10.1f}"
+                 f"{r['total_pss_kb'] / 1024:>11.1f}")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads", type=int, default=4, help="Request threads per worker")
+    parser.add_argument("--endpoints", default="home,pay", help="Comma-separated endpoints from bench_load")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per endpoint and worker count")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--clients", type=int, default=2, help="Load generator processes")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="Seconds added to every stub response")
+    parser.add_argument("--no-preload", dest="preload", action="store_false")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    stripe_stub = StubProcess(stripe_routes, latency=args.stub_latency).start()
+    twilio_stub = StubProcess(twilio_routes, latency=args.stub_latency).start()
+    scratch = tempfile.mkdtemp(prefix="bench-workers-")
+    environment = configure_environment(stripe_stub, twilio_stub, scratch)
+    environment["METRICS_DIR"] = os.path.join(scratch, "metrics")
+
+    counts = sorted({1, args.max_workers} | {2 ** i for i in range(args.max_workers.bit_length())
+                                             if 2 ** i <= args.max_workers})
+    results = []
+    with open(os.path.join(scratch, "server.log"), "a") as log:
+        for workers in counts:
+            results.append(measure(environment, workers, args, log))
+    print_report(results)
+    print(f"preload: {args.preload}, server log: {log.name}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"preload": args.preload, "cpus": os.cpu_count(), "results": results}, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("catalog")
+
+# Stripe's limit on lookup_keys per Price.list call
+_LOOKUP_BATCH = 10
+
+
+class Product:
+    """One SKU. ``unit_amount`` is in the currency's smallest unit (cents)."""
+
+    __slots__ = ("sku", "name", "unit_amount", "currency", "description")
+
+    def __init__(self, sku, name, unit_amount, currency="usd", description=None):
+        if not sku or not name:
+            raise ValueError("A product needs a sku and a name")
+        if not isinstance(unit_amount, int) or unit_amount <= 0:
+            raise ValueError(f"Invalid unit_amount for {sku}: {unit_amount!r}")
+        self.sku = sku
+        self.name = name
+        self.unit_amount = unit_amount
+        self.currency = currency.lower()
+        self.description = description
+
+    @property
+    def lookup_key(self):
+        # Changes with the price, so a repriced product gets a new Stripe Price
+        return f"{self.sku}:{self.currency}:{self.unit_amount}"
+
+    @property
+    def display_amount(self):
+        return f"{self.unit_amount / 100:.2f}"
+
+    def price_data(self):
+        """Inline ``price_data`` for a Checkout line item, used until the Price is synced."""
+        product_data = {"name": self.name}
+        if self.description:
+            product_data["description"] = self.description
+        return {"currency": self.currency, "product_data": product_data, "unit_amount": self.unit_amount}
+
+    def to_dict(self):
+        return {"sku": self.sku, "name": self.name, "unit_amount": self.unit_amount,
+                "currency": self.currency, "description": self.description}
+
+    def __eq__(self, other):
+        return isinstance(other, Product) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Product({self.sku!r}, {self.name!r}, {self.unit_amount}, {self.currency!r})"
+
+
+DEFAULT_PRODUCT = Product("test-product", "Test Product", 5000)
+
+
+def load_products(path):
+    """Read products from a JSON file or a SQLite database.
+
+    JSON is a list of objects (or ``{"products": [...]}``) with ``sku``,
+    ``name``, ``unit_amount`` and optionally ``currency`` and
+    ``description``. SQLite files (``.db``, ``.sqlite``, ``.sqlite3``) need
+    a ``products`` table with those columns; rows with ``active = 0`` are
+    skipped when the table has an ``active`` column.
+    """
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            conn.row_factory = sqlite3.Row
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(products)")}
+            query = "SELECT * FROM products" + (" WHERE active" if "active" in columns else "")
+            rows = [dict(row) for row in conn.execute(query)]
+        finally:
+            conn.close()
+    else:
+        with open(path) as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows["products"]
+
+    products = {}
+    for row in rows:
+        product = Product(row.get("sku"), row.get("name"), row.get("unit_amount"),
+                          row.get("currency") or "usd", row.get("description"))
+        if product.sku in products:
+            raise ValueError(f"Duplicate sku in catalog: {product.sku}")
+        products[product.sku] = product
+    return products
+
+
+class Catalog:
+    """Products by SKU, with the Stripe Price ID for each.
+
+    Products come from ``path`` (see ``load_products``), or are just
+    ``DEFAULT_PRODUCT`` without one. Lookups are dictionary reads on an
+    immutable snapshot, which ``reload`` replaces in one assignment, so
+    requests never wait on a reload. ``sync`` makes sure every product has
+    a Stripe Price, found by its lookup key or created once, and caches the
+    IDs in memory and, with ``price_cache_path``, in SQLite so restarts and
+    other workers skip the lookup. ``start`` syncs in the background and
+    then reloads whenever the file changes.
+    """
+
+    def __init__(self, path=None, price_cache_path=None, check_interval=5.0):
+        self.path = path
+        self.price_cache_path = price_cache_path
+        self.check_interval = check_interval
+
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        self._products = {}
+        self._prices = {}
+        self._mtime = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._listeners = []
+        self._stats = {"reloads": 0, "reload_errors": 0, "syncs": 0, "sync_errors": 0,
+                       "prices_found": 0, "prices_created": 0}
+
+        if price_cache_path:
+            self._init_db()
+            self._prices = self._load_prices()
+        if path is None:
+            self._products = {DEFAULT_PRODUCT.sku: DEFAULT_PRODUCT}
+        else:
+            # A bad file at startup is an error; later ones keep the last good catalog
+            self._mtime = self._file_mtime()
+            self._products = load_products(path)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        # A connection opened before a fork belongs to the parent; open our own
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.price_cache_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        directory = os.path.dirname(os.path.abspath(self.price_cache_path))
+        os.makedirs(directory, exist_ok=True)
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS catalog_prices (
+                lookup_key TEXT PRIMARY KEY,
+                price_id TEXT NOT NULL,
+                synced_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+    def _load_prices(self):
+        return dict(self._connect().execute("SELECT lookup_key, price_id FROM catalog_prices"))
+
+    def get(self, sku):
+        """The product for ``sku``, or None."""
+        return self._products.get(sku)
+
+    def price_id(self, product):
+        """The synced Stripe Price ID for ``product``, or None before it is synced."""
+        return self._prices.get(product.lookup_key)
+
+    def products(self):
+        return list(self._products.values())
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def add_listener(self, callback):
+        """Call ``callback()`` after every reload that changed the products."""
+        self._listeners.append(callback)
+
+    def reload(self):
+        """Re-read the products. A bad file is logged and the current products kept."""
+        if self.path is None:
+            return False
+        # Recorded before reading, so a bad file is reported once rather than every check
+        self._mtime = self._file_mtime()
+        try:
+            products = load_products(self.path)
+        except Exception as e:
+            self._stats["reload_errors"] += 1
+            logger.error("Catalog reload failed", extra={"path": self.path, "error": str(e)})
+            return False
+        changed = products != self._products
+        self._products = products
+        self._stats["reloads"] += 1
+        logger.info("Catalog loaded", extra={"path": self.path, "products": len(products)})
+        if changed:
+            for callback in self._listeners:
+                callback()
+        return True
+
+    def changed(self):
+        return self.path is not None and self._file_mtime() != self._mtime
+
+    def sync(self, gateway):
+        """Give every product a Stripe Price. Returns how many were still missing."""
+        with self._sync_lock:
+            missing = [p for p in self._products.values() if p.lookup_key not in self._prices]
+            found = {}
+            for i in range(0, len(missing), _LOOKUP_BATCH):
+                keys = [p.lookup_key for p in missing[i:i + _LOOKUP_BATCH]]
+                for price in gateway.list_prices(keys):
+                    found[price["lookup_key"]] = price["id"]
+            self._stats["prices_found"] += len(found)
+
+            for product in missing:
+                if product.lookup_key not in found:
+                    price = gateway.create_price(product)
+                    found[product.lookup_key] = price["id"]
+                    self._stats["prices_created"] += 1
+
+            if found and self.price_cache_path:
+                now = time.time()
+                self._connect().executemany(
+                    "INSERT OR REPLACE INTO catalog_prices (lookup_key, price_id, synced_at) VALUES (?, ?, ?)",
+                    [(key, price_id, now) for key, price_id in found.items()],
+                )
+            # Copy-on-write, so readers never see a dict being resized
+            self._prices = {**self._prices, **found}
+            self._stats["syncs"] += 1
+            return len(missing)
+
+    def start(self, gateway):
+        """Sync in the background, then reload and sync again when the file changes."""
+        # Threads don't survive fork(), so a forked child starts its own
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, args=(gateway,), name="catalog", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self, gateway):
+        synced = False
+        while True:
+            if self.changed() and self.reload():
+                synced = False
+            if not synced:
+                try:
+                    self.sync(gateway)
+                    synced = True
+                except Exception as e:
+                    self._stats["sync_errors"] += 1
+                    logger.error("Catalog price sync failed", extra={"error_type": type(e).__name__,
+                                                                     "error": str(e)})
+            if self._stopping.wait(self.check_interval):
+                return
+
+    def metrics(self):
+        products = self._products
+        stats = dict(self._stats)
+        stats["products"] = len(products)
+        stats["priced"] = sum(1 for p in products.values() if p.lookup_key in self._prices)
+        return stats
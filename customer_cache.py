@@ -0,0 +1,170 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_email(email):
+    # Case-insensitive on purpose: one customer per mailbox, however a checkout form
+    # cased it. Stripe's email filter is case-sensitive, so whichever casing is
+    # cached first is the customer every other casing gets.
+    return email.strip().lower()
+
+
+class CustomerCache:
+    """Stripe customer IDs and names keyed by normalized email.
+
+    An in-process LRU answers most lookups. When ``path`` is set, a SQLite
+    tier behind it lets the cache survive restarts and be shared by every
+    worker on the host. Entries expire after ``ttl`` seconds and are dropped
+    explicitly when Stripe reports the customer was updated or deleted.
+
+    An invalidation in one worker must reach the others' in-memory tiers
+    too. The SQLite file holds a generation counter that every invalidation
+    bumps; memory entries remember the generation they were read at and are
+    only trusted while it is unchanged.
+    """
+
+    def __init__(self, max_memory=10000, path=None, ttl=24 * 3600):
+        self.max_memory = max_memory
+        self.path = path
+        self.ttl = ttl
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+        if path:
+            self._init_db()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        # A connection opened before a fork belongs to the parent; open our own
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS customers (
+                email TEXT PRIMARY KEY,
+                customer_id TEXT NOT NULL,
+                name TEXT,
+                cached_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS customers_customer_id ON customers (customer_id)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER)")
+        conn.execute("INSERT OR IGNORE INTO generation (id, value) VALUES (0, 0)")
+
+    def _generation(self):
+        """The shared invalidation counter, or 0 without a disk tier."""
+        if not self.path:
+            return 0
+        return self._connect().execute("SELECT value FROM generation WHERE id = 0").fetchone()[0]
+
+    def _remember(self, email, entry):
+        with self._lock:
+            self._memory[email] = entry
+            self._memory.move_to_end(email)
+            while len(self._memory) > self.max_memory:
+                self._memory.popitem(last=False)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, email):
+        """Return ``(customer_id, name)`` for an email, or None on a miss."""
+        email = normalize_email(email)
+        now = time.time()
+        # Read before the row, so an invalidation in between makes the entry stale
+        generation = self._generation()
+        with self._lock:
+            entry = self._memory.get(email)
+            if entry is not None:
+                if entry[2] + self.ttl > now and entry[3] == generation:
+                    self._memory.move_to_end(email)
+                    self._stats["hits"] += 1
+                    return entry[0], entry[1]
+                del self._memory[email]
+
+        if self.path:
+            row = self._connect().execute(
+                "SELECT customer_id, name, cached_at FROM customers"
+                " WHERE email = ? AND cached_at > ?",
+                (email, now - self.ttl),
+            ).fetchone()
+            if row is not None:
+                self._remember(email, row + (generation,))
+                self._count("hits")
+                return row[0], row[1]
+
+        self._count("misses")
+        return None
+
+    def email_for(self, customer_id):
+        """The normalized email cached for a customer ID, or None. Not counted as a lookup."""
+        generation = self._generation()
+        with self._lock:
+            for email, entry in self._memory.items():
+                if entry[0] == customer_id and entry[3] == generation:
+                    return email
+        if self.path:
+            row = self._connect().execute(
+                "SELECT email FROM customers WHERE customer_id = ? AND cached_at > ?",
+                (customer_id, time.time() - self.ttl),
+            ).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    def put(self, email, customer_id, name=None):
+        email = normalize_email(email)
+        now = time.time()
+        self._remember(email, (customer_id, name, now, self._generation()))
+        if self.path:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO customers (email, customer_id, name, cached_at)"
+                " VALUES (?, ?, ?, ?)",
+                (email, customer_id, name, now),
+            )
+
+    def invalidate(self, customer_id=None, email=None):
+        """Forget a customer by ID, email or both."""
+        email = normalize_email(email) if email else None
+        with self._lock:
+            stale = [key for key, entry in self._memory.items()
+                     if key == email or (customer_id and entry[0] == customer_id)]
+            for key in stale:
+                del self._memory[key]
+            self._stats["invalidations"] += 1
+        if self.path:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM customers WHERE email = ? OR customer_id = ?", (email, customer_id))
+                conn.execute("UPDATE generation SET value = value + 1 WHERE id = 0")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_size"] = len(self._memory)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
@@ -0,0 +1,130 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class EventStore:
+    """Persistent record of processed Stripe events keyed on event ID.
+
+    Outcomes live in a SQLite table with a bounded in-memory LRU in front of
+    it, so a redelivered event is answered from memory without touching the
+    disk or any external API. Entries older than ``ttl`` seconds are evicted
+    from both tiers; Stripe stops retrying an event after three days, so the
+    default of seven days comfortably covers every redelivery.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_memory=10000, purge_interval=300.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.purge_interval = purge_interval
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._last_purge = 0.0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        # The file and its tables are created by the first connection, so
+        # constructing one (as importing the app does) leaves the disk alone
+        self._created = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        # A connection opened before a fork belongs to the parent; open our own
+        if conn is None or self._local.pid != os.getpid():
+            if not self._created:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._created:
+                self._init_db(conn)
+                self._created = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                event_id TEXT PRIMARY KEY,
+                event_type TEXT,
+                status INTEGER NOT NULL,
+                body TEXT NOT NULL,
+                processed_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS events_processed_at ON events (processed_at)"
+        )
+
+    def _remember(self, event_id, entry):
+        with self._lock:
+            self._memory[event_id] = entry
+            self._memory.move_to_end(event_id)
+            while len(self._memory) > self.max_memory:
+                self._memory.popitem(last=False)
+
+    def get(self, event_id):
+        """Return the stored ``(body, status)`` for an event, or None if unseen."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(event_id)
+            if entry is not None:
+                if entry[2] + self.ttl > now:
+                    self._memory.move_to_end(event_id)
+                    self._stats["memory_hits"] += 1
+                    return entry[0], entry[1]
+                del self._memory[event_id]
+
+        row = self._connect().execute(
+            "SELECT body, status, processed_at FROM events"
+            " WHERE event_id = ? AND processed_at > ?",
+            (event_id, now - self.ttl),
+        ).fetchone()
+        if row is None:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+
+        entry = (json.loads(row[0]), row[1], row[2])
+        self._remember(event_id, entry)
+        with self._lock:
+            self._stats["disk_hits"] += 1
+        return entry[0], entry[1]
+
+    def put(self, event_id, event_type, body, status):
+        """Record the outcome of a processed event."""
+        now = time.time()
+        self._connect().execute(
+            "INSERT OR REPLACE INTO events (event_id, event_type, status, body, processed_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (event_id, event_type, status, json.dumps(body), now),
+        )
+        self._remember(event_id, (body, status, now))
+        if now - self._last_purge > self.purge_interval:
+            self.purge(now)
+
+    def purge(self, now=None):
+        """Drop entries older than the TTL. Returns the number of rows removed."""
+        now = time.time() if now is None else now
+        self._last_purge = now
+        cutoff = now - self.ttl
+        with self._lock:
+            expired = [key for key, entry in self._memory.items() if entry[2] <= cutoff]
+            for key in expired:
+                del self._memory[key]
+        cursor = self._connect().execute(
+            "DELETE FROM events WHERE processed_at <= ?", (cutoff,)
+        )
+        return cursor.rowcount
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_size"] = len(self._memory)
+        return stats
@@ -0,0 +1,206 @@
+"""Ordered lanes: events with the same key run one at a time and in order; other keys run in parallel.
+
+Webhook events for one customer must not overlap: the upsert has to finish
+before the PaymentIntent is tagged, and ``customer.deleted`` must not race
+a ``checkout.session.completed`` for the same customer. Handling every
+event serially would guarantee that, but then one slow Stripe call would
+hold up everyone else's events.
+
+``Lanes`` hashes each key to one of ``lanes`` FIFO queues, each drained by
+its own worker thread. Events that share a key always land in the same lane,
+in the order they were submitted, so they run one after another. Lanes
+work in parallel with each other. Each lane holds at most ``depth``
+waiting events. A submitter waits for room, but only until its request
+deadline or ``max_wait``; past that it gets ``LaneFull``, which carries a
+``retry_after`` for a 503 response.
+
+``AsyncLanes`` gives the same ordering to coroutines on an event loop.
+Each event waits for the one submitted before it on its lane, until the
+request deadline. When a lane is full, a new event is refused at once
+rather than waiting.
+"""
+import asyncio
+import contextvars
+import os
+import queue
+import threading
+import weakref
+import zlib
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from resilience import DeadlineExceeded, remaining
+
+# Every live Lanes, so forked children start their own worker threads
+_instances = weakref.WeakSet()
+
+
+class LaneFull(Exception):
+    """A lane had no room for another event; try again after ``retry_after`` seconds."""
+
+    status = 503
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def lane_for(key, lanes):
+    # Stable across processes and restarts, unlike hash()
+    return zlib.crc32(key.encode("utf-8")) % lanes
+
+
+class Lanes:
+    """``lanes`` ordered queues drained in parallel, one worker thread each."""
+
+    def __init__(self, lanes=8, depth=100, max_wait=5.0, name="lanes"):
+        self.lanes = lanes
+        self.depth = depth
+        self.max_wait = max_wait
+        self.name = name
+        self._start_lock = threading.Lock()
+        self._reset()
+        _instances.add(self)
+
+    def _reset(self):
+        self._queues = [queue.Queue(self.depth) for _ in range(self.lanes)]
+        self._threads = []
+        self._stats = [{"processed": 0, "rejected": 0, "max_depth": 0} for _ in range(self.lanes)]
+        self._stats_lock = threading.Lock()
+
+    def _start(self):
+        # Started on first use, so a pre-fork parent that never submits starts no threads
+        with self._start_lock:
+            if self._threads:
+                return
+            for lane, work in enumerate(self._queues):
+                thread = threading.Thread(target=self._drain, args=(lane, work),
+                                          name=f"{self.name}-{lane}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _drain(self, lane, work):
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            future, context, fn, args = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    # The submitter's context, so logs keep its request ID and spans its trace
+                    future.set_result(context.run(fn, *args))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self._stats_lock:
+                self._stats[lane]["processed"] += 1
+
+    def submit(self, key, fn, *args):
+        """Queue ``fn(*args)`` on ``key``'s lane; returns a ``concurrent.futures.Future``."""
+        if not self._threads:
+            self._start()
+        lane = lane_for(key, self.lanes)
+        work = self._queues[lane]
+        future = Future()
+        left = remaining()
+        wait = self.max_wait if left is None else max(0.0, min(left, self.max_wait))
+        try:
+            work.put((future, contextvars.copy_context(), fn, args), timeout=wait)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats[lane]["rejected"] += 1
+            raise LaneFull(f"Lane {lane} is full ({self.depth} events waiting)") from None
+        with self._stats_lock:
+            stats = self._stats[lane]
+            stats["max_depth"] = max(stats["max_depth"], work.qsize())
+        return future
+
+    def run(self, key, fn, *args):
+        """``fn(*args)`` run on ``key``'s lane; waits for it until the request deadline."""
+        future = self.submit(key, fn, *args)
+        try:
+            return future.result(timeout=remaining())
+        except FutureTimeout:
+            # It still runs; a redelivery then finds its stored outcome
+            raise DeadlineExceeded(f"Deadline passed waiting on lane {lane_for(key, self.lanes)}") from None
+
+    def metrics(self):
+        with self._stats_lock:
+            stats = [dict(s, depth=work.qsize()) for s, work in zip(self._stats, self._queues)]
+        return {
+            "lanes": self.lanes,
+            "depth_limit": self.depth,
+            "running": bool(self._threads),
+            "processed": sum(s["processed"] for s in stats),
+            "rejected": sum(s["rejected"] for s in stats),
+            "waiting": sum(s["depth"] for s in stats),
+            "per_lane": stats,
+        }
+
+    def close(self):
+        """Stop the workers once the events already queued are done."""
+        with self._start_lock:
+            for work in self._queues:
+                work.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._reset()
+
+
+class AsyncLanes:
+    """The ordering of ``Lanes`` for coroutines: each event awaits the one before it on its lane."""
+
+    def __init__(self, lanes=8, depth=100):
+        self.lanes = lanes
+        self.depth = depth
+        self._tails = [None] * lanes
+        self._waiting = [0] * lanes
+        self._stats = [{"processed": 0, "rejected": 0, "max_depth": 0} for _ in range(lanes)]
+
+    async def run(self, key, coro_fn, *args):
+        """``await coro_fn(*args)`` once the events before it on ``key``'s lane are done."""
+        lane = lane_for(key, self.lanes)
+        stats = self._stats[lane]
+        if self._waiting[lane] >= self.depth:
+            stats["rejected"] += 1
+            raise LaneFull(f"Lane {lane} is full ({self.depth} events waiting)")
+        previous = self._tails[lane]
+        done = asyncio.get_running_loop().create_future()
+        self._tails[lane] = done
+        self._waiting[lane] += 1
+        stats["max_depth"] = max(stats["max_depth"], self._waiting[lane])
+        try:
+            if previous is not None and not previous.done():
+                # Our own cancellation or timeout must not cancel the event ahead of us
+                try:
+                    await asyncio.wait_for(asyncio.shield(previous), remaining())
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded(f"Deadline passed waiting on lane {lane}") from None
+            return await coro_fn(*args)
+        finally:
+            self._waiting[lane] -= 1
+            stats["processed"] += 1
+            if previous is not None and not previous.done():
+                # Cancelled while waiting: the next event still waits for the one ahead of us
+                previous.add_done_callback(lambda _: done.set_result(None))
+            else:
+                done.set_result(None)
+
+    def metrics(self):
+        stats = [dict(s, depth=waiting) for s, waiting in zip(self._stats, self._waiting)]
+        return {
+            "lanes": self.lanes,
+            "depth_limit": self.depth,
+            "processed": sum(s["processed"] for s in stats),
+            "rejected": sum(s["rejected"] for s in stats),
+            "waiting": sum(s["depth"] for s in stats),
+            "per_lane": stats,
+        }
+
+
+def _reset_after_fork():
+    for lanes in list(_instances):
+        # The parent's worker threads don't exist in the child
+        lanes._start_lock = threading.Lock()
+        lanes._reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,352 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("ledger")
+
+# Actions the webhook takes for a completed checkout
+CUSTOMER = "customer"
+PAYMENT_INTENT = "payment_intent"
+SMS = "sms"
+ACTIONS = (CUSTOMER, PAYMENT_INTENT, SMS)
+
+# Columns of a payment as the success page and /checkout/status show it
+RECORD_FIELDS = ("session_id", "payment_intent", "customer_email", "amount_total", "currency",
+                 "status", "payment_status", "created")
+
+
+def payment_record(session):
+    """The fields of a Checkout Session the ledger keeps, as a plain dict."""
+    return {
+        "session_id": session["id"],
+        "payment_intent": session.get("payment_intent"),
+        "customer_email": (session.get("customer_details") or {}).get("email"),
+        "amount_total": session.get("amount_total"),
+        "currency": session.get("currency"),
+        "status": session.get("status"),
+        "payment_status": session.get("payment_status"),
+        "created": session.get("created") or int(time.time()),
+    }
+
+
+class Ledger:
+    """What the webhook did for each completed Checkout Session.
+
+    One ``payments`` row per session, plus one ``actions`` row per attempt
+    at each side effect (customer upsert, PaymentIntent tagging, SMS) with
+    its outcome. Attempts are appended rather than overwritten, so a
+    redelivered event that sent a second SMS shows up as two successful
+    ``sms`` rows. ``reconcile.py`` joins this against Stripe.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # The file and its tables are created by the first connection, so
+        # constructing one (as importing the app does) leaves the disk alone
+        self._created = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        # A connection opened before a fork belongs to the parent; open our own
+        if conn is None or self._local.pid != os.getpid():
+            if not self._created:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._created:
+                self._init_db(conn)
+                self._created = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS payments (
+                session_id TEXT PRIMARY KEY,
+                payment_intent TEXT,
+                customer_email TEXT,
+                amount_total INTEGER,
+                currency TEXT,
+                status TEXT,
+                payment_status TEXT,
+                created INTEGER NOT NULL,
+                first_event_id TEXT NOT NULL,
+                events INTEGER NOT NULL DEFAULT 1,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS payments_created ON payments (created)")
+        conn.execute("CREATE INDEX IF NOT EXISTS payments_customer_email ON payments (customer_email, created)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS actions (
+                session_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                action TEXT NOT NULL,
+                ok INTEGER NOT NULL,
+                at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS actions_session ON actions (session_id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                name TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+    def write(self, payments=(), actions=()):
+        """Record payments and action outcomes in one transaction.
+
+        ``payments`` holds ``(event_id, record, at)`` tuples, one per
+        delivery of a completed checkout, with ``record`` from
+        ``payment_record``. ``actions`` holds ``(event_id, session_id,
+        outcomes, at)`` tuples; ``outcomes`` maps each action attempted to
+        whether it succeeded, and actions that were not attempted (no email,
+        no PaymentIntent) are left out.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO payments (session_id, payment_intent, customer_email, amount_total, currency,"
+                " status, payment_status, created, first_event_id, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (session_id) DO UPDATE SET events = events + 1,"
+                " status = excluded.status, payment_status = excluded.payment_status,"
+                " updated_at = excluded.updated_at",
+                [tuple(record[field] for field in RECORD_FIELDS) + (event_id, at)
+                 for event_id, record, at in payments],
+            )
+            conn.executemany(
+                "INSERT INTO actions (session_id, event_id, action, ok, at) VALUES (?, ?, ?, ?, ?)",
+                [(session_id, event_id, action, int(bool(ok)), at)
+                 for event_id, session_id, outcomes, at in actions for action, ok in outcomes.items()],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def record_checkout(self, event_id, session, outcomes):
+        """Record a handled ``checkout.session.completed`` event and what was done for it."""
+        now = time.time()
+        self.write([(event_id, payment_record(session), now)], [(event_id, session["id"], outcomes, now)])
+
+    def payment(self, session_id):
+        """The recorded payment for a Checkout Session, or None."""
+        row = self._connect().execute(
+            f"SELECT {', '.join(RECORD_FIELDS)} FROM payments WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return dict(zip(RECORD_FIELDS, row)) if row else None
+
+    def customer_payments(self, email, limit=20):
+        """A customer's most recent payments, newest first."""
+        rows = self._connect().execute(
+            f"SELECT {', '.join(RECORD_FIELDS)} FROM payments WHERE customer_email = ?"
+            " ORDER BY created DESC LIMIT ?", (email, limit)
+        )
+        return [dict(zip(RECORD_FIELDS, row)) for row in rows]
+
+    def sessions(self, since, until):
+        """Sessions created in ``[since, until)``, by ID, with successful attempts per action."""
+        counts = ", ".join(f"SUM(CASE WHEN a.action = '{action}' THEN a.ok ELSE 0 END)" for action in ACTIONS)
+        rows = self._connect().execute(
+            f"SELECT p.session_id, p.payment_intent, p.customer_email, p.created, p.events, {counts}"
+            " FROM payments p LEFT JOIN actions a ON a.session_id = p.session_id"
+            " WHERE p.created >= ? AND p.created < ? GROUP BY p.session_id",
+            (since, until),
+        )
+        return {
+            row[0]: {"payment_intent": row[1], "customer_email": row[2], "created": row[3], "events": row[4],
+                     "succeeded": dict(zip(ACTIONS, (count or 0 for count in row[5:])))}
+            for row in rows
+        }
+
+    def watermark(self, name):
+        row = self._connect().execute("SELECT value FROM watermarks WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, name, value):
+        self._connect().execute(
+            "INSERT INTO watermarks (name, value) VALUES (?, ?)"
+            " ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+            (name, value),
+        )
+
+
+class LedgerWriter:
+    """Write to a ``Ledger`` from a background thread, many records per transaction.
+
+    The webhook only queues what it did. The writer commits everything that
+    has queued up since its last commit, up to ``batch_size`` records, in a
+    single transaction, so a burst of events costs a few commits instead of
+    one each and the webhook never waits on SQLite. ``payment`` answers from
+    the queue for payments not committed yet. When the queue is full the
+    caller writes directly instead of dropping the record.
+
+    A batch that fails to commit is kept, still answered by ``payment``,
+    and retried with exponential backoff up to ``max_backoff`` seconds.
+    Until it is written the writer takes nothing new from the queue, so
+    once that fills callers write directly and find out for themselves.
+    """
+
+    def __init__(self, ledger, batch_size=200, max_queue=10000, base_backoff=0.1, max_backoff=30.0):
+        self.ledger = ledger
+        self.batch_size = batch_size
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = {}
+        self._unwritten = 0
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._failed = []
+        self._failures = 0
+        self._retry_at = 0.0
+        self._stats = {"queued": 0, "written": 0, "failed": 0, "batches": 0, "direct": 0, "max_batch": 0}
+
+    def record_payment(self, event_id, session):
+        """Queue a delivery of a completed checkout."""
+        record = payment_record(session)
+        with self._lock:
+            entry = self._pending.get(record["session_id"])
+            self._pending[record["session_id"]] = [record, entry[1] + 1 if entry else 1]
+        self._submit(("payment", (event_id, record, time.time())), record["session_id"])
+
+    def record_actions(self, event_id, session, outcomes):
+        """Queue the outcome of each action taken for a completed checkout."""
+        self._submit(("actions", (event_id, session["id"], dict(outcomes), time.time())))
+
+    def _submit(self, item, session_id=None):
+        with self._lock:
+            self._unwritten += 1
+        try:
+            self._queue.put_nowait(item + (session_id,))
+        except queue.Full:
+            with self._lock:
+                self._stats["direct"] += 1
+            if not self._write([item + (session_id,)]):
+                # Kept for the writer thread to retry
+                self.start()
+            return
+        with self._lock:
+            self._stats["queued"] += 1
+        self.start()
+
+    def payment(self, session_id):
+        """The payment for a Checkout Session, including one still queued, or None."""
+        with self._lock:
+            entry = self._pending.get(session_id)
+        if entry is not None:
+            return dict(entry[0])
+        return self.ledger.payment(session_id)
+
+    def _write(self, batch):
+        """Commit a batch; returns False if it failed and was kept for a retry."""
+        payments = [args for kind, args, _ in batch if kind == "payment"]
+        actions = [args for kind, args, _ in batch if kind == "actions"]
+        try:
+            self.ledger.write(payments, actions)
+            ok = True
+        except Exception as e:
+            ok = False
+            logger.error("Ledger write failed, will retry", extra={"records": len(batch), "error": str(e)})
+        with self._lock:
+            self._stats["written" if ok else "failed"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["max_batch"] = max(self._stats["max_batch"], len(batch))
+            if not ok:
+                # Its records stay pending, and so readable, until a retry commits them
+                self._failed.extend(batch)
+                self._failures += 1
+                delay = min(self.max_backoff, self.base_backoff * 2 ** (self._failures - 1))
+                self._retry_at = time.monotonic() + delay
+                return False
+            self._failures = 0
+            for _, _, session_id in batch:
+                entry = self._pending.get(session_id)
+                if entry is not None:
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self._pending[session_id]
+            self._unwritten -= len(batch)
+            self._written.notify_all()
+        return True
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far is written. Returns False on timeout."""
+        with self._lock:
+            return self._written.wait_for(lambda: not self._unwritten, timeout)
+
+    def start(self):
+        # Threads don't survive fork(), so a forked child starts its own
+        if self._running():
+            return
+        with self._lock:
+            if self._running():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="ledger-writer", daemon=True)
+            self._thread.start()
+
+    def _running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self, timeout=5.0):
+        """Write what is queued and stop the thread."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        with self._lock:
+            unwritten = self._unwritten
+        if unwritten:
+            logger.error("Ledger writer stopped with records unwritten", extra={"records": unwritten})
+
+    def _retry(self, now=False):
+        """Write the failed records once their backoff is over; False while they still wait or fail again."""
+        with self._lock:
+            if not self._failed:
+                return True
+            if not now and self._retry_at > time.monotonic():
+                return False
+            batch, self._failed = self._failed, []
+        return self._write(batch)
+
+    def _run(self):
+        while True:
+            if not self._retry():
+                # Wait out the backoff; stop() cuts it short for one last attempt
+                if self._stopping.wait(min(0.5, max(0.0, self._retry_at - time.monotonic()))):
+                    if not self._retry(now=True):
+                        return
+                continue
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            # Whatever queued up while the last batch was written goes in this one
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = self._unwritten
+            stats["retrying"] = len(self._failed)
+        return stats
@@ -0,0 +1,357 @@
+import bisect
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import weakref
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Every registry, so forked children stop writing into their parent's file
+_registries = weakref.WeakSet()
+
+
+class _DictValues:
+    """Sample values for a single process, kept in a dict."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, updates):
+        with self._lock:
+            for key, amount in updates:
+                self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def close(self):
+        pass
+
+
+class _MmapValues:
+    """Sample values for one process in a memory-mapped file.
+
+    The file starts with the number of bytes in use, followed by entries of
+    a 4-byte key length, the UTF-8 key padded to 8 bytes and a float64
+    value. Only the owning process writes to it; other processes read it to
+    aggregate. New entries are written before the used size is bumped, so a
+    reader never sees a half-written key.
+    """
+
+    _HEADER = struct.Struct("i4x")
+    _LENGTH = struct.Struct("i")
+    _VALUE = struct.Struct("d")
+
+    def __init__(self, path, initial_size=64 * 1024):
+        self.path = path
+        self._lock = threading.Lock()
+        self._positions = {}
+
+        self._file = open(path, "a+b")
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(initial_size)
+        self._capacity = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+        self._used = self._HEADER.unpack_from(self._map, 0)[0] or self._HEADER.size
+        # A reused PID (or a restart) continues from the values already in the file
+        for key, _, position in self._entries(self._map, self._used):
+            self._positions[key] = position
+
+    @classmethod
+    def _entries(cls, data, used):
+        offset = cls._HEADER.size
+        while offset < used:
+            length = cls._LENGTH.unpack_from(data, offset)[0]
+            key_end = offset + cls._LENGTH.size + length
+            position = key_end + (-key_end % 8)
+            key = bytes(data[offset + cls._LENGTH.size:key_end]).decode("utf-8")
+            yield key, cls._VALUE.unpack_from(data, position)[0], position
+            offset = position + cls._VALUE.size
+
+    @classmethod
+    def read(cls, path):
+        """Yield ``(key, value)`` pairs from another process's file."""
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < cls._HEADER.size:
+            return
+        used = min(cls._HEADER.unpack_from(data, 0)[0], len(data))
+        for key, value, _ in cls._entries(data, used):
+            yield key, value
+
+    def _position(self, key):
+        position = self._positions.get(key)
+        if position is not None:
+            return position
+
+        encoded = key.encode("utf-8")
+        key_end = self._used + self._LENGTH.size + len(encoded)
+        position = key_end + (-key_end % 8)
+        end = position + self._VALUE.size
+        if end > self._capacity:
+            self._grow(end)
+
+        self._LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + self._LENGTH.size:key_end] = encoded
+        self._VALUE.pack_into(self._map, position, 0.0)
+        self._used = end
+        self._HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def _grow(self, needed):
+        capacity = self._capacity
+        while capacity < needed:
+            capacity *= 2
+        self._map.close()
+        self._file.truncate(capacity)
+        self._capacity = capacity
+        self._map = mmap.mmap(self._file.fileno(), capacity)
+
+    def add(self, updates):
+        with self._lock:
+            for key, amount in updates:
+                position = self._position(key)
+                value = self._VALUE.unpack_from(self._map, position)[0]
+                self._VALUE.pack_into(self._map, position, value + amount)
+
+    def items(self):
+        with self._lock:
+            return [(key, self._VALUE.unpack_from(self._map, position)[0])
+                    for key, position in self._positions.items()]
+
+    def close(self):
+        with self._lock:
+            self._map.close()
+            self._file.close()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._keys = {}
+
+    def _label_values(self, labels):
+        if len(labels) != len(self.labelnames) or not all(name in labels for name in self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _key(self, suffix, values, extra=None):
+        pairs = list(zip(self.labelnames, values))
+        if extra:
+            pairs.append(extra)
+        return json.dumps([self.name, suffix, pairs])
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        values = self._label_values(labels)
+        key = self._keys.get(values)
+        if key is None:
+            key = self._keys[values] = self._key("_total", values)
+        self.registry._store().add(((key, amount),))
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def _child_keys(self, values):
+        keys = self._keys.get(values)
+        if keys is None:
+            buckets = [self._key("_bucket", values, ("le", _format_value(b))) for b in self.buckets]
+            keys = self._keys[values] = (buckets, self._key("_sum", values), self._key("_count", values))
+        return keys
+
+    def observe(self, value, **labels):
+        buckets, sum_key, count_key = self._child_keys(self._label_values(labels))
+        # Buckets are stored individually and made cumulative when rendered
+        bucket = buckets[bisect.bisect_left(self.buckets, value)]
+        self.registry._store().add(((bucket, 1.0), (sum_key, value), (count_key, 1.0)))
+
+    def time(self, **labels):
+        """Context manager that observes the time spent inside it."""
+        return _Timer(self, labels)
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsRegistry:
+    """Counters and histograms, exported in the Prometheus text format.
+
+    Without a directory, samples live in this process only. With one, every
+    process writes to its own memory-mapped file there and ``render`` sums
+    the files, so any worker can answer a scrape for the whole server.
+    Files of exited workers are kept so counters never go backwards; empty
+    the directory when the server is (re)started.
+    """
+
+    def __init__(self, directory=None):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._values = None
+        self.directory = None
+        self.set_directory(directory)
+        _registries.add(self)
+
+    def set_directory(self, directory):
+        with self._lock:
+            if self._values is not None:
+                self._values.close()
+                self._values = None
+            self.directory = directory
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    def _store(self):
+        values = self._values
+        if values is None:
+            with self._lock:
+                if self._values is None:
+                    if self.directory:
+                        path = os.path.join(self.directory, f"metrics-{os.getpid()}.bin")
+                        self._values = _MmapValues(path)
+                    else:
+                        self._values = _DictValues()
+                values = self._values
+        return values
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def collect(self):
+        """Sum every process's samples into ``{key: value}``."""
+        if not self.directory:
+            return dict(self._store().items())
+        totals = {}
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.bin")):
+            try:
+                for key, value in _MmapValues.read(path):
+                    totals[key] = totals.get(key, 0.0) + value
+            except (OSError, UnicodeDecodeError, struct.error):
+                # A worker may be mid-way through growing its file
+                continue
+        return totals
+
+    def render(self):
+        samples = {}
+        for key, value in self.collect().items():
+            name, suffix, pairs = json.loads(key)
+            samples.setdefault(name, []).append((suffix, [tuple(p) for p in pairs], value))
+
+        lines = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            lines.append(f"# HELP {name} {_escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind == "histogram":
+                lines.extend(_render_histogram(metric, samples.get(name, [])))
+            else:
+                for suffix, pairs, value in sorted(samples.get(name, [])):
+                    lines.append(f"{name}{suffix}{_format_labels(pairs)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _reset_after_fork(self):
+        # The child must not write into its parent's file
+        self._lock = threading.Lock()
+        self._values = None
+
+
+def _render_histogram(metric, samples):
+    series = {}
+    for suffix, pairs, value in samples:
+        if suffix == "_bucket":
+            labels, le = tuple(pairs[:-1]), pairs[-1][1]
+            series.setdefault(labels, {}).setdefault("buckets", {})[le] = value
+        else:
+            series.setdefault(tuple(pairs), {})[suffix] = value
+
+    for labels in sorted(series):
+        entry = series[labels]
+        cumulative = 0.0
+        for bound in metric.buckets:
+            le = _format_value(bound)
+            cumulative += entry.get("buckets", {}).get(le, 0.0)
+            yield f"{metric.name}_bucket{_format_labels(list(labels) + [('le', le)])} {_format_value(cumulative)}"
+        yield f"{metric.name}_sum{_format_labels(labels)} {_format_value(entry.get('_sum', 0.0))}"
+        yield f"{metric.name}_count{_format_labels(labels)} {_format_value(entry.get('_count', 0.0))}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _escape_help(text):
+    return text.replace("\\", r"\\").replace("\n", r"\n")
+
+
+def _reset_after_fork():
+    for registry in list(_registries):
+        registry._reset_after_fork()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# The process-wide registry used by the app and its helpers
+registry = MetricsRegistry()
+counter = registry.counter
+histogram = registry.histogram
+set_directory = registry.set_directory
+render = registry.render
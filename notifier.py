@@ -0,0 +1,85 @@
+import os
+import threading
+import weakref
+
+import outbound
+
+# Every live notifier, so forked children can drop the connections they inherited
+_instances = weakref.WeakSet()
+
+
+class SmsNotifier:
+    """Owns one Twilio client and its keep-alive HTTP connection pool.
+
+    Building a ``Client`` per message opens a new TLS session for every SMS.
+    A notifier builds its client once, on first use, on top of a pooled
+    ``requests`` session so consecutive sends reuse the same connections.
+    After a fork the client is discarded and rebuilt lazily in the child, so
+    pre-fork servers never share sockets between workers. The Twilio SDK
+    itself is only imported when the first client is built (see sdk.py).
+    """
+
+    def __init__(self, account_sid, auth_token, from_number,
+                 pool_size=10, timeout=10.0, base_url=None):
+        self.account_sid = account_sid
+        self.auth_token = auth_token
+        self.from_number = from_number
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.base_url = base_url
+
+        self._lock = threading.Lock()
+        self._client = None
+        _instances.add(self)
+
+    @property
+    def client(self):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._build_client()
+                client = self._client
+        return client
+
+    def _build_client(self):
+        from requests.adapters import HTTPAdapter
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+
+        http_client = TwilioHttpClient(pool_connections=True, timeout=self.timeout)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        http_client.session.mount("https://", adapter)
+        http_client.session.mount("http://", adapter)
+
+        client = Client(self.account_sid, self.auth_token, http_client=http_client)
+        if self.base_url:
+            # Used to point the client at a local stand-in for benchmarks
+            client.api.base_url = self.base_url
+        return client
+
+    def send(self, to, body, from_=None):
+        """Send an SMS and return the Twilio message. Defaults to the configured number."""
+        return outbound.call("twilio", "messages.create", self.client.messages.create,
+                             from_=from_ or self.from_number, body=body, to=to)
+
+    def close(self):
+        """Close pooled connections. The client is rebuilt on next use."""
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None and client.http_client.session is not None:
+            client.http_client.session.close()
+
+    def _reset_after_fork(self):
+        # The parent's lock may have been held mid-fork and its sockets belong
+        # to the parent, so start over without touching either
+        self._lock = threading.Lock()
+        self._client = None
+
+
+def _reset_after_fork():
+    for notifier in list(_instances):
+        notifier._reset_after_fork()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
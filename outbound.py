@@ -0,0 +1,219 @@
+import asyncio
+import contextvars
+import threading
+import time
+
+from twilio.base.exceptions import TwilioRestException
+
+import metrics
+import profiling
+import sdk
+from resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded, backoff_delay, remaining
+
+OUTBOUND_LATENCY = metrics.histogram(
+    "outbound_request_duration_seconds",
+    "Latency of calls to external APIs by dependency, operation and outcome.",
+    ["dependency", "operation", "outcome"],
+)
+OUTBOUND_RETRIES = metrics.counter(
+    "outbound_retries",
+    "Retried calls to external APIs after a transient failure.",
+    ["dependency", "operation"],
+)
+BREAKER_TRIPS = metrics.counter(
+    "circuit_breaker_trips",
+    "Times a dependency's circuit breaker opened.",
+    ["dependency"],
+)
+
+# Creating a message has no idempotency key, so it is only retried when
+# Twilio certainly did not accept it
+_NOT_IDEMPOTENT = {("twilio", "messages.create")}
+
+_settings = {
+    "max_attempts": 3,
+    "base_delay": 0.2,
+    "max_delay": 2.0,
+    "failure_threshold": 5,
+    "reset_timeout": 30.0,
+}
+_breakers = {}
+_lock = threading.Lock()
+_operation = contextvars.ContextVar("outbound_operation", default=None)
+
+
+def current_operation():
+    """``(dependency, operation)`` of the call this context is making, or None outside one."""
+    return _operation.get()
+
+
+def configure(**settings):
+    """Set retry and breaker settings; breakers created earlier are replaced."""
+    unknown = set(settings) - set(_settings)
+    if unknown:
+        raise ValueError(f"Unknown outbound settings: {', '.join(sorted(unknown))}")
+    with _lock:
+        _settings.update(settings)
+        _breakers.clear()
+
+
+def breaker(dependency):
+    """The circuit breaker shared by every call to ``dependency``."""
+    found = _breakers.get(dependency)
+    if found is None:
+        with _lock:
+            found = _breakers.get(dependency)
+            if found is None:
+                found = _breakers[dependency] = CircuitBreaker(
+                    dependency,
+                    failure_threshold=_settings["failure_threshold"],
+                    reset_timeout=_settings["reset_timeout"],
+                )
+    return found
+
+
+def breaker_metrics():
+    with _lock:
+        breakers = dict(_breakers)
+    return {name: b.metrics() for name, b in breakers.items()}
+
+
+def is_transient(exc):
+    """Whether a failure says the dependency is unhealthy, rather than the request being wrong."""
+    # An SDK that was never imported cannot have raised, so only loaded ones are checked
+    stripe = sdk.loaded("stripe")
+    if stripe is not None:
+        if isinstance(exc, (stripe.error.APIConnectionError, stripe.error.RateLimitError)):
+            return True
+        if isinstance(exc, stripe.error.StripeError):
+            if exc.http_status is None:
+                return isinstance(exc, stripe.error.APIError)
+            return exc.http_status >= 500
+    if isinstance(exc, TwilioRestException):
+        return exc.status >= 500 or exc.status == 429
+    return isinstance(exc, _transport_errors())
+
+
+def _transport_errors():
+    errors = (TimeoutError, ConnectionError)
+    requests = sdk.loaded("requests")
+    if requests is not None:
+        errors += (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    aiohttp = sdk.loaded("aiohttp")
+    if aiohttp is not None:
+        errors += (aiohttp.ClientError,)
+    return errors
+
+
+def _retry_safe(dependency, operation, exc):
+    if (dependency, operation) not in _NOT_IDEMPOTENT:
+        return True
+    # Rejected for rate or never connected: nothing was created
+    if isinstance(exc, TwilioRestException) and exc.status == 429:
+        return True
+    requests, aiohttp = sdk.loaded("requests"), sdk.loaded("aiohttp")
+    return ((requests is not None and isinstance(exc, requests.exceptions.ConnectTimeout))
+            or (aiohttp is not None and isinstance(exc, aiohttp.ClientConnectorError)))
+
+
+def _admit(dependency, operation, circuit):
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"No time left to call {dependency} {operation}")
+    try:
+        circuit.allow()
+    except CircuitOpenError:
+        OUTBOUND_LATENCY.observe(0.0, dependency=dependency, operation=operation, outcome="rejected")
+        raise
+    return left
+
+
+def _failed(dependency, operation, circuit, exc, attempt, elapsed):
+    """Record a failed attempt and return the delay before retrying, or None to give up."""
+    OUTBOUND_LATENCY.observe(elapsed, dependency=dependency, operation=operation, outcome="error")
+    if not is_transient(exc):
+        # The dependency answered; the request itself was at fault
+        circuit.record_success()
+        return None
+
+    if circuit.record_failure():
+        BREAKER_TRIPS.inc(dependency=dependency)
+
+    if attempt >= _settings["max_attempts"] or not _retry_safe(dependency, operation, exc):
+        return None
+    delay = backoff_delay(attempt, _settings["base_delay"], _settings["max_delay"])
+    left = remaining()
+    if left is not None and delay >= left:
+        return None
+    OUTBOUND_RETRIES.inc(dependency=dependency, operation=operation)
+    return delay
+
+
+def call(dependency, operation, fn, *args, **kwargs):
+    """Call an external API through one choke point.
+
+    ``dependency`` is the service (``"stripe"``, ``"twilio"``) and
+    ``operation`` the SDK call (``"Customer.list"``, ``"messages.create"``).
+    Latency is recorded for every attempt. Calls fail fast with
+    ``CircuitOpenError`` while the dependency's breaker is open, and with
+    ``DeadlineExceeded`` once the caller's deadline has passed. Transient
+    failures are retried with jittered exponential backoff as long as the
+    deadline allows; other exceptions propagate unchanged.
+    """
+    circuit = breaker(dependency)
+    attempt = 0
+    token = _operation.set((dependency, operation))
+    try:
+        with profiling.span(f"{dependency}.{operation}") as current:
+            while True:
+                attempt += 1
+                _admit(dependency, operation, circuit)
+                start = time.perf_counter()
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    delay = _failed(dependency, operation, circuit, e, attempt, time.perf_counter() - start)
+                    if delay is None:
+                        raise
+                    if current is not None:
+                        current.annotate(attempts=attempt + 1)
+                    time.sleep(delay)
+                    continue
+                circuit.record_success()
+                OUTBOUND_LATENCY.observe(time.perf_counter() - start,
+                                         dependency=dependency, operation=operation, outcome="ok")
+                return result
+    finally:
+        _operation.reset(token)
+
+
+async def call_async(dependency, operation, fn, *args, **kwargs):
+    """``call`` for coroutine functions. Each attempt is also cut off at the deadline."""
+    circuit = breaker(dependency)
+    attempt = 0
+    token = _operation.set((dependency, operation))
+    try:
+        with profiling.span(f"{dependency}.{operation}") as current:
+            while True:
+                attempt += 1
+                left = _admit(dependency, operation, circuit)
+                start = time.perf_counter()
+                try:
+                    result = await asyncio.wait_for(fn(*args, **kwargs), left)
+                except Exception as e:
+                    delay = _failed(dependency, operation, circuit, e, attempt, time.perf_counter() - start)
+                    if delay is None:
+                        if isinstance(e, TimeoutError) and left is not None:
+                            raise DeadlineExceeded(
+                                f"Deadline passed while calling {dependency} {operation}") from e
+                        raise
+                    if current is not None:
+                        current.annotate(attempts=attempt + 1)
+                    await asyncio.sleep(delay)
+                    continue
+                circuit.record_success()
+                OUTBOUND_LATENCY.observe(time.perf_counter() - start,
+                                         dependency=dependency, operation=operation, outcome="ok")
+                return result
+    finally:
+        _operation.reset(token)
@@ -0,0 +1,222 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+try:
+    import brotli
+except ImportError:  # Optional: without it responses are offered gzip only
+    brotli = None
+
+import metrics
+
+PAGE_CACHE = metrics.counter(
+    "page_cache_lookups",
+    "Rendered page and static asset lookups by cache and outcome (hit or miss).",
+    ["cache", "outcome"],
+)
+
+# Bodies smaller than this gain nothing from compression
+MIN_COMPRESS_SIZE = 256
+IMMUTABLE = "public, max-age=31536000, immutable"
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+_FINGERPRINTED = re.compile(r"^(.*)\.([0-9a-f]{12})(\.[^./]+)$")
+
+
+def accepted_encodings(header):
+    """Content codings a client accepts, from its ``Accept-Encoding`` header."""
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class Representation:
+    """A response body, compressed ahead of time, with its ETag.
+
+    ``precompress`` spends the most CPU for the smallest bodies, which pays
+    off for responses built once and served many times. Per-request bodies
+    should use the fast settings instead.
+    """
+
+    __slots__ = ("content_type", "etag", "bodies")
+
+    def __init__(self, body, content_type, precompress=True):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.content_type = content_type
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+        self.bodies = {"identity": body}
+        if len(body) >= MIN_COMPRESS_SIZE and content_type.startswith(_COMPRESSIBLE):
+            # mtime=0 keeps the gzip bytes, and so the ETag, the same on every worker
+            self.bodies["gzip"] = gzip.compress(body, 9 if precompress else 5, mtime=0)
+            if brotli is not None:
+                self.bodies["br"] = brotli.compress(body, quality=11 if precompress else 4)
+
+    def choose(self, accept_encoding):
+        """``(coding, body)``: the smallest variant the client accepts."""
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ("br", "gzip"):
+            if coding in self.bodies and coding in accepted:
+                return coding, self.bodies[coding]
+        return "identity", self.bodies["identity"]
+
+    def matches(self, if_none_match):
+        """Whether an ``If-None-Match`` header names this representation."""
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return True
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            # Each coding's tag is the body's tag plus "-gzip" or "-br"
+            if tag.strip('"').split("-", 1)[0] == self.etag:
+                return True
+        return False
+
+    def respond(self, accept_encoding=None, if_none_match=None, cache_control="no-cache"):
+        """``(status, headers, body)`` for a GET, 304 when the client's copy is current."""
+        coding, body = self.choose(accept_encoding)
+        headers = {
+            "ETag": f'"{self.etag}"' if coding == "identity" else f'"{self.etag}-{coding}"',
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if self.matches(if_none_match):
+            return 304, headers, b""
+        headers["Content-Type"] = self.content_type
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+        return 200, headers, body
+
+
+class PageShell:
+    """A page rendered once around a slot, so each request only renders the fragment that varies."""
+
+    SLOT = "<!--page-shell-slot-->"
+
+    def __init__(self, render):
+        """``render(slot)`` renders the whole page with ``slot`` where the fragment goes."""
+        page = render(Markup(self.SLOT))
+        self.head, found, self.tail = page.partition(self.SLOT)
+        if not found:
+            raise ValueError("The rendered page does not contain the slot")
+
+    def fill(self, fragment):
+        return self.head + fragment + self.tail
+
+
+class PageCache:
+    """Rendered pages (or shells) by key, least recently used evicted first."""
+
+    def __init__(self, max_entries=1000, name="pages"):
+        self.max_entries = max_entries
+        self.name = name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get(self, key, build):
+        """The entry for ``key``, calling ``build()`` to make it on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+        if entry is not None:
+            PAGE_CACHE.inc(cache=self.name, outcome="hit")
+            return entry
+
+        # Built outside the lock; a concurrent miss just builds the same entry twice
+        entry = build()
+        with self._lock:
+            self._stats["misses"] += 1
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        PAGE_CACHE.inc(cache=self.name, outcome="miss")
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        looked_up = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / looked_up, 4) if looked_up else None
+        return stats
+
+
+class StaticAssets:
+    """Files under ``directory``, precompressed and served by fingerprinted URL.
+
+    ``url("style.css")`` returns ``/style.<hash>.css``, where the hash is of
+    the file's contents. That URL can be cached for a year because a changed
+    file gets a new URL. The plain path still works and revalidates by ETag.
+    Files are read once, on first use.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self._cache = PageCache(max_entries=10000, name="static")
+
+    def _load(self, name):
+        path = os.path.normpath(os.path.join(self.directory, name))
+        if not path.startswith(self.directory + os.sep) or not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            body = f.read()
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+        return Representation(body, content_type)
+
+    def get(self, name):
+        """The representation of a file by its unfingerprinted name, or None."""
+        return self._cache.get(name, lambda: self._load(name))
+
+    def url(self, name):
+        asset = self.get(name)
+        if asset is None:
+            return "/" + name
+        stem, ext = os.path.splitext(name)
+        return f"/{stem}.{asset.etag[:12]}{ext}"
+
+    def lookup(self, path):
+        """``(representation, cache_control)`` for a request path, or None."""
+        name = path.lstrip("/")
+        match = _FINGERPRINTED.match(name)
+        if match:
+            asset = self.get(match.group(1) + match.group(3))
+            if asset is not None:
+                # A page from before a deploy may still ask for the old hash; serve the
+                # current file, but don't let it be cached under the old URL
+                return asset, IMMUTABLE if asset.etag.startswith(match.group(2)) else "no-cache"
+        asset = self.get(name)
+        if asset is None:
+            return None
+        return asset, "no-cache"
+
+    def metrics(self):
+        return self._cache.metrics()
@@ -0,0 +1,282 @@
+"""Span trees for every request, the slowest of them, and sampled cProfile captures.
+
+A request (or a queued webhook event) is traced with ``Profiler.begin`` /
+``Profiler.end`` or ``Profiler.trace``. Code it runs marks its steps with
+``span("name")``; outbound.call() does so for every Stripe and Twilio call.
+Spans nest through a context variable, so they follow the request into
+coroutines and into threads that run in a copy of its context (the SMS
+dispatcher does). Outside a traced request ``span`` does nothing.
+
+The ``slowest`` traces seen are kept, plus a ring buffer of the most recent
+ones over ``threshold`` seconds. With ``sample_rate`` above 0, that fraction
+of requests also runs under cProfile, and the capture is kept only when the
+request turns out to be slow. ``dump`` writes everything to a directory:
+a JSON file of the traces and one ``.prof`` file per capture, which
+``python -m pstats`` or snakeviz can open.
+"""
+import contextvars
+import cProfile
+import heapq
+import io
+import itertools
+import json
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("profiling_span", default=None)
+_trace = contextvars.ContextVar("profiling_trace", default=None)
+
+
+def current_trace():
+    """The trace of the request running in this context, or None."""
+    return _trace.get()
+
+
+class Span:
+    """One timed step. ``children`` are the steps it ran, in the order they started."""
+
+    __slots__ = ("name", "start", "end", "children", "attrs")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+        self.attrs = None
+
+    def annotate(self, **attrs):
+        if self.attrs is None:
+            self.attrs = {}
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin):
+        node = {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+        }
+        if self.end is None:
+            node["unfinished"] = True
+        if self.attrs:
+            node["attrs"] = self.attrs
+        if self.children:
+            node["children"] = [child.to_dict(origin) for child in list(self.children)]
+        return node
+
+
+class span:
+    """Time a block as a step of the current request; a no-op outside one.
+
+    ``with span("webhook.verify"):`` or, to add attributes,
+    ``with span("stripe.Customer.list") as current: current.annotate(...)``
+    (``current`` is None when nothing is being traced).
+    """
+
+    __slots__ = ("name", "_span", "_token")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        parent = _current.get()
+        if parent is None:
+            self._span = None
+            return None
+        self._span = Span(self.name)
+        parent.children.append(self._span)
+        self._token = _current.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is None:
+            return
+        self._span.end = time.perf_counter()
+        if exc_type is not None:
+            self._span.annotate(error=exc_type.__name__)
+        _current.reset(self._token)
+
+
+class Trace:
+    """The span tree of one request, with its outcome and any cProfile capture."""
+
+    __slots__ = ("id", "name", "request_id", "started_at", "root", "status",
+                 "profile", "profile_stats", "_tokens", "_profiler")
+
+    def __init__(self, trace_id, name, request_id):
+        self.id = trace_id
+        self.name = name
+        self.request_id = request_id
+        self.started_at = time.time()
+        self.root = Span(name)
+        self.status = None
+        self.profile = None
+        self.profile_stats = None
+        self._tokens = None
+        self._profiler = None
+
+    @property
+    def duration(self):
+        return self.root.duration
+
+    def to_dict(self, spans=True):
+        record = {
+            "id": self.id,
+            "name": self.name,
+            "request_id": self.request_id,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+        }
+        if spans:
+            record["spans"] = self.root.to_dict(self.root.start)
+        if self.profile is not None:
+            record["profile"] = self.profile
+        return record
+
+
+class Profiler:
+    """Traces requests and keeps the slowest and the recent slow ones.
+
+    ``slowest`` traces are kept by duration and ``recent`` slow ones (over
+    ``threshold`` seconds) in arrival order. ``sample_rate`` is the fraction
+    of requests run under cProfile; one capture runs at a time, and it is
+    kept only when the request took ``threshold`` or longer.
+    """
+
+    def __init__(self, slowest=50, recent=50, threshold=1.0, sample_rate=0.0, profile_lines=30):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.profile_lines = profile_lines
+        self._slowest_size = slowest
+        self._slowest = []
+        self._recent = deque(maxlen=recent)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._capturing = threading.Lock()
+        self._stats = {"traced": 0, "slow": 0, "sampled": 0, "captured": 0}
+
+    def begin(self, name, request_id=None):
+        """Start tracing a request in the current context; pass the result to ``end``."""
+        trace = Trace(next(self._ids), name, request_id)
+        trace._tokens = (_current.set(trace.root), _trace.set(trace))
+        if self.sample_rate and random.random() < self.sample_rate and self._capturing.acquire(blocking=False):
+            with self._lock:
+                self._stats["sampled"] += 1
+            trace._profiler = cProfile.Profile()
+            trace._profiler.enable()
+        return trace
+
+    def end(self, trace, status=None, name=None):
+        """Finish a trace started by ``begin`` and keep it if it is slow.
+
+        ``name`` renames it, for servers that only know the route afterwards.
+        """
+        trace.root.end = time.perf_counter()
+        trace.status = status
+        if name is not None:
+            trace.name = trace.root.name = name
+        try:
+            _current.reset(trace._tokens[0])
+            _trace.reset(trace._tokens[1])
+        except ValueError:
+            # Ended in a different context than it began in; just detach it
+            _current.set(None)
+            _trace.set(None)
+        duration = trace.duration
+        slow = duration >= self.threshold
+        if trace._profiler is not None:
+            trace._profiler.disable()
+            self._capturing.release()
+            if slow:
+                self._keep_profile(trace)
+            trace._profiler = None
+        with self._lock:
+            self._stats["traced"] += 1
+            if trace.profile is not None:
+                self._stats["captured"] += 1
+            if slow:
+                self._stats["slow"] += 1
+                self._recent.append(trace)
+            entry = (duration, trace.id, trace)
+            if len(self._slowest) < self._slowest_size:
+                heapq.heappush(self._slowest, entry)
+            elif duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def _keep_profile(self, trace):
+        profile = trace._profiler
+        profile.create_stats()
+        trace.profile_stats = profile.stats
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(self.profile_lines)
+        trace.profile = out.getvalue()
+
+    @contextmanager
+    def trace(self, name, request_id=None):
+        """Trace a block of work that is not an HTTP request, such as a queued event.
+
+        The block may set the yielded trace's ``status``; an exception sets it to the exception's name.
+        """
+        trace = self.begin(name, request_id)
+        try:
+            yield trace
+        except BaseException as e:
+            self.end(trace, type(e).__name__)
+            raise
+        self.end(trace, trace.status)
+
+    def slowest(self):
+        with self._lock:
+            entries = sorted(self._slowest, reverse=True)
+        return [trace for _, _, trace in entries]
+
+    def recent(self):
+        with self._lock:
+            return list(reversed(self._recent))
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(threshold_s=self.threshold, sample_rate=self.sample_rate)
+        return stats
+
+    def report(self, spans=True):
+        """Everything kept, as JSON-ready dicts: metrics, the slowest and the recent slow traces."""
+        return {
+            "metrics": self.metrics(),
+            "slowest": [trace.to_dict(spans) for trace in self.slowest()],
+            "recent_slow": [trace.to_dict(spans) for trace in self.recent()],
+        }
+
+    def reset(self):
+        with self._lock:
+            self._slowest = []
+            self._recent.clear()
+
+    def dump(self, directory):
+        """Write the report and every kept cProfile capture to ``directory``; returns the report's path."""
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        report = self.report()
+        written = set()
+        for trace in self.slowest() + self.recent():
+            if trace.profile_stats is None or trace.id in written:
+                continue
+            # The format cProfile.Profile.dump_stats writes, so pstats can load it
+            with open(os.path.join(directory, f"trace-{stamp}-{trace.id}.prof"), "wb") as f:
+                marshal.dump(trace.profile_stats, f)
+            written.add(trace.id)
+        path = os.path.join(directory, f"traces-{stamp}-{os.getpid()}.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+        return path
@@ -0,0 +1,201 @@
+"""Reconcile Stripe's completed Checkout Sessions against the webhook ledger.
+
+    python reconcile.py                  # sessions created since the last run
+    python reconcile.py --since 2024-05-01 --output gaps.jsonl
+
+Lists Checkout Sessions and PaymentIntents created since the watermark,
+joins them with the ledger (``LEDGER_PATH``) by session and PaymentIntent
+ID, and prints one JSON line per problem found:
+
+- ``missing_webhook``: Stripe completed the session but the webhook never handled it
+- ``missing_customer``: the customer was never upserted
+- ``missing_payment_intent_tag``: the PaymentIntent has no customer metadata
+- ``payment_not_succeeded``: the session is paid but its PaymentIntent did not succeed
+- ``missing_sms`` / ``duplicate_sms``: no SMS, or more than one, was sent
+- ``unknown_session``: the ledger has a session Stripe does not list as complete
+
+Stripe's list cursors only go forwards one page at a time, so the time
+range is split into slices that are paged in parallel. A run moves the
+watermark to its start time. The next run rescans from ``--overlap``
+seconds before that, because a session can complete up to a day after it
+was created. The exit status is 1 when problems were found.
+"""
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import stripe
+from dotenv import load_dotenv
+
+import services
+from ledger import CUSTOMER, PAYMENT_INTENT, SMS, Ledger
+from settings import Settings
+from stripe_transport import StripeTransport
+
+WATERMARK = "reconcile"
+# Checkout Sessions expire at most 24 hours after they are created
+DEFAULT_OVERLAP = 24 * 3600
+DEFAULT_FIRST_WINDOW = 7 * 24 * 3600
+PAGE_SIZE = 100
+
+
+def iter_listing(list_page, since, until, page_size=PAGE_SIZE):
+    """Every object ``list_page`` returns for ``created`` in ``[since, until)``, page by page."""
+    starting_after = None
+    while True:
+        page = list_page(created={"gte": since, "lt": until}, limit=page_size, starting_after=starting_after)
+        yield from page["data"]
+        if not page["has_more"] or not page["data"]:
+            return
+        starting_after = page["data"][-1]["id"]
+
+
+def time_slices(since, until, count):
+    """Split ``[since, until)`` into up to ``count`` whole-second ranges."""
+    count = max(1, min(count, until - since))
+    step = (until - since) / count
+    bounds = [since + round(step * i) for i in range(count)] + [until]
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+def fetch(pool, list_page, since, until, slices):
+    """Futures for the objects of each slice, paged in parallel."""
+    return [pool.submit(lambda a=a, b=b: list(iter_listing(list_page, a, b)))
+            for a, b in time_slices(since, until, slices)]
+
+
+def index(futures, keep=None):
+    """Hash index by ID of the objects the futures return, optionally filtered."""
+    objects = {}
+    for future in futures:
+        for obj in future.result():
+            if keep is None or keep(obj):
+                objects[obj["id"]] = obj
+    return objects
+
+
+def is_complete(session):
+    return session.get("status") == "complete" and session.get("payment_status") in ("paid", "no_payment_required")
+
+
+def diff(sessions, payment_intents, ledger_sessions):
+    """Problems found joining Stripe's sessions and PaymentIntents with the ledger, as dicts."""
+    problems = []
+
+    def problem(session_id, issue, **detail):
+        problems.append(dict(session_id=session_id, issue=issue, **detail))
+
+    for session_id, session in sessions.items():
+        record = ledger_sessions.get(session_id)
+        if record is None:
+            problem(session_id, "missing_webhook", created=session.get("created"))
+            continue
+        succeeded = record["succeeded"]
+        email = (session.get("customer_details") or {}).get("email")
+        if email and not succeeded[CUSTOMER]:
+            problem(session_id, "missing_customer", customer_email=email)
+
+        intent = payment_intents.get(session.get("payment_intent"))
+        if intent is not None:
+            if intent.get("status") != "succeeded":
+                problem(session_id, "payment_not_succeeded", payment_intent=intent["id"], status=intent.get("status"))
+            if email and not (intent.get("metadata") or {}).get("customer_id"):
+                problem(session_id, "missing_payment_intent_tag", payment_intent=intent["id"],
+                        tag_attempts_succeeded=succeeded[PAYMENT_INTENT])
+
+        if not succeeded[SMS]:
+            problem(session_id, "missing_sms")
+        elif succeeded[SMS] > 1:
+            problem(session_id, "duplicate_sms", sent=succeeded[SMS], events=record["events"])
+
+    for session_id, record in ledger_sessions.items():
+        if session_id not in sessions:
+            problem(session_id, "unknown_session", created=record["created"])
+    return problems
+
+
+def reconcile(gateway, ledger, since, until, slices=8, workers=8):
+    """Run one reconciliation of ``[since, until)``; returns ``(problems, stats)``."""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reconcile") as pool:
+        session_pages = fetch(pool, gateway.list_checkout_sessions, since, until, slices)
+        intent_pages = fetch(pool, gateway.list_payment_intents, since, until, slices)
+        # The ledger is read while Stripe is being listed
+        ledger_sessions = ledger.sessions(since, until)
+        sessions = index(session_pages, keep=is_complete)
+        payment_intents = index(intent_pages)
+    problems = diff(sessions, payment_intents, ledger_sessions)
+    stats = {
+        "since": since,
+        "until": until,
+        "stripe_sessions": len(sessions),
+        "stripe_payment_intents": len(payment_intents),
+        "ledger_sessions": len(ledger_sessions),
+        "problems": len(problems),
+        "elapsed_s": round(time.perf_counter() - started, 3),
+    }
+    for item in problems:
+        stats[item["issue"]] = stats.get(item["issue"], 0) + 1
+    return problems, stats
+
+
+def parse_time(value):
+    """Seconds since the epoch, or an ISO 8601 date or time (UTC unless it says otherwise)."""
+    try:
+        return int(float(value))
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return int(parsed.timestamp())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--since", type=parse_time,
+                        help="Scan sessions created from this time (epoch or ISO 8601) instead of the watermark")
+    parser.add_argument("--overlap", type=int, default=DEFAULT_OVERLAP,
+                        help="Seconds before the watermark to rescan (default: one day)")
+    parser.add_argument("--slices", type=int, default=8, help="Time slices listed in parallel")
+    parser.add_argument("--output", help="Write problems to this JSONL file instead of stdout")
+    parser.add_argument("--no-watermark", dest="update_watermark", action="store_false",
+                        help="Leave the watermark where it is")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    settings = Settings.from_env()
+    stripe.api_key = settings.stripe_api_key
+    if settings.stripe_api_base:
+        stripe.api_base = settings.stripe_api_base
+    # One keep-alive connection per slice, shared by the listing threads
+    stripe.default_http_client = StripeTransport.from_settings(
+        settings, pool_size=max(args.slices, settings.stripe_pool_size))
+    ledger = Ledger(settings.ledger_path)
+
+    until = int(time.time())
+    if args.since is not None:
+        since = args.since
+    else:
+        watermark = ledger.watermark(WATERMARK)
+        since = int(watermark - args.overlap) if watermark is not None else until - DEFAULT_FIRST_WINDOW
+
+    problems, stats = reconcile(services.StripeGateway(), ledger, since, until,
+                                slices=args.slices, workers=args.slices * 2)
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for item in problems:
+            out.write(json.dumps(item) + "\n")
+    finally:
+        if args.output:
+            out.close()
+    if args.update_watermark:
+        ledger.set_watermark(WATERMARK, until)
+    print(json.dumps(stats), file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""Replay Stripe events from a JSONL file through the webhook handler, e.g. after an outage.
+
+    python replay.py missed-events.jsonl --workers 8
+    python replay.py export.jsonl.gz --types checkout.session.completed,customer.updated
+
+Each line is one event, or one page of ``stripe events list`` output
+(``{"object": "list", "data": [...]}``). Events go through the same
+handler as ``/webhook`` (``app.process_event``), minus the signature check,
+which only applies to HTTP deliveries. Events the event store has already
+recorded are skipped, so a replay can overlap with what the webhook already
+processed.
+
+The file is read line by line and only a bounded window of events is in
+flight at a time, so memory stays flat however large the file is.
+Progress is checkpointed as a byte offset. An interrupted run resumes from
+there, and ``--restart`` starts over. Events that still fail are appended
+to a JSONL file that can itself be replayed later.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger("replay")
+
+DEFAULT_TYPES = "checkout.session.completed"
+
+
+def _open(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def iter_events(path, offset=0, on_invalid=None):
+    """Yield ``(line_start, line_end, event)`` for every event from byte ``offset`` on.
+
+    Lines that are not JSON, or not an event or a list of events, are passed
+    to ``on_invalid(line_start, line)`` and skipped.
+    """
+    with _open(path) as f:
+        f.seek(offset)
+        for line in f:
+            start, offset = offset, offset + len(line)
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = None
+            if isinstance(item, dict) and item.get("object") == "list":
+                events = item.get("data") or []
+            else:
+                events = [item]
+            if not all(isinstance(event, dict) and "id" in event and "type" in event for event in events):
+                if on_invalid is not None:
+                    on_invalid(start, line)
+                continue
+            for event in events:
+                yield start, offset, event
+
+
+class Checkpoint:
+    """The byte offset a replay of ``source`` has finished up to, kept in a small JSON file."""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+
+    def load(self):
+        """The saved offset for this source, or 0."""
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        return saved.get("offset", 0) if saved.get("source") == self.source else 0
+
+    def save(self, offset, stats=None):
+        # Written aside and renamed, so a crash never leaves a torn checkpoint
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"source": self.source, "offset": offset, "stats": stats or {},
+                       "updated_at": time.time()}, f)
+        os.replace(temporary, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def replay(events, handle, is_done=None, workers=4, window=None, types=None,
+           on_checkpoint=None, on_failed=None, on_progress=None,
+           checkpoint_interval=1.0, progress_interval=5.0, start_offset=0):
+    """Run ``handle(event)`` over ``(line_start, line_end, event)`` tuples from ``iter_events``.
+
+    ``handle`` returns ``(body, status)`` like the webhook handler; a status
+    of 500 or more, or an exception, is a failure and goes to
+    ``on_failed(event, error)``. ``is_done(event_id)`` skips events that
+    were already handled. At most ``window`` events (default ``workers * 4``)
+    are read ahead of the oldest unfinished one. ``on_checkpoint(offset,
+    stats)`` gets the offset before which every event is finished, at most
+    every ``checkpoint_interval`` seconds and once at the end. Returns the
+    stats.
+    """
+    window = window or workers * 4
+    stats = {"read": 0, "processed": 0, "skipped": 0, "filtered": 0, "failed": 0}
+    started = time.monotonic()
+    # [line_start, finished] for each event read and not yet checkpointed, in file order
+    unfinished = deque()
+    pending = {}
+    resume_at = start_offset
+    last_checkpoint = last_progress = started
+
+    def run(event):
+        if is_done is not None and is_done(event["id"]):
+            return "skipped", None
+        try:
+            body, status = handle(event)
+        except Exception as e:
+            return "failed", f"{type(e).__name__}: {e}"
+        if status >= 500:
+            return "failed", f"status {status}: {body}"
+        return "processed", None
+
+    def advance(force=False):
+        nonlocal resume_at, last_checkpoint, last_progress
+        while unfinished and unfinished[0][1]:
+            unfinished.popleft()
+        offset = unfinished[0][0] if unfinished else resume_at
+        now = time.monotonic()
+        if on_checkpoint is not None and (force or now - last_checkpoint >= checkpoint_interval):
+            on_checkpoint(offset, dict(stats))
+            last_checkpoint = now
+        if on_progress is not None and (force or now - last_progress >= progress_interval):
+            on_progress(rate(stats, now - started))
+            last_progress = now
+
+    def collect(done):
+        for future in done:
+            entry, event = pending.pop(future)
+            outcome, error = future.result()
+            stats[outcome] += 1
+            if outcome == "failed" and on_failed is not None:
+                on_failed(event, error)
+            entry[1] = True
+        advance()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="replay") as pool:
+        try:
+            line = None
+            for start, end, event in events:
+                # A list page holds many events; the line counts as read once the next one starts
+                if line is not None and start != line[0]:
+                    resume_at = line[1]
+                line = (start, end)
+                stats["read"] += 1
+                while len(unfinished) >= window:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                entry = [start, False]
+                unfinished.append(entry)
+                if types is not None and event["type"] not in types:
+                    stats["filtered"] += 1
+                    entry[1] = True
+                    advance()
+                    continue
+                pending[pool.submit(run, event)] = (entry, event)
+            if line is not None:
+                resume_at = line[1]
+        finally:
+            # Interrupted or not, let what was started finish so the checkpoint is exact
+            while pending:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            advance(force=True)
+    return stats
+
+
+def rate(stats, elapsed):
+    stats = dict(stats)
+    stats["elapsed_s"] = round(elapsed, 3)
+    stats["events_per_s"] = round(stats["read"] / elapsed, 1) if elapsed else None
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="JSONL file of events or event list pages (.gz is fine)")
+    parser.add_argument("--workers", type=int, default=4, help="Events handled in parallel")
+    parser.add_argument("--types", default=DEFAULT_TYPES,
+                        help=f"Comma-separated event types to replay, or 'all' (default: {DEFAULT_TYPES})")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: PATH.checkpoint)")
+    parser.add_argument("--failed", help="Where events that still fail are appended (default: PATH.failed.jsonl)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the top")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="Seconds between progress lines")
+    args = parser.parse_args(argv)
+
+    import app
+    from structured_logging import flush_logging
+
+    checkpoint = Checkpoint(args.checkpoint or args.path + ".checkpoint", args.path)
+    if args.restart:
+        checkpoint.clear()
+    offset = checkpoint.load()
+    types = None if args.types == "all" else {t.strip() for t in args.types.split(",") if t.strip()}
+
+    def on_invalid(start, line):
+        logger.warning("Skipping a line that is not an event", extra={"offset": start, "line": line[:200]})
+
+    with open(args.failed or args.path + ".failed.jsonl", "a") as failed:
+        def on_failed(event, error):
+            logger.error("Event failed", extra={"event_id": event["id"], "error": error})
+            failed.write(json.dumps(event) + "\n")
+            failed.flush()
+
+        def on_progress(stats):
+            print(json.dumps(stats), file=sys.stderr)
+
+        if offset:
+            print(f"Resuming {args.path} at byte {offset}", file=sys.stderr)
+        try:
+            stats = replay(iter_events(args.path, offset, on_invalid), app.process_event,
+                           is_done=lambda event_id: app.event_store.get(event_id) is not None,
+                           workers=args.workers, types=types, start_offset=offset,
+                           on_checkpoint=checkpoint.save, on_failed=on_failed, on_progress=on_progress,
+                           progress_interval=args.progress_interval)
+        except KeyboardInterrupt:
+            print("Interrupted; run the same command again to resume", file=sys.stderr)
+            return 130
+        finally:
+            flush_logging()
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
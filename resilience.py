@@ -0,0 +1,139 @@
+import contextvars
+import random
+import threading
+import time
+
+# Monotonic time by which the request (or task) currently being handled must finish
+deadline_var = contextvars.ContextVar("deadline", default=None)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Circuit breaker for {name} is open; retry in {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the caller's deadline leaves no time for another attempt."""
+
+
+def remaining():
+    """Seconds left before the current deadline, or None without one."""
+    deadline = deadline_var.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class deadline:
+    """Context manager bounding everything inside it to ``seconds``.
+
+    A nested deadline can only shorten the one it is nested in.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._token = None
+
+    def __enter__(self):
+        value = time.monotonic() + self.seconds
+        current = deadline_var.get()
+        self._token = deadline_var.set(value if current is None else min(current, value))
+        return self
+
+    def __exit__(self, *exc):
+        deadline_var.reset(self._token)
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Delay before retry number ``attempt``, exponential with jitter."""
+    delay = min(max_delay, base_delay * (2 ** (attempt - 1)))
+    return random.uniform(delay / 2, delay)
+
+
+class CircuitBreaker:
+    """Stops calling a dependency after repeated failures, then probes it.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    ``allow`` fails fast with ``CircuitOpenError`` for ``reset_timeout``
+    seconds. It then goes half-open and lets up to ``half_open_max_calls``
+    probe calls through: a success closes it, a failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._stats = {"trips": 0, "rejected": 0, "successes": 0, "failures": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def available(self):
+        """Whether a call would be let through right now, without taking a probe slot."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            return state == self.CLOSED or (state == self.HALF_OPEN and self._probes < self.half_open_max_calls)
+
+    def allow(self):
+        """Admit a call or raise ``CircuitOpenError``."""
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return
+            self._stats["rejected"] += 1
+            retry_after = max(0.0, self._opened_at + self.reset_timeout - now)
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self._stats["successes"] += 1
+            self._failures = 0
+            self._state = self.CLOSED
+
+    def record_failure(self):
+        """Count a failure. Returns True if it opened the breaker."""
+        with self._lock:
+            self._stats["failures"] += 1
+            self._failures += 1
+            state = self._current_state(time.monotonic())
+            if state == self.HALF_OPEN or (state == self.CLOSED and self._failures >= self.failure_threshold):
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._stats["trips"] += 1
+                return True
+            return False
+
+    def metrics(self):
+        with self._lock:
+            now = time.monotonic()
+            stats = dict(self._stats)
+            stats["state"] = self._current_state(now)
+            stats["consecutive_failures"] = self._failures
+            if stats["state"] == self.OPEN:
+                stats["retry_after"] = round(self._opened_at + self.reset_timeout - now, 3)
+        return stats
@@ -0,0 +1,109 @@
+"""The Stripe and Twilio SDKs, imported when first used instead of at startup.
+
+``import stripe`` loads every API resource module the SDK ships, and the
+Twilio client brings in ``requests`` and, on first use, its generated REST
+resources. Together that is most of the app's import time, and a test or a
+CLI that never calls Stripe pays it for nothing. Modules that only need an
+SDK once a request arrives take it from here:
+
+    from sdk import stripe
+
+``stripe`` is then a stand-in that imports the real module on first
+attribute access (thread-safely) and forwards everything to it. SDK
+settings that used to be assigned at import time are registered with
+``on_load`` and applied right after the import. A server that wants the
+cost paid before it takes traffic calls ``preload()`` in its warm-up step:
+serve.py does so before forking, asgi_app.py at lifespan startup.
+"""
+import importlib
+import sys
+import threading
+import time
+import types
+
+# What preload() imports: the SDK packages, the Twilio HTTP client and the
+# generated REST resources for sending messages, which Twilio loads lazily
+PRELOAD = (
+    "stripe",
+    "requests",
+    "twilio.rest",
+    "twilio.http.http_client",
+    "twilio.rest.api.v2010.account.message",
+)
+
+_lock = threading.RLock()
+_modules = {}
+_hooks = {}
+_setting_up = {}
+_import_seconds = {}
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module until it is needed, then forwards to it."""
+
+    def __getattr__(self, attr):
+        return getattr(load(self.__name__), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(load(self.__name__), attr, value)
+
+    def __dir__(self):
+        return dir(load(self.__name__))
+
+
+def lazy(name):
+    """A stand-in for module ``name`` that imports it on first attribute access."""
+    return LazyModule(name)
+
+
+def load(name):
+    """Import ``name`` (once) and run its ``on_load`` hooks; returns the module."""
+    module = _modules.get(name)
+    if module is None:
+        with _lock:
+            module = _modules.get(name) or _setting_up.get(name)
+            if module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(name)
+                _import_seconds[name] = time.perf_counter() - start
+                # Other threads wait for the hooks; a hook using the stand-in gets the module
+                _setting_up[name] = module
+                try:
+                    for setup in _hooks.get(name, ()):
+                        setup(module)
+                finally:
+                    del _setting_up[name]
+                _modules[name] = module
+    return module
+
+
+def loaded(name):
+    """Module ``name`` if anything has finished importing it, else None. Never imports it."""
+    module = _modules.get(name) or sys.modules.get(name)
+    if module is None or getattr(getattr(module, "__spec__", None), "_initializing", False):
+        return None
+    return module
+
+
+def on_load(name, setup):
+    """Run ``setup(module)`` when ``name`` is loaded through this module, or now if it already was."""
+    with _lock:
+        _hooks.setdefault(name, []).append(setup)
+        module = _modules.get(name)
+    if module is not None:
+        setup(module)
+
+
+def preload(names=PRELOAD):
+    """Import the SDKs now, for a warm-up step; returns seconds spent per module."""
+    for name in names:
+        load(name)
+    return metrics()
+
+
+def metrics():
+    with _lock:
+        return {name: round(seconds, 4) for name, seconds in _import_seconds.items()}
+
+
+stripe = lazy("stripe")
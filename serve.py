@@ -0,0 +1,102 @@
+"""Production server: gunicorn with several worker processes sharing a preloaded app.
+
+    python serve.py --workers 4 --threads 8 --bind 0.0.0.0:5000
+
+The parent process imports the app, its templates and the SDKs once, then
+forks the workers. They share those pages of memory copy-on-write instead
+of each importing everything again. The app only imports the SDKs when they
+are first used, so the parent imports them explicitly with ``app.warm_up``. What must not be shared is rebuilt in
+each worker after the fork: Stripe and Twilio connections, SQLite
+connections, the log writer thread and the background threads (see
+``app.init_worker``). Options default to the WEB_* environment variables.
+"""
+import argparse
+import glob
+import os
+import sys
+
+from dotenv import load_dotenv
+from gunicorn.app.base import BaseApplication
+
+load_dotenv()
+
+
+def default_workers():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+
+def post_fork(server, worker):
+    import app
+    app.init_worker()
+
+
+class PreforkServer(BaseApplication):
+    """Runs the Flask app in gunicorn, configured in code rather than from a config file."""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def gunicorn_options(args):
+    return {
+        "bind": args.bind,
+        "workers": args.workers,
+        # More than one thread switches gunicorn to its threaded worker
+        "threads": args.threads,
+        "timeout": args.timeout,
+        "preload_app": args.preload,
+        "post_fork": post_fork,
+        "accesslog": None,
+        "errorlog": "-",
+        "loglevel": "warning",
+    }
+
+
+def prepare_metrics_dir():
+    """Give each server run fresh per-worker metric files, so /metrics sums only live ones."""
+    directory = os.getenv("METRICS_DIR")
+    if directory:
+        for path in glob.glob(os.path.join(directory, "metrics-*.bin")):
+            os.remove(path)
+    return directory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bind", default=os.getenv("WEB_BIND", "127.0.0.1:5000"))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_WORKERS", "0")) or default_workers(),
+                        help="Worker processes (default: one per available CPU)")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("WEB_THREADS", "4")),
+                        help="Request threads per worker")
+    parser.add_argument("--timeout", type=int, default=int(os.getenv("WEB_TIMEOUT", "30")),
+                        help="Seconds a worker may be silent before it is restarted")
+    parser.add_argument("--no-preload", dest="preload", action="store_false",
+                        default=os.getenv("WEB_PRELOAD", "true").lower() in ("1", "true", "yes"),
+                        help="Import the app in every worker instead of once in the parent")
+    args = parser.parse_args(argv)
+
+    if args.workers > 1 and not prepare_metrics_dir():
+        print("METRICS_DIR is not set, so /metrics only reports the worker that answers it", file=sys.stderr)
+
+    if args.preload:
+        import app
+        missing_vars = app.missing_environment()
+        if missing_vars:
+            print(f"Missing required environment variables: {', '.join(missing_vars)}", file=sys.stderr)
+            return 1
+        app.warm_up()
+    PreforkServer(gunicorn_options(args)).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,383 @@
+"""Checkout, customer and notification logic shared by app.py (WSGI) and asgi_app.py (ASGI).
+
+Everything here is independent of the web framework. The two editions differ
+only in how they do I/O: app.py calls the Stripe SDK through
+``StripeGateway`` and sends SMS on dispatcher threads, while asgi_app.py uses
+the aiohttp clients in async_clients.py, which expose the same gateway
+methods as coroutines.
+"""
+import contextlib
+import functools
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import metrics
+import outbound
+from catalog import DEFAULT_PRODUCT
+from customer_cache import normalize_email
+from ledger import payment_record
+from sdk import stripe
+
+REQUEST_LATENCY = metrics.histogram(
+    "http_request_duration_seconds",
+    "Latency of HTTP requests by method, route and status.",
+    ["method", "route", "status"],
+)
+TEMPLATE_LATENCY = metrics.histogram(
+    "template_render_duration_seconds",
+    "Time spent rendering templates.",
+    ["template"],
+)
+WEBHOOK_EVENTS = metrics.counter(
+    "webhook_events",
+    "Stripe webhook events by type and outcome (HTTP status, duplicate or queued).",
+    ["event_type", "outcome"],
+)
+SMS_MESSAGES = metrics.counter(
+    "sms_messages",
+    "SMS notifications by outcome.",
+    ["outcome"],
+)
+
+
+def checkout_session_params(domain, user_phone, payment_method_types=None, product=None, price_id=None):
+    """Parameters for a Checkout Session selling one ``product``.
+
+    Defaults to the $50.00 test product. With the product's synced Stripe
+    ``price_id`` the line item references it; otherwise the price is sent
+    inline.
+    """
+    product = product or DEFAULT_PRODUCT
+    if price_id:
+        line_item = {"price": price_id, "quantity": 1}
+    else:
+        line_item = {"price_data": product.price_data(), "quantity": 1}
+    params = {
+        "line_items": [line_item],
+        "mode": "payment",
+        "success_url": (domain + "/success?payment_status=completed&amount=" + product.display_amount
+                        + "&transaction_id={CHECKOUT_SESSION_ID}"),
+        "cancel_url": domain + "/cancel",
+        "metadata": {"phone": user_phone},  # Store phone number in metadata
+        # Copy it onto the PaymentIntent too, so it is there before the webhook runs
+        "payment_intent_data": {"metadata": {"phone": user_phone}},
+    }
+    if payment_method_types:
+        params["payment_method_types"] = payment_method_types
+    return params
+
+
+def missing_twilio_config(account_sid, auth_token, from_number, user_phone):
+    """Names of the Twilio settings that are not set."""
+    settings = {
+        "TWILIO_ACCOUNT_SID": account_sid,
+        "TWILIO_AUTH_TOKEN": auth_token,
+        "TWILIO_PHONE_NUMBER": from_number,
+        "USER_PHONE": user_phone,
+    }
+    return [name for name, value in settings.items() if not value]
+
+
+def payment_sms_body(amount):
+    return f"Payment of ${amount:.2f} Successful! Thank you for your purchase."
+
+
+def customer_details(session):
+    """``(email, name)`` from a completed Checkout Session."""
+    details = session.get('customer_details') or {}
+    return details.get('email'), details.get('name')
+
+
+def payment_intent_metadata(session, customer_id, customer_email, customer_name):
+    return {
+        'customer_id': customer_id,
+        'customer_email': customer_email,
+        'customer_name': customer_name,
+        'phone': (session.get('metadata') or {}).get('phone'),
+    }
+
+
+def completed_body(session, amount, phone, customer_email, customer_name):
+    return {
+        "message": "Payment processed and SMS sent",
+        "amount": amount,
+        "phone": phone,
+        "session_id": session['id'],
+        "customer_email": customer_email,
+        "customer_name": customer_name,
+    }
+
+
+def success_details(session_id, record):
+    """Template values for the success page's payment details; ``record`` is None while unknown."""
+    if record is None:
+        return {"payment_status": "processing", "amount": None, "transaction_id": session_id}
+    amount = record.get("amount_total")
+    return {
+        "payment_status": record.get("payment_status") or "processing",
+        "amount": f"{amount / 100:.2f}" if amount is not None else None,
+        "transaction_id": session_id,
+    }
+
+
+class CheckoutLookup:
+    """Payment details of a Checkout Session for the success page and ``/checkout/status``.
+
+    The ledger answers once the webhook has recorded the session. Until
+    then the session is retrieved from Stripe, and the answer, including
+    "no such session", is kept for ``ttl`` seconds so a customer refreshing
+    the page does not cost a Stripe call each time.
+    """
+
+    def __init__(self, ledger, ttl=10.0, max_entries=1000):
+        self.ledger = ledger
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"ledger": 0, "recent": 0, "stripe": 0}
+
+    def cached(self, session_id):
+        """``(record, source)`` without calling Stripe, or None if Stripe must be asked."""
+        record = self.ledger.payment(session_id)
+        with self._lock:
+            if record is not None:
+                self._stats["ledger"] += 1
+                return record, "ledger"
+            entry = self._recent.get(session_id)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._recent[session_id]
+                return None
+            self._stats["recent"] += 1
+            return entry[0], "stripe"
+
+    def remember(self, session_id, session):
+        """Keep what Stripe returned for a session (None if it has no such session)."""
+        record = payment_record(session) if session is not None else None
+        with self._lock:
+            self._stats["stripe"] += 1
+            self._recent[session_id] = (record, time.monotonic() + self.ttl)
+            self._recent.move_to_end(session_id)
+            while len(self._recent) > self.max_entries:
+                self._recent.popitem(last=False)
+        return record, "stripe"
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["recent_size"] = len(self._recent)
+        return stats
+
+
+# What Stripe's Checkout Session IDs look like; anything else is not worth a lookup
+CHECKOUT_SESSION_ID = re.compile(r"cs_(test|live)_[A-Za-z0-9]{1,250}")
+
+
+def is_checkout_session_id(value):
+    return bool(value) and CHECKOUT_SESSION_ID.fullmatch(value) is not None
+
+
+def is_missing(exc):
+    return isinstance(exc, stripe.error.InvalidRequestError) and exc.http_status == 404
+
+
+def checkout_status(lookup, gateway, session_id, admit=None):
+    """``(record, source)`` for a Checkout Session; ``record`` is None if Stripe does not know it.
+
+    ``admit`` returns a context manager that each Stripe lookup runs
+    under, e.g. the client's admission, so lookups can't use up the rate
+    limit checkouts need. It raises ``admission.Rejected`` to refuse.
+    """
+    found = lookup.cached(session_id)
+    if found is not None:
+        return found
+    try:
+        with admit() if admit else contextlib.nullcontext():
+            session = gateway.retrieve_checkout_session(session_id)
+    except stripe.error.InvalidRequestError as e:
+        if not is_missing(e):
+            raise
+        session = None
+    return lookup.remember(session_id, session)
+
+
+async def checkout_status_async(lookup, gateway, session_id, admit=None):
+    """``checkout_status`` for a gateway whose methods are coroutines."""
+    found = lookup.cached(session_id)
+    if found is not None:
+        return found
+    try:
+        with admit() if admit else contextlib.nullcontext():
+            session = await gateway.retrieve_checkout_session(session_id)
+    except stripe.error.InvalidRequestError as e:
+        if not is_missing(e):
+            raise
+        session = None
+    return lookup.remember(session_id, session)
+
+
+def ordering_key(event, cache=None):
+    """The key whose events must be handled in order: the customer's email, else their ID, else the event ID.
+
+    A completed checkout and a ``customer.updated``/``customer.deleted``
+    for the same customer share the key, so they never run concurrently.
+    The email is what the handlers upsert and invalidate by, so it is the
+    key whenever the event has one. An event without one is keyed by the
+    email ``cache`` holds for its customer ID, which is the email another
+    event for that customer would be keyed by, and only failing that by
+    the ID itself.
+    """
+    data = event.get("data")
+    obj = data["object"] if data else None
+    email = customer_id = None
+    if event["type"] == "checkout.session.completed":
+        email = customer_details(obj)[0]
+        customer_id = obj.get("customer")
+    elif event["type"] in ("customer.updated", "customer.deleted"):
+        email = obj.get("email") or (data.get("previous_attributes") or {}).get("email")
+        customer_id = obj["id"]
+    if not email and customer_id:
+        email = cache.email_for(customer_id) if cache is not None else None
+        if not email:
+            return customer_id
+    return normalize_email(email) if email else event["id"]
+
+
+def invalidate_customer(cache, event):
+    """Drop a customer from the cache for ``customer.updated``/``customer.deleted``."""
+    customer = event["data"]["object"]
+    previous = event["data"].get("previous_attributes") or {}
+    # Drop both the current and any previous email so no stale ID is served
+    cache.invalidate(customer_id=customer["id"], email=customer.get("email"))
+    if previous.get("email"):
+        cache.invalidate(email=previous["email"])
+    return {"message": "Customer cache invalidated", "customer_id": customer["id"]}, 200
+
+
+class StripeGateway:
+    """The Stripe calls the app makes, through the SDK and ``outbound.call``.
+
+    Results are Stripe objects, which also support the dict access the
+    shared logic uses, so ``AsyncStripeClient`` can return plain dicts.
+    Creates carry an idempotency key that every retry reuses.
+    """
+
+    def create_checkout_session(self, params):
+        return outbound.call("stripe", "checkout.Session.create", stripe.checkout.Session.create,
+                             idempotency_key=str(uuid.uuid4()), **params)
+
+    def list_prices(self, lookup_keys):
+        return outbound.call("stripe", "Price.list", stripe.Price.list,
+                             lookup_keys=lookup_keys, active=True, limit=100).data
+
+    def create_price(self, product):
+        # Keyed by the lookup key, so workers syncing at once create one Price
+        return outbound.call("stripe", "Price.create", stripe.Price.create,
+                             currency=product.currency,
+                             unit_amount=product.unit_amount,
+                             product_data={"name": product.name},
+                             lookup_key=product.lookup_key,
+                             metadata={"sku": product.sku},
+                             idempotency_key=f"catalog-price-{product.lookup_key}")
+
+    def list_customers(self, email):
+        return outbound.call("stripe", "Customer.list", stripe.Customer.list, email=email).data
+
+    def create_customer(self, email, name):
+        return outbound.call("stripe", "Customer.create", stripe.Customer.create,
+                             email=email, name=name, idempotency_key=str(uuid.uuid4()))
+
+    def modify_customer(self, customer_id, **params):
+        return outbound.call("stripe", "Customer.modify", stripe.Customer.modify, customer_id, **params)
+
+    def modify_payment_intent(self, payment_intent_id, metadata):
+        return outbound.call("stripe", "PaymentIntent.modify", stripe.PaymentIntent.modify,
+                             payment_intent_id, metadata=metadata)
+
+    def retrieve_checkout_session(self, session_id):
+        return outbound.call("stripe", "checkout.Session.retrieve", stripe.checkout.Session.retrieve, session_id)
+
+    def list_checkout_sessions(self, **params):
+        """One page of Checkout Sessions; see ``reconcile.iter_listing`` for the rest."""
+        return outbound.call("stripe", "checkout.Session.list", stripe.checkout.Session.list, **params)
+
+    def list_payment_intents(self, **params):
+        return outbound.call("stripe", "PaymentIntent.list", stripe.PaymentIntent.list, **params)
+
+
+def upsert_customer(gateway, cache, email, name, flights=None):
+    """Create or update the Stripe customer for an email and return its ID.
+
+    The ``Customer.list`` lookup only runs when the email is not in the
+    customer cache. With ``flights`` (a ``SingleFlight``), concurrent
+    upserts for the same email share one lookup or create instead of each
+    creating a customer.
+    """
+    customer = cache.get(email)
+    if customer is None:
+        find = functools.partial(find_or_create_customer, gateway, cache, email, name,
+                                 recheck=bool(flights and flights.path))
+        customer = flights.do(normalize_email(email), find) if flights else find()
+    customer_id, current_name = customer
+    if name and current_name != name:
+        try:
+            customer = gateway.modify_customer(customer_id, name=name)
+        except stripe.error.InvalidRequestError as e:
+            if not is_missing(e):
+                raise
+            # Deleted in Stripe while still cached here; look the email up afresh
+            cache.invalidate(customer_id=customer_id, email=email)
+            return find_or_create_customer(gateway, cache, email, name)[0]
+        cache.put(email, customer["id"], customer.get("name"))
+    return customer_id
+
+
+def find_or_create_customer(gateway, cache, email, name, recheck=False):
+    """``(customer_id, name)`` of the Stripe customer for an email, created if there is none.
+
+    ``recheck`` looks in the cache first, for callers that waited while
+    another worker may have created the customer.
+    """
+    customer = cache.get(email) if recheck else None
+    if customer is not None:
+        return customer
+    customers = gateway.list_customers(email)
+    customer = customers[0] if customers else gateway.create_customer(email, name)
+    cache.put(email, customer["id"], customer.get("name"))
+    return customer["id"], customer.get("name")
+
+
+async def upsert_customer_async(gateway, cache, email, name, flights=None):
+    """``upsert_customer`` for a gateway whose methods are coroutines."""
+    customer = cache.get(email)
+    if customer is None:
+        find = functools.partial(find_or_create_customer_async, gateway, cache, email, name,
+                                 recheck=bool(flights and flights.path))
+        customer = await (flights.do_async(normalize_email(email), find) if flights else find())
+    customer_id, current_name = customer
+    if name and current_name != name:
+        try:
+            customer = await gateway.modify_customer(customer_id, name=name)
+        except stripe.error.InvalidRequestError as e:
+            if not is_missing(e):
+                raise
+            cache.invalidate(customer_id=customer_id, email=email)
+            return (await find_or_create_customer_async(gateway, cache, email, name))[0]
+        cache.put(email, customer["id"], customer.get("name"))
+    return customer_id
+
+
+async def find_or_create_customer_async(gateway, cache, email, name, recheck=False):
+    """``find_or_create_customer`` for a gateway whose methods are coroutines."""
+    customer = cache.get(email) if recheck else None
+    if customer is not None:
+        return customer
+    customers = await gateway.list_customers(email)
+    customer = customers[0] if customers else await gateway.create_customer(email, name)
+    cache.put(email, customer["id"], customer.get("name"))
+    return customer["id"], customer.get("name")
@@ -0,0 +1,250 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+import metrics
+
+POOL_SESSIONS = metrics.counter(
+    "checkout_pool_sessions",
+    "Checkout Sessions taken from the pool (hit), created on demand (miss) or discarded (expired).",
+    ["pool", "outcome"],
+)
+POOL_REFILL_LAG = metrics.histogram(
+    "checkout_pool_refill_lag_seconds",
+    "Time from a pooled Checkout Session being used to its replacement being ready.",
+    ["pool"],
+)
+
+
+class SessionPool:
+    """Keeps ``size`` Checkout Sessions created ahead of time.
+
+    ``create()`` makes one session with the Stripe API. ``workers``
+    background threads keep the pool full, so ``take`` can answer a click
+    with a ready session in constant time and no round trip to Stripe. Each
+    session is handed out once. Sessions with less than ``min_ttl`` seconds left before their
+    ``expires_at`` are discarded rather than served, so a customer always
+    has time to pay. When the pool is empty ``take`` falls back to creating
+    a session on the spot.
+    """
+
+    def __init__(self, create, size=5, min_ttl=600.0, workers=1, retry_delay=5.0, name="checkout",
+                 lag_samples=1000):
+        self.create = create
+        self.size = size
+        self.workers = workers
+        self.min_ttl = min_ttl
+        self.retry_delay = retry_delay
+        self.name = name
+
+        # (session, time after which it is too close to expiry to serve)
+        self._ready = deque()
+        # When each slot emptied, oldest first, for the refill lag
+        self._vacated = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._threads = []
+        self._creating = 0
+        self._stopping = False
+        self._lags = deque(maxlen=lag_samples)
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "created": 0, "errors": 0}
+
+    def _pop(self):
+        """Pop the oldest servable session, or None. Call with the lock held."""
+        now = time.time()
+        while self._ready:
+            session, stale_at = self._ready.popleft()
+            self._vacated.append(time.monotonic())
+            if stale_at > now:
+                self._stats["hits"] += 1
+                POOL_SESSIONS.inc(pool=self.name, outcome="hit")
+                return session
+            self._stats["expired"] += 1
+            POOL_SESSIONS.inc(pool=self.name, outcome="expired")
+        self._stats["misses"] += 1
+        POOL_SESSIONS.inc(pool=self.name, outcome="miss")
+        return None
+
+    def _add(self, session):
+        """Add a freshly created session. Call with the lock held."""
+        self._ready.append((session, session["expires_at"] - self.min_ttl))
+        self._stats["created"] += 1
+        if self._vacated:
+            lag = time.monotonic() - self._vacated.popleft()
+            self._lags.append(lag)
+            POOL_REFILL_LAG.observe(lag, pool=self.name)
+
+    def _needed(self):
+        """How many sessions to create now, or the seconds until the oldest goes stale.
+
+        Call with the lock held.
+        """
+        now = time.time()
+        while self._ready and self._ready[0][1] <= now:
+            self._ready.popleft()
+            self._vacated.append(time.monotonic())
+            self._stats["expired"] += 1
+            POOL_SESSIONS.inc(pool=self.name, outcome="expired")
+        missing = self.size - len(self._ready) - self._creating
+        if missing > 0:
+            return missing, None
+        # Everything missing is already being created
+        return 0, self._ready[0][1] - now if self._ready else None
+
+    def _failed(self, error):
+        self._stats["errors"] += 1
+        # An open circuit breaker says when Stripe is worth trying again
+        return getattr(error, "retry_after", None) or self.retry_delay
+
+    def take(self):
+        """Return a ready session, creating one synchronously if the pool is empty."""
+        with self._lock:
+            session = self._pop()
+            self._wakeup.notify()
+        self.start()
+        if session is None:
+            session = self.create()
+        return session
+
+    def start(self):
+        # Threads don't survive fork(), so a forked child starts its own
+        if self._running():
+            return
+        with self._lock:
+            if self._running():
+                return
+            self._threads = []
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"session-pool-{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def stop(self, timeout=5.0):
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while True:
+            with self._lock:
+                missing, wait = self._needed()
+                while not missing and not self._stopping:
+                    self._wakeup.wait(wait)
+                    missing, wait = self._needed()
+                if self._stopping:
+                    return
+                self._creating += 1
+            try:
+                session = self.create()
+            except Exception as e:
+                with self._lock:
+                    self._creating -= 1
+                    delay = self._failed(e)
+                    self._wakeup.wait(delay)
+                continue
+            with self._lock:
+                self._creating -= 1
+                self._add(session)
+
+    def clear(self):
+        """Drop every ready session, e.g. after the product they sell changed."""
+        with self._lock:
+            while self._ready:
+                self._ready.popleft()
+                self._vacated.append(time.monotonic())
+                self._stats["expired"] += 1
+                POOL_SESSIONS.inc(pool=self.name, outcome="expired")
+            self._wakeup.notify_all()
+
+    def metrics(self):
+        """Ready sessions, hit rate and how long used sessions take to be replaced."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["ready"] = len(self._ready)
+            lags = sorted(self._lags)
+        stats["size"] = self.size
+        taken = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / taken, 4) if taken else None
+        if lags:
+            stats["refill_lag_p50_ms"] = round(lags[len(lags) // 2] * 1000, 3)
+            stats["refill_lag_p95_ms"] = round(lags[max(0, int(len(lags) * 0.95) - 1)] * 1000, 3)
+            stats["refill_lag_max_ms"] = round(lags[-1] * 1000, 3)
+        return stats
+
+
+class AsyncSessionPool(SessionPool):
+    """``SessionPool`` for a coroutine ``create``, refilled by tasks on the running loop."""
+
+    def __init__(self, create, **options):
+        super().__init__(create, **options)
+        self._tasks = []
+        self._wake = None
+
+    async def take(self):
+        with self._lock:
+            session = self._pop()
+        self.start()
+        self._wake.set()
+        if session is None:
+            session = await self.create()
+        return session
+
+    def start(self):
+        if self._tasks and not all(task.done() for task in self._tasks):
+            return
+        self._stopping = False
+        self._wake = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=5.0):
+        if not self._tasks:
+            return
+        self._stopping = True
+        self._wake.set()
+        done, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        self._tasks = []
+
+    def clear(self):
+        super().clear()
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _sleep(self, seconds):
+        # Returns early when woken by a take or stop
+        try:
+            await asyncio.wait_for(self._wake.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def _run(self):
+        while not self._stopping:
+            with self._lock:
+                missing, wait = self._needed()
+                if missing:
+                    self._creating += 1
+            if not missing:
+                await self._sleep(wait)
+                continue
+            try:
+                session = await self.create()
+            except Exception as e:
+                with self._lock:
+                    self._creating -= 1
+                    delay = self._failed(e)
+                await self._sleep(delay)
+                continue
+            with self._lock:
+                self._creating -= 1
+                self._add(session)
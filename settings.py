@@ -0,0 +1,197 @@
+"""Configuration read from the environment once, validated, and shared as one object.
+
+Every setting is a field of ``Settings`` named after its environment
+variable in lower case (``TWILIO_POOL_SIZE`` is ``twilio_pool_size``).
+``get_settings()`` reads them the first time it is called and returns the
+same frozen object afterwards. A value that does not parse, or is out of
+range, fails startup with every problem listed at once instead of
+surfacing as a ``ValueError`` from whichever line happened to read it.
+"""
+import functools
+import os
+from dataclasses import dataclass, field, fields
+from typing import Optional
+
+_TRUE = ("1", "true", "yes", "on")
+_FALSE = ("0", "false", "no", "off")
+
+# Needed before the app can take payments or send texts
+REQUIRED = ("stripe_api_key", "stripe_public_key", "stripe_webhook_secret",
+            "twilio_account_sid", "twilio_auth_token", "twilio_phone_number", "user_phone")
+
+
+class SettingsError(ValueError):
+    """One or more settings have invalid values; ``problems`` lists them."""
+
+    def __init__(self, problems):
+        super().__init__("Invalid settings: " + "; ".join(problems))
+        self.problems = problems
+
+
+def setting(default, minimum=None, maximum=None, parse=None):
+    return field(default=default, metadata={"minimum": minimum, "maximum": maximum, "parse": parse})
+
+
+def parse_timeouts(raw):
+    """``"Customer.list=5,checkout.Session.create=20"`` as ``(("Customer.list", 5.0), ...)``."""
+    timeouts = []
+    for item in raw.split(","):
+        if not item.strip():
+            continue
+        name, sep, seconds = item.partition("=")
+        try:
+            value = float(seconds) if sep and name.strip() else None
+        except ValueError:
+            value = None
+        if value is None or value <= 0:
+            raise ValueError("must be name=seconds pairs separated by commas")
+        timeouts.append((name.strip(), value))
+    return tuple(timeouts)
+
+
+@dataclass(frozen=True)
+class Settings:
+    log_level: str = "INFO"
+    log_levels: Optional[str] = None
+    metrics_dir: Optional[str] = None
+    page_cache_size: int = setting(1000, minimum=1)
+
+    stripe_api_key: Optional[str] = None
+    stripe_public_key: Optional[str] = None
+    stripe_webhook_secret: Optional[str] = None
+    stripe_api_base: Optional[str] = None
+    stripe_timeout: float = setting(10.0, minimum=0)  # read timeout
+    stripe_connect_timeout: float = setting(3.0, minimum=0)
+    stripe_operation_timeouts: tuple = setting((), parse=parse_timeouts)
+    stripe_pool_size: int = setting(10, minimum=1)
+
+    twilio_account_sid: Optional[str] = None
+    twilio_auth_token: Optional[str] = None
+    twilio_phone_number: Optional[str] = None
+    user_phone: Optional[str] = None
+    twilio_api_base: Optional[str] = None
+    twilio_pool_size: int = setting(10, minimum=1)
+    twilio_timeout: float = setting(10.0, minimum=0)
+    twilio_sms_rate: float = setting(1.0, minimum=0)  # messages per second per sender, 0 for no limit
+    twilio_sms_burst: int = setting(5, minimum=1)
+    twilio_sms_queue_size: int = setting(1000, minimum=1)
+    twilio_sms_wait_timeout: float = setting(15.0, minimum=0)
+    twilio_sms_workers: int = setting(2, minimum=1)
+
+    request_deadline: float = setting(10.0, minimum=0)
+    outbound_max_attempts: int = setting(3, minimum=1)
+    outbound_backoff_base: float = setting(0.2, minimum=0)
+    outbound_backoff_max: float = setting(2.0, minimum=0)
+    breaker_failure_threshold: int = setting(5, minimum=1)
+    breaker_reset_timeout: float = setting(30.0, minimum=0)
+
+    profiling: bool = False  # /debug/profiles is unauthenticated; opt in where it is not exposed
+    profile_threshold: float = setting(1.0, minimum=0)
+    profile_sample_rate: float = setting(0.0, minimum=0, maximum=1)
+    profile_keep: int = setting(50, minimum=1)
+    profile_dir: str = "profiles"
+
+    catalog_path: Optional[str] = None
+    catalog_price_cache_path: Optional[str] = None
+    catalog_default_sku: str = "test-product"
+    catalog_sync_prices: bool = True
+    catalog_check_interval: float = setting(5.0, minimum=0)
+
+    admission_path: Optional[str] = None
+    admission_rate: float = setting(1.0, minimum=0)  # checkouts per second per client, 0 for no limit
+    admission_burst: int = setting(10, minimum=1)
+    admission_max_in_flight: int = setting(20, minimum=0)  # per host, 0 for no limit
+    admission_client_header: Optional[str] = None
+    admission_trusted_hops: int = setting(1, minimum=1)  # proxies in front that append to the header
+
+    checkout_pool_size: int = setting(0, minimum=0)
+    checkout_pool_min_ttl: float = setting(600.0, minimum=0)
+    checkout_pool_workers: int = setting(2, minimum=1)
+
+    webhook_max_bytes: int = setting(512 * 1024, minimum=1)
+    webhook_tolerance: int = setting(300, minimum=1)  # seconds a signature timestamp may be off
+    webhook_lanes: int = setting(8, minimum=1)
+    webhook_lane_depth: int = setting(100, minimum=1)  # events waiting per lane
+    webhook_async: bool = False
+    webhook_queue_path: str = "webhook_queue.db"
+    webhook_workers: int = setting(4, minimum=1)
+    webhook_max_attempts: int = setting(5, minimum=1)
+
+    event_store_path: str = "event_store.db"
+    event_store_ttl: int = setting(7 * 24 * 3600, minimum=0)
+    event_store_cache_size: int = setting(10000, minimum=1)
+
+    customer_cache_size: int = setting(10000, minimum=1)
+    customer_cache_path: Optional[str] = None
+    customer_cache_ttl: int = setting(24 * 3600, minimum=0)
+    customer_lock_path: Optional[str] = None
+
+    ledger_path: str = "ledger.db"
+    ledger_batch_size: int = setting(200, minimum=1)
+    checkout_lookup_ttl: float = setting(10.0, minimum=0)
+
+    @classmethod
+    def from_env(cls, environ=None):
+        """Settings from ``environ`` (default ``os.environ``); unset or empty variables keep their defaults.
+
+        Raises ``SettingsError`` naming every variable that is invalid.
+        """
+        environ = os.environ if environ is None else environ
+        values = {}
+        problems = []
+        for spec in fields(cls):
+            name = spec.name.upper()
+            raw = environ.get(name)
+            if raw is None or raw.strip() == "":
+                continue
+            try:
+                values[spec.name] = _parse(spec, raw.strip())
+            except ValueError as e:
+                problems.append(f"{name} {e} (got {raw!r})")
+        if problems:
+            raise SettingsError(problems)
+        return cls(**values)
+
+    def missing(self):
+        """Environment variable names of the required settings that are not set."""
+        return [name.upper() for name in REQUIRED if not getattr(self, name)]
+
+
+def _parse(spec, raw):
+    if spec.metadata.get("parse") is not None:
+        return spec.metadata["parse"](raw)
+    kind = spec.type
+    if kind is bool:
+        if raw.lower() in _TRUE:
+            return True
+        if raw.lower() in _FALSE:
+            return False
+        raise ValueError("must be true or false")
+    if kind is int:
+        try:
+            value = int(raw)
+        except ValueError:
+            raise ValueError("must be a whole number") from None
+    elif kind is float:
+        try:
+            value = float(raw)
+        except ValueError:
+            raise ValueError("must be a number") from None
+    else:
+        return raw
+    minimum, maximum = spec.metadata.get("minimum"), spec.metadata.get("maximum")
+    if minimum is not None and value < minimum:
+        raise ValueError(f"must be at least {minimum}")
+    if maximum is not None and value > maximum:
+        raise ValueError(f"must be at most {maximum}")
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings():
+    """The process's settings, read from the environment on the first call.
+
+    Load ``.env`` before the first call. ``get_settings.cache_clear()``
+    makes the next call read the environment again.
+    """
+    return Settings.from_env()
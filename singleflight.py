@@ -0,0 +1,226 @@
+"""Run one call per key at a time and share its result with everyone who asked meanwhile.
+
+When several requests need the same thing at the same moment, such as the
+Stripe customer for an email, only the first caller (the leader) runs the
+call. Callers that arrive while it is in flight wait for it and get its
+result, or its exception, instead of repeating it. Once the call finishes
+the key is free again; results are not cached here.
+
+With ``path`` set, leaders in different processes on the host also take
+turns: a leader holds a byte-range lock on that file, chosen by hashing
+the key, while its call runs. A leader that waited on the lock should
+re-check whatever store the other process wrote to (see
+``services.upsert_customer``). Without ``fcntl`` (Windows) only callers in
+the same process are coalesced.
+"""
+import asyncio
+import os
+import threading
+import time
+import weakref
+import zlib
+
+from resilience import DeadlineExceeded, remaining
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not POSIX
+    fcntl = None
+
+LOCK_POLL_INTERVAL = 0.005
+
+# Every live instance, so forked children forget calls in flight in the parent
+_instances = weakref.WeakSet()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls by key, within the process and optionally across the host.
+
+    ``do(key, fn)`` is for threads and ``do_async(key, coro_fn)`` for
+    coroutines on one event loop. Waiting, for the leader's result or for
+    the host lock, stops at the request deadline with ``DeadlineExceeded``.
+    """
+
+    def __init__(self, path=None, slots=256):
+        self.path = path if fcntl is not None else None
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        # fcntl locks belong to the process, so threads of one process
+        # must also exclude each other per slot
+        self._slot_locks = [threading.Lock() for _ in range(slots)]
+        self._fd = None
+        self._fd_pid = None
+        self._stats = {"leaders": 0, "shared": 0, "errors": 0, "lock_waits": 0}
+        if self.path:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+        _instances.add(self)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def do(self, key, fn):
+        """Return ``fn()``, or the result of the call already running for ``key``."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._stats["leaders"] += 1
+            else:
+                self._stats["shared"] += 1
+
+        if not leader:
+            if not call.done.wait(remaining()):
+                raise DeadlineExceeded(f"Deadline passed waiting for the call in flight for {key!r}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            slot = self._acquire(key)
+            try:
+                call.result = fn()
+            finally:
+                self._release(slot)
+        except BaseException as e:
+            call.error = e
+            self._count("errors")
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, coro_fn):
+        """Return ``await coro_fn()``, or the result of the call already running for ``key``."""
+        with self._lock:
+            future = self._async_calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+                self._stats["leaders"] += 1
+            else:
+                self._stats["shared"] += 1
+
+        if not leader:
+            try:
+                # A follower giving up must not cancel the leader's call
+                return await asyncio.wait_for(asyncio.shield(future), remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"Deadline passed waiting for the call in flight for {key!r}") from None
+
+        try:
+            slot = await self._acquire_async(key)
+            try:
+                result = await coro_fn()
+            finally:
+                self._release(slot)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # The leader raises it; don't warn when no follower retrieves it
+            future.exception()
+            self._count("errors")
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._async_calls.pop(key, None)
+
+    def _slot(self, key):
+        return zlib.crc32(key.encode("utf-8")) % self.slots
+
+    def _file(self):
+        # A descriptor opened before a fork is shared with the parent; open our own
+        if self._fd is None or self._fd_pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._fd_pid = os.getpid()
+        return self._fd
+
+    def _try_acquire(self, slot):
+        lock = self._slot_locks[slot]
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            fcntl.lockf(self._file(), fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+        except OSError:
+            lock.release()
+            return False
+        return True
+
+    def _acquire(self, key):
+        """Take the host lock for ``key``; returns the slot to release, or None without ``path``."""
+        if not self.path:
+            return None
+        slot = self._slot(key)
+        if not self._try_acquire(slot):
+            self._count("lock_waits")
+            while not self._try_acquire(slot):
+                left = remaining()
+                if left is not None and left <= 0:
+                    raise DeadlineExceeded(f"Deadline passed waiting for the host lock for {key!r}")
+                time.sleep(LOCK_POLL_INTERVAL)
+        return slot
+
+    async def _acquire_async(self, key):
+        if not self.path:
+            return None
+        slot = self._slot(key)
+        if not self._try_acquire(slot):
+            self._count("lock_waits")
+            while not self._try_acquire(slot):
+                left = remaining()
+                if left is not None and left <= 0:
+                    raise DeadlineExceeded(f"Deadline passed waiting for the host lock for {key!r}")
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+        return slot
+
+    def _release(self, slot):
+        if slot is None:
+            return
+        try:
+            fcntl.lockf(self._file(), fcntl.LOCK_UN, 1, slot)
+        finally:
+            self._slot_locks[slot].release()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls) + len(self._async_calls)
+        stats["host_wide"] = bool(self.path)
+        return stats
+
+    def _reset_after_fork(self):
+        # Leaders of the parent's calls don't exist in the child, and its
+        # locks may have been held mid-fork; fcntl locks are not inherited
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self._slot_locks = [threading.Lock() for _ in range(self.slots)]
+        self._fd = None
+
+
+def _reset_after_fork():
+    for flights in list(_instances):
+        flights._reset_after_fork()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,192 @@
+import contextvars
+import queue
+import threading
+import time
+from collections import deque
+
+
+class TokenBucket:
+    """Allow ``rate`` operations per second with bursts of up to ``burst``; a rate of 0 is no limit."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, returning how many seconds the caller must wait before using it."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class SmsHandle:
+    """Tracks one submitted notification. ``wait`` blocks until it is sent or fails."""
+
+    def __init__(self, key, to, body, sender):
+        self.key = key
+        self.to = to
+        self.body = body
+        self.sender = sender
+        self.submitted_at = time.monotonic()
+        self.completed_at = None
+        # Delivery runs in the submitter's context so its logs keep the request ID
+        self.context = contextvars.copy_context()
+        self.ok = None
+        self.error = None
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for delivery. Returns True if the message was sent."""
+        self._done.wait(timeout)
+        return bool(self.ok)
+
+    def _finish(self, ok, error=None):
+        self.ok = ok
+        self.error = error
+        self.completed_at = time.monotonic()
+        self._done.set()
+
+
+class SmsDispatcher:
+    """Queue SMS notifications and drain them within Twilio's per-number throughput.
+
+    ``send(to, body, sender)`` does the actual delivery and returns True on
+    success. Each sender number gets its own token bucket. Notifications that
+    share a ``key`` (for example a checkout session ID) are coalesced: while
+    one is queued, in flight, or was delivered within ``coalesce_window``
+    seconds, resubmitting returns the existing handle instead of sending again.
+    When the queue is full new notifications are dropped rather than blocking
+    the caller.
+    """
+
+    def __init__(self, send, default_sender=None, rate=1.0, burst=5,
+                 max_queue=1000, workers=2, coalesce_window=300.0, latency_samples=1000):
+        self.send = send
+        self.default_sender = default_sender
+        self.rate = rate
+        self.burst = burst
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._buckets = {}
+        self._handles = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stopping = threading.Event()
+        self._latencies = deque(maxlen=latency_samples)
+        self._stats = {"submitted": 0, "sent": 0, "failed": 0, "dropped": 0, "coalesced": 0}
+
+    def _bucket(self, sender):
+        bucket = self._buckets.get(sender)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(sender, TokenBucket(self.rate, self.burst))
+        return bucket
+
+    def submit(self, to, body, key=None, sender=None):
+        """Queue a notification and return its handle without blocking."""
+        sender = sender or self.default_sender
+        with self._lock:
+            self._stats["submitted"] += 1
+            if key is not None:
+                existing = self._handles.get(key)
+                if existing is not None and self._can_coalesce(existing):
+                    self._stats["coalesced"] += 1
+                    return existing
+            handle = SmsHandle(key, to, body, sender)
+            try:
+                self._queue.put_nowait(handle)
+            except queue.Full:
+                self._stats["dropped"] += 1
+                handle._finish(False, "SMS queue is full")
+                return handle
+            if key is not None:
+                self._handles[key] = handle
+                self._prune()
+        self.start()
+        return handle
+
+    def _can_coalesce(self, handle):
+        if not handle.done():
+            return True
+        return handle.ok and time.monotonic() - handle.completed_at < self.coalesce_window
+
+    def _prune(self):
+        # Keep the coalescing index from growing without bound
+        if len(self._handles) <= self._queue.maxsize * 2:
+            return
+        for key, handle in list(self._handles.items()):
+            if not self._can_coalesce(handle):
+                del self._handles[key]
+
+    def start(self):
+        # Threads don't survive fork(), so a forked child starts its own
+        if self._running():
+            return
+        with self._lock:
+            if self._running():
+                return
+            self._threads = []
+            self._stopping.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"sms-dispatcher-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                handle = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self._deliver(handle)
+
+    def _deliver(self, handle):
+        # Anything that goes wrong fails this handle, never the worker thread
+        try:
+            delay = self._bucket(handle.sender).reserve()
+            if delay:
+                time.sleep(delay)
+            ok = bool(handle.context.run(self.send, handle.to, handle.body, handle.sender))
+            error = None if ok else "Send reported failure"
+        except Exception as e:
+            ok, error = False, f"{type(e).__name__}: {str(e)}"
+        handle._finish(ok, error)
+        with self._lock:
+            self._stats["sent" if ok else "failed"] += 1
+            self._latencies.append(handle.completed_at - handle.submitted_at)
+
+    def metrics(self):
+        """Queue depth, delivery counters and submit-to-delivery latency."""
+        with self._lock:
+            stats = dict(self._stats)
+            latencies = sorted(self._latencies)
+        stats["queued"] = self._queue.qsize()
+        if latencies:
+            stats["latency_p50_ms"] = round(latencies[len(latencies) // 2] * 1000, 3)
+            stats["latency_p95_ms"] = round(latencies[max(0, int(len(latencies) * 0.95) - 1)] * 1000, 3)
+            stats["latency_max_ms"] = round(latencies[-1] * 1000, 3)
+        return stats
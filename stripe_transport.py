@@ -0,0 +1,191 @@
+"""One keep-alive connection pool per worker for every Stripe SDK call.
+
+The SDK's default ``RequestsClient`` gives each thread its own
+``requests.Session``. A server that runs each request on a new thread opens
+a fresh TCP connection and TLS session for every Stripe call. A request
+thread from a pool still keeps a separate set of idle connections.
+``StripeTransport`` shares a single session among all threads of the
+process. Its pool keeps up to ``pool_size`` idle connections; a burst
+beyond that still proceeds, and the extra connections are closed after
+use. It counts connections opened against requests sent, so reuse shows
+in ``metrics()``.
+
+Timeouts are a (connect, read) pair. The read timeout can be set per SDK
+operation, using the names ``outbound.call`` gives (``Customer.list``,
+``checkout.Session.create``), and neither may outlast the request's
+deadline. After a fork the child drops the parent's connections and opens
+its own.
+
+This module imports the Stripe SDK; app.py only imports it once the SDK
+is loaded (see sdk.py).
+"""
+import os
+import threading
+import weakref
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import outbound
+from resilience import remaining
+
+# Every live transport, so forked children can drop the connections they inherited
+_instances = weakref.WeakSet()
+
+
+class _Counters:
+    __slots__ = ("requests", "opened", "discarded", "errors", "lock")
+
+    def __init__(self):
+        self.requests = self.opened = self.discarded = self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+def _counting(pool_class, counters):
+    """``pool_class`` recording each new connection and each one dropped because the pool was full."""
+
+    class CountingPool(pool_class):
+        def _new_conn(self):
+            counters.add("opened")
+            return super()._new_conn()
+
+        def _put_conn(self, conn):
+            if conn is not None and self.pool is not None and self.pool.full():
+                counters.add("discarded")
+            super()._put_conn(conn)
+
+    return CountingPool
+
+
+class _CountingAdapter(HTTPAdapter):
+    def __init__(self, counters, **kwargs):
+        # Set first: the base constructor builds the pool manager
+        self._counters = counters
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting(HTTPConnectionPool, self._counters),
+            "https": _counting(HTTPSConnectionPool, self._counters),
+        }
+
+
+class StripeTransport(stripe.http_client.RequestsClient):
+    """The Stripe SDK's HTTP client: a shared, bounded keep-alive pool with per-operation timeouts.
+
+    Install it with ``stripe.default_http_client = StripeTransport(...)``.
+    ``operation_timeouts`` maps operation names to read timeouts that
+    replace ``read_timeout`` for those calls.
+    """
+
+    name = "requests-pooled"
+
+    def __init__(self, pool_size=10, connect_timeout=3.0, read_timeout=10.0, operation_timeouts=None):
+        super().__init__(timeout=(connect_timeout, read_timeout))
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.operation_timeouts = dict(operation_timeouts or {})
+        self._lock = threading.Lock()
+        self._session = None
+        self._counters = _Counters()
+        _instances.add(self)
+
+    @classmethod
+    def from_settings(cls, settings, pool_size=None):
+        """A transport configured by the STRIPE_* settings (see settings.py)."""
+        return cls(pool_size=pool_size or settings.stripe_pool_size,
+                   connect_timeout=settings.stripe_connect_timeout,
+                   read_timeout=settings.stripe_timeout,
+                   operation_timeouts=settings.stripe_operation_timeouts)
+
+    @property
+    def session(self):
+        session = self._session
+        if session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._build_session()
+                session = self._session
+        return session
+
+    def _build_session(self):
+        session = requests.Session()
+        # Retries are outbound.call's job, where the deadline and breaker are known
+        adapter = _CountingAdapter(self._counters, pool_connections=2, pool_maxsize=self.pool_size,
+                                   max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def timeout_for(self, operation):
+        """``(connect, read)`` seconds for an operation, cut short by the request's deadline."""
+        connect = self.connect_timeout
+        read = self.operation_timeouts.get(operation, self.read_timeout)
+        left = remaining()
+        if left is not None:
+            left = max(left, 0.001)
+            connect, read = min(connect, left), min(read, left)
+        return connect, read
+
+    def request(self, method, url, headers, post_data=None):
+        return self._send(method, url, headers, post_data, stream=False)
+
+    def request_stream(self, method, url, headers, post_data=None):
+        return self._send(method, url, headers, post_data, stream=True)
+
+    def _send(self, method, url, headers, post_data, stream):
+        current = outbound.current_operation()
+        operation = current[1] if current is not None and current[0] == "stripe" else None
+        kwargs = {"verify": stripe.ca_bundle_path if self._verify_ssl_certs else False}
+        if self._proxy:
+            kwargs["proxies"] = self._proxy
+        self._counters.add("requests")
+        try:
+            result = self.session.request(method, url, headers=headers, data=post_data,
+                                          timeout=self.timeout_for(operation), stream=stream, **kwargs)
+            content = result.raw if stream else result.content
+        except Exception as e:
+            self._counters.add("errors")
+            # Raises the SDK's APIConnectionError, as the stock client does
+            self._handle_request_error(e)
+        return content, result.status_code, result.headers
+
+    def metrics(self):
+        counters = self._counters
+        with counters.lock:
+            stats = {"requests": counters.requests, "opened": counters.opened,
+                     "discarded": counters.discarded, "errors": counters.errors}
+        stats["reused"] = max(0, stats["requests"] - stats["errors"] - stats["opened"])
+        stats.update(pool_size=self.pool_size, connect_timeout=self.connect_timeout,
+                     read_timeout=self.read_timeout, operation_timeouts=self.operation_timeouts)
+        return stats
+
+    def close(self):
+        """Close pooled connections. The session is rebuilt on next use."""
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+    def _reset_after_fork(self):
+        # The parent's lock may have been held mid-fork and its sockets belong
+        # to the parent, so start over without touching either
+        self._lock = threading.Lock()
+        self._session = None
+        self._counters = _Counters()
+
+
+def _reset_after_fork():
+    for transport in list(_instances):
+        transport._reset_after_fork()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
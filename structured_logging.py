@@ -0,0 +1,142 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# Request ID of the request (or queued event) currently being handled
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp records with the request ID bound in the calling thread or task."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the message, level, logger, request ID and any extras."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records with their message merged but leave JSON encoding to the writer thread."""
+
+    def prepare(self, record):
+        # This is the only handler on the root logger, so the record can be
+        # updated in place instead of copied
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_levels(spec):
+    """Parse ``"app=DEBUG,notifier=WARNING"`` into ``{"app": "DEBUG", ...}``."""
+    levels = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level="INFO", module_levels=None, stream=None):
+    """Route all logging through a queue to a background JSON writer.
+
+    Callers only pay for the level check and a queue put; formatting and the
+    write to ``stream`` happen on the listener thread. ``module_levels`` maps
+    logger names to levels, so verbose diagnostics can be enabled for one
+    module without turning them on everywhere. Safe to call more than once;
+    later calls replace the earlier configuration.
+    """
+    global _listener
+
+    records = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(records)
+    handler.addFilter(RequestIdFilter())
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    if _listener is not None:
+        _listener.stop()
+    for existing in [h for h in root.handlers if isinstance(h, _DeferredQueueHandler)]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(records, writer, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def flush_logging():
+    """Wait until the writer thread has emitted everything queued so far."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+        _listener.start()
+
+
+@atexit.register
+def _stop_listener():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _restart_listener_after_fork():
+    # Only the forking thread survives, so a pre-fork worker would queue its
+    # records forever without a writer of its own
+    if _listener is not None and _listener._thread is not None:
+        _listener._thread = None
+        _listener.start()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_listener_after_fork)
+
+
+class request_id:
+    """Context manager binding a request ID to everything logged inside it."""
+
+    def __init__(self, value):
+        self.value = value
+        self._token = None
+
+    def __enter__(self):
+        self._token = request_id_var.set(self.value)
+        return self.value
+
+    def __exit__(self, *exc):
+        request_id_var.reset(self._token)
+
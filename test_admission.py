@@ -0,0 +1,139 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from admission import Admission, Overloaded, RateLimited, forwarded_client
+
+
+class AdmissionTests(unittest.TestCase):
+    def setUp(self):
+        """Keep shared admission files in a scratch directory"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'admission.shm')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make(self, **options):
+        admission = Admission(**options)
+        self.addCleanup(admission.close)
+        return admission
+
+    def test_client_bucket_allows_bursts_then_refills(self):
+        """Test a client gets its burst, is then refused with 429 and admitted again after a refill"""
+        admission = self.make(rate=20, burst=3)
+        for _ in range(3):
+            with admission.admit('198.51.100.1'):
+                pass
+        with self.assertRaises(RateLimited) as raised:
+            admission.acquire('198.51.100.1')
+        self.assertEqual(raised.exception.status, 429)
+        self.assertAlmostEqual(raised.exception.retry_after, 0.05, delta=0.01)
+        # Other clients have their own buckets
+        with admission.admit('198.51.100.2'):
+            pass
+        time.sleep(0.06)
+        with admission.admit('198.51.100.1'):
+            pass
+        self.assertEqual(admission.metrics()['rate_limited'], 1)
+
+    def test_buckets_refill_across_a_reboot(self):
+        """Test a bucket stored in the shared file refills after the monotonic clock restarts"""
+        admission = self.make(path=self.path, rate=1, burst=1)
+        admission.acquire('198.51.100.1')
+        admission.release()
+        later = time.time() + 2
+        with mock.patch('admission.time.monotonic', return_value=0.0), \
+                mock.patch('admission.time.time', return_value=later):
+            rebooted = self.make(path=self.path, rate=1, burst=1)
+            with rebooted.admit('198.51.100.1'):
+                pass
+
+    def test_requests_in_flight_are_capped(self):
+        """Test admissions past the in-flight limit are refused with 503 until one finishes"""
+        admission = self.make(rate=0, max_in_flight=2)
+        admission.acquire('a')
+        admission.acquire('b')
+        with self.assertRaises(Overloaded) as raised:
+            admission.acquire('c')
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(admission.metrics()['in_flight'], 2)
+        admission.release()
+        admission.acquire('c')
+
+    def test_refused_requests_use_nothing(self):
+        """Test a request refused for load does not spend the client's token"""
+        admission = self.make(rate=0.01, burst=1, max_in_flight=1)
+        admission.acquire('a')
+        with self.assertRaises(Overloaded):
+            admission.acquire('b')
+        admission.release()
+        admission.acquire('b')
+
+    def test_forwarded_client_is_set_by_our_proxies(self):
+        """Test the client is read from the right of a forwarding header, past entries the client wrote"""
+        self.assertEqual(forwarded_client('198.51.100.7, 203.0.113.5'), '203.0.113.5')
+        self.assertEqual(forwarded_client('198.51.100.7, 203.0.113.5, 10.0.0.2', trusted_hops=2), '203.0.113.5')
+        self.assertEqual(forwarded_client('203.0.113.5', trusted_hops=3), '203.0.113.5')
+        self.assertIsNone(forwarded_client(' , '))
+
+    def test_file_laid_out_for_other_sizes_is_reset(self):
+        """Test a table written with different slot counts is reinitialized rather than misread"""
+        first = self.make(path=self.path, rate=0, client_slots=16)
+        first.acquire('a')
+        second = self.make(path=self.path, rate=0, client_slots=32)
+        self.assertEqual(second.metrics()['in_flight'], 0)
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "needs fork()")
+class SharedAdmissionTests(unittest.TestCase):
+    def setUp(self):
+        """Share an admission file between this process and forked workers"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'admission.shm')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def in_worker(self, work):
+        """Run ``work`` in a forked worker that opens the file itself; returns its exit status"""
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                work(Admission(self.path, rate=1, burst=2, max_in_flight=2))
+                status = 0
+            finally:
+                os._exit(status)
+        return os.waitpid(pid, 0)[1]
+
+    def test_limits_hold_across_workers(self):
+        """Test one client's burst and the in-flight limit are shared by every worker on the host"""
+        admission = Admission(self.path, rate=1, burst=2, max_in_flight=2)
+        self.addCleanup(admission.close)
+        admission.acquire('203.0.113.5')
+        # The worker takes the client's second token and leaves its request in flight
+        self.assertEqual(self.in_worker(lambda worker: worker.acquire('203.0.113.5')), 0)
+        self.assertEqual(admission.metrics()['in_flight'], 2)
+        with self.assertRaises(RateLimited):
+            admission.acquire('203.0.113.5')
+
+    def test_dead_workers_are_reclaimed(self):
+        """Test requests left in flight by a worker that died stop counting against the limit"""
+        admission = Admission(self.path, rate=0, max_in_flight=2)
+        self.addCleanup(admission.close)
+
+        def crash_mid_request(worker):
+            worker.acquire('a')
+            worker.acquire('b')
+
+        self.assertEqual(self.in_worker(crash_mid_request), 0)
+        self.assertEqual(admission.metrics()['in_flight'], 2)
+        with admission.admit('c'):
+            self.assertEqual(admission.metrics()['in_flight'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+import asyncio
+import dataclasses
+import gzip
+import importlib
+import json
+import os
+import re
+import tempfile
+import unittest
+from unittest import mock
+
+from bench_stubs import StubServer, checkout_completed_event, sign_webhook, stripe_routes, twilio_routes
+
+WEBHOOK_SECRET = 'whsec_test'
+stubs = []
+asgi_app = None
+
+
+def setUpModule():
+    """Point the ASGI edition at local Stripe and Twilio stand-ins and import it"""
+    global asgi_app
+    stubs.extend([StubServer(stripe_routes()).start(), StubServer(twilio_routes()).start()])
+    scratch = tempfile.mkdtemp()
+    os.environ.update({
+        'STRIPE_API_KEY': 'sk_test',
+        'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'STRIPE_API_BASE': stubs[0].url,
+        'TWILIO_ACCOUNT_SID': 'AC' + '0' * 32,
+        'TWILIO_AUTH_TOKEN': 'token',
+        'TWILIO_PHONE_NUMBER': '+15550001',
+        'TWILIO_API_BASE': stubs[1].url,
+        'USER_PHONE': '+15550002',
+        'EVENT_STORE_PATH': os.path.join(scratch, 'events.db'),
+        'LEDGER_PATH': os.path.join(scratch, 'ledger.db'),
+        'LOG_LEVEL': 'CRITICAL',
+        'PROFILING': 'true',
+    })
+    asgi_app = importlib.import_module('asgi_app')
+
+
+def tearDownModule():
+    for stub in stubs:
+        stub.stop()
+
+
+def call(method, path, body=b'', headers=None, query=b''):
+    """Run one request through the ASGI app and return ``(status, headers, body)``"""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+                 'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]}
+        try:
+            await asgi_app.app(scope, receive, send)
+        finally:
+            await asgi_app.stripe_client.close()
+            await asgi_app.twilio_client.close()
+
+    asyncio.run(run())
+    start, body_message = messages
+    return start['status'], dict(start['headers']), body_message['body']
+
+
+def post_event(payload):
+    return call('POST', '/webhook', payload, {'Stripe-Signature': sign_webhook(payload, WEBHOOK_SECRET)})
+
+
+class AsgiAppTests(unittest.TestCase):
+    def test_home_renders(self):
+        """Test the index page renders with a request ID header"""
+        status, headers, body = call('GET', '/')
+        self.assertEqual(status, 200)
+        self.assertIn(b'x-request-id', headers)
+
+    def test_pages_are_compressed_and_revalidated(self):
+        """Test cached pages are gzipped for clients that accept it and answer 304 to their ETag"""
+        status, headers, body = call('GET', '/cancel', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual((status, headers[b'content-encoding']), (200, b'gzip'))
+        self.assertIn(b'</html>', gzip.decompress(body))
+        status, _, body = call('GET', '/cancel', headers={'If-None-Match': headers[b'etag'].decode()})
+        self.assertEqual((status, body), (304, b''))
+
+    def test_pages_link_the_fingerprinted_stylesheet(self):
+        """Test every page links style.css by its content hash and that URL is cached as immutable"""
+        urls = set()
+        for path, query in (('/', b''), ('/cancel', b''), ('/success', b'transaction_id=cs_1')):
+            _, _, body = call('GET', path, query=query)
+            urls.update(re.findall(rb'href="(/style\.[0-9a-f]+\.css)"', body))
+        self.assertEqual(len(urls), 1)
+        status, headers, body = call('GET', urls.pop().decode())
+        self.assertEqual(status, 200)
+        self.assertIn(b'immutable', headers[b'cache-control'])
+        self.assertIn(b'font-family', body)
+
+    def test_success_html_escapes_query_parameters(self):
+        """Test the per-request payment details are escaped inside the cached shell"""
+        status, _, body = call('GET', '/success', query=b'transaction_id=%3Cb%3Ecs_1&amount=50.00')
+        self.assertEqual(status, 200)
+        self.assertIn(b'&lt;b&gt;cs_1', body)
+        self.assertNotIn(b'page-shell-slot', body)
+
+    def test_success_without_transaction_redirects_home(self):
+        """Test direct access to the success page goes back to the home page"""
+        status, headers, _ = call('GET', '/success')
+        self.assertEqual((status, headers[b'location']), (302, b'/'))
+        status, _, body = call('GET', '/success', query=b'transaction_id=cs_1&amount=50.00')
+        self.assertEqual(status, 200)
+        self.assertIn(b'cs_1', body)
+
+    def test_pay_creates_checkout_session(self):
+        """Test /pay returns the new session ID"""
+        status, _, body = call('POST', '/pay')
+        self.assertEqual(status, 200)
+        self.assertIn(b'cs_test_', body)
+
+    def test_checkout_rate_limited_per_client(self):
+        """Test a client over its checkout rate gets 429 with Retry-After while others still get through"""
+        original = asgi_app.checkout_admission
+        asgi_app.checkout_admission = asgi_app.admission.Admission(rate=0.1, burst=1)
+        self.addCleanup(setattr, asgi_app, 'checkout_admission', original)
+        self.assertEqual(call('POST', '/pay')[0], 200)
+        status, headers, body = call('POST', '/pay')
+        self.assertEqual((status, headers[b'retry-after']), (429, b'10'))
+        self.assertIn(b'Too many checkout requests', body)
+        proxied = dataclasses.replace(asgi_app.settings, admission_client_header='X-Forwarded-For')
+        with mock.patch.object(asgi_app, 'settings', proxied):
+            self.assertEqual(call('POST', '/pay', headers={'X-Forwarded-For': '203.0.113.9'})[0], 200)
+            # A forged leftmost entry doesn't make the proxy's client someone new
+            spoofed = {'X-Forwarded-For': '198.51.100.7, 203.0.113.9'}
+            self.assertEqual(call('POST', '/pay', headers=spoofed)[0], 429)
+
+    def test_status_lookups_are_admitted_per_client(self):
+        """Test a client guessing session IDs is rate limited before its lookups reach Stripe"""
+        original = asgi_app.checkout_admission
+        asgi_app.checkout_admission = asgi_app.admission.Admission(rate=0.1, burst=2)
+        self.addCleanup(setattr, asgi_app, 'checkout_admission', original)
+        for i in range(2):
+            query = f'session_id=cs_test_guess{i}'.encode()
+            self.assertEqual(call('GET', '/checkout/status', query=query)[0], 404)
+        status, headers, _ = call('GET', '/checkout/status', query=b'session_id=cs_test_guess2')
+        self.assertEqual((status, headers[b'retry-after']), (429, b'10'))
+        # Answers already known cost nothing, and the success page still renders
+        self.assertEqual(call('GET', '/checkout/status', query=b'session_id=cs_test_guess0')[0], 404)
+        self.assertEqual(call('GET', '/success', query=b'transaction_id=cs_test_guess3')[0], 200)
+
+    def test_wrong_method_is_rejected(self):
+        """Test routes only answer their own methods"""
+        self.assertEqual(call('GET', '/pay')[0], 405)
+
+    def test_checkout_completed_is_processed_once(self):
+        """Test a completed checkout texts once and a redelivery gets the stored response"""
+        payload = checkout_completed_event(1)
+        sms_before = stubs[1].requests
+        status, _, body = post_event(payload)
+        self.assertEqual(status, 200)
+        self.assertIn(b'Payment processed and SMS sent', body)
+        self.assertEqual(post_event(payload)[:1], (200,))
+        self.assertEqual(stubs[1].requests, sms_before + 1)
+
+    def test_success_and_status_show_the_recorded_payment(self):
+        """Test a handled checkout is shown from the ledger, whatever the query string says"""
+        self.assertEqual(post_event(checkout_completed_event(3, amount=1250))[0], 200)
+        session_id = 'cs_test_%024d' % 3
+        status, _, body = call('GET', '/success', query=f'transaction_id={session_id}&amount=99.00'.encode())
+        self.assertEqual(status, 200)
+        self.assertIn(b'$12.50', body)
+        self.assertIn(b'Paid', body)
+        self.assertNotIn(b'99.00', body)
+
+        status, _, body = call('GET', '/checkout/status', query=f'session_id={session_id}'.encode())
+        self.assertEqual(status, 200)
+        result = json.loads(body)
+        self.assertEqual((result['source'], result['session']['amount_total']), ('ledger', 1250))
+
+    def test_status_falls_back_to_stripe(self):
+        """Test a session the webhook has not recorded is retrieved from Stripe, and unknown ones are 404"""
+        session_id = json.loads(call('POST', '/pay')[2])['id']
+        status, _, body = call('GET', '/checkout/status', query=f'session_id={session_id}'.encode())
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['source'], 'stripe')
+        self.assertEqual(json.loads(body)['session']['status'], 'open')
+        self.assertEqual(call('GET', '/checkout/status', query=b'session_id=cs_test_unknown')[0], 404)
+        self.assertEqual(call('GET', '/checkout/status', query=b'session_id=cs_unknown')[0], 400)
+        self.assertEqual(call('GET', '/checkout/status')[0], 400)
+
+    def test_profiles_show_webhook_steps(self):
+        """Test a webhook's span tree names its verification and outbound calls"""
+        self.assertEqual(post_event(checkout_completed_event(900004))[0], 200)
+        status, _, body = call('GET', '/debug/profiles')
+        self.assertEqual(status, 200)
+        [webhook] = [trace for trace in json.loads(body)['slowest']
+                     if trace['request_id'] and trace['name'] == 'POST /webhook'
+                     and 'stripe.PaymentIntent.modify' in json.dumps(trace['spans'])][:1]
+        steps = [child['name'] for child in webhook['spans']['children']]
+        self.assertEqual(steps[0], 'webhook.verify')
+        self.assertIn('twilio.messages.create', steps)
+
+    def test_full_lane_answers_503(self):
+        """Test a webhook whose lane has no room gets 503 with Retry-After so Stripe redelivers it"""
+        with mock.patch.object(asgi_app, 'webhook_lanes', asgi_app.AsyncLanes(lanes=1, depth=0)):
+            status, headers, _ = post_event(checkout_completed_event(900007))
+        self.assertEqual(status, 503)
+        self.assertIn(b'retry-after', headers)
+
+    def test_profiles_are_hidden_unless_enabled(self):
+        """Test the profiling endpoints answer 404 when PROFILING is off, as it is by default"""
+        disabled = dataclasses.replace(asgi_app.settings, profiling=False)
+        with mock.patch.object(asgi_app, 'settings', disabled):
+            self.assertEqual(call('GET', '/debug/profiles')[0], 404)
+            self.assertEqual(call('POST', '/debug/profiles/dump')[0], 404)
+
+    def test_invalid_signature_is_rejected(self):
+        """Test unsigned payloads are refused"""
+        status, _, _ = call('POST', '/webhook', checkout_completed_event(2), {'Stripe-Signature': 't=1,v1=bad'})
+        self.assertEqual(status, 400)
+
+    def test_oversized_webhook_is_refused_before_buffering(self):
+        """Test /webhook answers 413 on Content-Length or once the streamed body passes the limit"""
+        limited = dataclasses.replace(asgi_app.settings, webhook_max_bytes=1024)
+        with mock.patch.object(asgi_app, 'settings', limited):
+            status, _, _ = call('POST', '/webhook', b'{}', {'Content-Length': '4096'})
+            self.assertEqual(status, 413)
+
+            received = []
+
+            async def endless():
+                received.append(1)
+                return {'type': 'http.request', 'body': b'x' * 512, 'more_body': True}
+
+            with self.assertRaises(asgi_app.webhook_ingest.PayloadTooLarge):
+                asyncio.run(asgi_app.read_body(endless, 1024))
+            self.assertEqual(len(received), 3)
+            status, _, _ = call('POST', '/webhook', b'x' * 2048)
+            self.assertEqual(status, 413)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import asyncio
+import unittest
+
+import stripe
+
+from async_clients import AsyncStripeClient, AsyncTwilioClient, encode_params
+from bench_stubs import StubServer, stripe_routes, twilio_routes
+
+ACCOUNT_SID = 'AC' + '0' * 32
+
+
+class EncodeParamsTests(unittest.TestCase):
+    def test_nested_params_use_stripe_form_encoding(self):
+        """Test dicts, lists and booleans are flattened like the Stripe SDK does"""
+        params = {'line_items': [{'price_data': {'unit_amount': 5000}, 'quantity': 1}],
+                  'metadata': {'phone': '+1'}, 'livemode': False, 'skip': None}
+        self.assertEqual(encode_params(params), [
+            ('line_items[0][price_data][unit_amount]', '5000'),
+            ('line_items[0][quantity]', '1'),
+            ('metadata[phone]', '+1'),
+            ('livemode', 'false'),
+        ])
+
+
+class AsyncStripeClientTests(unittest.TestCase):
+    def setUp(self):
+        """Start a local Stripe stand-in"""
+        self.stub = StubServer(stripe_routes()).start()
+        self.client = AsyncStripeClient('sk_test', self.stub.url)
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def run_closing(self, coro):
+        async def run():
+            try:
+                return await coro
+            finally:
+                await self.client.close()
+        return asyncio.run(run())
+
+    def test_customer_round_trip(self):
+        """Test created customers are found by email"""
+        async def scenario():
+            created = await self.client.create_customer('a@example.com', 'A')
+            return created, await self.client.list_customers('a@example.com')
+        created, found = self.run_closing(scenario())
+        self.assertEqual([c['id'] for c in found], [created['id']])
+
+    def test_api_errors_raise_stripe_errors(self):
+        """Test error responses surface as Stripe exceptions"""
+        self.stub.error_rate = 1.0
+        with self.assertRaises(stripe.error.APIError):
+            self.run_closing(self.client.list_customers('a@example.com'))
+
+
+class AsyncTwilioClientTests(unittest.TestCase):
+    def setUp(self):
+        """Start a local Twilio stand-in"""
+        self.stub = StubServer(twilio_routes()).start()
+        self.client = AsyncTwilioClient(ACCOUNT_SID, 'token', '+15550001', base_url=self.stub.url,
+                                        rate=100, burst=100)
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def send_all(self, *keys):
+        async def run():
+            try:
+                return await asyncio.gather(*(self.client.send('+15550002', 'Hi', key=key) for key in keys))
+            finally:
+                await self.client.close()
+        return asyncio.run(run())
+
+    def test_sends_with_the_same_key_are_coalesced(self):
+        """Test concurrent sends for one checkout session text once"""
+        first, second, other = self.send_all('cs_1', 'cs_1', 'cs_2')
+        self.assertEqual(first['sid'], second['sid'])
+        self.assertNotEqual(first['sid'], other['sid'])
+        self.assertEqual(self.stub.requests, 2)
+
+    def test_failed_sends_are_not_coalesced(self):
+        """Test a retry after a failure gets a fresh attempt"""
+        self.stub.error_rate = 1.0
+        with self.assertRaises(Exception):
+            self.send_all('cs_1')
+        self.stub.error_rate = 0.0
+        self.assertEqual(self.send_all('cs_1')[0]['status'], 'queued')
+        self.assertEqual(self.stub.requests, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from catalog import DEFAULT_PRODUCT, Catalog, Product, load_products
+
+
+class FakeGateway:
+    """Stripe Prices kept in a dict, counting calls"""
+
+    def __init__(self, existing=None):
+        self.prices = dict(existing or {})
+        self.calls = []
+
+    def list_prices(self, lookup_keys):
+        self.calls.append(('list', list(lookup_keys)))
+        return [{'id': self.prices[key], 'lookup_key': key} for key in lookup_keys if key in self.prices]
+
+    def create_price(self, product):
+        self.calls.append(('create', product.sku))
+        price_id = f'price_{len(self.prices) + 1}'
+        self.prices[product.lookup_key] = price_id
+        return {'id': price_id, 'lookup_key': product.lookup_key}
+
+
+class CatalogTests(unittest.TestCase):
+    def setUp(self):
+        """Write a two-product JSON catalog"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'catalog.json')
+        self.write([
+            {'sku': 'tee', 'name': 'T-shirt', 'unit_amount': 2000},
+            {'sku': 'mug', 'name': 'Mug', 'unit_amount': 1200, 'currency': 'EUR'},
+        ])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, products):
+        with open(self.path, 'w') as f:
+            json.dump(products, f)
+        # Make sure the change is visible even on coarse mtime filesystems
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_loads_json_and_sqlite(self):
+        """Test both sources give the same products, skipping inactive rows"""
+        from_json = load_products(self.path)
+        self.assertEqual(from_json['mug'].currency, 'eur')
+
+        db_path = os.path.join(self.tmpdir.name, 'catalog.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute('CREATE TABLE products (sku, name, unit_amount, currency, description, active)')
+        conn.executemany('INSERT INTO products VALUES (?, ?, ?, ?, ?, ?)', [
+            ('tee', 'T-shirt', 2000, 'usd', None, 1),
+            ('mug', 'Mug', 1200, 'eur', None, 1),
+            ('old', 'Retired', 100, 'usd', None, 0),
+        ])
+        conn.commit()
+        conn.close()
+        self.assertEqual(load_products(db_path), from_json)
+
+    def test_invalid_products_are_rejected(self):
+        """Test duplicate SKUs and non-integer amounts raise ValueError"""
+        self.write([{'sku': 'a', 'name': 'A', 'unit_amount': 1}, {'sku': 'a', 'name': 'B', 'unit_amount': 2}])
+        with self.assertRaises(ValueError):
+            load_products(self.path)
+        with self.assertRaises(ValueError):
+            Product('a', 'A', 10.5)
+
+    def test_default_catalog_has_the_test_product(self):
+        """Test without a file the catalog sells the original $50 product"""
+        catalog = Catalog()
+        self.assertEqual(catalog.get('test-product'), DEFAULT_PRODUCT)
+        self.assertEqual(DEFAULT_PRODUCT.display_amount, '50.00')
+
+    def test_sync_finds_or_creates_prices_once(self):
+        """Test existing Prices are found by lookup key, missing ones created, and IDs cached"""
+        gateway = FakeGateway({'tee:usd:2000': 'price_existing'})
+        cache_path = os.path.join(self.tmpdir.name, 'prices.db')
+        catalog = Catalog(self.path, price_cache_path=cache_path)
+        self.assertIsNone(catalog.price_id(catalog.get('tee')))
+
+        self.assertEqual(catalog.sync(gateway), 2)
+        self.assertEqual(catalog.price_id(catalog.get('tee')), 'price_existing')
+        self.assertEqual(gateway.calls.count(('create', 'mug')), 1)
+        self.assertEqual(catalog.sync(gateway), 0)
+        self.assertEqual(len(gateway.calls), 2)
+
+        # Another worker starts with the IDs from the shared cache
+        other = Catalog(self.path, price_cache_path=cache_path)
+        self.assertEqual(other.sync(FakeGateway()), 0)
+        self.assertEqual(other.price_id(other.get('mug')), catalog.price_id(catalog.get('mug')))
+
+    def test_reload_swaps_products_and_notifies(self):
+        """Test a changed file is picked up, a repriced product needs a new Price, and listeners run"""
+        catalog = Catalog(self.path)
+        catalog.sync(FakeGateway())
+        changes = []
+        catalog.add_listener(lambda: changes.append(True))
+        self.assertFalse(catalog.changed())
+
+        self.write([{'sku': 'tee', 'name': 'T-shirt', 'unit_amount': 2500}])
+        self.assertTrue(catalog.changed())
+        self.assertTrue(catalog.reload())
+        self.assertIsNone(catalog.get('mug'))
+        self.assertIsNone(catalog.price_id(catalog.get('tee')))
+        self.assertEqual(changes, [True])
+
+    def test_bad_reload_keeps_current_products(self):
+        """Test a broken file is reported and the last good catalog kept"""
+        catalog = Catalog(self.path)
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        self.assertFalse(catalog.reload())
+        self.assertIsNotNone(catalog.get('tee'))
+        self.assertEqual(catalog.metrics()['reload_errors'], 1)
+        self.assertFalse(catalog.changed())
+
+    def test_background_thread_syncs_and_reloads(self):
+        """Test start() syncs prices and follows file changes"""
+        gateway = FakeGateway()
+        catalog = Catalog(self.path, check_interval=0.02)
+        catalog.start(gateway)
+        try:
+            deadline = time.monotonic() + 5
+            while catalog.metrics()['priced'] < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.write([{'sku': 'hat', 'name': 'Hat', 'unit_amount': 900}])
+            while catalog.price_id(catalog.get('hat') or DEFAULT_PRODUCT) is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            catalog.stop()
+        self.assertIsNotNone(catalog.price_id(catalog.get('hat')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from customer_cache import CustomerCache, normalize_email
+
+
+class CustomerCacheTests(unittest.TestCase):
+    def setUp(self):
+        """Create a two-tier cache backed by a temporary database"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'customers.db')
+        self.cache = CustomerCache(max_memory=2, path=self.path, ttl=60)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_emails_are_normalized(self):
+        """Test lookups ignore case and surrounding whitespace"""
+        self.assertEqual(normalize_email('  Test@Example.COM '), 'test@example.com')
+        self.cache.put('Test@Example.com', 'cus_1', 'Test User')
+        self.assertEqual(self.cache.get('test@example.com '), ('cus_1', 'Test User'))
+
+    def test_hits_and_misses_are_counted(self):
+        """Test the monitoring counters"""
+        self.cache.get('test@example.com')
+        self.cache.put('test@example.com', 'cus_1')
+        self.cache.get('test@example.com')
+        metrics = self.cache.metrics()
+        self.assertEqual((metrics['hits'], metrics['misses']), (1, 1))
+        self.assertEqual(metrics['hit_rate'], 0.5)
+
+    def test_disk_tier_is_shared_between_instances(self):
+        """Test a second cache on the same file sees stored customers"""
+        self.cache.put('test@example.com', 'cus_1', 'Test User')
+        other = CustomerCache(path=self.path, ttl=60)
+        self.assertEqual(other.get('test@example.com'), ('cus_1', 'Test User'))
+
+    def test_invalidation_reaches_other_workers_memory(self):
+        """Test a customer dropped by one worker is not served from another worker's memory tier"""
+        other = CustomerCache(path=self.path, ttl=60)
+        self.cache.put('test@example.com', 'cus_1', 'Test User')
+        self.cache.put('kept@example.com', 'cus_2')
+        self.assertEqual(other.get('test@example.com'), ('cus_1', 'Test User'))
+        self.assertEqual(other.get('kept@example.com'), ('cus_2', None))
+        self.cache.invalidate(customer_id='cus_1')
+        self.assertIsNone(other.get('test@example.com'))
+        self.assertEqual(other.get('kept@example.com'), ('cus_2', None))
+
+    def test_invalidate_by_customer_id(self):
+        """Test customer.deleted style invalidation by ID"""
+        self.cache.put('test@example.com', 'cus_1')
+        self.cache.invalidate(customer_id='cus_1')
+        self.assertIsNone(self.cache.get('test@example.com'))
+
+    def test_memory_only_cache(self):
+        """Test the cache works without a disk tier"""
+        cache = CustomerCache(max_memory=1)
+        cache.put('a@example.com', 'cus_a')
+        cache.put('b@example.com', 'cus_b')
+        self.assertIsNone(cache.get('a@example.com'))
+        self.assertEqual(cache.get('b@example.com'), ('cus_b', None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from event_store import EventStore
+
+
+class EventStoreTests(unittest.TestCase):
+    def setUp(self):
+        """Create an event store backed by a temporary database"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'events.db')
+        self.store = EventStore(self.path, ttl=60, max_memory=2)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_unknown_event_returns_none(self):
+        """Test unseen events are misses"""
+        self.assertIsNone(self.store.get('evt_missing'))
+        self.assertEqual(self.store.metrics()['misses'], 1)
+
+    def test_stored_outcome_is_returned(self):
+        """Test a recorded outcome is returned from memory"""
+        self.store.put('evt_1', 'checkout.session.completed', {'message': 'ok'}, 200)
+        self.assertEqual(self.store.get('evt_1'), ({'message': 'ok'}, 200))
+        self.assertEqual(self.store.metrics()['memory_hits'], 1)
+
+    def test_memory_tier_is_bounded(self):
+        """Test the LRU evicts old entries but the disk tier keeps them"""
+        for i in range(3):
+            self.store.put(f'evt_{i}', 'checkout.session.completed', {'n': i}, 200)
+        self.assertEqual(self.store.metrics()['memory_size'], 2)
+        self.assertEqual(self.store.get('evt_0'), ({'n': 0}, 200))
+        self.assertEqual(self.store.metrics()['disk_hits'], 1)
+
+    def test_outcomes_survive_reopen(self):
+        """Test outcomes persist across restarts"""
+        self.store.put('evt_1', 'checkout.session.completed', {'message': 'ok'}, 200)
+        reopened = EventStore(self.path, ttl=60)
+        self.assertEqual(reopened.get('evt_1'), ({'message': 'ok'}, 200))
+
+    def test_expired_entries_are_purged(self):
+        """Test entries older than the TTL are evicted"""
+        self.store.put('evt_1', 'checkout.session.completed', {}, 200)
+        self.assertEqual(self.store.purge(now=self.store._last_purge + 120), 1)
+        self.assertIsNone(self.store.get('evt_1'))
+
+if __name__ == '__main__':
+    unittest.main()
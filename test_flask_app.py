@@ -0,0 +1,244 @@
+import dataclasses
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from bench_stubs import StubServer, checkout_completed_event, sign_webhook, stripe_routes, twilio_routes
+from lanes import lane_for
+from settings import get_settings
+
+WEBHOOK_SECRET = 'whsec_test'
+stubs = []
+flask_app = None
+client = None
+
+
+def setUpModule():
+    """Point the Flask edition at local Stripe and Twilio stand-ins and import it"""
+    global flask_app, client
+    stubs.extend([StubServer(stripe_routes()).start(), StubServer(twilio_routes()).start()])
+    scratch = tempfile.mkdtemp()
+    os.environ.update({
+        'STRIPE_API_KEY': 'sk_test',
+        'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'STRIPE_API_BASE': stubs[0].url,
+        'TWILIO_ACCOUNT_SID': 'AC' + '0' * 32,
+        'TWILIO_AUTH_TOKEN': 'token',
+        'TWILIO_PHONE_NUMBER': '+15550001',
+        'TWILIO_API_BASE': stubs[1].url,
+        'TWILIO_SMS_RATE': '0',
+        'USER_PHONE': '+15550002',
+        'EVENT_STORE_PATH': os.path.join(scratch, 'events.db'),
+        'LEDGER_PATH': os.path.join(scratch, 'ledger.db'),
+        'LOG_LEVEL': 'CRITICAL',
+    })
+    # Another test module may have read the environment first
+    get_settings.cache_clear()
+    flask_app = importlib.import_module('app')
+    client = flask_app.app.test_client()
+
+
+def tearDownModule():
+    for stub in stubs:
+        stub.stop()
+
+
+def post_event(payload):
+    return client.post('/webhook', data=payload,
+                       headers={'Stripe-Signature': sign_webhook(payload, WEBHOOK_SECRET)})
+
+
+class FlaskAppTests(unittest.TestCase):
+    def test_async_mode_acknowledges_then_processes_from_the_queue(self):
+        """Test WEBHOOK_ASYNC answers before any outbound call and a queue worker does the work later"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        queue = flask_app.WebhookQueue(os.path.join(tmpdir.name, 'queue.db'),
+                                       handler=flask_app.process_queued_event, workers=1)
+        payload = checkout_completed_event(700001)
+        requests_before = stubs[0].requests, stubs[1].requests
+        with mock.patch.object(flask_app, 'webhook_queue', queue):
+            response = post_event(payload)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['message'], 'Event queued')
+            self.assertEqual(post_event(payload).get_json()['message'], 'Event queued')
+            self.assertEqual((stubs[0].requests, stubs[1].requests), requests_before)
+            self.assertEqual(client.get('/webhook/queue').get_json()['pending'], 1)
+
+            self.assertEqual(queue.drain(), 1)
+            self.assertEqual(stubs[1].requests, requests_before[1] + 1)
+            # Once handled, a redelivery gets the stored outcome instead of a second job
+            response = post_event(payload)
+            self.assertIn('Payment processed and SMS sent', response.get_json()['message'])
+        self.assertEqual(client.get('/webhook/queue').status_code, 404)
+
+    def test_checkout_completed_is_processed_once(self):
+        """Test a completed checkout texts once and a redelivery gets the stored response without outbound calls"""
+        payload = checkout_completed_event(700002)
+        response = post_event(payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['message'], 'Payment processed and SMS sent')
+        requests_before = stubs[0].requests, stubs[1].requests
+        redelivered = post_event(payload)
+        self.assertEqual((redelivered.status_code, redelivered.get_json()), (200, response.get_json()))
+        self.assertEqual((stubs[0].requests, stubs[1].requests), requests_before)
+
+    def test_invalid_signature_is_rejected(self):
+        """Test unsigned payloads are refused and not recorded as seen"""
+        payload = checkout_completed_event(700003)
+        response = client.post('/webhook', data=payload, headers={'Stripe-Signature': 't=1,v1=bad'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(post_event(payload).status_code, 200)
+
+    def test_request_deadline_ends_with_the_request(self):
+        """Test the thread that served a request is left without its deadline or request ID"""
+        self.assertEqual(client.get('/', headers={'X-Request-ID': 'req-7'}).headers['X-Request-ID'], 'req-7')
+        self.assertIsNone(flask_app.resilience.remaining())
+        self.assertIsNone(flask_app.request_id_var.get())
+
+    def test_success_and_status_show_the_recorded_payment(self):
+        """Test a handled checkout is shown from the ledger, whatever the query string says"""
+        self.assertEqual(post_event(checkout_completed_event(700004, amount=1250)).status_code, 200)
+        session_id = 'cs_test_%024d' % 700004
+        response = client.get('/success', query_string={'transaction_id': session_id, 'amount': '99.00'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'$12.50', response.data)
+        self.assertIn(b'Paid', response.data)
+        self.assertNotIn(b'99.00', response.data)
+
+        response = client.get('/checkout/status', query_string={'session_id': session_id})
+        self.assertEqual(response.status_code, 200)
+        result = response.get_json()
+        self.assertEqual((result['source'], result['session']['amount_total']), ('ledger', 1250))
+
+    def test_status_falls_back_to_stripe(self):
+        """Test a session the webhook has not recorded is retrieved from Stripe, and bad or unknown IDs are refused"""
+        session_id = client.post('/pay').get_json()['id']
+        response = client.get('/checkout/status', query_string={'session_id': session_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.get_json()['source'], response.get_json()['session']['status']),
+                         ('stripe', 'open'))
+        self.assertEqual(client.get('/checkout/status?session_id=cs_test_unknown').status_code, 404)
+        self.assertEqual(client.get('/checkout/status?session_id=cs_unknown').status_code, 400)
+        self.assertEqual(client.get('/checkout/status').status_code, 400)
+
+    def admission(self, **options):
+        admission = flask_app.admission.Admission(**options)
+        self.addCleanup(admission.close)
+        patcher = mock.patch.object(flask_app, 'checkout_admission', admission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return admission
+
+    def test_checkout_rate_limited_per_client(self):
+        """Test a client over its checkout rate gets 429 with Retry-After on both buttons while others get through"""
+        self.admission(rate=0.1, burst=1)
+        self.assertEqual(client.post('/pay').status_code, 200)
+        for path in ('/pay', '/create-checkout-session'):
+            response = client.post(path)
+            self.assertEqual((response.status_code, response.headers['Retry-After']), (429, '10'))
+            self.assertIn('Too many checkout requests', response.get_json()['error'])
+        other = client.post('/create-checkout-session', environ_base={'REMOTE_ADDR': '203.0.113.5'})
+        self.assertEqual(other.status_code, 303)
+        proxied = dataclasses.replace(flask_app.settings, admission_client_header='X-Forwarded-For')
+        with mock.patch.object(flask_app, 'settings', proxied):
+            self.assertEqual(client.post('/pay', headers={'X-Forwarded-For': '203.0.113.9'}).status_code, 200)
+            # A forged leftmost entry doesn't make the proxy's client someone new
+            spoofed = {'X-Forwarded-For': '198.51.100.7, 203.0.113.9'}
+            self.assertEqual(client.post('/pay', headers=spoofed).status_code, 429)
+
+    def test_checkout_shed_when_too_many_in_flight(self):
+        """Test checkouts beyond the in-flight limit get 503 with Retry-After until a place is free"""
+        admission = self.admission(rate=0, max_in_flight=1)
+        admission.acquire('203.0.113.8')
+        for path in ('/pay', '/create-checkout-session'):
+            response = client.post(path)
+            self.assertEqual((response.status_code, response.headers['Retry-After']), (503, '1'))
+        admission.release()
+        self.assertEqual(client.post('/pay').status_code, 200)
+
+    def test_status_lookups_are_admitted_per_client(self):
+        """Test a client guessing session IDs is rate limited before its lookups reach Stripe"""
+        self.admission(rate=0.1, burst=2)
+        for i in range(2):
+            self.assertEqual(client.get(f'/checkout/status?session_id=cs_test_guess{i}').status_code, 404)
+        requests_before = stubs[0].requests
+        response = client.get('/checkout/status?session_id=cs_test_guess2')
+        self.assertEqual((response.status_code, response.headers['Retry-After']), (429, '10'))
+        self.assertEqual(stubs[0].requests, requests_before)
+        # Answers already known cost nothing, and the success page still renders
+        self.assertEqual(client.get('/checkout/status?session_id=cs_test_guess0').status_code, 404)
+        self.assertEqual(client.get('/success?transaction_id=cs_test_guess3').status_code, 200)
+
+    def test_customer_events_run_in_order_beside_other_customers(self):
+        """Test a customer's deletion waits for their checkout while another customer's checkout runs alongside"""
+        lanes = flask_app.Lanes(lanes=4, name='test-lane')
+        self.addCleanup(lanes.close)
+        email = 'ordered@example.com'
+        other = next(f'other{n}@example.com' for n in range(100)
+                     if lane_for(f'other{n}@example.com', 4) != lane_for(email, 4))
+        checkout = checkout_completed_event(700005, email=email)
+        # Keyed by event ID it would land on another lane; only the shared email keeps it behind the checkout
+        deleted = json.dumps({'id': 'evt_ordered_deleted_1', 'object': 'event', 'type': 'customer.deleted',
+                              'created': int(time.time()),
+                              'data': {'object': {'id': 'cus_ordered', 'email': email}}}).encode()
+        handle_event = flask_app.handle_event
+        started, release = [], threading.Event()
+
+        def blocking_handle_event(event):
+            started.append(event['id'])
+            if event['id'] == json.loads(checkout)['id']:
+                release.wait(5)
+            return handle_event(event)
+
+        responses = {}
+
+        def post_in_thread(name, payload):
+            thread = threading.Thread(target=lambda: responses.update({name: post_event(payload)}))
+            thread.start()
+            return thread
+
+        with mock.patch.object(flask_app, 'webhook_lanes', lanes), \
+                mock.patch.object(flask_app, 'handle_event', blocking_handle_event):
+            threads = [post_in_thread('checkout', checkout)]
+            while not started:
+                time.sleep(0.001)
+            threads.append(post_in_thread('deleted', deleted))
+            deadline = time.monotonic() + 2
+            while not lanes.metrics()['waiting'] and len(started) == 1 and time.monotonic() < deadline:
+                time.sleep(0.001)
+            self.assertEqual(lanes.metrics()['waiting'], 1)
+            self.assertEqual(post_event(checkout_completed_event(700006, email=other)).status_code, 200)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+        self.assertEqual(started, [json.loads(checkout)['id'], 'evt_%024d' % 700006, 'evt_ordered_deleted_1'])
+        self.assertEqual({name: response.status_code for name, response in responses.items()},
+                         {'checkout': 200, 'deleted': 200})
+
+    def test_full_lane_answers_503(self):
+        """Test a webhook whose lane has no room gets 503 with Retry-After so Stripe redelivers it"""
+        lanes = flask_app.Lanes(lanes=1, depth=1, max_wait=0.01, name='test-lane')
+        self.addCleanup(lanes.close)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        running = lanes.submit('busy', release.wait)
+        while not running.running():
+            time.sleep(0.001)
+        lanes.submit('busy', lambda: None)
+        payload = checkout_completed_event(700007)
+        with mock.patch.object(flask_app, 'webhook_lanes', lanes):
+            response = post_event(payload)
+        self.assertEqual((response.status_code, response.headers['Retry-After']), (503, '1'))
+        # Nothing was stored, so Stripe's redelivery is handled
+        release.set()
+        self.assertEqual(post_event(payload).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import resilience
+import services
+import webhook_ingest
+from customer_cache import CustomerCache
+from lanes import AsyncLanes, LaneFull, Lanes, lane_for
+from structured_logging import request_id, request_id_var
+
+
+def event(event_type, obj, event_id='evt_1'):
+    return webhook_ingest.event_from_dict({'id': event_id, 'type': event_type, 'data': {'object': obj}})
+
+
+class LanesTests(unittest.TestCase):
+    def make(self, **options):
+        lanes = Lanes(**options)
+        self.addCleanup(lanes.close)
+        return lanes
+
+    def test_same_key_in_order_other_keys_in_parallel(self):
+        """Test events sharing a key never overlap while events for other keys run alongside"""
+        lanes = self.make(lanes=4)
+        keys = ['a@example.com', 'b@example.com']
+        self.assertNotEqual(lane_for(keys[0], 4), lane_for(keys[1], 4))
+        seen = {key: [] for key in keys}
+        running = {key: 0 for key in keys}
+        overlap = []
+        both = threading.Barrier(2, timeout=2)
+
+        def handle(key, n):
+            running[key] += 1
+            overlap.append(running[key])
+            if n == 0:
+                # Only passes if the other key's first event runs at the same time
+                both.wait()
+            time.sleep(0.005)
+            seen[key].append(n)
+            running[key] -= 1
+
+        futures = [lanes.submit(key, handle, key, n) for n in range(5) for key in keys]
+        for future in futures:
+            future.result(2)
+        self.assertEqual(seen, {key: list(range(5)) for key in keys})
+        self.assertEqual(max(overlap), 1)
+        self.assertEqual(lanes.metrics()['processed'], 10)
+
+    def test_full_lane_is_refused(self):
+        """Test a submission waits for room only up to max_wait, then gets LaneFull with a 503"""
+        lanes = self.make(lanes=1, depth=1, max_wait=0.05)
+        release = threading.Event()
+        running = lanes.submit('a', release.wait)
+        while not running.running():
+            time.sleep(0.001)
+        lanes.submit('a', lambda: None)
+        with self.assertRaises(LaneFull) as raised:
+            lanes.submit('a', lambda: None)
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(lanes.metrics()['rejected'], 1)
+        release.set()
+
+    def test_run_gives_up_at_the_deadline(self):
+        """Test run raises DeadlineExceeded instead of waiting past the request deadline"""
+        lanes = self.make(lanes=1)
+        release = threading.Event()
+        lanes.submit('a', release.wait)
+        with resilience.deadline(0.05):
+            with self.assertRaises(resilience.DeadlineExceeded):
+                lanes.run('a', lambda: None)
+        release.set()
+
+    def test_handler_sees_the_submitters_context(self):
+        """Test the handler runs with the request ID of the request that submitted it"""
+        lanes = self.make(lanes=2)
+        with request_id('req-42'):
+            self.assertEqual(lanes.run('a', request_id_var.get), 'req-42')
+
+
+class AsyncLanesTests(unittest.TestCase):
+    def test_same_key_in_order(self):
+        """Test coroutines sharing a key finish in submission order even when earlier ones are slower"""
+        lanes = AsyncLanes(lanes=4)
+        seen = []
+
+        async def handle(n):
+            await asyncio.sleep(0.01 * (3 - n))
+            seen.append(n)
+            return n
+
+        async def main():
+            return await asyncio.gather(*(lanes.run('a', handle, n) for n in range(3)))
+
+        self.assertEqual(asyncio.run(main()), [0, 1, 2])
+        self.assertEqual(seen, [0, 1, 2])
+
+    def test_full_lane_is_refused(self):
+        """Test an event for a full lane is refused at once and the lane keeps working"""
+        lanes = AsyncLanes(lanes=1, depth=2)
+
+        async def main():
+            started = [asyncio.create_task(lanes.run('a', asyncio.sleep, 0.01)) for _ in range(2)]
+            await asyncio.sleep(0)
+            with self.assertRaises(LaneFull):
+                await lanes.run('a', asyncio.sleep, 0)
+            await asyncio.gather(*started)
+            await lanes.run('a', asyncio.sleep, 0)
+
+        asyncio.run(main())
+        self.assertEqual(lanes.metrics()['rejected'], 1)
+
+    def test_waiting_gives_up_at_the_deadline(self):
+        """Test an event waiting behind a slow one raises DeadlineExceeded at the request deadline"""
+        lanes = AsyncLanes(lanes=1)
+
+        async def main():
+            slow = asyncio.create_task(lanes.run('a', asyncio.sleep, 0.1))
+            await asyncio.sleep(0)
+            with resilience.deadline(0.02):
+                with self.assertRaises(resilience.DeadlineExceeded):
+                    await lanes.run('a', asyncio.sleep, 0)
+            await slow
+
+        asyncio.run(main())
+
+    def test_cancelled_waiter_keeps_the_order(self):
+        """Test cancelling a waiting event does not let the next one overtake the one running"""
+        lanes = AsyncLanes(lanes=1)
+        seen = []
+
+        async def handle(n, delay):
+            await asyncio.sleep(delay)
+            seen.append(n)
+
+        async def main():
+            first = asyncio.create_task(lanes.run('a', handle, 0, 0.03))
+            second = asyncio.create_task(lanes.run('a', handle, 1, 0))
+            third = asyncio.create_task(lanes.run('a', handle, 2, 0))
+            await asyncio.sleep(0.005)
+            second.cancel()
+            await asyncio.gather(first, third, return_exceptions=True)
+
+        asyncio.run(main())
+        self.assertEqual(seen, [0, 2])
+
+
+class OrderingKeyTests(unittest.TestCase):
+    def test_customer_events_share_the_checkout_key(self):
+        """Test a checkout and a customer.deleted for the same email map to the same key"""
+        checkout = event('checkout.session.completed',
+                         {'id': 'cs_1', 'customer_details': {'email': 'A@Example.com', 'name': 'A'}})
+        deleted = event('customer.deleted', {'id': 'cus_1', 'email': 'a@example.com'}, 'evt_2')
+        self.assertEqual(services.ordering_key(checkout), services.ordering_key(deleted))
+
+    def test_customer_without_an_email_shares_a_lane(self):
+        """Test a checkout and a deletion for one customer with no email are keyed by the customer ID"""
+        checkout = event('checkout.session.completed', {'id': 'cs_2', 'customer': 'cus_7'})
+        deleted = event('customer.deleted', {'id': 'cus_7'}, 'evt_2')
+        self.assertEqual(services.ordering_key(checkout), 'cus_7')
+        self.assertEqual(lane_for(services.ordering_key(checkout), 8), lane_for(services.ordering_key(deleted), 8))
+
+    def test_checkout_without_an_email_finds_the_customers_lane(self):
+        """Test a checkout carrying only a customer ID shares a lane with that customer's deletion"""
+        cache = CustomerCache()
+        cache.put('a@example.com', 'cus_7')
+        checkout = event('checkout.session.completed', {'id': 'cs_3', 'customer': 'cus_7'})
+        deleted = event('customer.deleted', {'id': 'cus_7', 'email': 'a@example.com'}, 'evt_2')
+        self.assertEqual(services.ordering_key(checkout, cache), services.ordering_key(deleted, cache))
+        with_email = event('checkout.session.completed',
+                           {'id': 'cs_4', 'customer': 'cus_7', 'customer_details': {'email': 'a@example.com'}})
+        self.assertEqual(services.ordering_key(with_email, cache), services.ordering_key(deleted, cache))
+
+    def test_events_without_an_email(self):
+        """Test events with no email fall back to the customer ID or the event ID"""
+        self.assertEqual(services.ordering_key(event('customer.deleted', {'id': 'cus_9'})), 'cus_9')
+        self.assertEqual(services.ordering_key(event('payment_intent.succeeded', {'id': 'pi_1'}, 'evt_3')),
+                         'evt_3')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from ledger import CUSTOMER, PAYMENT_INTENT, SMS, Ledger, LedgerWriter
+
+
+def session(i, created=1000):
+    return {'id': f'cs_{i}', 'payment_intent': f'pi_{i}', 'created': created, 'amount_total': 500,
+            'currency': 'usd', 'customer_details': {'email': f'user{i}@example.com'}}
+
+
+class LedgerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ledger = Ledger(os.path.join(self.tmpdir.name, 'ledger.db'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_redelivery_appends_attempts(self):
+        """Test a second event for a session counts as a second attempt at each action"""
+        self.ledger.record_checkout('evt_1', session(1), {CUSTOMER: True, PAYMENT_INTENT: False, SMS: True})
+        self.ledger.record_checkout('evt_2', session(1), {CUSTOMER: True, SMS: True})
+
+        record = self.ledger.sessions(0, 2000)['cs_1']
+        self.assertEqual(record['events'], 2)
+        self.assertEqual(record['payment_intent'], 'pi_1')
+        self.assertEqual(record['customer_email'], 'user1@example.com')
+        self.assertEqual(record['succeeded'], {CUSTOMER: 2, PAYMENT_INTENT: 0, SMS: 2})
+
+    def test_sessions_are_filtered_by_creation_time(self):
+        """Test only sessions created in the half-open range are returned"""
+        for i, created in enumerate((999, 1000, 1500, 2000)):
+            self.ledger.record_checkout(f'evt_{i}', session(i, created), {})
+        self.assertEqual(sorted(self.ledger.sessions(1000, 2000)), ['cs_1', 'cs_2'])
+        self.assertEqual(self.ledger.sessions(1000, 2000)['cs_1']['succeeded'],
+                         {CUSTOMER: 0, PAYMENT_INTENT: 0, SMS: 0})
+
+    def test_watermark(self):
+        """Test a watermark is unset until saved and can be moved"""
+        self.assertIsNone(self.ledger.watermark('reconcile'))
+        self.ledger.set_watermark('reconcile', 100)
+        self.ledger.set_watermark('reconcile', 200)
+        self.assertEqual(Ledger(self.ledger.path).watermark('reconcile'), 200)
+
+
+    def test_customer_payments_newest_first(self):
+        """Test a customer's payments are found by email, newest first"""
+        for i, created in enumerate((1000, 3000, 2000)):
+            record = dict(session(i, created), customer_details={'email': 'same@example.com'})
+            self.ledger.record_checkout(f'evt_{i}', record, {})
+        self.ledger.record_checkout('evt_9', session(9), {})
+        payments = self.ledger.customer_payments('same@example.com', limit=2)
+        self.assertEqual([p['session_id'] for p in payments], ['cs_1', 'cs_2'])
+        self.assertEqual(self.ledger.payment('cs_9')['amount_total'], 500)
+        self.assertIsNone(self.ledger.payment('cs_missing'))
+
+
+class GatedLedger(Ledger):
+    """A ledger whose first write waits until the test lets it finish"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.writes = 0
+
+    def write(self, payments=(), actions=()):
+        self.writes += 1
+        if self.writes == 1:
+            self.entered.set()
+            self.release.wait(5)
+        super().write(payments, actions)
+
+
+class FlakyLedger(Ledger):
+    """A ledger whose first ``failures`` writes raise, as a locked or full disk would"""
+
+    def __init__(self, path, failures):
+        super().__init__(path)
+        self.failures = failures
+
+    def write(self, payments=(), actions=()):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database is locked')
+        super().write(payments, actions)
+
+
+class LedgerWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ledger = GatedLedger(os.path.join(self.tmpdir.name, 'ledger.db'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_writes_are_batched_and_readable_while_queued(self):
+        """Test records queued during a slow write go in one transaction and are served meanwhile"""
+        writer = LedgerWriter(self.ledger)
+        writer.record_payment('evt_0', session(0))
+        self.assertTrue(self.ledger.entered.wait(5))
+        for i in range(1, 21):
+            writer.record_payment(f'evt_{i}', session(i))
+            writer.record_actions(f'evt_{i}', session(i), {SMS: True})
+
+        self.assertIsNone(self.ledger.payment('cs_5'))
+        self.assertEqual(writer.payment('cs_5')['amount_total'], 500)
+        self.ledger.release.set()
+        self.assertTrue(writer.flush())
+        writer.stop()
+
+        self.assertEqual(len(self.ledger.sessions(0, 2000)), 21)
+        self.assertEqual(self.ledger.sessions(0, 2000)['cs_5']['succeeded'][SMS], 1)
+        stats = writer.metrics()
+        self.assertEqual((stats['written'], stats['batches'], stats['pending']), (41, 2, 0))
+        self.assertEqual(stats['max_batch'], 40)
+
+    def test_full_queue_writes_directly(self):
+        """Test nothing is dropped when the queue is full"""
+        writer = LedgerWriter(self.ledger, max_queue=1)
+        writer.record_payment('evt_0', session(0))
+        self.assertTrue(self.ledger.entered.wait(5))
+        writer.record_payment('evt_1', session(1))
+        writer.record_payment('evt_2', session(2))
+        self.assertIsNotNone(self.ledger.payment('cs_2'))
+        self.ledger.release.set()
+        self.assertTrue(writer.flush())
+        writer.stop()
+        self.assertEqual(len(self.ledger.sessions(0, 2000)), 3)
+        self.assertEqual(writer.metrics()['direct'], 1)
+
+    def test_failed_batches_are_retried_not_dropped(self):
+        """Test records from failed writes stay readable and are committed by a later retry"""
+        ledger = FlakyLedger(os.path.join(self.tmpdir.name, 'flaky.db'), failures=3)
+        writer = LedgerWriter(ledger, base_backoff=0.01)
+        writer.record_payment('evt_0', session(0))
+        writer.record_actions('evt_0', session(0), {SMS: True})
+        self.assertEqual(writer.payment('cs_0')['amount_total'], 500)
+        self.assertTrue(writer.flush())
+        writer.stop()
+        self.assertEqual(ledger.sessions(0, 2000)['cs_0']['succeeded'][SMS], 1)
+        stats = writer.metrics()
+        self.assertGreater(stats['failed'], 0)
+        self.assertEqual((stats['pending'], stats['retrying']), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
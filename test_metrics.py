@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+from metrics import MetricsRegistry, _MmapValues
+
+
+def _record_in_child(directory):
+    registry = MetricsRegistry(directory)
+    registry.counter('jobs', 'Jobs.', ['kind']).inc(kind='a')
+    registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0)).observe(0.5)
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        """Create an in-process registry and a temporary metrics directory"""
+        self.registry = MetricsRegistry()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_counter_is_rendered_with_labels(self):
+        """Test counters accumulate per label set and escape label values"""
+        jobs = self.registry.counter('jobs', 'Jobs run.', ['kind'])
+        jobs.inc(kind='a')
+        jobs.inc(2, kind='a')
+        jobs.inc(kind='say "hi"')
+        output = self.registry.render()
+        self.assertIn('# TYPE jobs counter', output)
+        self.assertIn('jobs_total{kind="a"} 3', output)
+        self.assertIn('jobs_total{kind="say \\"hi\\""} 1', output)
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test bucket counts, sum and count for a histogram"""
+        latency = self.registry.histogram('latency_seconds', 'Latency.', ['route'], buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            latency.observe(value, route='/')
+        output = self.registry.render()
+        self.assertIn('latency_seconds_bucket{route="/",le="0.1"} 2', output)
+        self.assertIn('latency_seconds_bucket{route="/",le="1"} 3', output)
+        self.assertIn('latency_seconds_bucket{route="/",le="+Inf"} 4', output)
+        self.assertIn('latency_seconds_sum{route="/"} 2.65', output)
+        self.assertIn('latency_seconds_count{route="/"} 4', output)
+
+    def test_wrong_labels_are_rejected(self):
+        """Test a sample must carry exactly the declared labels"""
+        jobs = self.registry.counter('jobs', 'Jobs run.', ['kind'])
+        with self.assertRaises(ValueError):
+            jobs.inc(queue='a')
+
+    def test_processes_are_aggregated(self):
+        """Test samples written by other processes are summed into one scrape"""
+        context = multiprocessing.get_context('spawn')
+        for _ in range(2):
+            child = context.Process(target=_record_in_child, args=(self.tmpdir.name,))
+            child.start()
+            child.join(30)
+            self.assertEqual(child.exitcode, 0)
+
+        _record_in_child(self.tmpdir.name)
+        registry = MetricsRegistry(self.tmpdir.name)
+        registry.counter('jobs', 'Jobs.', ['kind'])
+        registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+        output = registry.render()
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 3)
+        self.assertIn('jobs_total{kind="a"} 3', output)
+        self.assertIn('latency_seconds_bucket{le="1"} 3', output)
+        self.assertIn('latency_seconds_sum 1.5', output)
+
+    def test_mmap_file_grows_and_reopens(self):
+        """Test a worker's file grows past its initial size and keeps values when reopened"""
+        path = os.path.join(self.tmpdir.name, 'metrics-1.bin')
+        values = _MmapValues(path, initial_size=64)
+        values.add([(f'key-{i}', float(i)) for i in range(100)])
+        values.close()
+
+        reopened = _MmapValues(path)
+        reopened.add([('key-99', 1.0)])
+        stored = dict(_MmapValues.read(path))
+        self.assertEqual(len(stored), 100)
+        self.assertEqual(stored['key-42'], 42.0)
+        self.assertEqual(stored['key-99'], 100.0)
+        reopened.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from bench_stubs import StubServer, twilio_routes
+from notifier import SmsNotifier, _reset_after_fork
+
+ACCOUNT_SID = 'AC' + '0' * 32
+
+
+class SmsNotifierTests(unittest.TestCase):
+    def setUp(self):
+        """Start a local Twilio stand-in"""
+        self.stub = StubServer(twilio_routes()).start()
+        self.notifier = SmsNotifier(ACCOUNT_SID, 'token', '+15550001', base_url=self.stub.url)
+        self.notifier.client.http_client.session.trust_env = False
+
+    def tearDown(self):
+        self.notifier.close()
+        self.stub.stop()
+
+    def test_client_is_built_once(self):
+        """Test the same client is reused between sends"""
+        self.assertIs(self.notifier.client, self.notifier.client)
+
+    def test_sends_reuse_one_connection(self):
+        """Test consecutive messages share a keep-alive connection"""
+        for _ in range(3):
+            message = self.notifier.send('+15550002', 'Payment of $50.00 Successful!')
+            self.assertEqual(message.status, 'queued')
+        self.assertEqual(self.stub.requests, 3)
+        self.assertEqual(self.stub.connections, 1)
+
+    def test_client_is_rebuilt_after_fork(self):
+        """Test forked children drop the inherited client"""
+        client = self.notifier.client
+        _reset_after_fork()
+        self.assertIsNot(self.notifier.client, client)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from page_cache import IMMUTABLE, PageCache, PageShell, Representation, StaticAssets, accepted_encodings
+
+PAGE = "<html><body>" + "Thanks for your order! " * 40 + "</body></html>"
+
+
+class RepresentationTests(unittest.TestCase):
+    def test_accept_encoding_parsing(self):
+        """Test codings with q=0 are excluded"""
+        self.assertEqual(accepted_encodings("gzip, deflate;q=0.5, br;q=0"), {"gzip", "deflate"})
+        self.assertEqual(accepted_encodings(None), set())
+
+    def test_serves_smallest_accepted_variant(self):
+        """Test gzip is served to clients that accept it and the identity body otherwise"""
+        page = Representation(PAGE, "text/html; charset=utf-8")
+        status, headers, body = page.respond("gzip")
+        self.assertEqual((status, headers["Content-Encoding"]), (200, "gzip"))
+        self.assertEqual(gzip.decompress(body).decode(), PAGE)
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        status, headers, body = page.respond(None)
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(body.decode(), PAGE)
+
+    def test_conditional_get(self):
+        """Test a matching If-None-Match gets an empty 304 and a stale one the body"""
+        page = Representation(PAGE, "text/html; charset=utf-8")
+        _, headers, _ = page.respond("gzip")
+        self.assertEqual(page.respond("gzip", headers["ETag"])[0], 304)
+        self.assertEqual(page.respond(None, 'W/' + headers["ETag"])[2], b"")
+        self.assertEqual(page.respond(None, '"0000"')[0], 200)
+
+    def test_small_and_binary_bodies_are_not_compressed(self):
+        """Test compression is skipped where it cannot help"""
+        self.assertEqual(list(Representation("tiny", "text/plain").bodies), ["identity"])
+        self.assertEqual(list(Representation(b"\x89PNG" * 100, "image/png").bodies), ["identity"])
+
+
+class PageCacheTests(unittest.TestCase):
+    def test_builds_once_and_evicts_least_recent(self):
+        """Test hits skip the build and the oldest entry is evicted"""
+        cache = PageCache(max_entries=2)
+        builds = []
+        for key in ["a", "a", "b", "c", "a"]:
+            cache.get(key, lambda key=key: builds.append(key) or key.upper())
+        self.assertEqual(builds, ["a", "b", "c", "a"])
+        self.assertEqual(cache.metrics()["hits"], 1)
+
+    def test_shell_renders_once_around_the_fragment(self):
+        """Test the shell keeps the static parts and fills in the fragment"""
+        shell = PageShell(lambda slot: f"<div>{slot}</div>")
+        self.assertEqual(shell.fill("<p>details</p>"), "<div><p>details</p></div>")
+        with self.assertRaises(ValueError):
+            PageShell(lambda slot: "<div></div>")
+
+
+class StaticAssetsTests(unittest.TestCase):
+    def setUp(self):
+        """A static directory with one stylesheet"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmpdir.name, "style.css"), "w") as f:
+            f.write("body { margin: 0; }\n" * 50)
+        self.assets = StaticAssets(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_fingerprinted_url_is_immutable(self):
+        """Test the fingerprinted URL is cached for a year and the plain one revalidated"""
+        url = self.assets.url("style.css")
+        self.assertRegex(url, r"^/style\.[0-9a-f]{12}\.css$")
+        asset, cache_control = self.assets.lookup(url)
+        self.assertEqual(cache_control, IMMUTABLE)
+        self.assertEqual(asset.content_type, "text/css; charset=utf-8")
+        self.assertEqual(self.assets.lookup("/style.css")[1], "no-cache")
+        self.assertEqual(self.assets.lookup("/style.000000000000.css")[1], "no-cache")
+
+    def test_missing_and_outside_files_are_not_served(self):
+        """Test unknown files and paths escaping the directory return None"""
+        self.assertIsNone(self.assets.lookup("/missing.css"))
+        self.assertIsNone(self.assets.lookup("/../etc/passwd"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import contextvars
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+import unittest
+
+import outbound
+from profiling import Profiler, span
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfilingTests(unittest.TestCase):
+    def test_span_outside_a_trace_does_nothing(self):
+        """Test spans are no-ops when no request is traced"""
+        with span("orphan") as current:
+            self.assertIsNone(current)
+
+    def test_spans_nest_and_follow_copied_contexts(self):
+        """Test spans form a tree, including ones opened on a thread running in the request's context"""
+        profiler = Profiler(threshold=0)
+        with profiler.trace("POST /webhook", "req-1") as trace:
+            with span("webhook.verify"):
+                pass
+            with span("sms.send"):
+                context = contextvars.copy_context()
+                thread = threading.Thread(target=context.run, args=(outbound.call, "twilio", "messages.create",
+                                                                     lambda: "SM1"))
+                thread.start()
+                thread.join()
+            trace.status = 200
+
+        tree = trace.to_dict()["spans"]
+        self.assertEqual(tree["name"], "POST /webhook")
+        self.assertEqual([child["name"] for child in tree["children"]], ["webhook.verify", "sms.send"])
+        self.assertEqual(tree["children"][1]["children"][0]["name"], "twilio.messages.create")
+        self.assertEqual(trace.status, 200)
+        with span("after") as current:
+            self.assertIsNone(current)
+
+    def test_failed_steps_are_marked(self):
+        """Test an exception marks its span and the trace"""
+        profiler = Profiler(threshold=0)
+        with self.assertRaises(KeyError):
+            with profiler.trace("event checkout.session.completed"):
+                with span("customer.upsert"):
+                    raise KeyError("email")
+        trace = profiler.recent()[0]
+        self.assertEqual(trace.status, "KeyError")
+        self.assertEqual(trace.to_dict()["spans"]["children"][0]["attrs"], {"error": "KeyError"})
+
+    def test_keeps_the_slowest_and_recent_slow_requests(self):
+        """Test only the N slowest are kept, slowest first, and slow ones go in the ring buffer"""
+        profiler = Profiler(slowest=3, recent=2, threshold=0.004)
+        for i, seconds in enumerate([0.001, 0.006, 0.002, 0.005, 0.0, 0.007]):
+            with profiler.trace(f"req {i}"):
+                busy(seconds)
+        self.assertEqual([trace.name for trace in profiler.slowest()], ["req 5", "req 1", "req 3"])
+        self.assertEqual([trace.name for trace in profiler.recent()], ["req 5", "req 3"])
+        self.assertEqual(profiler.metrics()["traced"], 6)
+        self.assertEqual(profiler.metrics()["slow"], 3)
+
+    def test_sampled_profiles_are_kept_only_for_slow_requests(self):
+        """Test cProfile captures of fast requests are dropped and slow ones dumped for pstats"""
+        profiler = Profiler(threshold=0.01, sample_rate=1.0)
+        with profiler.trace("fast"):
+            pass
+        with profiler.trace("slow"):
+            busy(0.02)
+        stats = profiler.metrics()
+        self.assertEqual((stats["sampled"], stats["captured"]), (2, 1))
+        slow = profiler.recent()[0]
+        self.assertIn("busy", slow.profile)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = profiler.dump(directory)
+            with open(path) as f:
+                report = json.load(f)
+            self.assertEqual(report["recent_slow"][0]["name"], "slow")
+            [capture] = [name for name in os.listdir(directory) if name.endswith(".prof")]
+            loaded = pstats.Stats(os.path.join(directory, capture))
+            self.assertTrue(any(func[2] == "busy" for func in loaded.stats))
+
+
+if __name__ == '__main__':
+    unittest.main()
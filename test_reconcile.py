@@ -0,0 +1,136 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from ledger import CUSTOMER, PAYMENT_INTENT, SMS, Ledger
+from reconcile import diff, iter_listing, main, reconcile, time_slices
+
+
+def stripe_session(i, created, status='complete'):
+    return {'id': f'cs_{i}', 'object': 'checkout.session', 'created': created, 'status': status,
+            'payment_status': 'paid' if status == 'complete' else 'unpaid', 'payment_intent': f'pi_{i}',
+            'customer_details': {'email': f'user{i}@example.com'}}
+
+
+def payment_intent(i, created, status='succeeded', tagged=True):
+    return {'id': f'pi_{i}', 'object': 'payment_intent', 'created': created, 'status': status,
+            'metadata': {'customer_id': f'cus_{i}'} if tagged else {}}
+
+
+class FakeGateway:
+    """Lists objects like Stripe: newest first, filtered on ``created``, paged with ``starting_after``"""
+
+    def __init__(self, sessions=(), payment_intents=()):
+        self.objects = {'sessions': list(sessions), 'payment_intents': list(payment_intents)}
+        self.pages = 0
+        self.lock = threading.Lock()
+
+    def _list(self, kind, created, limit, starting_after=None):
+        with self.lock:
+            self.pages += 1
+        matching = sorted((o for o in self.objects[kind] if created['gte'] <= o['created'] < created['lt']),
+                          key=lambda o: (-o['created'], o['id']))
+        start = 0
+        if starting_after is not None:
+            start = [o['id'] for o in matching].index(starting_after) + 1
+        return {'object': 'list', 'data': matching[start:start + limit], 'has_more': start + limit < len(matching)}
+
+    def list_checkout_sessions(self, **params):
+        return self._list('sessions', **params)
+
+    def list_payment_intents(self, **params):
+        return self._list('payment_intents', **params)
+
+
+class ReconcileTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ledger = Ledger(os.path.join(self.tmpdir.name, 'ledger.db'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_listing_follows_cursors(self):
+        """Test every object in range is listed once across pages"""
+        gateway = FakeGateway(sessions=[stripe_session(i, 1000 + i % 7) for i in range(25)])
+        listed = [o['id'] for o in iter_listing(gateway.list_checkout_sessions, 1000, 1005, page_size=4)]
+        expected = [o['id'] for o in gateway.objects['sessions'] if o['created'] < 1005]
+        self.assertEqual(sorted(listed), sorted(expected))
+        self.assertEqual(gateway.pages, 5)
+
+    def test_time_slices_cover_the_range(self):
+        """Test slices are contiguous, non-empty and never more than the seconds available"""
+        self.assertEqual(time_slices(0, 10, 3), [(0, 3), (3, 7), (7, 10)])
+        self.assertEqual(time_slices(5, 7, 8), [(5, 6), (6, 7)])
+        self.assertEqual(time_slices(5, 6, 1), [(5, 6)])
+
+    def test_diff_reports_each_issue(self):
+        """Test each kind of gap between Stripe and the ledger is reported"""
+        sessions = {s['id']: s for s in (stripe_session(i, 1000) for i in range(6))}
+        intents = {p['id']: p for p in (payment_intent(0, 1000), payment_intent(1, 1000, tagged=False),
+                                         payment_intent(2, 1000, status='requires_payment_method'),
+                                         payment_intent(3, 1000), payment_intent(4, 1000))}
+        everything = {CUSTOMER: 1, PAYMENT_INTENT: 1, SMS: 1}
+
+        def record(succeeded, events=1):
+            return {'created': 1000, 'events': events, 'succeeded': dict(everything, **succeeded)}
+
+        ledger_sessions = {
+            'cs_0': record({}),
+            'cs_1': record({PAYMENT_INTENT: 0}),
+            'cs_2': record({}),
+            'cs_3': record({CUSTOMER: 0, SMS: 0}),
+            'cs_4': record({SMS: 2}, events=2),
+            'cs_9': record({}),
+        }
+        problems = {(p['session_id'], p['issue']) for p in diff(sessions, intents, ledger_sessions)}
+        self.assertEqual(problems, {
+            ('cs_1', 'missing_payment_intent_tag'),
+            ('cs_2', 'payment_not_succeeded'),
+            ('cs_3', 'missing_customer'),
+            ('cs_3', 'missing_sms'),
+            ('cs_4', 'duplicate_sms'),
+            ('cs_5', 'missing_webhook'),
+            ('cs_9', 'unknown_session'),
+        })
+
+    def test_reconcile_joins_stripe_and_the_ledger(self):
+        """Test open sessions are ignored and a fully handled session is clean"""
+        gateway = FakeGateway(
+            sessions=[stripe_session(i, 1000 + i) for i in range(30)] + [stripe_session(99, 1001, status='open')],
+            payment_intents=[payment_intent(i, 1000 + i) for i in range(30)],
+        )
+        for i in range(30):
+            if i != 7:
+                self.ledger.record_checkout(f'evt_{i}', stripe_session(i, 1000 + i),
+                                            {CUSTOMER: True, PAYMENT_INTENT: True, SMS: True})
+        problems, stats = reconcile(gateway, self.ledger, 1000, 1030, slices=4, workers=4)
+        self.assertEqual(problems, [{'session_id': 'cs_7', 'issue': 'missing_webhook', 'created': 1007}])
+        self.assertEqual(stats['stripe_sessions'], 30)
+        self.assertEqual(stats['stripe_payment_intents'], 30)
+        self.assertEqual(stats['ledger_sessions'], 29)
+        self.assertEqual(stats['missing_webhook'], 1)
+
+    def test_main_scans_from_the_watermark(self):
+        """Test a run starts an overlap before the watermark and then moves it"""
+        ranges = []
+
+        def fake_reconcile(gateway, ledger, since, until, **options):
+            ranges.append((since, until))
+            return [], {}
+
+        self.ledger.set_watermark('reconcile', 5000)
+        with mock.patch('reconcile.reconcile', fake_reconcile), \
+                mock.patch.dict(os.environ, {'LEDGER_PATH': self.ledger.path}):
+            self.assertEqual(main(['--overlap', '100']), 0)
+            self.assertEqual(ranges[0][0], 4900)
+            self.assertEqual(self.ledger.watermark('reconcile'), ranges[0][1])
+
+            self.assertEqual(main(['--since', '1970-01-01T00:16:40', '--no-watermark']), 0)
+            self.assertEqual(ranges[1][0], 1000)
+            self.assertEqual(self.ledger.watermark('reconcile'), ranges[0][1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from replay import Checkpoint, iter_events, replay
+
+
+def event(i, type_='checkout.session.completed'):
+    return {'id': f'evt_{i}', 'object': 'event', 'type': type_, 'data': {'object': {'id': f'cs_{i}'}}}
+
+
+class ReplayTests(unittest.TestCase):
+    def setUp(self):
+        """Write ten events: eight single-event lines and one list page of two"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'events.jsonl')
+        self.events = [event(i, 'customer.updated' if i == 3 else 'checkout.session.completed')
+                       for i in range(10)]
+        with open(self.path, 'w') as f:
+            for e in self.events[:8]:
+                f.write(json.dumps(e) + '\n')
+            f.write('not json\n')
+            f.write(json.dumps({'object': 'list', 'data': self.events[8:]}) + '\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reads_events_and_list_pages(self):
+        """Test every event is yielded, bad lines reported, and reading resumes at an offset"""
+        invalid = []
+        read = list(iter_events(self.path, on_invalid=lambda start, line: invalid.append(line)))
+        self.assertEqual([e for _, _, e in read], self.events)
+        self.assertEqual(invalid, [b'not json\n'])
+        # Both events of the list page share its line
+        self.assertEqual(read[8][:2], read[9][:2])
+
+        resumed = [e['id'] for _, _, e in iter_events(self.path, read[5][0])]
+        self.assertEqual(resumed, [f'evt_{i}' for i in range(5, 10)])
+
+    def test_reads_gzip(self):
+        """Test a compressed export reads the same as the plain file"""
+        compressed = self.path + '.gz'
+        with open(self.path, 'rb') as src, gzip.open(compressed, 'wb') as dst:
+            dst.write(src.read())
+        self.assertEqual([e for _, _, e in iter_events(compressed)], self.events)
+
+    def test_replay_filters_skips_and_records_failures(self):
+        """Test only wanted types run, done events are skipped and failures reported"""
+        handled, failed = [], []
+
+        def handle(e):
+            handled.append(e['id'])
+            return ({'error': 'boom'}, 500) if e['id'] == 'evt_4' else ({'status': 'success'}, 200)
+
+        stats = replay(iter_events(self.path), handle, is_done=lambda event_id: event_id == 'evt_0',
+                       types={'checkout.session.completed'},
+                       on_failed=lambda e, error: failed.append((e['id'], error)))
+        self.assertEqual(stats, {'read': 10, 'processed': 7, 'skipped': 1, 'filtered': 1, 'failed': 1})
+        self.assertNotIn('evt_0', handled)
+        self.assertNotIn('evt_3', handled)
+        self.assertEqual(failed, [('evt_4', "status 500: {'error': 'boom'}")])
+
+    def test_parallelism_and_read_ahead_are_bounded(self):
+        """Test at most `workers` events run at once and the window bounds read-ahead"""
+        lock = threading.Lock()
+        counts = {'running': 0, 'max_running': 0, 'finished': 0, 'read': 0, 'max_ahead': 0}
+
+        def handle(e):
+            with lock:
+                counts['running'] += 1
+                counts['max_running'] = max(counts['max_running'], counts['running'])
+            time.sleep(0.005)
+            with lock:
+                counts['running'] -= 1
+                counts['finished'] += 1
+            return {}, 200
+
+        def events():
+            for i in range(40):
+                with lock:
+                    counts['read'] += 1
+                    counts['max_ahead'] = max(counts['max_ahead'], counts['read'] - counts['finished'])
+                yield i, i + 1, event(i)
+
+        stats = replay(events(), handle, workers=2, window=3)
+        self.assertEqual(stats['processed'], 40)
+        self.assertLessEqual(counts['max_running'], 2)
+        # The window, plus the event read while waiting for room
+        self.assertLessEqual(counts['max_ahead'], 4)
+
+    def test_checkpoint_only_covers_finished_events(self):
+        """Test the checkpoint waits for a slow early event"""
+        checkpoint = Checkpoint(os.path.join(self.tmpdir.name, 'replay.checkpoint'), self.path)
+        release = threading.Event()
+        offsets = []
+
+        def handle(e):
+            if e['id'] == 'evt_1':
+                release.wait(5)
+            return {}, 200
+
+        def save(offset, stats):
+            offsets.append(offset)
+            checkpoint.save(offset, stats)
+            release.set()
+
+        lines = list(iter_events(self.path))
+        replay(iter_events(self.path), handle, workers=4, on_checkpoint=save, checkpoint_interval=0)
+        # Until evt_1 finished, nothing past its line was checkpointed
+        self.assertEqual(offsets[0], lines[1][0])
+        self.assertEqual(checkpoint.load(), os.path.getsize(self.path))
+
+        # Another file's checkpoint is ignored
+        self.assertEqual(Checkpoint(checkpoint.path, self.path + '.other').load(), 0)
+
+    def test_interrupted_replay_resumes_without_losing_events(self):
+        """Test an interruption mid-file resumes at the first unfinished line"""
+        checkpoint = Checkpoint(os.path.join(self.tmpdir.name, 'replay.checkpoint'), self.path)
+
+        def interrupted():
+            for i, item in enumerate(iter_events(self.path)):
+                if i == 9:  # The second event of the list page
+                    raise KeyboardInterrupt
+                yield item
+
+        handled = []
+
+        def handle(e):
+            handled.append(e['id'])
+            return {}, 200
+
+        with self.assertRaises(KeyboardInterrupt):
+            replay(interrupted(), handle, on_checkpoint=checkpoint.save)
+        replay(iter_events(self.path, checkpoint.load()), handle, on_checkpoint=checkpoint.save)
+        # The list page is replayed whole; the event store makes the repeat harmless
+        self.assertEqual(sorted(set(handled)), sorted(e['id'] for e in self.events))
+        self.assertEqual(handled.count('evt_8'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
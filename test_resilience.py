@@ -0,0 +1,163 @@
+import asyncio
+import time
+import unittest
+
+import stripe
+from twilio.base.exceptions import TwilioRestException
+
+import outbound
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded
+
+
+def server_error():
+    return stripe.error.APIError("boom", http_status=502)
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def test_opens_after_threshold_and_fails_fast(self):
+        """Test consecutive failures open the breaker and later calls are rejected"""
+        breaker = CircuitBreaker("stripe", failure_threshold=2, reset_timeout=60)
+        self.assertFalse(breaker.record_failure())
+        self.assertTrue(breaker.record_failure())
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError) as raised:
+            breaker.allow()
+        self.assertGreater(raised.exception.retry_after, 59)
+        metrics = breaker.metrics()
+        self.assertEqual(metrics['trips'], 1)
+        self.assertEqual(metrics['rejected'], 1)
+
+    def test_half_open_allows_one_probe(self):
+        """Test after the reset timeout a single probe decides the state"""
+        breaker = CircuitBreaker("twilio", failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.allow()
+        self.assertFalse(breaker.available())
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow()
+
+        # A failed probe opens it again, a successful one closes it
+        self.assertTrue(breaker.record_failure())
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.06)
+        breaker.allow()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_nested_deadline_only_shortens(self):
+        """Test an inner deadline cannot extend the outer one"""
+        self.assertIsNone(resilience.remaining())
+        with resilience.deadline(1):
+            with resilience.deadline(60):
+                self.assertLessEqual(resilience.remaining(), 1)
+            with resilience.deadline(0.1):
+                self.assertLessEqual(resilience.remaining(), 0.1)
+        self.assertIsNone(resilience.remaining())
+
+
+class OutboundTests(unittest.TestCase):
+    def setUp(self):
+        """Fresh breakers with no backoff delay"""
+        outbound.configure(max_attempts=3, base_delay=0, max_delay=0, failure_threshold=3, reset_timeout=60)
+
+    def tearDown(self):
+        outbound.configure(max_attempts=3, base_delay=0.2, max_delay=2.0, failure_threshold=5, reset_timeout=30.0)
+
+    def test_retries_transient_failures(self):
+        """Test a 5xx is retried and the eventual result returned"""
+        results = [server_error(), server_error(), "ok"]
+
+        def flaky():
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.assertEqual(outbound.call("stripe", "Customer.list", flaky), "ok")
+        self.assertEqual(outbound.breaker("stripe").state, CircuitBreaker.CLOSED)
+
+    def test_client_errors_are_not_retried_or_counted(self):
+        """Test a 4xx propagates at once and does not count against the breaker"""
+        calls = []
+
+        def invalid():
+            calls.append(1)
+            raise stripe.error.InvalidRequestError("bad", "email", http_status=400)
+
+        for _ in range(5):
+            with self.assertRaises(stripe.error.InvalidRequestError):
+                outbound.call("stripe", "Customer.create", invalid)
+        self.assertEqual(len(calls), 5)
+        self.assertEqual(outbound.breaker("stripe").state, CircuitBreaker.CLOSED)
+
+    def test_sms_create_only_retried_when_not_accepted(self):
+        """Test a Twilio 500 is not retried but a 429 is"""
+        calls = []
+        outbound.configure(failure_threshold=10)
+
+        def failing(status):
+            calls.append(status)
+            raise TwilioRestException(status, "uri", "error")
+
+        with self.assertRaises(TwilioRestException):
+            outbound.call("twilio", "messages.create", failing, 500)
+        self.assertEqual(calls, [500])
+
+        with self.assertRaises(TwilioRestException):
+            outbound.call("twilio", "messages.create", failing, 429)
+        self.assertEqual(calls, [500, 429, 429, 429])
+
+    def test_open_breaker_fails_fast(self):
+        """Test once the breaker trips the dependency is no longer called"""
+        calls = []
+
+        def down():
+            calls.append(1)
+            raise server_error()
+
+        with self.assertRaises(stripe.error.APIError):
+            outbound.call("stripe", "Customer.list", down)
+        self.assertEqual(len(calls), 3)
+        with self.assertRaises(CircuitOpenError):
+            outbound.call("stripe", "Customer.list", down)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(outbound.breaker_metrics()["stripe"]["trips"], 1)
+
+    def test_deadline_stops_retries(self):
+        """Test no attempt starts once the deadline has passed"""
+        outbound.configure(max_attempts=10, base_delay=0.05, max_delay=0.05)
+        calls = []
+
+        def down():
+            calls.append(1)
+            raise stripe.error.APIConnectionError("refused")
+
+        with resilience.deadline(0.01):
+            with self.assertRaises(stripe.error.APIConnectionError):
+                outbound.call("stripe", "Customer.list", down)
+        self.assertEqual(len(calls), 1)
+
+        with resilience.deadline(0):
+            with self.assertRaises(DeadlineExceeded):
+                outbound.call("stripe", "Customer.list", down)
+
+    def test_async_attempt_is_cut_off_at_deadline(self):
+        """Test a slow coroutine raises DeadlineExceeded when time runs out"""
+        async def slow():
+            await asyncio.sleep(1)
+
+        async def run():
+            with resilience.deadline(0.05):
+                await outbound.call_async("stripe", "Customer.list", slow)
+
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            asyncio.run(run())
+        self.assertLess(time.monotonic() - started, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import sdk
+
+PROBE = """
+import time
+time.sleep(0.05)
+imports = globals().get("imports", 0) + 1
+value = "real"
+"""
+
+
+class LazyModuleTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.name = f"sdk_probe_{self.id().rsplit('.', 1)[-1]}"
+        with open(os.path.join(self.directory.name, self.name + ".py"), "w") as f:
+            f.write(PROBE)
+        sys.path.insert(0, self.directory.name)
+
+    def tearDown(self):
+        sys.path.remove(self.directory.name)
+        sys.modules.pop(self.name, None)
+        self.directory.cleanup()
+
+    def test_imported_on_first_attribute_access(self):
+        """Test the stand-in imports nothing until used, then forwards to the module"""
+        probe = sdk.lazy(self.name)
+        self.assertNotIn(self.name, sys.modules)
+        self.assertIsNone(sdk.loaded(self.name))
+        self.assertEqual(probe.value, "real")
+        self.assertIs(sdk.loaded(self.name), sys.modules[self.name])
+        probe.value = "configured"
+        self.assertEqual(sys.modules[self.name].value, "configured")
+        self.assertIn(self.name, sdk.metrics())
+
+    def test_hooks_run_once_with_the_module(self):
+        """Test load hooks configure the module before it is used, and late hooks run at once"""
+        calls = []
+        sdk.on_load(self.name, lambda module: calls.append(("early", module.value)))
+        sdk.on_load(self.name, lambda module: setattr(module, "value", "configured"))
+        probe = sdk.lazy(self.name)
+        self.assertEqual(probe.value, "configured")
+        self.assertEqual(probe.value, "configured")
+        sdk.on_load(self.name, lambda module: calls.append(("late", module.value)))
+        self.assertEqual(calls, [("early", "real"), ("late", "configured")])
+
+    def test_concurrent_first_use_imports_once(self):
+        """Test threads racing to the first access all see the configured module"""
+        sdk.on_load(self.name, lambda module: setattr(module, "value", "configured"))
+        probe = sdk.lazy(self.name)
+        seen = []
+        threads = [threading.Thread(target=lambda: seen.append(probe.value)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(seen, ["configured"] * 8)
+        self.assertEqual(sys.modules[self.name].imports, 1)
+
+
+class StartupTests(unittest.TestCase):
+    def test_app_import_leaves_the_sdks_unloaded(self):
+        """Test importing the Flask app imports neither SDK nor their HTTP stacks"""
+        scratch = tempfile.mkdtemp()
+        env = dict(os.environ,
+                   LOG_LEVEL="CRITICAL",
+                   EVENT_STORE_PATH=os.path.join(scratch, "events.db"),
+                   LEDGER_PATH=os.path.join(scratch, "ledger.db"))
+        code = ("import json, sys, app; "
+                "print(json.dumps([m for m in ('stripe', 'twilio.rest', 'requests', 'aiohttp') "
+                "if m in sys.modules]))")
+        output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+        self.assertEqual(json.loads(output.strip().splitlines()[-1]), [])
+
+    def test_app_import_has_no_side_effects(self):
+        """Test importing the Flask app with default settings starts no threads and creates no files"""
+        scratch = tempfile.mkdtemp()
+        env = dict(os.environ, LOG_LEVEL="CRITICAL", PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        code = ("import json, threading, app; "
+                "print(json.dumps(sorted(t.name for t in threading.enumerate() "
+                "if t.name.startswith(('catalog', 'session-pool', 'webhook-worker')))))")
+        output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True,
+                                cwd=scratch, check=True).stdout
+        self.assertEqual(json.loads(output.strip().splitlines()[-1]), [])
+        self.assertEqual(os.listdir(scratch), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+import unittest
+
+import serve
+from event_store import EventStore
+from sms_dispatcher import SmsDispatcher
+
+
+def in_child(check):
+    """Run ``check()`` in a forked child and return what it returned (JSON-encoded across a pipe)"""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            result = check()
+        except Exception as e:
+            result = {"error": repr(e)}
+        os.write(write_end, json.dumps(result).encode())
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as f:
+        result = json.loads(f.read())
+    os.waitpid(pid, 0)
+    return result
+
+
+class ServeTests(unittest.TestCase):
+    def test_gunicorn_options(self):
+        """Test the app is preloaded and every worker runs the post-fork setup"""
+        args = serve.argparse.Namespace(bind="127.0.0.1:0", workers=3, threads=8, timeout=30, preload=True)
+        options = serve.gunicorn_options(args)
+        self.assertTrue(options["preload_app"])
+        self.assertIs(options["post_fork"], serve.post_fork)
+        self.assertEqual((options["workers"], options["threads"]), (3, 8))
+
+    def test_stale_metric_files_are_removed(self):
+        """Test a restart starts from empty per-worker metric files"""
+        with tempfile.TemporaryDirectory() as directory:
+            open(os.path.join(directory, "metrics-123.bin"), "wb").close()
+            open(os.path.join(directory, "other.txt"), "w").close()
+            os.environ["METRICS_DIR"] = directory
+            try:
+                self.assertEqual(serve.prepare_metrics_dir(), directory)
+            finally:
+                del os.environ["METRICS_DIR"]
+            self.assertEqual(os.listdir(directory), ["other.txt"])
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "needs fork()")
+class ForkSafetyTests(unittest.TestCase):
+    def test_child_opens_its_own_sqlite_connection(self):
+        """Test a forked child does not reuse the parent's SQLite connection"""
+        with tempfile.TemporaryDirectory() as directory:
+            store = EventStore(os.path.join(directory, "events.db"))
+            parent_conn = id(store._connect())
+
+            def check():
+                store.put("evt_child", "checkout.session.completed", {"ok": True}, 200)
+                return {"same": id(store._connect()) == parent_conn}
+
+            self.assertEqual(in_child(check), {"same": False})
+            store._memory.clear()
+            self.assertEqual(store.get("evt_child")[1], 200)
+
+    def test_child_restarts_worker_threads(self):
+        """Test a dispatcher started before fork delivers in the child"""
+        dispatcher = SmsDispatcher(lambda to, body, sender=None: True, rate=1000, burst=1000)
+        dispatcher.start()
+        try:
+            def check():
+                handle = dispatcher.submit("+15550002", "hello")
+                return {"ok": handle.wait(5)}
+
+            result = in_child(check)
+        finally:
+            dispatcher.stop()
+        self.assertTrue(result["ok"])
+
+
+if __name__ == '__main__':
+    unittest.main()
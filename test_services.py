@@ -0,0 +1,205 @@
+import asyncio
+import contextlib
+import unittest
+
+import stripe
+
+import services
+from catalog import Product
+from customer_cache import CustomerCache
+
+
+class FakeGateway:
+    """Records calls and returns customers as plain dicts"""
+
+    def __init__(self, existing=None, deleted=()):
+        self.calls = []
+        self.existing = existing or []
+        self.deleted = set(deleted)
+
+    def list_customers(self, email):
+        self.calls.append('list')
+        return self.existing
+
+    def create_customer(self, email, name):
+        self.calls.append('create')
+        return {'id': 'cus_new', 'name': name}
+
+    def modify_customer(self, customer_id, **params):
+        self.calls.append('modify')
+        if customer_id in self.deleted:
+            raise stripe.error.InvalidRequestError(f'No such customer: {customer_id}', 'id',
+                                                   code='resource_missing', http_status=404)
+        return {'id': customer_id, **params}
+
+    def retrieve_checkout_session(self, session_id):
+        self.calls.append('retrieve')
+        if session_id == 'cs_missing':
+            raise stripe.error.InvalidRequestError('No such checkout.session', 'id', http_status=404)
+        if session_id == 'cs_error':
+            raise stripe.error.APIError('Stripe is down', http_status=500)
+        return {'id': session_id, 'amount_total': 1250, 'currency': 'usd', 'status': 'open',
+                'payment_status': 'unpaid', 'created': 1000}
+
+
+class AsyncFakeGateway(FakeGateway):
+    async def list_customers(self, email):
+        return FakeGateway.list_customers(self, email)
+
+    async def create_customer(self, email, name):
+        return FakeGateway.create_customer(self, email, name)
+
+    async def modify_customer(self, customer_id, **params):
+        return FakeGateway.modify_customer(self, customer_id, **params)
+
+    async def retrieve_checkout_session(self, session_id):
+        return FakeGateway.retrieve_checkout_session(self, session_id)
+
+
+class FakeLedger:
+    def __init__(self, payments=None):
+        self.payments = payments or {}
+
+    def payment(self, session_id):
+        return self.payments.get(session_id)
+
+
+class ServicesTests(unittest.TestCase):
+    def setUp(self):
+        """Create an in-memory customer cache"""
+        self.cache = CustomerCache()
+
+    def test_checkout_session_params(self):
+        """Test the session carries the phone number and optional payment method types"""
+        params = services.checkout_session_params('http://localhost:5000', '+15550002')
+        self.assertEqual(params['metadata'], {'phone': '+15550002'})
+        self.assertEqual(params['payment_intent_data'], {'metadata': {'phone': '+15550002'}})
+        self.assertNotIn('payment_method_types', params)
+        params = services.checkout_session_params('http://localhost:5000', '+15550002', ['card'])
+        self.assertEqual(params['payment_method_types'], ['card'])
+
+    def test_checkout_session_params_use_synced_price(self):
+        """Test a product's Price ID replaces the inline price_data"""
+        product = Product('mug', 'Mug', 1250)
+        params = services.checkout_session_params('http://localhost:5000', '+15550002',
+                                                  product=product, price_id='price_1')
+        self.assertEqual(params['line_items'], [{'price': 'price_1', 'quantity': 1}])
+        self.assertIn('amount=12.50', params['success_url'])
+        params = services.checkout_session_params('http://localhost:5000', '+15550002', product=product)
+        self.assertEqual(params['line_items'][0]['price_data']['unit_amount'], 1250)
+
+    def test_missing_twilio_config(self):
+        """Test unset Twilio settings are reported by name"""
+        self.assertEqual(services.missing_twilio_config('AC1', None, '+1', ''),
+                         ['TWILIO_AUTH_TOKEN', 'USER_PHONE'])
+
+    def test_upsert_creates_then_uses_cache(self):
+        """Test a new customer is created once and then served from the cache"""
+        gateway = FakeGateway()
+        self.assertEqual(services.upsert_customer(gateway, self.cache, 'a@example.com', 'A'), 'cus_new')
+        self.assertEqual(services.upsert_customer(gateway, self.cache, 'a@example.com', 'A'), 'cus_new')
+        self.assertEqual(gateway.calls, ['list', 'create'])
+
+    def test_upsert_renames_existing_customer(self):
+        """Test an existing customer with a different name is modified"""
+        gateway = FakeGateway(existing=[{'id': 'cus_1', 'name': 'Old'}])
+        self.assertEqual(services.upsert_customer(gateway, self.cache, 'a@example.com', 'New'), 'cus_1')
+        self.assertEqual(gateway.calls, ['list', 'modify'])
+        self.assertEqual(self.cache.get('a@example.com'), ('cus_1', 'New'))
+
+    def test_async_upsert_matches_sync(self):
+        """Test the coroutine version makes the same calls"""
+        gateway = AsyncFakeGateway(existing=[{'id': 'cus_1', 'name': 'Old'}])
+        customer_id = asyncio.run(services.upsert_customer_async(gateway, self.cache, 'a@example.com', 'New'))
+        self.assertEqual(customer_id, 'cus_1')
+        self.assertEqual(gateway.calls, ['list', 'modify'])
+
+    def test_upsert_replaces_a_cached_customer_stripe_deleted(self):
+        """Test a cached ID Stripe no longer has is dropped and the customer looked up afresh"""
+        self.cache.put('a@example.com', 'cus_gone', 'Old')
+        gateway = FakeGateway(deleted=['cus_gone'])
+        self.assertEqual(services.upsert_customer(gateway, self.cache, 'a@example.com', 'New'), 'cus_new')
+        self.assertEqual(gateway.calls, ['modify', 'list', 'create'])
+        self.assertEqual(self.cache.get('a@example.com'), ('cus_new', 'New'))
+        self.cache.put('b@example.com', 'cus_gone', 'Old')
+        gateway = AsyncFakeGateway(deleted=['cus_gone'])
+        customer_id = asyncio.run(services.upsert_customer_async(gateway, self.cache, 'b@example.com', 'New'))
+        self.assertEqual(customer_id, 'cus_new')
+
+    def test_invalidate_customer_drops_previous_email(self):
+        """Test customer.updated forgets both the new and the previous email"""
+        self.cache.put('old@example.com', 'cus_1')
+        event = {'data': {'object': {'id': 'cus_1', 'email': 'new@example.com'},
+                          'previous_attributes': {'email': 'old@example.com'}}}
+        body, status = services.invalidate_customer(self.cache, event)
+        self.assertEqual((body['customer_id'], status), ('cus_1', 200))
+        self.assertIsNone(self.cache.get('old@example.com'))
+
+
+    def test_checkout_status_prefers_the_ledger(self):
+        """Test a recorded session is answered without calling Stripe"""
+        gateway = FakeGateway()
+        lookup = services.CheckoutLookup(FakeLedger({'cs_1': {'session_id': 'cs_1', 'amount_total': 5000}}))
+        record, source = services.checkout_status(lookup, gateway, 'cs_1')
+        self.assertEqual((record['amount_total'], source), (5000, 'ledger'))
+        self.assertEqual(gateway.calls, [])
+
+    def test_checkout_status_keeps_stripe_answers_briefly(self):
+        """Test a session the ledger lacks is retrieved once per TTL, including a missing one"""
+        gateway = FakeGateway()
+        lookup = services.CheckoutLookup(FakeLedger(), ttl=60)
+        for _ in range(3):
+            record, source = services.checkout_status(lookup, gateway, 'cs_2')
+            self.assertIsNone(services.checkout_status(lookup, gateway, 'cs_missing')[0])
+        self.assertEqual((record['payment_status'], source), ('unpaid', 'stripe'))
+        self.assertEqual(gateway.calls, ['retrieve', 'retrieve'])
+        self.assertEqual(lookup.metrics()['recent'], 4)
+
+        with self.assertRaises(stripe.error.APIError):
+            services.checkout_status(lookup, gateway, 'cs_error')
+
+        expiring = services.CheckoutLookup(FakeLedger(), ttl=0)
+        services.checkout_status(expiring, gateway, 'cs_2')
+        services.checkout_status(expiring, gateway, 'cs_2')
+        self.assertEqual(gateway.calls.count('retrieve'), 5)
+
+    def test_checkout_status_admits_only_stripe_lookups(self):
+        """Test the admission hook wraps Stripe retrieves but not answers the ledger already has"""
+        admitted = []
+
+        @contextlib.contextmanager
+        def admit():
+            admitted.append(1)
+            yield
+
+        lookup = services.CheckoutLookup(FakeLedger({'cs_1': {'session_id': 'cs_1'}}))
+        services.checkout_status(lookup, FakeGateway(), 'cs_1', admit=admit)
+        services.checkout_status(lookup, FakeGateway(), 'cs_2', admit=admit)
+        asyncio.run(services.checkout_status_async(lookup, AsyncFakeGateway(), 'cs_3', admit=admit))
+        self.assertEqual(len(admitted), 2)
+
+    def test_session_ids_are_checked_before_lookup(self):
+        """Test only IDs shaped like Stripe's Checkout Session IDs are looked up"""
+        self.assertTrue(services.is_checkout_session_id('cs_test_a1B2c3'))
+        self.assertTrue(services.is_checkout_session_id('cs_live_a1B2c3'))
+        for value in ('', 'cs_1', 'cs_test_', 'cs_test_a/../b', 'pi_test_a1', 'cs_test_a1\n'):
+            self.assertFalse(services.is_checkout_session_id(value))
+
+    def test_async_checkout_status_matches_sync(self):
+        """Test the coroutine version retrieves and remembers the same way"""
+        gateway = AsyncFakeGateway()
+        lookup = services.CheckoutLookup(FakeLedger())
+        record, source = asyncio.run(services.checkout_status_async(lookup, gateway, 'cs_2'))
+        self.assertEqual((record['amount_total'], source), (1250, 'stripe'))
+        self.assertEqual(lookup.cached('cs_2'), (record, 'stripe'))
+
+    def test_success_details_come_from_the_record(self):
+        """Test the success page shows the recorded status and amount, or that it is processing"""
+        self.assertEqual(services.success_details('cs_1', {'amount_total': 1250, 'payment_status': 'paid'}),
+                         {'payment_status': 'paid', 'amount': '12.50', 'transaction_id': 'cs_1'})
+        self.assertEqual(services.success_details('cs_1', None),
+                         {'payment_status': 'processing', 'amount': None, 'transaction_id': 'cs_1'})
+
+
+if __name__ == '__main__':
+    unittest.main()
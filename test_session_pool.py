@@ -0,0 +1,118 @@
+import asyncio
+import itertools
+import threading
+import time
+import unittest
+
+from session_pool import AsyncSessionPool, SessionPool
+
+
+class FakeStripe:
+    """Creates numbered sessions expiring ``ttl`` seconds from now"""
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.ids = itertools.count(1)
+        self.fail = False
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def create(self):
+        self.gate.wait(5)
+        if self.fail:
+            raise ConnectionError("Stripe is down")
+        return {"id": f"cs_{next(self.ids)}", "expires_at": time.time() + self.ttl}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met")
+        time.sleep(0.01)
+
+
+class SessionPoolTests(unittest.TestCase):
+    def setUp(self):
+        """A pool of three sessions over a fake Stripe"""
+        self.stripe = FakeStripe()
+        self.pool = SessionPool(self.stripe.create, size=3, min_ttl=60, retry_delay=0.05, name="test")
+
+    def tearDown(self):
+        self.stripe.gate.set()
+        self.pool.stop()
+
+    def test_serves_each_session_once_and_refills(self):
+        """Test taken sessions are unique and replaced in the background"""
+        self.pool.start()
+        wait_for(lambda: self.pool.metrics()['ready'] == 3)
+        taken = [self.pool.take()['id'] for _ in range(3)]
+        self.assertEqual(len(set(taken)), 3)
+        wait_for(lambda: self.pool.metrics()['ready'] == 3)
+        metrics = self.pool.metrics()
+        self.assertEqual(metrics['hits'], 3)
+        self.assertEqual(metrics['hit_rate'], 1.0)
+        self.assertIn('refill_lag_p50_ms', metrics)
+
+    def test_falls_back_to_creating_when_empty(self):
+        """Test an empty pool creates a session on the caller's thread"""
+        self.pool.start()
+        wait_for(lambda: self.pool.metrics()['ready'] == 3)
+        self.stripe.gate.clear()
+        for _ in range(3):
+            self.pool.take()
+        result = []
+        taker = threading.Thread(target=lambda: result.append(self.pool.take()))
+        taker.start()
+        wait_for(lambda: self.pool.metrics()['misses'] == 1)
+        self.stripe.gate.set()
+        taker.join(5)
+        self.assertTrue(result[0]['id'].startswith('cs_'))
+
+    def test_sessions_near_expiry_are_not_served(self):
+        """Test sessions without min_ttl left are discarded and replaced"""
+        self.stripe.ttl = 60.2
+        self.pool.start()
+        wait_for(lambda: self.pool.metrics()['created'] >= 3)
+        self.stripe.ttl = 3600
+        time.sleep(0.25)
+        session = self.pool.take()
+        self.assertGreater(session['expires_at'], time.time() + 60)
+        self.assertGreaterEqual(self.pool.metrics()['expired'], 3)
+
+    def test_refill_survives_errors(self):
+        """Test creation failures are counted and retried"""
+        self.stripe.fail = True
+        self.pool.start()
+        wait_for(lambda: self.pool.metrics()['errors'] >= 2)
+        self.stripe.fail = False
+        wait_for(lambda: self.pool.metrics()['ready'] == 3)
+
+
+class AsyncSessionPoolTests(unittest.TestCase):
+    def test_async_pool_refills_on_the_loop(self):
+        """Test the async pool prefills, serves hits and falls back to create"""
+        stripe = FakeStripe()
+
+        async def create():
+            return stripe.create()
+
+        async def scenario():
+            pool = AsyncSessionPool(create, size=2, min_ttl=60, name="test")
+            first = await pool.take()  # Nothing ready yet
+            for _ in range(100):
+                if pool.metrics()['ready'] == 2:
+                    break
+                await asyncio.sleep(0.01)
+            second = await pool.take()
+            await pool.stop()
+            return first, second, pool.metrics()
+
+        first, second, metrics = asyncio.run(scenario())
+        self.assertNotEqual(first['id'], second['id'])
+        self.assertEqual(metrics['misses'], 1)
+        self.assertEqual(metrics['hits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import unittest
+from unittest import mock
+
+import settings
+from settings import Settings, SettingsError
+
+
+class SettingsTests(unittest.TestCase):
+    def tearDown(self):
+        settings.get_settings.cache_clear()
+
+    def test_defaults_when_unset(self):
+        """Test unset and empty variables keep the documented defaults"""
+        config = Settings.from_env({"TWILIO_POOL_SIZE": "", "CATALOG_PATH": "  "})
+        self.assertEqual(config.twilio_pool_size, 10)
+        self.assertIsNone(config.catalog_path)
+        self.assertFalse(config.profiling)
+        self.assertEqual(config.event_store_ttl, 7 * 24 * 3600)
+
+    def test_values_are_typed(self):
+        """Test numbers and flags are converted from their environment strings"""
+        config = Settings.from_env({
+            "TWILIO_POOL_SIZE": "25",
+            "STRIPE_TIMEOUT": "2.5",
+            "WEBHOOK_ASYNC": "yes",
+            "PROFILING": "1",
+            "LEDGER_PATH": "/tmp/ledger.db",
+        })
+        self.assertEqual((config.twilio_pool_size, config.stripe_timeout), (25, 2.5))
+        self.assertIs(config.webhook_async, True)
+        self.assertIs(config.profiling, True)
+        self.assertEqual(config.ledger_path, "/tmp/ledger.db")
+
+    def test_every_invalid_value_is_reported(self):
+        """Test one error names each variable that does not parse or is out of range"""
+        with self.assertRaises(SettingsError) as raised:
+            Settings.from_env({
+                "TWILIO_POOL_SIZE": "ten",
+                "PROFILE_SAMPLE_RATE": "2",
+                "WEBHOOK_ASYNC": "maybe",
+                "CHECKOUT_POOL_SIZE": "-1",
+            })
+        problems = raised.exception.problems
+        self.assertEqual(len(problems), 4)
+        self.assertIn("TWILIO_POOL_SIZE must be a whole number (got 'ten')", problems)
+        self.assertIn("PROFILE_SAMPLE_RATE must be at most 1 (got '2')", problems)
+        self.assertIsInstance(raised.exception, ValueError)
+
+    def test_operation_timeouts(self):
+        """Test per-operation timeouts parse as name and seconds pairs"""
+        config = Settings.from_env({"STRIPE_OPERATION_TIMEOUTS": "checkout.Session.create=20, Customer.list=5"})
+        self.assertEqual(dict(config.stripe_operation_timeouts),
+                         {"checkout.Session.create": 20.0, "Customer.list": 5.0})
+        with self.assertRaises(SettingsError) as raised:
+            Settings.from_env({"STRIPE_OPERATION_TIMEOUTS": "Customer.list"})
+        self.assertIn("must be name=seconds pairs", raised.exception.problems[0])
+
+    def test_settings_are_frozen(self):
+        """Test settings cannot be changed once read"""
+        config = Settings.from_env({})
+        with self.assertRaises(AttributeError):
+            config.twilio_pool_size = 1
+
+    def test_missing_required_settings(self):
+        """Test the required settings that are unset are named by their variables"""
+        config = Settings.from_env({"STRIPE_API_KEY": "sk_test", "USER_PHONE": "+15550002"})
+        self.assertIn("STRIPE_WEBHOOK_SECRET", config.missing())
+        self.assertNotIn("STRIPE_API_KEY", config.missing())
+        self.assertNotIn("USER_PHONE", config.missing())
+
+    def test_get_settings_reads_the_environment_once(self):
+        """Test the settings object is cached until the cache is cleared"""
+        settings.get_settings.cache_clear()
+        with mock.patch.dict(os.environ, {"LEDGER_BATCH_SIZE": "7"}):
+            first = settings.get_settings()
+        with mock.patch.dict(os.environ, {"LEDGER_BATCH_SIZE": "8"}):
+            self.assertIs(settings.get_settings(), first)
+            self.assertEqual(settings.get_settings().ledger_batch_size, 7)
+            settings.get_settings.cache_clear()
+            self.assertEqual(settings.get_settings().ledger_batch_size, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import stripe
+
+import resilience
+import services
+from bench_stubs import StubServer, stripe_routes
+from customer_cache import CustomerCache
+from singleflight import SingleFlight
+
+
+class SlowGateway:
+    """A Stripe stand-in whose lookups are slow enough for upserts to overlap"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.customers = []
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def list_customers(self, email):
+        self.calls.append('list')
+        time.sleep(self.delay)
+        with self.lock:
+            return [c for c in self.customers if c['email'] == email]
+
+    def create_customer(self, email, name):
+        self.calls.append('create')
+        with self.lock:
+            customer = {'id': f'cus_{len(self.customers)}', 'email': email, 'name': name}
+            self.customers.append(customer)
+        return customer
+
+    def modify_customer(self, customer_id, **params):
+        self.calls.append('modify')
+        return {'id': customer_id, **params}
+
+
+class AsyncSlowGateway(SlowGateway):
+    async def list_customers(self, email):
+        self.calls.append('list')
+        await asyncio.sleep(self.delay)
+        return [c for c in self.customers if c['email'] == email]
+
+    async def create_customer(self, email, name):
+        return SlowGateway.create_customer(self, email, name)
+
+    async def modify_customer(self, customer_id, **params):
+        return SlowGateway.modify_customer(self, customer_id, **params)
+
+
+def run_threads(target, count):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(target())) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class SingleFlightTests(unittest.TestCase):
+    def test_concurrent_callers_share_one_call(self):
+        """Test callers arriving while a call is in flight get its result without running it"""
+        flights = SingleFlight()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'result'
+
+        results = run_threads(lambda: flights.do('key', fetch), 6)
+        self.assertEqual(results, ['result'] * 6)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.metrics()['shared'], 5)
+        # Finished calls are not cached
+        flights.do('key', fetch)
+        self.assertEqual(len(calls), 2)
+
+    def test_errors_reach_every_waiting_caller(self):
+        """Test the leader's exception is raised to the callers that shared its call"""
+        flights = SingleFlight()
+
+        def fail():
+            time.sleep(0.1)
+            raise ValueError('boom')
+
+        def call():
+            try:
+                return flights.do('key', fail)
+            except ValueError as e:
+                return str(e)
+
+        self.assertEqual(run_threads(call, 4), ['boom'] * 4)
+        self.assertEqual(flights.metrics()['errors'], 1)
+        self.assertEqual(flights.metrics()['in_flight'], 0)
+
+    def test_waiting_stops_at_the_deadline(self):
+        """Test a caller waiting on a slow leader gives up when its request deadline passes"""
+        flights = SingleFlight()
+        leader = threading.Thread(target=flights.do, args=('key', lambda: time.sleep(0.3)))
+        leader.start()
+        time.sleep(0.02)
+        with resilience.deadline(0.05):
+            with self.assertRaises(resilience.DeadlineExceeded):
+                flights.do('key', lambda: None)
+        leader.join()
+
+    def test_concurrent_upserts_create_one_customer(self):
+        """Test overlapping webhooks for one email create a single customer"""
+        gateway = SlowGateway()
+        cache = CustomerCache()
+        flights = SingleFlight()
+        emails = ['Same@example.com', 'same@example.com ', 'same@example.com']
+        ids = run_threads(lambda: services.upsert_customer(gateway, cache, emails[len(gateway.calls) % 3],
+                                                           'Same', flights), 8)
+        self.assertEqual(set(ids), {'cus_0'})
+        self.assertEqual(gateway.calls, ['list', 'create'])
+
+    def test_waiters_with_another_name_rename_the_shared_customer(self):
+        """Test a caller sharing the lookup still updates the customer's name"""
+        gateway = SlowGateway()
+        gateway.customers.append({'id': 'cus_1', 'email': 'a@example.com', 'name': 'Old'})
+        cache = CustomerCache()
+        flights = SingleFlight()
+        first = threading.Thread(target=services.upsert_customer,
+                                 args=(gateway, cache, 'a@example.com', 'Old', flights))
+        first.start()
+        time.sleep(0.01)
+        self.assertEqual(services.upsert_customer(gateway, cache, 'a@example.com', 'New', flights), 'cus_1')
+        first.join()
+        self.assertEqual(gateway.calls, ['list', 'modify'])
+        self.assertEqual(cache.get('a@example.com'), ('cus_1', 'New'))
+
+    def test_async_upserts_create_one_customer(self):
+        """Test coroutines upserting one email on the same loop share the lookup"""
+        gateway = AsyncSlowGateway()
+        cache = CustomerCache()
+        flights = SingleFlight()
+
+        async def main():
+            return await asyncio.gather(*(services.upsert_customer_async(gateway, cache, 'b@example.com',
+                                                                         'B', flights)
+                                          for _ in range(5)))
+
+        self.assertEqual(asyncio.run(main()), ['cus_0'] * 5)
+        self.assertEqual(gateway.calls, ['list', 'create'])
+        self.assertEqual(flights.metrics()['shared'], 4)
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "needs fork()")
+class HostWideTests(unittest.TestCase):
+    def setUp(self):
+        """Run a Stripe stand-in slow enough for worker processes to race"""
+        self.stub = StubServer(stripe_routes(), latency=0.1).start()
+        self.saved = (stripe.api_key, stripe.api_base)
+        stripe.api_key = 'sk_test'
+        stripe.api_base = self.stub.url
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        stripe.api_key, stripe.api_base = self.saved
+        self.stub.stop()
+        self.directory.cleanup()
+
+    def test_workers_take_turns_per_email(self):
+        """Test worker processes sharing the lock file create the customer once"""
+        lock_path = os.path.join(self.directory.name, 'customers.lock')
+        cache_path = os.path.join(self.directory.name, 'customers.db')
+        pids = []
+        for _ in range(3):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    cache = CustomerCache(path=cache_path)
+                    flights = SingleFlight(path=lock_path)
+                    services.upsert_customer(services.StripeGateway(), cache, 'c@example.com', 'C', flights)
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        statuses = [os.waitpid(pid, 0)[1] for pid in pids]
+        self.assertEqual(statuses, [0, 0, 0])
+        self.assertEqual(self.stub.calls.get('POST /v1/customers', 0), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
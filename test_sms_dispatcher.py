@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+
+from sms_dispatcher import SmsDispatcher, TokenBucket
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_burst_is_granted_immediately(self):
+        """Test tokens up to the burst size need no wait"""
+        bucket = TokenBucket(rate=1.0, burst=3)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 0.0])
+
+    def test_reservation_beyond_burst_waits(self):
+        """Test callers past the burst are told how long to wait"""
+        bucket = TokenBucket(rate=10.0, burst=1)
+        bucket.reserve()
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+
+    def test_zero_rate_is_unlimited(self):
+        """Test a rate of 0 never makes callers wait"""
+        bucket = TokenBucket(rate=0, burst=1)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 0.0])
+
+
+class SmsDispatcherTests(unittest.TestCase):
+    def setUp(self):
+        """Create a dispatcher with a recording send function"""
+        self.sent = []
+        self.release = threading.Event()
+        self.release.set()
+
+        def send(to, body, sender):
+            self.release.wait(5)
+            self.sent.append((to, body, sender))
+            return True
+
+        self.dispatcher = SmsDispatcher(send, default_sender='+15550001', rate=1000, burst=1000,
+                                        max_queue=2, workers=1)
+
+    def tearDown(self):
+        self.release.set()
+        self.dispatcher.stop()
+
+    def test_submit_returns_handle_that_can_be_waited_on(self):
+        """Test a submitted message is delivered"""
+        handle = self.dispatcher.submit('+15550002', 'Payment of $50.00 Successful!')
+        self.assertTrue(handle.wait(5))
+        self.assertEqual(self.sent, [('+15550002', 'Payment of $50.00 Successful!', '+15550001')])
+        self.assertIn('latency_p50_ms', self.dispatcher.metrics())
+
+    def test_duplicate_keys_are_coalesced(self):
+        """Test notifications for the same session are only sent once"""
+        first = self.dispatcher.submit('+15550002', 'body', key='cs_1')
+        self.assertTrue(first.wait(5))
+        second = self.dispatcher.submit('+15550002', 'body', key='cs_1')
+        self.assertIs(first, second)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.dispatcher.metrics()['coalesced'], 1)
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        """Test submissions beyond the queue size are dropped"""
+        self.release.clear()
+        handles = [self.dispatcher.submit('+15550002', f'body {i}') for i in range(5)]
+        time.sleep(0.1)
+        self.assertTrue(any(h.done() and not h.ok for h in handles))
+        self.assertGreater(self.dispatcher.metrics()['dropped'], 0)
+
+    def test_send_failures_are_reported(self):
+        """Test exceptions from send fail the handle"""
+        def failing(to, body, sender):
+            raise RuntimeError('boom')
+
+        dispatcher = SmsDispatcher(failing, workers=1)
+        handle = dispatcher.submit('+15550002', 'body')
+        self.assertFalse(handle.wait(5))
+        self.assertIn('boom', handle.error)
+        self.assertEqual(dispatcher.metrics()['failed'], 1)
+        dispatcher.stop()
+
+    def test_pacing_failures_fail_the_handle_not_the_worker(self):
+        """Test an error while rate limiting fails that message and the worker keeps delivering"""
+        self.dispatcher._bucket('+15559999').reserve = lambda: 1 / 0
+        failed = self.dispatcher.submit('+15550002', 'body', sender='+15559999')
+        self.assertFalse(failed.wait(5))
+        self.assertIn('ZeroDivisionError', failed.error)
+        self.assertTrue(self.dispatcher.submit('+15550002', 'next').wait(5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import threading
+import unittest
+
+import stripe
+
+import outbound
+import resilience
+from bench_stubs import StubServer, stripe_routes
+from services import StripeGateway
+from stripe_transport import StripeTransport
+
+
+class StripeTransportTests(unittest.TestCase):
+    def setUp(self):
+        """Point the Stripe SDK at a local stand-in through a fresh transport"""
+        self.stub = StubServer(stripe_routes()).start()
+        self.saved = (stripe.api_key, stripe.api_base, stripe.default_http_client)
+        stripe.api_key = 'sk_test'
+        stripe.api_base = self.stub.url
+        self.gateway = StripeGateway()
+
+    def tearDown(self):
+        stripe.api_key, stripe.api_base, stripe.default_http_client = self.saved
+        self.stub.stop()
+
+    def install(self, **options):
+        transport = stripe.default_http_client = StripeTransport(**options)
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_threads_share_keep_alive_connections(self):
+        """Test calls from many threads reuse the pool instead of connecting per thread"""
+        transport = self.install(pool_size=4)
+
+        def work():
+            for _ in range(5):
+                self.gateway.list_customers('reuse@example.com')
+
+        for _ in range(3):
+            # A new set of threads each round, as a thread-per-request server would have
+            threads = [threading.Thread(target=work) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        stats = transport.metrics()
+        self.assertEqual(stats['requests'], 60)
+        self.assertLessEqual(stats['opened'], 4)
+        self.assertEqual(stats['opened'], self.stub.connections)
+        self.assertEqual(stats['reused'], 60 - stats['opened'])
+
+    def test_burst_beyond_the_pool_is_not_kept(self):
+        """Test connections opened for a burst over the pool size are closed, not kept idle"""
+        self.stub.latency = 0.05
+        transport = self.install(pool_size=2)
+        threads = [threading.Thread(target=self.gateway.list_customers, args=('burst@example.com',))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = transport.metrics()
+        self.assertGreater(stats['opened'], 2)
+        self.assertEqual(stats['discarded'], stats['opened'] - 2)
+
+    def test_timeouts_per_operation_and_deadline(self):
+        """Test the read timeout follows the operation and neither outlasts the deadline"""
+        transport = self.install(connect_timeout=3, read_timeout=10,
+                                 operation_timeouts={'checkout.Session.create': 20})
+        self.assertEqual(transport.timeout_for(None), (3, 10))
+        self.assertEqual(transport.timeout_for('checkout.Session.create'), (3, 20))
+        seen = []
+        outbound.call('stripe', 'checkout.Session.create',
+                      lambda: seen.append(transport.timeout_for(outbound.current_operation()[1])))
+        self.assertEqual(seen, [(3, 20)])
+        with resilience.deadline(2):
+            connect, read = transport.timeout_for('checkout.Session.create')
+        self.assertLessEqual((connect, read), (2, 2))
+        self.assertIsNone(outbound.current_operation())
+
+    def test_connection_errors_raise_the_sdk_error(self):
+        """Test a refused connection surfaces as Stripe's APIConnectionError and is counted"""
+        transport = self.install(connect_timeout=1)
+        self.stub.stop()
+        with self.assertRaises(stripe.error.APIConnectionError):
+            stripe.Customer.list(email='down@example.com')
+        self.assertEqual(transport.metrics()['errors'], 1)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork()")
+    def test_forked_child_opens_its_own_connections(self):
+        """Test a forked child does not reuse the parent's pooled connections"""
+        transport = self.install()
+        self.gateway.list_customers('fork@example.com')
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            try:
+                self.gateway.list_customers('fork@example.com')
+                opened = transport.metrics()['opened']
+            except Exception:
+                opened = -1
+            os.write(write_end, str(opened).encode())
+            os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as f:
+            child_opened = int(f.read())
+        os.waitpid(pid, 0)
+        self.assertEqual(child_opened, 1)
+        self.assertEqual(self.stub.connections, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import io
+import json
+import logging
+import unittest
+
+from structured_logging import flush_logging, parse_levels, request_id, setup_logging
+
+
+class StructuredLoggingTests(unittest.TestCase):
+    def setUp(self):
+        """Send logs to an in-memory stream"""
+        self.stream = io.StringIO()
+        setup_logging('INFO', {'test.verbose': 'DEBUG'}, stream=self.stream)
+
+    def tearDown(self):
+        logging.getLogger('test.verbose').setLevel(logging.NOTSET)
+
+    def records(self):
+        flush_logging()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_records_are_json_with_extras(self):
+        """Test messages, levels and extra fields are emitted as JSON"""
+        logging.getLogger('test').info('Payment %s', 'processed', extra={'amount': 50.0})
+        record = self.records()[0]
+        self.assertEqual(record['message'], 'Payment processed')
+        self.assertEqual(record['level'], 'INFO')
+        self.assertEqual(record['logger'], 'test')
+        self.assertEqual(record['amount'], 50.0)
+
+    def test_request_id_is_attached(self):
+        """Test records carry the bound request ID"""
+        with request_id('req-123'):
+            logging.getLogger('test').info('inside')
+        logging.getLogger('test').info('outside')
+        inside, outside = self.records()
+        self.assertEqual(inside['request_id'], 'req-123')
+        self.assertNotIn('request_id', outside)
+
+    def test_module_levels(self):
+        """Test debug records only appear for modules set to DEBUG"""
+        logging.getLogger('test').debug('hidden')
+        logging.getLogger('test.verbose').debug('shown')
+        self.assertEqual([r['message'] for r in self.records()], ['shown'])
+
+    def test_exceptions_are_included(self):
+        """Test tracebacks survive the trip through the queue"""
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logging.getLogger('test').exception('failed')
+        self.assertIn('ValueError: boom', self.records()[0]['exc_info'])
+
+    def test_parse_levels(self):
+        """Test the LOG_LEVELS format"""
+        self.assertEqual(parse_levels('app=debug, notifier=WARNING'),
+                         {'app': 'DEBUG', 'notifier': 'WARNING'})
+        self.assertEqual(parse_levels(None), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import json
+import time
+import unittest
+
+import stripe
+
+import services
+import webhook_ingest
+from bench_stubs import checkout_completed_event, sign_webhook
+from customer_cache import CustomerCache
+from ledger import payment_record
+from webhook_ingest import InvalidPayload, InvalidSignature, PayloadTooLarge
+
+SECRET = 'whsec_test'
+
+
+def event_payload(event_type, obj, **extra):
+    """An event body with the type as its last key, the order Stripe sends"""
+    event = {'id': 'evt_1', 'object': 'event', 'created': 1700000000, 'data': {'object': obj, **extra},
+             'livemode': False, 'type': event_type}
+    return json.dumps(event).encode('utf-8')
+
+
+class VerifyTests(unittest.TestCase):
+    def setUp(self):
+        """Sign one checkout event"""
+        self.payload = checkout_completed_event(1)
+        self.header = sign_webhook(self.payload, SECRET)
+
+    def test_matches_the_sdk(self):
+        """Test a body the SDK accepts is accepted, and one it rejects is rejected"""
+        stripe.Webhook.construct_event(self.payload, self.header, SECRET)
+        webhook_ingest.verify(self.payload, self.header, SECRET)
+        with self.assertRaises(stripe.error.SignatureVerificationError):
+            stripe.Webhook.construct_event(self.payload + b' ', self.header, SECRET)
+        with self.assertRaises(InvalidSignature):
+            webhook_ingest.verify(self.payload + b' ', self.header, SECRET)
+
+    def test_rejects_before_computing_the_signature(self):
+        """Test oversized bodies, unusable headers and stale or future timestamps are refused"""
+        with self.assertRaises(PayloadTooLarge):
+            webhook_ingest.verify(self.payload, self.header, SECRET, max_bytes=len(self.payload) - 1)
+        for header in (None, '', 'v1=abc', 't=soon,v1=abc', 't=1700000000'):
+            with self.assertRaises(InvalidSignature):
+                webhook_ingest.verify(self.payload, header, SECRET)
+        for skew in (-301, 301):
+            header = sign_webhook(self.payload, SECRET, timestamp=int(time.time()) + skew)
+            with self.assertRaises(InvalidSignature):
+                webhook_ingest.verify(self.payload, header, SECRET)
+
+    def test_any_v1_signature_may_match(self):
+        """Test a header carrying signatures for a rolled and a current secret is accepted"""
+        old = sign_webhook(self.payload, 'whsec_old').split(',')[1]
+        webhook_ingest.verify(self.payload, f'{self.header},{old}', SECRET)
+
+    def test_errors_are_value_errors(self):
+        """Test every rejection can be caught as ValueError, like the SDK's payload errors"""
+        for error in (InvalidSignature, InvalidPayload, PayloadTooLarge):
+            self.assertTrue(issubclass(error, ValueError))
+
+
+class ParseTests(unittest.TestCase):
+    def test_checkout_session_record(self):
+        """Test a completed checkout decodes into records the handlers can read"""
+        payload = checkout_completed_event(7, email='a@example.com', amount=1250)
+        event = webhook_ingest.construct_event(payload, sign_webhook(payload, SECRET), SECRET)
+        session = event['data']['object']
+        self.assertEqual((event['type'], event.id), ('checkout.session.completed', f'evt_{7:024d}'))
+        self.assertEqual(session['amount_total'], 1250)
+        self.assertEqual(services.customer_details(session), ('a@example.com', 'Customer 7'))
+        self.assertEqual(session.get('metadata'), {'phone': '+15550002'})
+        self.assertEqual(payment_record(session)['customer_email'], 'a@example.com')
+        self.assertIsNone(session.get('line_items'))
+        with self.assertRaises(KeyError):
+            session['line_items']
+        with self.assertRaises(AttributeError):
+            session.extra = 1
+
+    def test_unhandled_types_are_not_parsed(self):
+        """Test an event nobody handles comes back without its object"""
+        payload = event_payload('payment_intent.succeeded', {'id': 'pi_1', 'payment_method_types': ['card'],
+                                                              'next_action': {'type': 'redirect'}})
+        self.assertEqual(webhook_ingest.peek_type(payload), 'payment_intent.succeeded')
+        event = webhook_ingest.parse(payload)
+        self.assertEqual((event.id, event.type, event.data), ('evt_1', 'payment_intent.succeeded', None))
+
+    def test_type_found_wherever_it_is(self):
+        """Test an ambiguous body falls back to a full parse with the same result"""
+        body = {'type': 'customer.updated', 'id': 'evt_2',
+                'data': {'object': {'id': 'cus_1', 'email': 'a@example.com',
+                                    'tax_ids': [{'type': 'eu_vat'}]}}}
+        payload = json.dumps(body).encode('utf-8')
+        self.assertIsNone(webhook_ingest.peek_type(payload))
+        event = webhook_ingest.parse(payload)
+        self.assertEqual((event.id, event['data']['object']['email']), ('evt_2', 'a@example.com'))
+
+    def test_customer_update_keeps_the_previous_email(self):
+        """Test customer.updated carries what the customer cache needs to drop both emails"""
+        cache = CustomerCache()
+        cache.put('old@example.com', 'cus_1')
+        payload = event_payload('customer.updated', {'id': 'cus_1', 'email': 'new@example.com'},
+                                previous_attributes={'email': 'old@example.com', 'name': 'Old'})
+        body, status = services.invalidate_customer(cache, webhook_ingest.parse(payload))
+        self.assertEqual((body['customer_id'], status), ('cus_1', 200))
+        self.assertIsNone(cache.get('old@example.com'))
+
+    def test_malformed_bodies(self):
+        """Test bodies that are not events are reported as invalid payloads"""
+        for payload in (b'{nope', b'[]', b'{"type": "customer.updated", "id": "evt_1"}',
+                        b'{"id": "evt_1"}'):
+            with self.assertRaises(InvalidPayload):
+                webhook_ingest.parse(payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
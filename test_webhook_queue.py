@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+
+from webhook_queue import WebhookQueue
+
+
+class WebhookQueueTests(unittest.TestCase):
+    def setUp(self):
+        """Create a queue backed by a temporary database"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'queue.db')
+        self.handled = []
+        self.responses = []
+
+        def handler(payload):
+            self.handled.append(payload)
+            if self.responses:
+                return self.responses.pop(0)
+            return {"status": "success"}, 200
+
+        self.queue = WebhookQueue(self.path, handler, workers=1, max_attempts=2, base_delay=0)
+
+    def tearDown(self):
+        self.queue.stop()
+        self.tmpdir.cleanup()
+
+    def test_enqueue_is_idempotent_on_event_id(self):
+        """Test the same event is only queued once"""
+        self.assertTrue(self.queue.enqueue('evt_1', 'checkout.session.completed', '{}'))
+        self.assertFalse(self.queue.enqueue('evt_1', 'checkout.session.completed', '{}'))
+        self.assertEqual(self.queue.metrics()['depth'], 1)
+
+    def test_drain_processes_and_removes_jobs(self):
+        """Test processed jobs leave the queue"""
+        self.queue.enqueue('evt_1', 'checkout.session.completed', '{"id": "evt_1"}')
+        self.assertEqual(self.queue.drain(), 1)
+        self.assertEqual(self.handled, ['{"id": "evt_1"}'])
+        metrics = self.queue.metrics()
+        self.assertEqual(metrics['depth'], 0)
+        self.assertEqual(metrics['processed'], 1)
+
+    def test_failed_jobs_are_retried_then_dead_lettered(self):
+        """Test 5xx responses are retried until max_attempts"""
+        self.responses = [({"error": "boom"}, 500), ({"error": "boom"}, 500)]
+        self.queue.enqueue('evt_1', 'checkout.session.completed', '{}')
+        self.queue.drain()
+        metrics = self.queue.metrics()
+        self.assertEqual(len(self.handled), 2)
+        self.assertEqual(metrics['retried'], 1)
+        self.assertEqual(metrics['dead_letters'], 1)
+
+    def test_redelivered_dead_letters_are_requeued(self):
+        """Test a redelivery of a dead-lettered event is queued again with fresh attempts"""
+        self.responses = [({"error": "boom"}, 500), ({"error": "boom"}, 500)]
+        self.queue.enqueue('evt_1', 'checkout.session.completed', '{}')
+        self.queue.drain()
+        self.assertTrue(self.queue.enqueue('evt_1', 'checkout.session.completed', '{"retry": 1}'))
+        self.assertEqual(self.queue.metrics()['dead_letters'], 0)
+        self.assertEqual(self.queue.drain(), 1)
+        self.assertEqual(self.handled[-1], '{"retry": 1}')
+        self.assertEqual(self.queue.metrics()['depth'], 0)
+
+    def test_queue_survives_reopen(self):
+        """Test queued events persist across restarts"""
+        self.queue.enqueue('evt_1', 'checkout.session.completed', '{}')
+        reopened = WebhookQueue(self.path, lambda payload: ({}, 200), workers=1)
+        self.assertEqual(reopened.metrics()['pending'], 1)
+
+    def test_background_workers_process_jobs(self):
+        """Test started workers drain the queue"""
+        self.queue.start()
+        self.queue.enqueue('evt_1', 'checkout.session.completed', '{}')
+        for _ in range(100):
+            if self.queue.metrics()['processed']:
+                break
+            self.queue._stopping.wait(0.05)
+        self.assertEqual(self.queue.metrics()['processed'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+"""Verify Stripe webhooks over the raw body and decode only the fields the handlers use.
+
+``stripe.Webhook.construct_event`` decodes the body to text, copies it into
+the signed string, parses it into ordered dicts and then wraps every level
+in a ``StripeObject``. The handlers read about ten fields of that.
+``construct_event`` here does the cheap checks first:
+
+1. the body is no larger than ``max_bytes``
+2. the ``Stripe-Signature`` timestamp is within ``tolerance`` seconds of now
+3. the HMAC matches, computed over the body bytes as they are (no copy)
+
+It then looks for the event type without parsing the body. Types nobody
+handles come back as a bare ``Event`` with only ``id`` and ``type``; the
+rest are parsed once with the C JSON decoder into ``__slots__`` records.
+Records support ``record["field"]`` and ``record.get("field")``, so
+handlers written against Stripe's objects work with either.
+"""
+import hashlib
+import hmac
+import json
+import re
+import time
+
+DEFAULT_TOLERANCE = 300
+DEFAULT_MAX_BYTES = 512 * 1024
+
+# The event types app.handle_event and asgi_app.handle_event act on
+HANDLED_TYPES = frozenset({"checkout.session.completed", "customer.updated", "customer.deleted"})
+
+# A key is never preceded by a backslash, so these can't match inside a string value
+_TYPE = re.compile(rb'"type"\s*:\s*"([^"\\]*)"')
+_ID = re.compile(rb'\s*\{\s*"id"\s*:\s*"([^"\\]*)"')
+_CLOSING = re.compile(rb'\s*\}\s*$')
+
+
+class WebhookError(ValueError):
+    """A webhook request that must be rejected."""
+
+
+class PayloadTooLarge(WebhookError):
+    pass
+
+
+class InvalidSignature(WebhookError):
+    pass
+
+
+class InvalidPayload(WebhookError):
+    pass
+
+
+class Record:
+    """Read access by item as well as attribute, limited to the record's fields."""
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class CustomerDetails(Record):
+    __slots__ = ("email", "name", "phone")
+
+    def __init__(self, email=None, name=None, phone=None):
+        self.email = email
+        self.name = name
+        self.phone = phone
+
+
+class CheckoutSession(Record):
+    __slots__ = ("id", "amount_total", "currency", "payment_intent", "payment_status", "status",
+                 "created", "customer", "customer_details", "metadata")
+
+    def __init__(self, data):
+        self.id = data["id"]
+        self.amount_total = data.get("amount_total")
+        self.currency = data.get("currency")
+        payment_intent = data.get("payment_intent")
+        # Expanded objects carry their ID
+        self.payment_intent = payment_intent.get("id") if isinstance(payment_intent, dict) else payment_intent
+        self.payment_status = data.get("payment_status")
+        self.status = data.get("status")
+        self.created = data.get("created")
+        customer = data.get("customer")
+        self.customer = customer.get("id") if isinstance(customer, dict) else customer
+        details = data.get("customer_details")
+        self.customer_details = (CustomerDetails(details.get("email"), details.get("name"), details.get("phone"))
+                                 if details else None)
+        self.metadata = data.get("metadata") or {}
+
+
+class Customer(Record):
+    __slots__ = ("id", "email", "name")
+
+    def __init__(self, data):
+        self.id = data["id"]
+        self.email = data.get("email")
+        self.name = data.get("name")
+
+
+class EventData(Record):
+    __slots__ = ("object", "previous_attributes")
+
+    def __init__(self, object, previous_attributes=None):
+        self.object = object
+        self.previous_attributes = previous_attributes
+
+
+class Event(Record):
+    __slots__ = ("id", "type", "created", "livemode", "data")
+
+    def __init__(self, id, type, created=None, livemode=None, data=None):
+        self.id = id
+        self.type = type
+        self.created = created
+        self.livemode = livemode
+        self.data = data
+
+
+_OBJECTS = {
+    "checkout.session.completed": CheckoutSession,
+    "customer.updated": Customer,
+    "customer.deleted": Customer,
+}
+
+
+def event_from_dict(data, handled=HANDLED_TYPES):
+    """An ``Event`` from a parsed Stripe event; the object is only decoded for handled types."""
+    try:
+        event_type = data["type"]
+        event = Event(data["id"], event_type, data.get("created"), data.get("livemode"))
+        if event_type in handled and event_type in _OBJECTS:
+            body = data["data"]
+            previous = body.get("previous_attributes") or {}
+            # Of the previous attributes only the email matters (the customer cache)
+            event.data = EventData(_OBJECTS[event_type](body["object"]),
+                                   {"email": previous["email"]} if previous.get("email") else None)
+    except (KeyError, TypeError, AttributeError) as e:
+        raise InvalidPayload(f"Malformed event: {e!r}") from None
+    return event
+
+
+def signature_parts(header):
+    """``(timestamp, [v1 signatures])`` from a ``Stripe-Signature`` header."""
+    timestamp = None
+    signatures = []
+    for item in (header or "").split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            try:
+                timestamp = int(value)
+            except ValueError:
+                raise InvalidSignature("Unable to extract timestamp from header") from None
+        elif key == "v1":
+            signatures.append(value.encode("utf-8", "replace"))
+    if timestamp is None:
+        raise InvalidSignature("Unable to extract timestamp from header")
+    if not signatures:
+        raise InvalidSignature("No v1 signatures found in header")
+    return timestamp, signatures
+
+
+def verify(payload, header, secret, tolerance=DEFAULT_TOLERANCE, max_bytes=DEFAULT_MAX_BYTES, now=None):
+    """Check size, timestamp and signature of a webhook body; raises a ``WebhookError`` subclass."""
+    if len(payload) > max_bytes:
+        raise PayloadTooLarge(f"Payload is {len(payload)} bytes, more than {max_bytes}")
+    timestamp, signatures = signature_parts(header)
+    now = time.time() if now is None else now
+    if tolerance and abs(now - timestamp) > tolerance:
+        raise InvalidSignature(f"Timestamp outside the tolerance zone ({timestamp})")
+    mac = hmac.new(secret.encode("utf-8"), b"%d." % timestamp, hashlib.sha256)
+    mac.update(payload)
+    expected = mac.hexdigest().encode("ascii")
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise InvalidSignature("No signatures found matching the expected signature for payload")
+
+
+def peek_type(payload):
+    """The top-level event type, found without parsing; None when it can't be told apart from nested ones."""
+    matches = list(_TYPE.finditer(payload))
+    if len(matches) == 1:
+        # Every event has a type, so a lone one is the event's
+        return matches[0].group(1).decode("utf-8")
+    # Stripe sends the type as the last key of the event
+    if matches and _CLOSING.match(payload, matches[-1].end()):
+        return matches[-1].group(1).decode("utf-8")
+    return None
+
+
+def parse(payload, handled=HANDLED_TYPES):
+    """An ``Event`` from a verified body; unhandled types are not parsed at all when it can be avoided."""
+    event_type = peek_type(payload)
+    if event_type is not None and event_type not in handled:
+        match = _ID.match(payload)
+        if match is not None:
+            return Event(match.group(1).decode("utf-8"), event_type)
+    try:
+        data = json.loads(payload)
+    except ValueError as e:
+        raise InvalidPayload(f"Invalid JSON: {e}") from None
+    if not isinstance(data, dict):
+        raise InvalidPayload("Event is not a JSON object")
+    return event_from_dict(data, handled)
+
+
+def construct_event(payload, header, secret, tolerance=DEFAULT_TOLERANCE, max_bytes=DEFAULT_MAX_BYTES,
+                    handled=HANDLED_TYPES):
+    """Verify a webhook body (bytes) and return its ``Event``; the fast ``stripe.Webhook.construct_event``."""
+    verify(payload, header, secret, tolerance, max_bytes)
+    return parse(payload, handled)
@@ -0,0 +1,239 @@
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("webhook_queue")
+
+
+class WebhookQueue:
+    """Durable SQLite-backed queue for processing webhook events in the background.
+
+    Events are written to disk before the webhook is acknowledged, so a crash
+    or restart never loses work. A pool of worker threads claims jobs one at a
+    time, hands the raw payload to ``handler`` and retries failures with
+    jittered exponential backoff until ``max_attempts`` is reached.
+
+    ``handler`` receives the raw event payload (a JSON string) and returns a
+    ``(body, status)`` tuple. A status of 500 or above, or an exception, marks
+    the attempt as failed.
+    """
+
+    def __init__(self, path, handler, workers=4, max_attempts=5,
+                 base_delay=1.0, max_delay=300.0, lease=300.0, poll_interval=1.0):
+        self.path = path
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.poll_interval = poll_interval
+
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self._stats = {"processed": 0, "failed": 0, "retried": 0, "dead_lettered": 0}
+
+        # The file and its tables are created by the first connection, so
+        # constructing one (as importing the app does) leaves the disk alone
+        self._created = False
+
+    # -- storage -----------------------------------------------------------
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        # A connection opened before a fork belongs to the parent; open our own
+        if conn is None or self._local.pid != os.getpid():
+            if not self._created:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._created:
+                self._init_db(conn)
+                self._created = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_id TEXT NOT NULL UNIQUE,
+                event_type TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                enqueued_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                locked_at REAL,
+                last_error TEXT
+            )
+        """)
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, available_at)"
+        )
+
+    def enqueue(self, event_id, event_type, payload):
+        """Persist an event for processing.
+
+        Returns False if an event with the same ID is already queued. A
+        redelivery of a dead-lettered event re-arms it with fresh attempts, since
+        Stripe stops retrying once we acknowledge it.
+        """
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO jobs (event_id, event_type, payload, enqueued_at, available_at)"
+            " VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (event_id) DO UPDATE SET status = 'pending', attempts = 0, payload = excluded.payload,"
+            " available_at = excluded.available_at, locked_at = NULL"
+            " WHERE status = 'dead'",
+            (event_id, event_type, payload, now, now),
+        )
+        self._wakeup.set()
+        return cursor.rowcount == 1
+
+    def _claim(self):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Jobs whose worker died mid-flight become claimable again once their lease expires
+            row = conn.execute(
+                "SELECT id, event_id, payload, attempts FROM jobs"
+                " WHERE (status = 'pending' AND available_at <= ?)"
+                " OR (status = 'running' AND locked_at <= ?)"
+                " ORDER BY available_at LIMIT 1",
+                (now, now - self.lease),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_at = ?"
+                    " WHERE id = ?",
+                    (now, row[0]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        job_id, event_id, payload, attempts = row
+        return job_id, event_id, payload, attempts + 1
+
+    def _complete(self, job_id):
+        self._connect().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def _fail(self, job_id, attempts, error):
+        if attempts >= self.max_attempts:
+            self._connect().execute(
+                "UPDATE jobs SET status = 'dead', locked_at = NULL, last_error = ? WHERE id = ?",
+                (error, job_id),
+            )
+            return False
+        self._connect().execute(
+            "UPDATE jobs SET status = 'pending', locked_at = NULL, available_at = ?, last_error = ?"
+            " WHERE id = ?",
+            (time.time() + self.backoff(attempts), error, job_id),
+        )
+        return True
+
+    def backoff(self, attempts):
+        """Delay before the next attempt, with full jitter."""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return random.uniform(delay / 2, delay)
+
+    # -- workers -----------------------------------------------------------
+
+    def start(self):
+        # Threads don't survive fork(), so a forked child starts its own
+        if any(thread.is_alive() for thread in self._threads):
+            return
+        self._threads = []
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.OperationalError as e:
+                logger.error("Webhook queue claim failed", extra={"error": str(e)})
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self.process(job)
+
+    def process(self, job):
+        job_id, event_id, payload, attempts = job
+        try:
+            body, status = self.handler(payload)
+            error = None if status < 500 else str(body)
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)}"
+
+        if error is None:
+            self._complete(job_id)
+            self._count("processed")
+            return
+
+        logger.warning("Webhook job failed", extra={"event_id": event_id, "attempt": attempts, "error": error})
+        self._count("failed")
+        self._count("retried" if self._fail(job_id, attempts, error) else "dead_lettered")
+
+    def drain(self):
+        """Process every ready job on the calling thread. Mostly useful for tests and tools."""
+        processed = 0
+        while True:
+            job = self._claim()
+            if job is None:
+                return processed
+            self.process(job)
+            processed += 1
+
+    # -- monitoring --------------------------------------------------------
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def metrics(self):
+        """Queue depth, lag and counters for monitoring."""
+        now = time.time()
+        rows = self._connect().execute(
+            "SELECT status, COUNT(*), MIN(enqueued_at) FROM jobs GROUP BY status"
+        ).fetchall()
+        by_status = {status: (count, oldest) for status, count, oldest in rows}
+        pending, oldest_pending = by_status.get("pending", (0, None))
+        running, oldest_running = by_status.get("running", (0, None))
+        dead, _ = by_status.get("dead", (0, None))
+        oldest = min([t for t in (oldest_pending, oldest_running) if t is not None], default=None)
+        with self._stats_lock:
+            stats = dict(self._stats)
+        return {
+            "depth": pending + running,
+            "pending": pending,
+            "running": running,
+            "dead_letters": dead,
+            "lag_seconds": round(now - oldest, 3) if oldest is not None else 0.0,
+            "workers": len(self._threads),
+            **stats,
+        }